@@ -1,7 +1,9 @@
+import os
 from logging.config import fileConfig
 
-from sqlalchemy import engine_from_config
+from sqlalchemy import create_engine
 from sqlalchemy import pool
+from sqlalchemy.engine import URL
 
 from alembic import context
 
@@ -20,10 +22,22 @@ if config.config_file_name is not None:
 # target_metadata = mymodel.Base.metadata
 target_metadata = None
 
-# other values from the config, defined by the needs of env.py,
-# can be acquired:
-# my_important_option = config.get_main_option("my_important_option")
-# ... etc.
+
+
+def database_url():
+    """URL базы: VOLUM_DATABASE_URL, sqlalchemy.url из alembic.ini или DB_CONFIG сервера"""
+    url = os.environ.get("VOLUM_DATABASE_URL")
+    if url:
+        return url
+    url = config.get_main_option("sqlalchemy.url")
+    if url and not url.startswith("driver://"):
+        return url
+    # server.start_server передает свои параметры; при запуске `alembic upgrade head` берем их из server.py
+    db_config = config.attributes.get("db_config")
+    if db_config is None:
+        from server import DB_CONFIG as db_config
+    return URL.create("postgresql+pg8000", username=db_config["user"], password=db_config["password"],
+                      host=db_config["host"], port=db_config["port"], database=db_config["database"])
 
 
 def run_migrations_offline() -> None:
@@ -38,7 +52,7 @@ def run_migrations_offline() -> None:
     script output.
 
     """
-    url = config.get_main_option("sqlalchemy.url")
+    url = database_url()
     context.configure(
         url=url,
         target_metadata=target_metadata,
@@ -57,11 +71,7 @@ def run_migrations_online() -> None:
     and associate a connection with the context.
 
     """
-    connectable = engine_from_config(
-        config.get_section(config.config_ini_section, {}),
-        prefix="sqlalchemy.",
-        poolclass=pool.NullPool,
-    )
+    connectable = create_engine(database_url(), poolclass=pool.NullPool)
 
     with connectable.connect() as connection:
         context.configure(
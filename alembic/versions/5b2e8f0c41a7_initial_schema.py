@@ -0,0 +1,152 @@
+"""initial schema
+
+Revision ID: 5b2e8f0c41a7
+Revises: 
+Create Date: 2026-10-18 12:00:00.000000
+
+Таблицы, которые раньше создавали сервер и клиент при первом обращении
+(проверкой information_schema). IF NOT EXISTS - чтобы база, созданная
+прежним кодом, принимала миграцию без изменений, а недостающие колонки
+(read, edited, deleted, notification_seen, status) добавлялись.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5b2e8f0c41a7'
+down_revision: Union[str, None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            username VARCHAR(50) PRIMARY KEY,
+            password VARCHAR(100) NOT NULL,
+            email VARCHAR(100)
+        )
+    """)
+    op.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS email VARCHAR(100)")
+
+    op.execute("""
+        CREATE TABLE IF NOT EXISTS messages (
+            id SERIAL PRIMARY KEY,
+            sender VARCHAR(50) REFERENCES users(username),
+            receiver VARCHAR(50) REFERENCES users(username),
+            content TEXT NOT NULL,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            read BOOLEAN DEFAULT TRUE,
+            edited BOOLEAN DEFAULT FALSE,
+            deleted BOOLEAN DEFAULT FALSE
+        )
+    """)
+    op.execute("ALTER TABLE messages ADD COLUMN IF NOT EXISTS read BOOLEAN DEFAULT TRUE")
+    op.execute("ALTER TABLE messages ADD COLUMN IF NOT EXISTS edited BOOLEAN DEFAULT FALSE")
+    op.execute("ALTER TABLE messages ADD COLUMN IF NOT EXISTS deleted BOOLEAN DEFAULT FALSE")
+
+    op.execute("""
+        CREATE TABLE IF NOT EXISTS friends (
+            id SERIAL PRIMARY KEY,
+            user1 VARCHAR(50) REFERENCES users(username),
+            user2 VARCHAR(50) REFERENCES users(username),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(user1, user2)
+        )
+    """)
+
+    op.execute("""
+        CREATE TABLE IF NOT EXISTS friend_requests (
+            id SERIAL PRIMARY KEY,
+            sender VARCHAR(50) REFERENCES users(username),
+            receiver VARCHAR(50) REFERENCES users(username),
+            status VARCHAR(20) DEFAULT 'pending',
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    op.execute("""
+        CREATE TABLE IF NOT EXISTS groups (
+            id SERIAL PRIMARY KEY,
+            name VARCHAR(100) NOT NULL,
+            invite_link VARCHAR(50) UNIQUE NOT NULL,
+            avatar_path VARCHAR(255),
+            creator_username VARCHAR(50) REFERENCES users(username),
+            description TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    op.execute("""
+        CREATE TABLE IF NOT EXISTS group_members (
+            id SERIAL PRIMARY KEY,
+            group_id INTEGER REFERENCES groups(id) ON DELETE CASCADE,
+            username VARCHAR(50) REFERENCES users(username),
+            role VARCHAR(20) DEFAULT 'member',
+            joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(group_id, username)
+        )
+    """)
+
+    op.execute("""
+        CREATE TABLE IF NOT EXISTS group_messages (
+            id SERIAL PRIMARY KEY,
+            group_id INTEGER REFERENCES groups(id) ON DELETE CASCADE,
+            sender VARCHAR(50) REFERENCES users(username),
+            content TEXT NOT NULL,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            edited BOOLEAN DEFAULT FALSE,
+            deleted BOOLEAN DEFAULT FALSE
+        )
+    """)
+
+    op.execute("""
+        CREATE TABLE IF NOT EXISTS group_invites (
+            id VARCHAR(50) PRIMARY KEY,
+            group_id INTEGER REFERENCES groups(id) ON DELETE CASCADE,
+            inviter VARCHAR(50) REFERENCES users(username),
+            invitee VARCHAR(50) REFERENCES users(username),
+            status VARCHAR(20) DEFAULT 'pending',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            responded_at TIMESTAMP
+        )
+    """)
+
+    op.execute("""
+        CREATE TABLE IF NOT EXISTS call_logs (
+            id SERIAL PRIMARY KEY,
+            caller VARCHAR(50) REFERENCES users(username),
+            recipient VARCHAR(50) REFERENCES users(username),
+            start_time TIMESTAMP,
+            end_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            duration INTEGER NOT NULL,
+            status VARCHAR(20) DEFAULT 'ended',
+            timestamp BIGINT,
+            notification_seen BOOLEAN DEFAULT FALSE
+        )
+    """)
+    op.execute("ALTER TABLE call_logs ADD COLUMN IF NOT EXISTS status VARCHAR(20) DEFAULT 'ended'")
+    op.execute("ALTER TABLE call_logs ADD COLUMN IF NOT EXISTS notification_seen BOOLEAN DEFAULT FALSE")
+
+    op.execute("""
+        CREATE TABLE IF NOT EXISTS notification_settings (
+            username VARCHAR(50) PRIMARY KEY REFERENCES users(username),
+            enabled BOOLEAN DEFAULT TRUE
+        )
+    """)
+
+    op.execute("""
+        CREATE TABLE IF NOT EXISTS user_profiles (
+            username VARCHAR(50) PRIMARY KEY REFERENCES users(username),
+            avatar_path VARCHAR(255)
+        )
+    """)
+
+
+def downgrade() -> None:
+    for table in ("user_profiles", "notification_settings", "call_logs", "group_invites", "group_messages",
+                  "group_members", "groups", "friend_requests", "friends", "messages", "users"):
+        op.drop_table(table)
@@ -0,0 +1,42 @@
+"""chat indexes
+
+Revision ID: 9d4a6c3e2f18
+Revises: 5b2e8f0c41a7
+Create Date: 2026-10-18 12:10:00.000000
+
+Индексы под запросы горячих путей: история переписки, непрочитанные,
+друзья в обе стороны, участники и история групп. Индексы (user1, user2)
+и (group_id, username) уже дают ограничения UNIQUE этих таблиц, поэтому
+добавляются только обратный индекс друзей и остальные.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9d4a6c3e2f18'
+down_revision: Union[str, None] = '5b2e8f0c41a7'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # История личной переписки: WHERE sender/receiver ... ORDER BY timestamp
+    op.create_index("ix_messages_sender_receiver_timestamp", "messages", ["sender", "receiver", "timestamp"],
+                    if_not_exists=True)
+    # Непрочитанные: WHERE receiver = %s AND read = FALSE
+    op.create_index("ix_messages_receiver_read", "messages", ["receiver", "read"], if_not_exists=True)
+    # Друзья пользователя: WHERE user1 = %s OR user2 = %s - (user1, user2) дает UNIQUE
+    op.create_index("ix_friends_user2_user1", "friends", ["user2", "user1"], if_not_exists=True)
+    # История группы: WHERE group_id = %s ORDER BY timestamp
+    op.create_index("ix_group_messages_group_id_timestamp", "group_messages", ["group_id", "timestamp"],
+                    if_not_exists=True)
+
+
+def downgrade() -> None:
+    op.drop_index("ix_group_messages_group_id_timestamp", table_name="group_messages")
+    op.drop_index("ix_friends_user2_user1", table_name="friends")
+    op.drop_index("ix_messages_receiver_read", table_name="messages")
+    op.drop_index("ix_messages_sender_receiver_timestamp", table_name="messages")
@@ -0,0 +1,110 @@
+from array import array
+
+try:
+    import opuslib
+except Exception:  # нет пакета или системной libopus - остается только PCM
+    opuslib = None
+
+# Имена кодеков в сигналах звонков
+CODEC_PCM = "pcm"
+CODEC_OPUS = "opus"
+
+# Битрейт Opus для речи, бит/с (PCM 44.1 кГц моно - ~705 кбит/с)
+OPUS_BITRATE = 24000
+
+# Маркер паузы вместо аудиоблока: отправитель замолчал, получатель воспроизводит
+# комфортный шум с уровнем, указанным последним байтом (-дБFS)
+COMFORT_NOISE_MARKER = b"\xffCN"
+COMFORT_NOISE_SIZE = len(COMFORT_NOISE_MARKER) + 1
+
+
+class PcmCodec:
+    """Без сжатия: 16-bit PCM, моно, 44.1 кГц, блоки по 1024 сэмпла (прежний формат)"""
+    name = CODEC_PCM
+    sample_rate = 44100
+    frame_size = 1024
+
+    def __init__(self):
+        self._last = None
+
+    def encode(self, pcm):
+        return pcm
+
+    def decode(self, data):
+        self._last = bytes(data)
+        return self._last
+
+    def conceal(self):
+        """Потерянный блок: повтор предыдущего с затуханием вдвое"""
+        if self._last is None:
+            return bytes(self.frame_size * 2)
+        self._last = array('h', (sample // 2 for sample in array('h', self._last))).tobytes()
+        return self._last
+
+
+class OpusCodec:
+    """Opus: 48 кГц моно, пакеты по 20 мс.
+
+    Пакеты Opus имеют переменную длину, поэтому кодек используется только
+    поверх кадрового протокола, где каждый аудиокадр - ровно один пакет.
+    """
+    name = CODEC_OPUS
+    sample_rate = 48000
+    frame_size = 960
+
+    def __init__(self, bitrate=OPUS_BITRATE):
+        self._encoder = opuslib.Encoder(self.sample_rate, 1, opuslib.APPLICATION_VOIP)
+        self._encoder.bitrate = bitrate
+        self._decoder = opuslib.Decoder(self.sample_rate, 1)
+
+    def encode(self, pcm):
+        return self._encoder.encode(pcm, self.frame_size)
+
+    def decode(self, data):
+        return self._decoder.decode(bytes(data), self.frame_size)
+
+    def conceal(self):
+        """Потерянный пакет: маскировку (PLC) выполняет декодер Opus"""
+        return self._decoder.decode(b"", self.frame_size)
+
+
+def make_comfort_noise(level_db):
+    """Маркер паузы с уровнем фонового шума отправителя, дБFS (<= 0)"""
+    return COMFORT_NOISE_MARKER + bytes([min(127, max(0, int(round(-level_db))))])
+
+
+def parse_comfort_noise(data):
+    """Уровень шума (дБFS) из маркера паузы или None, если это обычный аудиоблок"""
+    if len(data) == COMFORT_NOISE_SIZE and bytes(data[:len(COMFORT_NOISE_MARKER)]) == COMFORT_NOISE_MARKER:
+        return -float(data[-1])
+    return None
+
+
+def available_codecs(framed=True):
+    """Кодеки, которые может предложить клиент, в порядке предпочтения"""
+    if framed and opuslib is not None:
+        return [CODEC_OPUS, CODEC_PCM]
+    return [CODEC_PCM]
+
+
+def parse_codec_list(value):
+    codecs = [codec for codec in value.split(",") if codec]
+    return codecs or [CODEC_PCM]
+
+
+def format_codec_list(codecs):
+    return ",".join(codecs)
+
+
+def choose_codec(offered, supported):
+    """Первый из предложенных кодеков, поддерживаемый второй стороной; иначе PCM"""
+    for codec in offered:
+        if codec in supported:
+            return codec
+    return CODEC_PCM
+
+
+def create_codec(name):
+    if name == CODEC_OPUS and opuslib is not None:
+        return OpusCodec()
+    return PcmCodec()
@@ -0,0 +1,223 @@
+import threading
+import time
+from collections import deque
+
+from audio_codec import make_comfort_noise
+
+try:
+    import numpy as np
+except ImportError:  # микширование недоступно, сервер пересылает аудио как раньше
+    np = None
+
+# Формат аудио клиентов: 16-bit PCM, моно, 44100 Гц, блоки по 1024 сэмпла
+SAMPLE_RATE = 44100
+BLOCK_FRAMES = 1024
+BLOCK_BYTES = BLOCK_FRAMES * 2
+BLOCK_DURATION = BLOCK_FRAMES / SAMPLE_RATE  # ~23 мс
+
+# Сколько блоков накопить от говорящего, прежде чем подмешивать его (сглаживание джиттера)
+JITTER_BLOCKS = 2
+# Больше блоков в буфере говорящего не держим - старые отбрасываются, чтобы не росла задержка
+MAX_BUFFERED_BLOCKS = 10
+# Уровень комфортного шума, о котором микшер сообщает участникам, когда все замолчали, дБFS
+MIX_COMFORT_NOISE_DB = -70.0
+
+
+def mixing_available():
+    return np is not None
+
+
+class _Speaker:
+    """Буфер аудио одного говорящего"""
+    __slots__ = ("pending", "blocks", "primed", "paused")
+
+    def __init__(self):
+        self.pending = bytearray()  # хвост, не набравший целого блока
+        self.blocks = deque()
+        self.primed = False  # набран ли начальный запас JITTER_BLOCKS
+        self.paused = False  # говорящий прислал маркер паузы - доигрываем остаток без ожидания
+
+
+class GroupCallMixer:
+    """Микшер групповых звонков: один смешанный поток на участника.
+
+    Аудио говорящих складывается в буферы блоками по BLOCK_FRAMES сэмплов.
+    Отдельный поток раз в BLOCK_DURATION берет по одному блоку от каждого
+    говорящего, суммирует их и отправляет каждому участнику сумму без его
+    собственного голоса (с насыщением до int16). Объем данных, получаемых
+    участником, не зависит от числа говорящих. Замолчавшие говорящие (pause)
+    в смешивании не участвуют, а когда молчат все, участники получают маркер
+    паузы вместо потока тишины.
+
+    get_participants(group_id) возвращает {username: socket} участников,
+    send(group_id, username, socket, data) отправляет смешанный блок.
+    """
+    def __init__(self, get_participants, send):
+        if np is None:
+            raise RuntimeError("numpy is required for group call mixing")
+        self._get_participants = get_participants
+        self._send = send
+        self._lock = threading.Lock()
+        self._calls = {}  # group_id -> {username: _Speaker}
+        self._active = set()  # звонки, в которых в прошлом такте кто-то говорил
+        self._thread = None
+        self._running = False
+
+        # Статистика
+        self.ticks = 0
+        self.mixed_blocks = 0
+        self.dropped_blocks = 0
+        self.underruns = 0
+        self.late_ticks = 0
+        self.pauses = 0
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+
+    def push(self, group_id, username, data):
+        """Принимает аудио говорящего (произвольной длины, блоки собираются здесь)"""
+        with self._lock:
+            speakers = self._calls.setdefault(group_id, {})
+            speaker = speakers.get(username)
+            if speaker is None:
+                speaker = speakers[username] = _Speaker()
+
+            speaker.paused = False
+            speaker.pending += data
+            while len(speaker.pending) >= BLOCK_BYTES:
+                speaker.blocks.append(bytes(speaker.pending[:BLOCK_BYTES]))
+                del speaker.pending[:BLOCK_BYTES]
+                if len(speaker.blocks) > MAX_BUFFERED_BLOCKS:
+                    speaker.blocks.popleft()
+                    self.dropped_blocks += 1
+
+    def pause(self, group_id, username):
+        """Говорящий замолчал (маркер паузы): его буфер больше не ждет пополнения"""
+        with self._lock:
+            speaker = self._calls.get(group_id, {}).get(username)
+            if speaker is not None:
+                speaker.paused = True
+                speaker.pending.clear()
+                self.pauses += 1
+
+    def remove_speaker(self, group_id, username):
+        """Участник вышел из звонка"""
+        with self._lock:
+            speakers = self._calls.get(group_id)
+            if speakers is not None:
+                speakers.pop(username, None)
+                if not speakers:
+                    del self._calls[group_id]
+
+    def remove_call(self, group_id):
+        with self._lock:
+            self._calls.pop(group_id, None)
+            self._active.discard(group_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "calls": len(self._calls),
+                "speakers": sum(len(speakers) for speakers in self._calls.values()),
+                "ticks": self.ticks,
+                "mixed_blocks": self.mixed_blocks,
+                "dropped_blocks": self.dropped_blocks,
+                "underruns": self.underruns,
+                "late_ticks": self.late_ticks,
+                "pauses": self.pauses,
+            }
+
+    # --- тактирование ---
+
+    def _run(self):
+        next_tick = time.monotonic()
+        while self._running:
+            next_tick += BLOCK_DURATION
+            try:
+                self._tick()
+            except Exception as e:
+                print(f"[GROUP CALL MIXER ERROR] {e}")
+
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -MAX_BUFFERED_BLOCKS * BLOCK_DURATION:
+                # Сильно отстали (например, процесс был приостановлен) - не догоняем рывком
+                self.late_ticks += 1
+                next_tick = time.monotonic()
+
+    def _tick(self):
+        with self._lock:
+            self.ticks += 1
+            frames = {}
+            for group_id, speakers in self._calls.items():
+                blocks = self._take_blocks(speakers)
+                if blocks:
+                    frames[group_id] = blocks
+            quiet = self._active - frames.keys()
+            self._active = set(frames)
+
+        # Смешивание и отправка - вне блокировки, чтобы не задерживать push()
+        for group_id, blocks in frames.items():
+            self._mix_and_send(group_id, blocks)
+        for group_id in quiet:
+            self._send_pause(group_id)
+
+    def _take_blocks(self, speakers):
+        """По одному блоку от каждого готового говорящего"""
+        blocks = {}
+        for username, speaker in speakers.items():
+            if not speaker.primed and not speaker.paused:
+                if len(speaker.blocks) < JITTER_BLOCKS:
+                    continue
+                speaker.primed = True
+            if speaker.blocks:
+                blocks[username] = speaker.blocks.popleft()
+            elif speaker.primed:
+                # Буфер опустел - снова копим запас перед подмешиванием
+                speaker.primed = False
+                if not speaker.paused:
+                    self.underruns += 1
+        return blocks
+
+    def _send_pause(self, group_id):
+        participants = self._get_participants(group_id)
+        marker = make_comfort_noise(MIX_COMFORT_NOISE_DB)
+        for username, participant_socket in (participants or {}).items():
+            try:
+                self._send(group_id, username, participant_socket, marker)
+            except Exception as e:
+                print(f"[GROUP CALL MIXER ERROR] Failed to send pause to {username}: {e}")
+
+    def _mix_and_send(self, group_id, blocks):
+        participants = self._get_participants(group_id)
+        if not participants:
+            return
+
+        samples = {username: np.frombuffer(block, dtype="<i2").astype(np.int32)
+                   for username, block in blocks.items()}
+        total = np.sum(list(samples.values()), axis=0, dtype=np.int32)
+        # Общий микс для тех, кто сам молчал в этом такте
+        common = None
+
+        for username, participant_socket in participants.items():
+            own = samples.get(username)
+            if own is None:
+                if common is None:
+                    common = np.clip(total, -32768, 32767).astype("<i2").tobytes()
+                mixed = common
+            elif len(samples) == 1:
+                continue  # говорит только он сам - слышать нечего
+            else:
+                mixed = np.clip(total - own, -32768, 32767).astype("<i2").tobytes()
+
+            try:
+                self._send(group_id, username, participant_socket, mixed)
+                self.mixed_blocks += 1
+            except Exception as e:
+                print(f"[GROUP CALL MIXER ERROR] Failed to send mix to {username}: {e}")
@@ -0,0 +1,98 @@
+"""Задержка и выделения памяти на кадр для бэкендов захвата экрана.
+
+Для каждого доступного бэкенда (screen_capture.CAPTURE_BACKENDS) меряется:
+
+  * grab - только снимок экрана бэкендом;
+  * capture - снимок, масштабирование и перевод в BGR через ScreenGrabber
+    (то, что получает кодировщик демонстрации);
+  * legacy - тот же снимок, но обработка как раньше: новый массив,
+    cvtColor и resize с выделением памяти на каждом шаге.
+
+Память - пик выделений tracemalloc за кадр (NumPy учитывается; буферы
+PIL внутри pyautogui и память X-сервера - нет). Недоступные бэкенды
+пропускаются с причиной. Нужен дисплей (DISPLAY на Linux).
+
+    python benchmarks/capture_latency.py --frames 200 --scale 0.5
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from screen_capture import CAPTURE_BACKENDS, ScreenGrabber, create_capture_backend  # noqa: E402
+
+LEGACY_CONVERSIONS = {"BGRA": cv2.COLOR_BGRA2BGR, "RGB": cv2.COLOR_RGB2BGR, "RGBA": cv2.COLOR_RGBA2BGR}
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def legacy_capture(backend, scale_factor):
+    """Обработка кадра до ScreenGrabber: копия снимка и новые массивы на каждом шаге"""
+    frame = np.array(backend.grab())
+    frame = cv2.cvtColor(frame, LEGACY_CONVERSIONS[backend.color_order])
+    h, w = frame.shape[:2]
+    return cv2.resize(frame, (int(w * scale_factor), int(h * scale_factor)))
+
+
+def measure(step, frames, warmup):
+    """Задержки кадров (мс) и средний пик выделений за кадр (байт)"""
+    for _ in range(warmup):
+        step()
+    latency = []
+    peaks = 0
+    tracemalloc.start()
+    for _ in range(frames):
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        step()
+        latency.append((time.perf_counter() - started) * 1000)
+        peaks += tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    return latency, peaks / frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backends", default=",".join(CAPTURE_BACKENDS), help="бэкенды через запятую")
+    parser.add_argument("--frames", type=int, default=100, help="кадров на замер")
+    parser.add_argument("--warmup", type=int, default=5, help="кадров до начала замера")
+    parser.add_argument("--scale", type=float, default=1.0, help="масштаб кадра для capture и legacy")
+    parser.add_argument("--region", default="", help="область захвата x,y,ширина,высота (по умолчанию весь экран)")
+    args = parser.parse_args()
+    region = tuple(int(part) for part in args.region.split(",")) if args.region else None
+
+    print(f"{'backend':<10} {'mode':<8} {'size':>11} {'p50 ms':>8} {'p95 ms':>8} {'alloc KB':>10}")
+    for name in args.backends.split(","):
+        try:
+            backend = create_capture_backend(name, region)
+        except Exception as e:
+            print(f"{name:<10} skipped: {e}")
+            continue
+        grabber = ScreenGrabber(backend)
+        try:
+            h, w = backend.grab().shape[:2]
+            modes = (
+                ("grab", backend.grab),
+                ("capture", lambda: grabber.capture(args.scale)),
+                ("legacy", lambda: legacy_capture(backend, args.scale)),
+            )
+            for mode, step in modes:
+                latency, allocated = measure(step, args.frames, args.warmup)
+                print(f"{name:<10} {mode:<8} {f'{w}x{h}':>11} {percentile(latency, 0.5):>8.2f} "
+                      f"{percentile(latency, 0.95):>8.2f} {allocated / 1024:>10.1f}")
+        finally:
+            grabber.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""Пропускная способность передачи файла: строки base64 против кадров FRAME_FILE.
+
+Отправитель -> пересылка (как на сервере) -> получатель, все по TCP на
+localhost с кадровым протоколом:
+
+  * text - прежний путь: чтение по 4 КБ, base64, строки
+    FILE_TRANSFER:CHUNK по 900 символов; пересылка разбирает каждую строку,
+    получатель декодирует base64. Клиент ждал 20 мс после каждой строки;
+    здесь пауза задается --text-delay-ms, а в таблице дополнительно
+    показано время с паузой 20 мс;
+  * binary - FileSender: части по 256 КБ кадрами FRAME_FILE, пересылка
+    проверяет заголовок и отправляет нагрузку как есть.
+
+Время считается от START до получения END целиком собранного файла.
+
+    python benchmarks/file_transfer.py --size-mb 10
+"""
+import argparse
+import base64
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from file_transfer import FileSender  # noqa: E402
+from protocol import (FILE_PERSONAL, FRAME_FILE, FRAME_TEXT, PROTOCOL_FILE_FRAMES, RECV_BUFFER_SIZE,  # noqa: E402
+                      FrameDecoder, FramedSocket, unpack_file_chunk)
+
+HOST = "127.0.0.1"
+LEGACY_DELAY = 0.02  # пауза клиента после каждой строки в прежнем ChatWindow.send_file
+
+
+def tcp_pair():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind((HOST, 0))
+    listener.listen(1)
+    client = socket.create_connection(listener.getsockname())
+    server, _ = listener.accept()
+    listener.close()
+    return client, server
+
+
+def relay(inbound, outbound, stats):
+    """Пересылка как на сервере: текст построчно, части файла без разбора данных"""
+    decoder = FrameDecoder()
+    buffer = ""
+    while True:
+        data = inbound.recv(RECV_BUFFER_SIZE)
+        if not data:
+            outbound.close()
+            return
+        stats["wire_bytes"] += len(data)
+        for frame_type, payload in decoder.feed(data):
+            if frame_type == FRAME_FILE:
+                if unpack_file_chunk(payload) is not None:
+                    outbound.send_frame(FRAME_FILE, payload)
+                continue
+            buffer += str(payload, "utf-8")
+            lines = buffer.split("\n")
+            buffer = lines[-1]
+            for line in lines[:-1]:
+                if line:
+                    outbound.send(f"{line}\n".encode("utf-8"))
+
+
+def receive(sock, done):
+    """Получатель: собирает файл из строк CHUNK или кадров FRAME_FILE до END"""
+    decoder = FrameDecoder()
+    buffer = ""
+    received = bytearray()
+    while True:
+        data = sock.recv(RECV_BUFFER_SIZE)
+        if not data:
+            return
+        for frame_type, payload in decoder.feed(data):
+            if frame_type == FRAME_FILE:
+                received += unpack_file_chunk(payload)[5]
+                continue
+            if frame_type != FRAME_TEXT:
+                continue
+            buffer += str(payload, "utf-8")
+            lines = buffer.split("\n")
+            buffer = lines[-1]
+            for line in lines[:-1]:
+                parts = line.split(":", 4)
+                if parts[1] == "CHUNK":
+                    received += base64.b64decode(parts[4])
+                elif parts[1] == "END":
+                    done["data"] = bytes(received)
+                    done["at"] = time.perf_counter()
+                    return
+
+
+def send_text(sock, path, delay):
+    """Прежний ChatWindow.send_file: 4 КБ -> base64 -> строки по 900 символов"""
+    name = os.path.basename(path)
+    sock.send(f"FILE_TRANSFER:START:alice:bob:{name}:{os.path.getsize(path)}\n".encode("utf-8"))
+    lines = 0
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(4096)
+            if not chunk:
+                break
+            encoded = base64.b64encode(chunk).decode("utf-8")
+            for i in range(0, len(encoded), 900):
+                sock.send(f"FILE_TRANSFER:CHUNK:alice:bob:{encoded[i:i + 900]}\n".encode("utf-8"))
+                lines += 1
+                if delay:
+                    time.sleep(delay)
+    sock.send(f"FILE_TRANSFER:END:alice:bob:{name}\n".encode("utf-8"))
+    return lines
+
+
+def send_binary(sock, path):
+    sender = FileSender(sock, FILE_PERSONAL, "alice", "bob", path)
+    sender.run()
+    return -(-sender.size // sender.chunk_size)
+
+
+def run(mode, path, delay):
+    sender_sock, relay_in = tcp_pair()
+    relay_out, receiver_sock = tcp_pair()
+    sender = FramedSocket(sender_sock, PROTOCOL_FILE_FRAMES)
+    stats = {"wire_bytes": 0}
+    done = {}
+    threading.Thread(target=relay, args=(relay_in, FramedSocket(relay_out, PROTOCOL_FILE_FRAMES), stats),
+                     daemon=True).start()
+    receiver = threading.Thread(target=receive, args=(receiver_sock, done), daemon=True)
+    receiver.start()
+
+    started = time.perf_counter()
+    messages = send_text(sender, path, delay) if mode == "text" else send_binary(sender, path)
+    receiver.join()
+    sender_sock.close()
+    with open(path, "rb") as f:
+        ok = done.get("data") == f.read()
+    return done.get("at", time.perf_counter()) - started, messages, stats["wire_bytes"], ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=float, default=10.0, help="размер файла, МБ")
+    parser.add_argument("--text-delay-ms", type=float, default=0.0,
+                        help="пауза после каждой строки text (в клиенте было 20)")
+    args = parser.parse_args()
+
+    size = int(args.size_mb * 1024 * 1024)
+    with tempfile.NamedTemporaryFile(delete=False) as f:
+        f.write(os.urandom(size))
+        path = f.name
+    try:
+        print(f"{'mode':<7} {'size MB':>8} {'messages':>9} {'wire MB':>8} {'time s':>8} {'MB/s':>8} "
+              f"{'with 20ms':>10} {'ok':>3}")
+        for mode in ("text", "binary"):
+            elapsed, messages, wire_bytes, ok = run(mode, path, args.text_delay_ms / 1000)
+            legacy = f"{elapsed + messages * LEGACY_DELAY:>9.1f}s" if mode == "text" else f"{'-':>10}"
+            print(f"{mode:<7} {size / 1048576:>8.1f} {messages:>9} {wire_bytes / 1048576:>8.1f} {elapsed:>8.2f} "
+                  f"{size / 1048576 / elapsed:>8.1f} {legacy} {'yes' if ok else 'NO':>3}")
+    finally:
+        os.unlink(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+"""Задержка "от рта до уха" для аудио звонка по TCP и по UDP при потерях пакетов.
+
+Отправитель генерирует блоки с периодом длительности блока, получатель
+складывает их в JitterBuffer клиента и воспроизводит по тому же такту.
+Между ними стоит локальный имитатор сети (без netem):
+
+  * UDP: пакет теряется с вероятностью --loss и задерживается на
+    случайную величину до --jitter-ms (возможна перестановка); путь идет
+    через MediaRelay сервера;
+  * TCP: потерянный сегмент доставляется повторно через --rto-ms, и все
+    данные за ним ждут (блокировка начала очереди), порядок сохраняется.
+
+Задержка считается от момента "записи" блока до его воспроизведения.
+
+    python benchmarks/media_latency.py --loss 0,0.01,0.03,0.05 --duration 10
+"""
+import argparse
+import heapq
+import os
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from jitter_buffer import JitterBuffer, PLAYOUT_FRAME, PLAYOUT_CONCEAL  # noqa: E402
+from media_relay import MediaRelay  # noqa: E402
+from media_transport import MAX_DATAGRAM_SIZE, MediaChannel  # noqa: E402
+from protocol import FrameDecoder, encode_frame, FRAME_AUDIO  # noqa: E402
+
+HOST = "127.0.0.1"
+CAPTURE_TIME = struct.Struct("!d")
+
+
+class DelayLine:
+    """Доставляет элементы в заданное время (поток с очередью по времени)"""
+    def __init__(self, deliver):
+        self.deliver = deliver
+        self._heap = []
+        self._cond = threading.Condition()
+        self._counter = 0
+        self._running = True
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def put(self, at, item):
+        with self._cond:
+            self._counter += 1
+            heapq.heappush(self._heap, (at, self._counter, item))
+            self._cond.notify()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and (not self._heap or self._heap[0][0] > time.monotonic()):
+                    timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+                    self._cond.wait(timeout)
+                if not self._running:
+                    return
+                _, _, item = heapq.heappop(self._heap)
+            try:
+                self.deliver(item)
+            except OSError:
+                return
+
+
+def lossy_udp_proxy(target, loss, jitter, rng):
+    """UDP-прокси: теряет и задерживает пакеты в обе стороны. Возвращает порт"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((HOST, 0))
+    upstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    upstream.connect(target)
+    client = {}
+
+    to_server = DelayLine(lambda data: upstream.send(data))
+    to_client = DelayLine(lambda data: sock.sendto(data, client["addr"]))
+
+    def forward_up():
+        while True:
+            try:
+                data, addr = sock.recvfrom(MAX_DATAGRAM_SIZE)
+            except OSError:
+                return
+            client["addr"] = addr
+            if rng.random() >= loss:
+                to_server.put(time.monotonic() + rng.uniform(0, jitter), data)
+
+    def forward_down():
+        while True:
+            try:
+                data = upstream.recv(MAX_DATAGRAM_SIZE)
+            except OSError:
+                return
+            if "addr" in client and rng.random() >= loss:
+                to_client.put(time.monotonic() + rng.uniform(0, jitter), data)
+
+    threading.Thread(target=forward_up, daemon=True).start()
+    threading.Thread(target=forward_down, daemon=True).start()
+    return sock.getsockname()[1]
+
+
+def lossy_tcp_link(loss, jitter, rto, rng):
+    """Пара TCP-сокетов через прокси: потеря сегмента = задержка на RTO всего, что за ним"""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind((HOST, 0))
+    listener.listen(2)
+    port = listener.getsockname()[1]
+
+    sender = socket.create_connection((HOST, port))
+    proxy_in, _ = listener.accept()
+    receiver_listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    receiver_listener.bind((HOST, 0))
+    receiver_listener.listen(1)
+    proxy_out = socket.create_connection(receiver_listener.getsockname())
+    receiver, _ = receiver_listener.accept()
+    for sock in (sender, proxy_out):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    delay_line = DelayLine(proxy_out.sendall)
+    state = {"release": 0.0}
+
+    def forward():
+        while True:
+            try:
+                data = proxy_in.recv(65536)
+            except OSError:
+                return
+            if not data:
+                return
+            now = time.monotonic()
+            at = now + rng.uniform(0, jitter)
+            if rng.random() < loss:
+                at = now + rto  # повторная передача после таймаута
+            # TCP сохраняет порядок: ничто не обгоняет задержанный сегмент
+            state["release"] = max(state["release"], at)
+            delay_line.put(state["release"], data)
+
+    threading.Thread(target=forward, daemon=True).start()
+    return sender, receiver
+
+
+def playout(buffer, frame_duration, duration, results):
+    """Такт воспроизведения: фиксирует задержку каждого проигранного блока"""
+    next_tick = time.monotonic()
+    end = next_tick + duration
+    while next_tick < end:
+        kind, frame = buffer.pop()
+        if kind == PLAYOUT_FRAME:
+            results["latency"].append(time.time() - CAPTURE_TIME.unpack_from(frame)[0])
+        elif kind == PLAYOUT_CONCEAL:
+            results["concealed"] += 1
+        next_tick += frame_duration
+        time.sleep(max(0.0, next_tick - time.monotonic()))
+
+
+def capture(send, frame_duration, frame_bytes, duration):
+    next_tick = time.monotonic()
+    end = next_tick + duration
+    padding = bytes(frame_bytes - CAPTURE_TIME.size)
+    sent = 0
+    while next_tick < end:
+        send(CAPTURE_TIME.pack(time.time()) + padding)
+        sent += 1
+        next_tick += frame_duration
+        time.sleep(max(0.0, next_tick - time.monotonic()))
+    return sent
+
+
+def run_udp(args, loss, rng):
+    relay = MediaRelay(lambda session, seq, timestamp, payload: relay.send(
+        relay.session_for("bench", "receiver"), payload, timestamp))
+    relay_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    relay_sock.bind((HOST, 0))
+    relay_port = relay_sock.getsockname()[1]
+    relay_sock.close()
+    relay.serve_thread(HOST, relay_port)
+
+    proxy_port = lossy_udp_proxy((HOST, relay_port), loss, args.jitter_ms / 1000, rng)
+    buffer = JitterBuffer(args.frame_ms / 1000)
+    sender = MediaChannel(HOST, proxy_port, relay.issue("bench", "sender"), lambda *packet: None)
+    receiver = MediaChannel(HOST, relay_port, relay.issue("bench", "receiver"),
+                            lambda seq, sent_at, payload: buffer.push(payload, seq, sent_at))
+    sender.start()
+    receiver.start()
+    time.sleep(0.3)
+
+    results = {"latency": [], "concealed": 0}
+    player = threading.Thread(target=playout, args=(buffer, args.frame_ms / 1000, args.duration + 0.5, results))
+    player.start()
+    sent = capture(sender.send, args.frame_ms / 1000, args.frame_bytes, args.duration)
+    player.join()
+    sender.close()
+    receiver.close()
+    return sent, results, buffer.stats()
+
+
+def run_tcp(args, loss, rng):
+    sender, receiver = lossy_tcp_link(loss, args.jitter_ms / 1000, args.rto_ms / 1000, rng)
+    buffer = JitterBuffer(args.frame_ms / 1000)
+
+    def receive():
+        decoder = FrameDecoder()
+        while True:
+            try:
+                data = receiver.recv(65536)
+            except OSError:
+                return
+            if not data:
+                return
+            for _, payload in decoder.feed(data):
+                buffer.push(payload)
+
+    threading.Thread(target=receive, daemon=True).start()
+    results = {"latency": [], "concealed": 0}
+    player = threading.Thread(target=playout, args=(buffer, args.frame_ms / 1000, args.duration + 0.5, results))
+    player.start()
+    sent = capture(lambda frame: sender.sendall(encode_frame(FRAME_AUDIO, frame)),
+                   args.frame_ms / 1000, args.frame_bytes, args.duration)
+    player.join()
+    sender.close()
+    receiver.close()
+    return sent, results, buffer.stats()
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--loss", default="0,0.01,0.03,0.05", help="доли потерянных пакетов через запятую")
+    parser.add_argument("--duration", type=float, default=10.0, help="длительность прогона, сек")
+    parser.add_argument("--jitter-ms", type=float, default=10.0, help="случайная задержка сети до N мс")
+    parser.add_argument("--rto-ms", type=float, default=200.0, help="задержка повторной передачи TCP, мс")
+    parser.add_argument("--frame-ms", type=float, default=20.0, help="длительность аудиоблока, мс")
+    parser.add_argument("--frame-bytes", type=int, default=80, help="размер аудиоблока (Opus 24 кбит/с ~ 60-80)")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    print(f"{'transport':<9} {'loss':>5} {'sent':>5} {'played':>6} {'concealed':>9} {'late':>5} "
+          f"{'p50 ms':>7} {'p95 ms':>7} {'p99 ms':>7} {'max ms':>7}")
+    for loss in (float(value) for value in args.loss.split(",")):
+        for name, run in (("tcp", run_tcp), ("udp", run_udp)):
+            sent, results, stats = run(args, loss, random.Random(args.seed))
+            latency = [value * 1000 for value in results["latency"]]
+            print(f"{name:<9} {loss:>5.2f} {sent:>5} {len(latency):>6} {results['concealed']:>9} "
+                  f"{stats['late']:>5} {percentile(latency, 0.5):>7.1f} {percentile(latency, 0.95):>7.1f} "
+                  f"{percentile(latency, 0.99):>7.1f} {max(latency, default=float('nan')):>7.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""Сообщений в секунду у handle_direct_message и handle_group_message по способам записи в БД.
+
+Обработчики сервера вызываются напрямую через run_with_session, как на
+сервере: каждое сообщение получает ленивую сессию пула (PoolSession), сеть
+не участвует:
+
+  * plain - запросы обычным курсором: PostgreSQL разбирает и планирует
+    каждый запрос заново (как было);
+  * prepared - PreparedStatements: запросы готовятся один раз на
+    соединении и выполняются по имени;
+  * write-behind - MessageWriter: обработчик только ставит сообщение в
+    очередь, вставка идет пакетами в фоне. "ack msg/s" - скорость самих
+    обработчиков, "msg/s" - до записи в базу последнего сообщения.
+
+Личное сообщение - проверка существования получателя и INSERT INTO
+messages, групповое - INSERT INTO group_messages ... RETURNING id. С
+--cold-cache кэши друзей и групп сбрасываются перед каждым сообщением, и в
+замер попадают запросы проверки дружбы и членства. Нужна база со схемой
+(alembic upgrade head); тестовые пользователи bench_* и их сообщения
+удаляются после замера.
+
+    python benchmarks/prepared_statements.py --messages 5000 --host 127.0.0.1 --password 12345
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pg8000  # noqa: E402
+
+import server  # noqa: E402
+from db_pool import ConnectionPool  # noqa: E402
+from message_writer import MessageWriter  # noqa: E402
+
+SENDER = "bench_sender"
+RECEIVER = "bench_receiver"
+GROUP_LINK = "bench-statements"
+
+
+class NullSocket:
+    """Сокет получателей: рассылка группе ничего не отправляет"""
+    def send(self, data):
+        return len(data)
+
+    sendall = send
+
+
+def prepare_data(connection):
+    cursor = connection.cursor()
+    for username in (SENDER, RECEIVER):
+        cursor.execute("INSERT INTO users (username, password) VALUES (%s, 'x') ON CONFLICT DO NOTHING",
+                       (username,))
+    cursor.execute("INSERT INTO friends (user1, user2) VALUES (%s, %s) ON CONFLICT DO NOTHING", (SENDER, RECEIVER))
+    cursor.execute(
+        """
+        INSERT INTO groups (name, invite_link, creator_username) VALUES ('bench', %s, %s)
+        ON CONFLICT (invite_link) DO UPDATE SET name = EXCLUDED.name
+        RETURNING id
+        """,
+        (GROUP_LINK, SENDER)
+    )
+    group_id = cursor.fetchone()[0]
+    cursor.execute("INSERT INTO group_members (group_id, username) VALUES (%s, %s) ON CONFLICT DO NOTHING",
+                   (group_id, SENDER))
+    connection.commit()
+    cursor.close()
+    return group_id
+
+
+def cleanup_data(connection):
+    cursor = connection.cursor()
+    cursor.execute("DELETE FROM messages WHERE sender = %s", (SENDER,))
+    cursor.execute("DELETE FROM groups WHERE invite_link = %s", (GROUP_LINK,))
+    cursor.execute("DELETE FROM friends WHERE user1 = %s", (SENDER,))
+    cursor.execute("DELETE FROM users WHERE username IN (%s, %s)", (SENDER, RECEIVER))
+    connection.commit()
+    cursor.close()
+
+
+def run(db_config, mode, handler, count, cold_cache):
+    """Время обработки count сообщений и время до их записи в базу (подготовка запросов входит в замер)"""
+    connection = pg8000.connect(**db_config)
+    group_id = prepare_data(connection)
+    server.statements.enabled = mode != "plain"
+    # Второе соединение - потоку записи MessageWriter
+    pool = ConnectionPool(db_config, min_size=1, max_size=2)
+    spool = None
+    if mode == "write-behind":
+        spool = tempfile.TemporaryDirectory()
+        server.message_writer = MessageWriter(pool, spool.name, server.WRITE_BEHIND_BATCH_SIZE,
+                                              server.WRITE_BEHIND_INTERVAL)
+
+    sock = NullSocket()
+    server.registry.register(sock, server.ClientConnection(sock, ("127.0.0.1", 0)), SENDER)
+    server.registry.register_group(sock, SENDER)
+    server.registry.join_group(sock, group_id)
+    if handler == "direct":
+        call = server.handle_direct_message
+        message = f"DIRECT_MESSAGE:{SENDER}:{RECEIVER}:benchmark message"
+    else:
+        call = server.handle_group_message
+        message = f"GROUP_MESSAGE:{group_id}:{SENDER}:benchmark message"
+
+    try:
+        server.friend_cache.clear()
+        server.group_cache.invalidate(group_id)
+        # Обработчики печатают каждое сообщение - вывод в замер не включаем
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            started = time.perf_counter()
+            for _ in range(count):
+                if cold_cache:
+                    server.friend_cache.clear()
+                    server.group_cache.invalidate(group_id)
+                server.run_with_session(pool, call, message, sock)
+                output.seek(0)
+                output.truncate()
+            handled = time.perf_counter() - started
+            if server.message_writer is not None:
+                server.message_writer.flush()
+            elapsed = time.perf_counter() - started
+    finally:
+        if server.message_writer is not None:
+            server.message_writer.close()
+            server.message_writer = None
+            spool.cleanup()
+        pool.close()
+        server.registry.unregister(sock)
+        server.registry.unregister_group(sock)
+        cleanup_data(connection)
+        connection.close()
+    return handled, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=5000, help="сообщений на замер")
+    parser.add_argument("--cold-cache", action="store_true", help="сбрасывать кэши друзей и групп перед сообщением")
+    parser.add_argument("--host", default=server.DB_CONFIG["host"])
+    parser.add_argument("--port", type=int, default=server.DB_CONFIG["port"])
+    parser.add_argument("--user", default=server.DB_CONFIG["user"])
+    parser.add_argument("--password", default=server.DB_CONFIG["password"])
+    parser.add_argument("--database", default=server.DB_CONFIG["database"])
+    args = parser.parse_args()
+    db_config = {"host": args.host, "port": args.port, "user": args.user, "password": args.password,
+                 "database": args.database}
+
+    print(f"{'handler':<8} {'mode':<13} {'messages':>9} {'time s':>8} {'ack msg/s':>10} {'msg/s':>9} {'speedup':>8}")
+    for handler in ("direct", "group"):
+        baseline = None
+        for mode in ("plain", "prepared", "write-behind"):
+            handled, elapsed = run(db_config, mode, handler, args.messages, args.cold_cache)
+            rate = args.messages / elapsed
+            baseline = baseline or rate
+            print(f"{handler:<8} {mode:<13} {args.messages:>9} {elapsed:>8.2f} {args.messages / handled:>10.0f} "
+                  f"{rate:>9.0f} {rate / baseline:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+import hashlib
+import os
+import re
+import threading
+
+# Имя объекта - SHA-256 содержимого в hex
+DIGEST_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+# Размер блока при чтении файлов (хеширование недокачанных данных, раздача)
+READ_SIZE = 256 * 1024
+
+
+class BlobError(Exception):
+    """Ошибка загрузки в хранилище (неверный хеш, смещение, занятая загрузка)"""
+
+
+class _Upload:
+    """Недокачанный объект: файл partial/<хеш>.part и хеш уже записанных данных"""
+    def __init__(self, path, owner):
+        self.path = path
+        self.owner = owner
+        self.hasher = hashlib.sha256()
+        self.offset = 0
+        if os.path.exists(path):
+            # Продолжение после обрыва: хеш восстанавливается по уже записанному
+            with open(path, "rb") as f:
+                while True:
+                    data = f.read(READ_SIZE)
+                    if not data:
+                        break
+                    self.hasher.update(data)
+                    self.offset += len(data)
+        self.file = open(path, "ab")
+
+
+class BlobStore:
+    """Хранилище файлов на диске с адресацией по содержимому (SHA-256).
+
+    Готовые объекты лежат в objects/<2 символа хеша>/<хеш>, недокачанные -
+    в partial/<хеш>.part и переживают обрыв соединения и перезапуск сервера:
+    begin() возвращает, сколько байт уже есть, и загрузка продолжается с
+    этого места. Когда пришли все байты, хеш сверяется с заявленным и файл
+    атомарно переносится в objects/; при несовпадении недокачанный файл
+    удаляется. Одновременно объект загружает только один владелец.
+    """
+    def __init__(self, root):
+        self.root = root
+        self._objects = os.path.join(root, "objects")
+        self._partial = os.path.join(root, "partial")
+        os.makedirs(self._objects, exist_ok=True)
+        os.makedirs(self._partial, exist_ok=True)
+        self._lock = threading.Lock()
+        self._uploads = {}  # хеш -> _Upload
+
+        # Статистика
+        self.stored = 0
+        self.deduplicated = 0
+        self.resumed = 0
+
+    @staticmethod
+    def valid_digest(digest):
+        return bool(DIGEST_PATTERN.match(digest))
+
+    def path(self, digest):
+        if not self.valid_digest(digest):
+            raise BlobError(f"Invalid digest: {digest!r}")
+        return os.path.join(self._objects, digest[:2], digest)
+
+    def has(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def begin(self, digest, size, owner):
+        """Начинает или продолжает загрузку; возвращает число уже сохраненных байт"""
+        if self.has(digest):
+            self.deduplicated += 1
+            return size
+        with self._lock:
+            upload = self._uploads.get(digest)
+            if upload is not None and upload.owner != owner:
+                raise BlobError("Upload of this file is already in progress")
+            if upload is None:
+                upload = _Upload(os.path.join(self._partial, f"{digest}.part"), owner)
+                self._uploads[digest] = upload
+                if upload.offset:
+                    self.resumed += 1
+            if upload.offset > size:
+                self._discard(digest)
+                raise BlobError("Stored part is larger than the file")
+            return upload.offset
+
+    def write(self, digest, offset, data, owner):
+        """Дописывает часть; возвращает новое смещение"""
+        with self._lock:
+            upload = self._uploads.get(digest)
+        if upload is None or upload.owner != owner:
+            raise BlobError("No upload in progress")
+        if offset != upload.offset:
+            raise BlobError(f"Chunk at {offset}, expected {upload.offset}")
+        upload.file.write(data)
+        # Сбрасываем на диск сразу: после обрыва продолжение начнется с записанного
+        upload.file.flush()
+        upload.hasher.update(data)
+        upload.offset += len(data)
+        return upload.offset
+
+    def complete(self, digest, owner):
+        """Сверяет хеш и переносит объект в objects/; BlobError при несовпадении"""
+        with self._lock:
+            upload = self._uploads.get(digest)
+            if upload is None or upload.owner != owner:
+                raise BlobError("No upload in progress")
+            del self._uploads[digest]
+        upload.file.close()
+        if upload.hasher.hexdigest() != digest:
+            os.remove(upload.path)
+            raise BlobError("Checksum mismatch")
+        target = self.path(digest)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(upload.path, target)
+        self.stored += 1
+        return target
+
+    def release(self, owner, digest=None):
+        """Закрывает загрузки владельца (все или одну); недокачанные данные остаются для продолжения"""
+        with self._lock:
+            digests = [d for d, upload in self._uploads.items()
+                       if upload.owner == owner and digest in (None, d)]
+            uploads = [self._uploads.pop(d) for d in digests]
+        for upload in uploads:
+            upload.file.close()
+
+    def _discard(self, digest):
+        upload = self._uploads.pop(digest)
+        upload.file.close()
+        os.remove(upload.path)
+
+    def stats(self):
+        with self._lock:
+            active = len(self._uploads)
+        return {"stored": self.stored, "deduplicated": self.deduplicated, "resumed": self.resumed,
+                "active_uploads": active}
@@ -293,6 +293,8 @@ class CallDialog(QtWidgets.QDialog):
                     parent=self
                 )
                 self.screen_sharing_window.start_sharing(self.parent.client.get_screen_socket())
+                self.parent.client.screen_ack_handler = self.screen_sharing_window.on_screen_ack
+                self.parent.client.screen_keyframe_handler = self.screen_sharing_window.force_keyframe
                 self.screen_sharing_window.show()
         else:
             # Завершаем демонстрацию экрана
@@ -301,6 +303,8 @@ class CallDialog(QtWidgets.QDialog):
             # Отправляем сигнал о завершении демонстрации через отдельное соединение
             if hasattr(self.parent, 'client'):
                 self.parent.client.send_screen_control_signal("stop")
+                self.parent.client.screen_ack_handler = None
+                self.parent.client.screen_keyframe_handler = None
 
             # Закрываем окно демонстрации экрана
             if self.screen_sharing_window:
@@ -503,6 +507,8 @@ class GroupCallDialog:
                 self.client.get_screen_socket(),
                 self.group_data['id']
             )
+            self.client.screen_ack_handler = self.screen_sharing_window.on_screen_ack
+            self.client.screen_keyframe_handler = self.screen_sharing_window.force_keyframe
             self.screen_sharing_window.show()
 
         else:
@@ -512,6 +518,8 @@ class GroupCallDialog:
             # Отправляем сигнал остановки
             signal = f"GROUP_SCREEN_CONTROL:stop:{self.group_data['id']}:{self.username}:{time.time()}"
             self.client.send_message(signal)
+            self.client.screen_ack_handler = None
+            self.client.screen_keyframe_handler = None
             print(f"[GROUP SCREEN] Sent stop signal: {signal}")
 
             # Закрываем окно демонстрации экрана
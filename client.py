@@ -19,13 +19,27 @@ from screen_sharing_window import ScreenSharingWindow
 from group_settings_dialog import GroupSettingsDialog
 import struct
 import zlib
+from audio_codec import (PcmCodec, available_codecs, choose_codec, create_codec,
+                         format_codec_list, make_comfort_noise, parse_codec_list, parse_comfort_noise, CODEC_PCM)
+from media_transport import MediaChannel
+from jitter_buffer import JitterBuffer, PLAYOUT_FRAME, PLAYOUT_CONCEAL, PLAYOUT_SILENCE
+from vad import VoiceActivityDetector, VAD_PAUSE, VAD_SILENCE, comfort_noise
+from protocol import (FrameDecoder, client_handshake, is_framed, send_binary, unpack_screen_frame, unpack_file_chunk,
+                      FRAME_TEXT, FRAME_AUDIO, FRAME_SCREEN, FRAME_FILE, SCREEN_GROUP, FILE_PERSONAL, FILE_GROUP,
+                      RECV_BUFFER_SIZE)
+from file_transfer import FileReceiver, FileSender, dispatch_file_reply
 from PyQt5.QtCore import QObject, pyqtSignal, QTimer
 from PyQt5.QtWidgets import QApplication
 
+# Период вывода статистики приема аудио во время звонка, сек
+AUDIO_STATS_INTERVAL = 10
+# Не отправлять блоки без речи (вместо них - маркер паузы с уровнем фонового шума)
+SILENCE_SUPPRESSION = os.environ.get("VOLUM_SILENCE_SUPPRESSION", "1") == "1"
 
 
 class ChatClient:
     def __init__(self, host, port):
+        self.server_host = host
         # Основное соединение
         self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.client.connect((host, port))
@@ -48,6 +62,14 @@ class ChatClient:
         self.group_call_client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1048576)
         self.group_call_client.connect((host, port + 3))  # Порт 5558
 
+        # Согласуем кадровый протокол; старый сервер не ответит на приветствие,
+        # тогда все соединения остаются на прежнем текстовом протоколе
+        self.client = client_handshake(self.client)
+        if is_framed(self.client):
+            self.screen_client = client_handshake(self.screen_client)
+            self.group_client = client_handshake(self.group_client)
+            self.group_call_client = client_handshake(self.group_call_client)
+
         self.username = None
         self.current_call = None
         self.call_recipient = None
@@ -63,11 +85,28 @@ class ChatClient:
         self.audio_thread = None
         self.is_mic_muted = False
         self.is_speaker_muted = False
+        # Кодек текущего звонка (согласуется в CALL_SIGNAL / GROUP_CALL_JOIN)
+        self.audio_codec = PcmCodec()
+        self.call_codec_offer = [CODEC_PCM]  # кодеки, предложенные звонящим
+        # Принятое аудио копится здесь и воспроизводится из обратного вызова PyAudio
+        self.jitter_buffer = JitterBuffer(*self.jitter_buffer_params(self.audio_codec))
+        self.last_audio_stats = 0
+        # Детектор речи текущей отправки (None - подавление пауз выключено)
+        self.vad = None
+        # Уровень комфортного шума, пока собеседник молчит (None - он говорит)
+        self.comfort_noise_level = None
+        # UDP-канал аудио текущего звонка (если сервер выдал токен), иначе аудио идет по TCP
+        self.media_channel = None
 
         # Флаги для демонстрации экрана
         self.is_sharing_screen = False
         self.is_receiving_screen = False
         self.screen_thread = None
+        # Окно, которое сейчас демонстрирует экран, получает подтверждения кадров от зрителей
+        self.screen_ack_handler = None
+        self.screen_keyframe_handler = None  # демонстрирующий: зритель просит ключевой кадр
+        # Принимаемые файлы (личные и групповые) пишутся на диск по мере получения
+        self.incoming_files = FileReceiver()
 
         self.init_audio_streams()
 
@@ -213,8 +252,11 @@ class ChatClient:
         """Запуск группового аудио через отдельный сокет"""
         print(f"[GROUP CALL AUDIO] Starting group call audio for group {group_id}")
 
-        # Присоединяемся к групповому звонку
+        # Присоединяемся к групповому звонку; кодеки предлагаем только серверу
+        # с кадровым протоколом (старый сервер не разберет лишнее поле)
         join_message = f"GROUP_CALL_JOIN:{group_id}"
+        if is_framed(self.group_call_client):
+            join_message += f":{format_codec_list(available_codecs())}"
         try:
             self.group_call_client.send(f"{join_message}\n".encode('utf-8'))
         except Exception as e:
@@ -224,7 +266,7 @@ class ChatClient:
         self.is_in_group_call = True
         self.current_group_call_id = group_id
         self.is_in_call = True  # Для работы send_audio
-        self.start_audio()
+        # Запись начинается после GROUP_CALL_JOINED, когда известен кодек звонка
 
     def stop_group_call_audio(self):
         print("[GROUP CALL AUDIO] Stopping group call audio")
@@ -240,6 +282,7 @@ class ChatClient:
         self.is_in_group_call = False
         self.current_group_call_id = None
         self.is_in_call = False  # Важно! Сбрасываем общий флаг звонка
+        self.close_media_channel()
 
         # Принудительно останавливаем и перезапускаем аудиопотоки
         self.stop_audio()
@@ -254,26 +297,146 @@ class ChatClient:
                 self.stream_input.close()
             if self.stream_output:
                 self.stream_output.close()
+            self.audio_codec = PcmCodec()
             self.init_audio_streams()
             print("[AUDIO FIX] Audio streams reinitialized after group call")
         except Exception as e:
             print(f"[AUDIO FIX ERROR] Failed to reinitialize audio: {e}")
 
     def init_audio_streams(self):
+        self.jitter_buffer.configure(*self.jitter_buffer_params(self.audio_codec))
         try:
             self.stream_input = self.p.open(format=pyaudio.paInt16,
                                             channels=1,
-                                            rate=44100,
+                                            rate=self.audio_codec.sample_rate,
                                             input=True,
-                                            frames_per_buffer=1024)
+                                            frames_per_buffer=self.audio_codec.frame_size)
+            # Вывод в режиме обратного вызова: PyAudio сам забирает блоки из буфера
+            # джиттера, сетевые потоки не ждут звуковую карту
             self.stream_output = self.p.open(format=pyaudio.paInt16,
                                              channels=1,
-                                             rate=44100,
+                                             rate=self.audio_codec.sample_rate,
                                              output=True,
-                                             frames_per_buffer=1024)
+                                             frames_per_buffer=self.audio_codec.frame_size,
+                                             stream_callback=self.playout_callback)
         except Exception as e:
             print(f"Ошибка инициализации аудиопотоков: {e}")
 
+    @staticmethod
+    def jitter_buffer_params(codec):
+        """Длительность блока и размер блока PCM (для сборки из порций старого протокола)"""
+        block_bytes = codec.frame_size * 2 if codec.name == CODEC_PCM else None
+        return codec.frame_size / codec.sample_rate, block_bytes
+
+    def receive_audio(self, data, seq=None, sent_at=None):
+        """Кладет принятое аудио в буфер джиттера (вызывается из сетевых потоков)"""
+        if self.stream_output and not self.is_speaker_muted:
+            self.jitter_buffer.push(data, seq, sent_at, parse_comfort_noise(data) is not None)
+
+    def open_media_channel(self, token, port):
+        """Открывает UDP-канал аудио по токену, выданному сервером"""
+        self.close_media_channel()
+        try:
+            channel = MediaChannel(self.server_host, port, token, self.receive_media_audio)
+            channel.start()
+            self.media_channel = channel
+            print(f"[MEDIA] Opened UDP media channel to port {port}")
+        except Exception as e:
+            print(f"[MEDIA] UDP is unavailable, using TCP for audio: {e}")
+
+    def close_media_channel(self):
+        if self.media_channel is not None:
+            self.media_channel.close()
+            self.media_channel = None
+
+    def receive_media_audio(self, seq, sent_at, payload):
+        if self.is_in_call or self.is_in_group_call:
+            self.receive_audio(payload, seq, sent_at)
+
+    def playout_callback(self, in_data, frame_count, time_info, status):
+        """Обратный вызов PyAudio: очередной блок из буфера джиттера или маскировка потери"""
+        codec = self.audio_codec
+        pcm = None
+        try:
+            kind, packet = self.jitter_buffer.pop()
+            if kind == PLAYOUT_FRAME:
+                level = parse_comfort_noise(packet)
+                if level is None:
+                    self.comfort_noise_level = None
+                    pcm = codec.decode(packet)
+                else:
+                    # Собеседник замолчал: вместо полной тишины - шум его уровня
+                    self.comfort_noise_level = level
+                    pcm = comfort_noise(frame_count, level)
+            elif kind == PLAYOUT_CONCEAL:
+                pcm = codec.conceal()
+            elif kind == PLAYOUT_SILENCE and self.comfort_noise_level is not None:
+                pcm = comfort_noise(frame_count, self.comfort_noise_level)
+        except Exception as e:
+            print(f"Ошибка воспроизведения аудио: {e}")
+
+        size = frame_count * 2
+        if pcm is None:
+            pcm = bytes(size)
+        elif len(pcm) != size:
+            pcm = pcm[:size].ljust(size, b"\0")
+        return pcm, pyaudio.paContinue
+
+    def report_audio_stats(self):
+        """Выводит состояние буфера джиттера и оценку задержки "от рта до уха".
+
+        В оценку входят длительность блока записи, задержки устройств ввода и
+        вывода и время ожидания в буфере джиттера; время в сети не учитывается.
+        """
+        stats = self.jitter_buffer.stats()
+        device_latency = 0.0
+        try:
+            if self.stream_input:
+                device_latency += self.stream_input.get_input_latency()
+            if self.stream_output:
+                device_latency += self.stream_output.get_output_latency()
+        except Exception:
+            pass
+        frame_ms = self.audio_codec.frame_size / self.audio_codec.sample_rate * 1000
+        transport = "udp" if self.media_channel is not None and self.media_channel.ready else "tcp"
+        if stats['transit_ms'] is not None:
+            # По UDP известно время отправки: сеть + буфер измерены, добавляем запись и устройства
+            latency = f"{frame_ms + device_latency * 1000 + stats['transit_ms']:.0f}ms"
+        else:
+            latency = f"{frame_ms + device_latency * 1000 + stats['delay_ms']:.0f}ms (+network)"
+        print(f"[AUDIO] transport={transport} depth={stats['depth']}/{stats['target']} "
+              f"jitter={stats['jitter_ms']:.1f}ms received={stats['received']} played={stats['played']} "
+              f"lost={stats['concealed']} late={stats['late']} "
+              f"buffer_delay={stats['delay_ms']:.0f}ms mouth_to_ear~{latency}")
+        if self.vad is not None:
+            vad_stats = self.vad.stats()
+            print(f"[AUDIO] vad speech={vad_stats['speech']} suppressed={vad_stats['suppressed']} "
+                  f"({vad_stats['suppressed_ratio'] * 100:.0f}%) noise_floor={vad_stats['noise_floor_db']:.0f}dBFS")
+
+    def set_audio_codec(self, name):
+        """Переключает кодек звонка; при смене частоты переоткрывает аудиопотоки"""
+        previous = self.audio_codec
+        codec = create_codec(name)
+        self.audio_codec = codec
+        print(f"[AUDIO] Using {codec.name} codec")
+
+        if (codec.sample_rate, codec.frame_size) == (previous.sample_rate, previous.frame_size):
+            self.jitter_buffer.configure(*self.jitter_buffer_params(codec))
+            return
+
+        was_recording = self.is_recording
+        self.stop_audio()
+        try:
+            if self.stream_input:
+                self.stream_input.close()
+            if self.stream_output:
+                self.stream_output.close()
+        except Exception as e:
+            print(f"[AUDIO] Error closing streams: {e}")
+        self.init_audio_streams()
+        if was_recording:
+            self.start_audio()
+
     def reset_audio_state(self):
         '''Полный сброс состояния аудио после группового звонка'''
         print("[AUDIO RESET] Resetting audio state")
@@ -286,6 +449,7 @@ class ChatClient:
         self.is_in_group_call = False
         self.current_group_call_id = None
         self.is_recording = False
+        self.close_media_channel()
 
         # Закрываем и переоткрываем аудиопотоки
         try:
@@ -301,6 +465,7 @@ class ChatClient:
         # Переинициализируем потоки
         import time
         time.sleep(0.2)  # Даем время на освобождение ресурсов
+        self.audio_codec = PcmCodec()
         self.init_audio_streams()
 
         print("[AUDIO RESET] Audio state reset complete")
@@ -324,6 +489,34 @@ class ChatClient:
             except Exception as e:
                 print(f"[GROUP ERROR] Failed to authenticate: {e}")
 
+    def send_friendship_changed(self, friend_username):
+        """Сообщает серверу о добавлении/удалении друга, чтобы он сбросил кэш дружбы"""
+        try:
+            self.client.send(f"FRIENDS_CHANGED:{self.username}:{friend_username}\n".encode("utf-8"))
+        except Exception as e:
+            print(f"[ERROR] Failed to send friends change notice: {e}")
+
+    def send_group_members_changed(self, group_id):
+        """Сообщает серверу об изменении состава группы, чтобы он сбросил кэш"""
+        try:
+            self.group_client.send(f"GROUP_MEMBERS_CHANGED:{group_id}\n".encode("utf-8"))
+        except Exception as e:
+            print(f"[GROUP ERROR] Failed to send members change notice: {e}")
+
+    def open_chat(self, peer):
+        """Сообщает серверу собеседника открытого личного чата"""
+        try:
+            self.client.send(f"CHAT_OPEN:{self.username}:{peer}\n".encode("utf-8"))
+        except Exception as e:
+            print(f"[ERROR] Failed to send chat open notice: {e}")
+
+    def close_chat(self):
+        """Сообщает серверу, что личный чат закрыт"""
+        try:
+            self.client.send(f"CHAT_CLOSE:{self.username}\n".encode("utf-8"))
+        except Exception as e:
+            print(f"[ERROR] Failed to send chat close notice: {e}")
+
     def send_direct_message(self, recipient, message):
         """Отправляет личное сообщение конкретному получателю"""
         try:
@@ -353,51 +546,15 @@ class ChatClient:
         except Exception as e:
             print(f"[GROUP ERROR] Failed to leave group: {e}")
 
-    def send_group_file(self, group_id, file_path):
-        """Отправляет файл в группу (идентично личным сообщениям)"""
+    def send_group_file(self, group_id, file_path, on_progress=None, on_done=None):
+        """Отправляет файл в группу в фоновом потоке; возвращает FileSender или None"""
         try:
-            # Получаем информацию о файле
-            file_name = os.path.basename(file_path)
-            file_size = os.path.getsize(file_path)
-
-            print(f"[GROUP FILE] Sending {file_name} to group {group_id}")
-
-            # Уведомляем о начале передачи файла в группу
-            file_info = f"GROUP_FILE_TRANSFER:START:{self.username}:{group_id}:{file_name}:{file_size}"
-            self.group_client.send(f"{file_info}\n".encode('utf-8'))
-
-            # Читаем и отправляем файл по частям (идентично личным сообщениям)
-            with open(file_path, 'rb') as f:
-                chunk_size = 4096  # 4KB части
-                while True:
-                    chunk = f.read(chunk_size)
-                    if not chunk:
-                        break
-
-                    # Кодируем часть в base64 (идентично личным сообщениям)
-                    import base64
-                    encoded_chunk = base64.b64encode(chunk).decode('utf-8').replace('\n', '')
-
-                    # Разбиваем большие части на более мелкие (идентично личным сообщениям)
-                    max_msg_size = 900
-                    for i in range(0, len(encoded_chunk), max_msg_size):
-                        sub_chunk = encoded_chunk[i:i + max_msg_size]
-                        chunk_msg = f"GROUP_FILE_TRANSFER:CHUNK:{self.username}:{group_id}:{sub_chunk}"
-                        self.group_client.send(f"{chunk_msg}\n".encode('utf-8'))
-
-                        # Небольшая задержка (идентично личным сообщениям)
-                        import time
-
-            # Уведомляем о завершении (идентично личным сообщениям)
-            end_msg = f"GROUP_FILE_TRANSFER:END:{self.username}:{group_id}:{file_name}"
-            self.group_client.send(f"{end_msg}\n".encode('utf-8'))
-
-            print(f"[GROUP FILE] Sent {file_name} to group {group_id}")
-            return True
-
+            print(f"[GROUP FILE] Sending {os.path.basename(file_path)} to group {group_id}")
+            return FileSender(self.group_client, FILE_GROUP, self.username, group_id, file_path,
+                              on_progress=on_progress, on_done=on_done).start()
         except Exception as e:
             print(f"[ERROR] Failed to send group file: {e}")
-            return False
+            return None
 
     def send_group_message(self, group_id, message):
         """Отправляет сообщение в группу"""
@@ -421,9 +578,12 @@ class ChatClient:
         except Exception as e:
             print(f"Ошибка отправки сообщения демонстрации экрана: {e}")
 
-    def send_call_signal(self, signal_type, recipient=None, duration=0):
+    def send_call_signal(self, signal_type, recipient=None, duration=0, codecs=None):
         recipient = recipient or self.call_recipient
         signal = f"CALL_SIGNAL:{signal_type}:{self.username}:{recipient}:{time.time()}:{duration}"
+        if codecs:
+            # Необязательное поле: предложенные (incoming_call) или выбранный (call_accepted) кодек
+            signal += f":{codecs}"
         self.send_message(signal)
         print(f"[CLIENT] Sent call signal: {signal_type} to {recipient}")
 
@@ -441,164 +601,189 @@ class ChatClient:
         """Возвращает сокет для демонстрации экрана"""
         return self.screen_client
 
-    def receive_messages(self, callback):
-        def handle_main_messages():
-            """Обрабатывает сообщения из основного соединения"""
-            buffer = ""
-            while True:
-                try:
-                    data = self.client.recv(1024)
-                    if not data:
-                        print("[CLIENT] Main connection closed by server")
-                        break
+    def iter_incoming(self, sock, recv_size):
+        """Читает сокет и выдает ("text", строка), ("screen", кадр экрана), ("file", часть файла) или ("binary", данные).
+
+        Для кадрового протокола тип данных берется из заголовка кадра,
+        для старого - текст определяется попыткой декодирования UTF-8.
+        Генератор завершается, когда сервер закрывает соединение.
+        """
+        buffer = ""
+        decoder = FrameDecoder() if is_framed(sock) else None
+        while True:
+            data = sock.recv(RECV_BUFFER_SIZE if decoder else recv_size)
+            if not data:
+                return
 
+            if decoder:
+                for frame_type, payload in decoder.feed(data):
+                    if frame_type == FRAME_SCREEN:
+                        yield "screen", payload
+                        continue
+                    if frame_type == FRAME_FILE:
+                        yield "file", payload
+                        continue
+                    if frame_type != FRAME_TEXT:
+                        yield "binary", payload
+                        continue
                     try:
-                        buffer += data.decode("utf-8")
-                        messages = buffer.split('\n')
-                        buffer = messages[-1]
-                        for message in messages[:-1]:
-                            if message:
-                                if message.startswith("GROUP_SCREEN_SIGNAL:"):
-                                    self.handle_group_screen_signal(message, callback)
-                                elif message.startswith("CALL_SIGNAL:"):
-                                    self.handle_call_signal(message, callback)
-                                elif message.startswith("FILE_TRANSFER:"):
-                                    callback(message)
-                                else:
-                                    callback(message)
+                        buffer += str(payload, "utf-8")
                     except UnicodeDecodeError:
+                        # Поврежденный кадр пропускаем, чтение продолжается
+                        print("[ERROR] Invalid UTF-8 in text frame")
+                        continue
+                    messages = buffer.split('\n')
+                    buffer = messages[-1]
+                    for message in messages[:-1]:
+                        if message:
+                            yield "text", message
+                continue
+
+            try:
+                buffer += data.decode("utf-8")
+            except UnicodeDecodeError:
+                yield "binary", data
+                continue
+            messages = buffer.split('\n')
+            buffer = messages[-1]
+            for message in messages[:-1]:
+                if message:
+                    yield "text", message
+
+    def receive_messages(self, callback):
+        def handle_main_messages():
+            """Обрабатывает сообщения из основного соединения"""
+            try:
+                for kind, message in self.iter_incoming(self.client, 1024):
+                    if kind == "text":
+                        if message.startswith("GROUP_SCREEN_SIGNAL:"):
+                            self.handle_group_screen_signal(message, callback)
+                        elif message.startswith("CALL_SIGNAL:"):
+                            self.handle_call_signal(message, callback)
+                        elif message.startswith("FILE_TRANSFER:"):
+                            callback(message)
+                        elif message.startswith(("FILE_ACCEPT:", "FILE_STORED:", "FILE_REJECT:")):
+                            dispatch_file_reply(message)
+                        else:
+                            callback(message)
+                    elif kind == "file":
+                        self.handle_file_chunk(message)
+                    else:
                         # Аудиоданные
-                        if self.is_in_call and self.stream_output and not self.is_speaker_muted:
-                            try:
-                                self.stream_output.write(data)
-                            except Exception as e:
-                                print(f"Ошибка воспроизведения аудио: {e}")
-                except Exception as e:
-                    print(f"Ошибка получения сообщений: {e}")
-                    break
+                        if self.is_in_call:
+                            self.receive_audio(message)
+                print("[CLIENT] Main connection closed by server")
+            except Exception as e:
+                print(f"Ошибка получения сообщений: {e}")
 
         def handle_screen_messages():
             """Обрабатывает сообщения из соединения демонстрации экрана"""
-            buffer = ""
             screen_data_buffers = {}
 
-            while True:
-                try:
-                    data = self.screen_client.recv(65536)
-                    if not data:
-                        print("[CLIENT] Screen connection closed by server")
-                        break
-
-                    try:
-                        # Пытаемся декодировать как текст
-                        buffer += data.decode("utf-8")
-                        messages = buffer.split('\n')
-                        buffer = messages[-1]
-                        for message in messages[:-1]:
-                            if message:
-                                if message.startswith("SCREEN_CONTROL:"):
-                                    self.handle_screen_control_signal(message, callback)
-                                elif message.startswith("SCREEN_DATA_START:"):
-                                    self.handle_screen_data_start(message, screen_data_buffers)
-                                elif message.startswith("SCREEN_DATA_CHUNK:"):
-                                    self.handle_screen_data_chunk(message, screen_data_buffers)
-                                elif message.startswith("SCREEN_DATA_END:"):
-                                    self.handle_screen_data_end(message, screen_data_buffers, callback)
-                                    # Обработка групповых данных экрана
-                                elif message.startswith("GROUP_SCREEN_DATA_START:"):
-                                    print(f"[GROUP SCREEN CLIENT] Received START: {message}")
-                                    if hasattr(self, 'chat_window') and self.chat_window:
-                                        self.chat_window.handle_group_screen_data(message)
-                                elif message.startswith("GROUP_SCREEN_DATA_CHUNK:"):
-                                    # Не логируем каждый chunk чтобы не засорять логи
-                                    if hasattr(self, 'chat_window') and self.chat_window:
-                                        self.chat_window.handle_group_screen_data(message)
-                                elif message.startswith("GROUP_SCREEN_DATA_END:"):
-                                    print(f"[GROUP SCREEN CLIENT] Received END: {message}")
-                                    if hasattr(self, 'chat_window') and self.chat_window:
-                                        self.chat_window.handle_group_screen_data(message)
-                    except UnicodeDecodeError:
+            try:
+                for kind, message in self.iter_incoming(self.screen_client, 65536):
+                    if kind == "text":
+                        if message.startswith("SCREEN_CONTROL:"):
+                            self.handle_screen_control_signal(message, callback)
+                        elif message.startswith("SCREEN_ACK:"):
+                            self.handle_screen_ack(message)
+                        elif message.startswith("SCREEN_KEYFRAME:"):
+                            self.handle_screen_keyframe_request(message)
+                        elif message.startswith("SCREEN_DATA_START:"):
+                            self.handle_screen_data_start(message, screen_data_buffers)
+                        elif message.startswith("SCREEN_DATA_CHUNK:"):
+                            self.handle_screen_data_chunk(message, screen_data_buffers)
+                        elif message.startswith("SCREEN_DATA_END:"):
+                            self.handle_screen_data_end(message, screen_data_buffers, callback)
+                            # Обработка групповых данных экрана
+                        elif message.startswith("GROUP_SCREEN_DATA_START:"):
+                            print(f"[GROUP SCREEN CLIENT] Received START: {message}")
+                            if hasattr(self, 'chat_window') and self.chat_window:
+                                self.chat_window.handle_group_screen_data(message)
+                        elif message.startswith("GROUP_SCREEN_DATA_CHUNK:"):
+                            # Не логируем каждый chunk чтобы не засорять логи
+                            if hasattr(self, 'chat_window') and self.chat_window:
+                                self.chat_window.handle_group_screen_data(message)
+                        elif message.startswith("GROUP_SCREEN_DATA_END:"):
+                            print(f"[GROUP SCREEN CLIENT] Received END: {message}")
+                            if hasattr(self, 'chat_window') and self.chat_window:
+                                self.chat_window.handle_group_screen_data(message)
+                    elif kind == "screen":
+                        self.handle_screen_frame(message)
+                    else:
                         # Это бинарные данные демонстрации экрана
                         if self.is_receiving_screen:
                             try:
                                 # Распаковываем данные
-                                decompressed_data = zlib.decompress(data)
+                                decompressed_data = zlib.decompress(message)
                                 callback(f"SCREEN_DATA:{decompressed_data}")
                             except Exception as e:
                                 print(f"[SCREEN ERROR] Error decompressing screen data: {e}")
-                except Exception as e:
-                    print(f"Ошибка получения сообщений демонстрации экрана: {e}")
-                    break
+                print("[CLIENT] Screen connection closed by server")
+            except Exception as e:
+                print(f"Ошибка получения сообщений демонстрации экрана: {e}")
 
         def handle_group_call_messages():
             """Обрабатывает сообщения из соединения групповых звонков"""
-            buffer = ""
-            while True:
-                try:
-                    data = self.group_call_client.recv(8192)
-                    if not data:
-                        print("[CLIENT] Group call connection closed by server")
-                        break
-
-                    try:
-                        buffer += data.decode("utf-8")
-                        messages = buffer.split('\n')
-                        buffer = messages[-1]
-                        for message in messages[:-1]:
-                            if message:
-                                if message.startswith("GROUP_CALL_AUTH_SUCCESS"):
-                                    print("[GROUP CALL] Authentication successful")
-                                elif message.startswith("GROUP_CALL_JOINED:"):
-                                    group_id = message.split(":", 1)[1]
-                                    print(f"[GROUP CALL] Joined call in group {group_id}")
-                                elif message.startswith("GROUP_CALL_LEFT:"):
-                                    group_id = message.split(":", 1)[1]
-                                    print(f"[GROUP CALL] Left call in group {group_id}")
-                                elif message.startswith("GROUP_CALL_STATUS:"):
-                                    callback(message)
-                    except UnicodeDecodeError:
+            try:
+                for kind, message in self.iter_incoming(self.group_call_client, 8192):
+                    if kind == "text":
+                        if message.startswith("GROUP_CALL_AUTH_SUCCESS"):
+                            print("[GROUP CALL] Authentication successful")
+                        elif message.startswith("GROUP_CALL_JOINED:"):
+                            # GROUP_CALL_JOINED:group_id[:codec[:media_token:media_port]]
+                            parts = message.split(":")
+                            group_id = parts[1]
+                            print(f"[GROUP CALL] Joined call in group {group_id}")
+                            self.set_audio_codec(parts[2] if len(parts) > 2 else CODEC_PCM)
+                            if len(parts) > 4 and self.is_in_group_call:
+                                self.open_media_channel(parts[3], int(parts[4]))
+                            if self.is_in_group_call:
+                                self.start_audio()
+                        elif message.startswith("GROUP_CALL_CODEC:"):
+                            # Сервер сменил кодек звонка (подключился участник без поддержки текущего)
+                            parts = message.split(":")
+                            if len(parts) > 2 and self.is_in_group_call:
+                                self.set_audio_codec(parts[2])
+                        elif message.startswith("GROUP_CALL_LEFT:"):
+                            group_id = message.split(":", 1)[1]
+                            print(f"[GROUP CALL] Left call in group {group_id}")
+                        elif message.startswith("GROUP_CALL_STATUS:"):
+                            callback(message)
+                    else:
                         # Аудиоданные для групповых звонков
-                        if self.is_in_group_call and self.stream_output and not self.is_speaker_muted:
-                            try:
-                                self.stream_output.write(data)
-                                print("[GROUP CALL AUDIO] Received and played audio")
-                            except Exception as e:
-                                print(f"[GROUP CALL AUDIO ERROR] Error playing audio: {e}")
-                except Exception as e:
-                    print(f"Ошибка получения сообщений групповых звонков: {e}")
-                    break
+                        if self.is_in_group_call:
+                            self.receive_audio(message)
+                print("[CLIENT] Group call connection closed by server")
+            except Exception as e:
+                print(f"Ошибка получения сообщений групповых звонков: {e}")
 
         def handle_group_messages():
             """Обрабатывает сообщения из группового чата"""
-            buffer = ""
-            while True:
-                try:
-                    data = self.group_client.recv(1024)
-                    if not data:
-                        print("[CLIENT] Group connection closed by server")
-                        break
-
-                    try:
-                        buffer += data.decode("utf-8")
-                        messages = buffer.split('\n')
-                        buffer = messages[-1]
-                        for message in messages[:-1]:
-                            if message:
-                                if message.startswith("GROUP_AUTH_SUCCESS"):
-                                    print("[GROUP] Authentication successful")
-                                elif message.startswith("GROUP_JOINED:"):
-                                    group_id = message.split(":", 1)[1]
-                                    callback(f"GROUP_JOINED:{group_id}")
-                                elif message.startswith("GROUP_LEFT:"):
-                                    group_id = message.split(":", 1)[1]
-                                    callback(f"GROUP_LEFT:{group_id}")
-                                elif message.startswith("GROUP_MESSAGE:"):
-                                    callback(message)
-                    except UnicodeDecodeError:
-                        pass
-                except Exception as e:
-                    print(f"Ошибка получения групповых сообщений: {e}")
-                    break
+            try:
+                for kind, message in self.iter_incoming(self.group_client, 1024):
+                    if kind == "file":
+                        self.handle_file_chunk(message)
+                        continue
+                    if kind != "text":
+                        continue
+                    if message.startswith("GROUP_FILE_TRANSFER:"):
+                        self.handle_group_file_transfer(message)
+                    elif message.startswith(("FILE_ACCEPT:", "FILE_STORED:", "FILE_REJECT:")):
+                        dispatch_file_reply(message)
+                    elif message.startswith("GROUP_AUTH_SUCCESS"):
+                        print("[GROUP] Authentication successful")
+                    elif message.startswith("GROUP_JOINED:"):
+                        group_id = message.split(":", 1)[1]
+                        callback(f"GROUP_JOINED:{group_id}")
+                    elif message.startswith("GROUP_LEFT:"):
+                        group_id = message.split(":", 1)[1]
+                        callback(f"GROUP_LEFT:{group_id}")
+                    elif message.startswith("GROUP_MESSAGE:"):
+                        callback(message)
+                print("[CLIENT] Group connection closed by server")
+            except Exception as e:
+                print(f"Ошибка получения групповых сообщений: {e}")
 
         # Запускаем оба потока
         main_thread = threading.Thread(target=handle_main_messages)
@@ -619,6 +804,51 @@ class ChatClient:
         group_call_thread.daemon = True
         group_call_thread.start()
 
+    def handle_screen_frame(self, payload):
+        """Передает кадр экрана (FRAME_SCREEN) потоку декодера окна демонстрации"""
+        frame = unpack_screen_frame(payload)
+        if frame is None:
+            print("[SCREEN ERROR] Malformed screen frame")
+            return
+        kind, sender, target, frame_id, image, delta = frame
+        if not self.chat_window:
+            return
+        if kind == SCREEN_GROUP:
+            try:
+                group_id = int(target)
+            except ValueError:
+                return
+            self.chat_window.route_screen_frame(sender, group_id, bytes(image), delta, frame_id)
+            self.send_screen_message(f"SCREEN_ACK:{self.username}:{sender}:{frame_id}:{group_id}")
+        elif target == self.username:
+            self.chat_window.route_screen_frame(sender, None, bytes(image), delta, frame_id)
+            self.send_screen_message(f"SCREEN_ACK:{self.username}:{sender}:{frame_id}")
+
+    def handle_screen_ack(self, message):
+        """Подтверждение кадра от зрителя: SCREEN_ACK:viewer:sender:frame_id[:group_id]"""
+        parts = message.split(":")
+        if len(parts) < 4 or parts[2] != self.username or self.screen_ack_handler is None:
+            return
+        try:
+            self.screen_ack_handler(parts[1], int(parts[3]))
+        except ValueError:
+            print(f"[SCREEN ERROR] Invalid screen ack: {message}")
+
+    def request_screen_keyframe(self, sender, group_id=None):
+        """Просит демонстрирующего прислать ключевой кадр: SCREEN_KEYFRAME:viewer:sender[:group_id]"""
+        request = f"SCREEN_KEYFRAME:{self.username}:{sender}"
+        if group_id is not None:
+            request += f":{group_id}"
+        self.send_screen_message(request)
+
+    def handle_screen_keyframe_request(self, message):
+        """Зритель пропустил разностный кадр: SCREEN_KEYFRAME:viewer:sender[:group_id]"""
+        parts = message.split(":")
+        if len(parts) < 3 or parts[2] != self.username or self.screen_keyframe_handler is None:
+            return
+        print(f"[SCREEN] {parts[1]} requested a keyframe")
+        self.screen_keyframe_handler()
+
     def handle_screen_data_start(self, message, screen_data_buffers):
         """Обрабатывает начало передачи кадра"""
         try:
@@ -675,7 +905,7 @@ class ChatClient:
             print(f"[SCREEN ERROR] Error handling screen data end: {e}")
 
     def handle_group_file_transfer(self, message):
-        """Обрабатывает передачу файлов в группах с безопасностью потоков"""
+        """Обрабатывает передачу файлов в группах (вызывается из потока группового чата)"""
         try:
             parts = message.split(":", 4)
             if len(parts) < 5:
@@ -686,82 +916,78 @@ class ChatClient:
             sender = parts[2]
             group_id = int(parts[3])
 
-            # Проверяем, что это наша текущая группа
-            if not self.current_group or self.current_group['id'] != group_id:
-                return
-
             # Обрабатываем только если мы НЕ отправитель
             if sender == self.username:
                 return
 
             if action == "START":
-                file_info = parts[4].split(":", 1)
+                # Начинаем прием, только если это наша текущая группа
+                window = self.chat_window
+                if not window or not window.current_group or window.current_group['id'] != group_id:
+                    return
+
+                # START:отправитель:группа:имя:размер[:номер передачи[:sha256]]
+                file_info = parts[4].split(":")
                 file_name = file_info[0]
                 try:
                     file_size = int(file_info[1])
-                except ValueError:
+                except (IndexError, ValueError):
                     file_size = 0
+                transfer_id = int(file_info[2]) if len(file_info) > 2 else None
+                digest = file_info[3] if len(file_info) > 3 else None
 
-                # Создаем временный файл для входящих данных
-                self.incoming_group_file = {
-                    "name": file_name,
-                    "size": file_size,
-                    "sender": sender,
-                    "group_id": group_id,
-                    "data": bytearray(),
-                    "path": os.path.join("downloads", file_name)
-                }
-
-                # Создаем директорию, если не существует
-                os.makedirs("downloads", exist_ok=True)
-
+                self.incoming_files.start((FILE_GROUP, sender, str(group_id), transfer_id), file_name, file_size,
+                                          sender, digest)
                 print(f"[GROUP FILE] Starting to receive {file_name} from {sender}")
 
-            elif action == "CHUNK" and hasattr(self, "incoming_group_file"):
-                # Декодируем и добавляем часть файла
-                encoded_chunk = parts[4]
+            elif action == "CHUNK":
+                # Строки base64 приходят только от передач без номера (старый протокол)
                 try:
-                    encoded_chunk = encoded_chunk.replace(' ', '').replace('\n', '').replace('\r', '')
-                    padding = 4 - (len(encoded_chunk) % 4) if len(encoded_chunk) % 4 != 0 else 0
-                    encoded_chunk += '=' * padding
-
-                    import base64
-                    chunk_data = base64.b64decode(encoded_chunk)
-                    self.incoming_group_file["data"].extend(chunk_data)
+                    self.incoming_files.write_text((FILE_GROUP, sender, str(group_id), None), parts[4])
                 except Exception as e:
                     print(f"[ERROR] Failed to decode group file chunk: {e}")
 
-            elif action == "END" and hasattr(self, "incoming_group_file"):
-                file_name = parts[4]
+            elif action == "END":
+                # END:отправитель:группа:имя[:номер передачи]
+                end_info = parts[4].split(":")
+                file_name = end_info[0]
+                transfer_id = int(end_info[1]) if len(end_info) > 1 else None
 
                 try:
-                    # Сохраняем полный файл
-                    with open(self.incoming_group_file["path"], "wb") as f:
-                        f.write(self.incoming_group_file["data"])
+                    path = self.incoming_files.finish((FILE_GROUP, sender, str(group_id), transfer_id))
+                    if path is None:
+                        return
 
                     print(f"[GROUP FILE] Saved file {file_name} from {sender}")
 
-                    # Проверяем, является ли файл изображением
-                    is_image = file_name.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp'))
-
-                    # Используем сигнал для безопасного обновления UI
-                    if is_image:
-                        # Создаем уменьшенную копию в фоновом потоке
-                        scaled_path = self.create_scaled_image_safe(self.incoming_group_file["path"])
+                    window = self.chat_window
+                    if window:
+                        # Уменьшенная копия для отображения в чате
+                        if file_name.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')):
+                            window.create_scaled_image(path)
 
-                    # Используем сигнал для обновления UI из главного потока
-                    # Эмитируем сигнал для обновления отображения файлов
-                    self.update_ui_signal.emit("refresh_file_display", None)
+                        # Используем сигнал для обновления UI из главного потока
+                        window.update_ui_signal.emit("refresh_file_display", None)
 
                 except Exception as e:
                     print(f"[ERROR] Failed to save group file: {e}")
 
-                # Очищаем
-                del self.incoming_group_file
-
         except Exception as e:
             print(f"[ERROR] Error handling group file transfer: {e}")
 
+    def handle_file_chunk(self, payload):
+        """Часть файла кадром FRAME_FILE - сразу на диск, во временный файл своей передачи"""
+        chunk = unpack_file_chunk(payload)
+        if chunk is None:
+            print("[FILE ERROR] Malformed file chunk")
+            return
+        kind, sender, target, transfer_id, offset, data = chunk
+        try:
+            self.incoming_files.write((kind, sender, target, transfer_id), offset, data)
+        except Exception as e:
+            print(f"[FILE ERROR] Failed to write file chunk: {e}")
+            self.incoming_files.abort((kind, sender, target, transfer_id))
+
     def handle_screen_control_signal(self, message, callback):
         """Обрабатывает сигналы управления демонстрацией экрана"""
         try:
@@ -815,6 +1041,7 @@ class ChatClient:
             if signal_type == "incoming_call":
                 # Если мы получатель звонка
                 if recipient == self.username:
+                    self.call_codec_offer = parse_codec_list(parts[5]) if len(parts) > 5 else [CODEC_PCM]
                     print(f"[CLIENT] Showing incoming call from {sender}")
                     callback(f"INCOMING_CALL:{sender}")
                 # Если мы звонящий, обновляем UI
@@ -823,6 +1050,10 @@ class ChatClient:
                     callback(f"OUTGOING_CALL:{recipient}")
             # Обрабатываем принятие звонка
             elif signal_type == "call_accepted":
+                if recipient == self.username and sender == self.call_recipient:
+                    # Собеседник выбрал кодек из нашего предложения (старый клиент - PCM)
+                    codec = parts[5] if len(parts) > 5 else CODEC_PCM
+                    self.set_audio_codec(choose_codec([codec], available_codecs(is_framed(self.client))))
                 if (sender == self.username and recipient == self.call_recipient) or \
                         (recipient == self.username and sender == self.call_recipient):
                     callback(f"CALL_ACCEPTED:{sender if recipient == self.username else recipient}")
@@ -833,12 +1064,17 @@ class ChatClient:
                     callback(f"CALL_REJECTED:{sender if recipient == self.username else recipient}")
                 if sender == self.username:
                     self.call_recipient = None
+            # Сервер выдал токен UDP-сессии: CALL_SIGNAL:media_session:партнер:мы:время:0:токен:порт
+            elif signal_type == "media_session":
+                if recipient == self.username and sender == self.call_recipient and len(parts) > 7:
+                    self.open_media_channel(parts[6], int(parts[7]))
             # Обрабатываем завершение звонка
             elif signal_type == "call_ended":
                 if self.call_recipient == sender or self.username == recipient or sender == self.call_recipient:
                     callback(f"CALL_ENDED:{sender}:{duration}")
                     self.call_recipient = None
                     self.is_in_call = False
+                    self.close_media_channel()
                     self.stop_audio()
                     # Останавливаем демонстрацию экрана при завершении звонка
                     self.is_sharing_screen = False
@@ -849,30 +1085,61 @@ class ChatClient:
                     callback(f"CALL_ENDED:{sender}:{duration}")
                     self.call_recipient = None
                     self.is_in_call = False
+                    self.close_media_channel()
                     self.stop_audio()
                     self.is_sharing_screen = False
                     self.is_receiving_screen = False
         except Exception as e:
             print(f"Ошибка обработки сигнала звонка: {e}")
 
+    def silence_suppression_enabled(self):
+        """Маркер паузы понимают только клиенты нового протокола - старому серверу шлем поток как раньше"""
+        audio_socket = self.group_call_client if self.is_in_group_call else self.client
+        return SILENCE_SUPPRESSION and is_framed(audio_socket)
+
     def send_audio(self):
         """метод отправки аудио"""
+        codec = self.audio_codec
+        self.vad = None
+        if self.silence_suppression_enabled():
+            self.vad = VoiceActivityDetector(codec.frame_size / codec.sample_rate)
         while self.is_recording and (self.is_in_call or self.is_in_group_call):
+            if time.time() - self.last_audio_stats >= AUDIO_STATS_INTERVAL:
+                self.last_audio_stats = time.time()
+                self.report_audio_stats()
             try:
                 if not self.is_mic_muted:
-                    data = self.stream_input.read(1024, exception_on_overflow=False)
+                    codec = self.audio_codec
+                    pcm = self.stream_input.read(codec.frame_size, exception_on_overflow=False)
+                    decision = self.vad.process(pcm) if self.vad is not None else None
+                    if decision == VAD_SILENCE:
+                        continue
+                    if decision == VAD_PAUSE:
+                        data = make_comfort_noise(self.vad.noise_floor_db)
+                    else:
+                        data = codec.encode(pcm)
+
+                    media_channel = self.media_channel
+                    if media_channel is not None and media_channel.ready:
+                        # UDP: потерянный пакет не задерживает следующие
+                        try:
+                            media_channel.send(data)
+                            continue
+                        except OSError as e:
+                            print(f"[MEDIA] UDP send failed, falling back to TCP: {e}")
+                            self.close_media_channel()
 
                     if self.is_in_group_call and self.current_group_call_id:
                         # Отправляем аудио через отдельный сокет групповых звонков
                         try:
-                            self.group_call_client.send(data)
+                            send_binary(self.group_call_client, FRAME_AUDIO, data)
                             print(f"[GROUP CALL AUDIO] Sent audio to group {self.current_group_call_id}")
                         except Exception as e:
                             print(f"[GROUP CALL AUDIO ERROR] Failed to send audio: {e}")
                             break
                     else:
                         # Обычный личный звонок через основной сокет
-                        self.client.send(data)
+                        send_binary(self.client, FRAME_AUDIO, data)
                 else:
                     time.sleep(0.1)
             except Exception as e:
@@ -892,6 +1159,9 @@ class ChatClient:
         if self.audio_thread:
             self.audio_thread.join(timeout=1.0)
             self.audio_thread = None
+            self.report_audio_stats()
+            self.jitter_buffer.reset()
+            self.comfort_noise_level = None
             print("[CLIENT] Stopped audio stream")
 
     def set_mic_muted(self, is_muted):
@@ -909,6 +1179,8 @@ class ChatClient:
         else:
             if self.stream_output and not self.stream_output.is_active():
                 try:
+                    # Накопленное за время выключения не воспроизводим
+                    self.jitter_buffer.reset()
                     self.stream_output.start_stream()
                 except Exception as e:
                     print(f"[ERROR] Failed to start audio stream: {e}")
@@ -918,7 +1190,8 @@ class ChatClient:
         if self.is_in_call:
             return False
         self.call_recipient = recipient
-        self.send_call_signal("incoming_call", recipient)
+        self.send_call_signal("incoming_call", recipient,
+                              codecs=format_codec_list(available_codecs(is_framed(self.client))))
         return True
 
     def accept_call(self, caller):
@@ -926,7 +1199,9 @@ class ChatClient:
             return False
         self.call_recipient = caller
         self.is_in_call = True
-        self.send_call_signal("call_accepted", caller)
+        codec = choose_codec(self.call_codec_offer, available_codecs(is_framed(self.client)))
+        self.set_audio_codec(codec)
+        self.send_call_signal("call_accepted", caller, codecs=codec)
         self.start_audio()
         return True
 
@@ -937,6 +1212,7 @@ class ChatClient:
         if self.call_recipient:
             self.send_call_signal("call_ended", self.call_recipient, duration)
             self.is_in_call = False
+            self.close_media_channel()
             self.stop_audio()
             self.is_sharing_screen = False
             self.is_receiving_screen = False
@@ -948,6 +1224,9 @@ class ChatWindow(QtWidgets.QWidget):
     group_screen_stop_signal = QtCore.pyqtSignal(str, int)  # sender, group_id
     group_screen_data_signal = QtCore.pyqtSignal(str)  # message
     update_ui_signal = QtCore.pyqtSignal(str, object)
+    # ход отправки файла (FileSender) и ее завершение: передача, ошибка или None
+    file_progress_signal = QtCore.pyqtSignal(object)
+    file_sent_signal = QtCore.pyqtSignal(object, object)
     # сигнал для обновления чата
     refresh_chat_signal = QtCore.pyqtSignal()
 
@@ -990,6 +1269,9 @@ class ChatWindow(QtWidgets.QWidget):
 
         # Подключаем сигналы
         self.update_ui_signal.connect(self.update_ui)
+        self.file_progress_signal.connect(self.update_file_progress)
+        self.file_sent_signal.connect(self.finish_file_transfer)
+        self.file_progress_bars = {}  # номер передачи -> полоса хода отправки файла
 
         # Подключаем сигнал для обновления чата
         self.refresh_chat_signal.connect(self.refresh_chat_safe)
@@ -1698,6 +1980,7 @@ class ChatWindow(QtWidgets.QWidget):
     def on_group_created(self, group_data):
         """Обработчик создания новой группы"""
         print(f"[GROUP] Created new group: {group_data['name']}")
+        self.client.send_group_members_changed(group_data['id'])
 
         # Загружаем и отображаем созданные группы
         # Убираем дублирующий вызов load_user_groups()
@@ -1785,7 +2068,7 @@ class ChatWindow(QtWidgets.QWidget):
         # Закрываем личный чат при открытии группового
         if self.current_chat_with:
             print(f"[CHAT] Closing personal chat with {self.current_chat_with} to open group chat")
-            self.current_chat_with = None
+            self.close_personal_chat()
 
         # Переключаемся на экран чата
         if self.content_stack.currentIndex() == 0:
@@ -1917,6 +2200,7 @@ class ChatWindow(QtWidgets.QWidget):
     def on_group_left(self, group_id):
         """Обработчик выхода из группы"""
         print(f"[GROUP] Left group: {group_id}")
+        self.client.send_group_members_changed(group_id)
 
         # Если покинутая группа была открыта, закрываем чат
         if self.current_group and self.current_group['id'] == group_id:
@@ -1948,6 +2232,7 @@ class ChatWindow(QtWidgets.QWidget):
     def on_group_deleted(self, group_id):
         """Обработчик удаления группы"""
         print(f"[GROUP] Group deleted: {group_id}")
+        self.client.send_group_members_changed(group_id)
 
         # Если удаленная группа была открыта, закрываем чат
         if self.current_group and self.current_group['id'] == group_id:
@@ -2034,6 +2319,24 @@ class ChatWindow(QtWidgets.QWidget):
         except Exception as e:
             print(f"[GROUP SCREEN ERROR] Error handling data safely: {e}")
 
+    def route_screen_frame(self, sender, group_id, image, delta, frame_id=None):
+        """Кадр демонстрации экрана (бинарный протокол) из сетевого потока.
+
+        Окно только ставит кадр в очередь своего потока декодера, поэтому
+        главный поток не занят декодированием и не копит очередь кадров.
+        """
+        try:
+            if group_id is None:
+                if self.screen_sharing_window and not self.screen_sharing_window.is_sender:
+                    self.screen_sharing_window.display_screen_frame(image, delta, frame_id)
+                return
+            if sender == self.username or not self.current_group or self.current_group['id'] != group_id:
+                return
+            if self.group_screen_window:
+                self.group_screen_window.process_group_screen_frame(sender, group_id, image, delta, frame_id)
+        except Exception as e:
+            print(f"[SCREEN ERROR] Error handling screen frame: {e}")
+
     def delete_message(self):
         """Удаляет выбранное сообщение"""
         # Запрашиваем подтверждение
@@ -2265,6 +2568,8 @@ class ChatWindow(QtWidgets.QWidget):
             self.stop_screen_sharing_receiver()
         elif action == "screen_data":
             self.process_screen_data(data)
+        elif action == "refresh_file_display":
+            self.refresh_file_display()
 
     def handle_group_exclusion(self, group_name, group_id):
         """Обрабатывает исключение пользователя из группы"""
@@ -2517,6 +2822,7 @@ class ChatWindow(QtWidgets.QWidget):
         if self.connection:
             dialog = FriendsDialog(self.connection, self.username, self)
             dialog.friendsUpdated.connect(self.load_friends)
+            dialog.friendshipChanged.connect(self.client.send_friendship_changed)
             dialog.exec_()
 
     def handle_call_ended(self, duration):
@@ -2594,7 +2900,7 @@ class ChatWindow(QtWidgets.QWidget):
             self.handle_group_screen_data(message)
         # Обработка групповых файлов
         if message.startswith("GROUP_FILE_TRANSFER:"):
-            self.handle_group_file_transfer(message)
+            self.client.handle_group_file_transfer(message)
             return
         # Обработка групповых сообщений
         if message.startswith("GROUP_MESSAGE:"):
@@ -2673,64 +2979,50 @@ class ChatWindow(QtWidgets.QWidget):
 
             # Обрабатываем только если мы получатель
             if recipient == self.username:
+                incoming_files = self.client.incoming_files
                 if action == "START":
-                    file_info = parts[4].split(":", 1)
+                    # START:отправитель:получатель:имя:размер[:номер передачи[:sha256]]
+                    file_info = parts[4].split(":")
                     file_name = file_info[0]
                     try:
                         file_size = int(file_info[1])
-                    except ValueError:
-                        print(f"[ОШИБКА] Неверный формат размера файла: {file_info[1]}")
+                    except (IndexError, ValueError):
+                        print(f"[ОШИБКА] Неверный формат размера файла: {parts[4]}")
                         file_size = 0
+                    transfer_id = int(file_info[2]) if len(file_info) > 2 else None
+                    digest = file_info[3] if len(file_info) > 3 else None
 
-                    # Создаем временный файл для хранения входящих данных
-                    self.incoming_file = {
-                        "name": file_name,
-                        "size": file_size,
-                        "sender": sender,
-                        "data": bytearray(),
-                        "path": os.path.join("downloads", file_name)
-                    }
-
-                    # Убеждаемся, что директория downloads существует
-                    os.makedirs("downloads", exist_ok=True)
+                    try:
+                        incoming_files.start((FILE_PERSONAL, sender, recipient, transfer_id), file_name, file_size,
+                                             sender, digest)
+                    except Exception as e:
+                        print(f"[ОШИБКА] Не удалось начать прием файла {file_name}: {e}")
+                        return
 
                     # Уведомляем UI
                     self.update_ui_signal.emit("display_message",
                                                f"Система: Получение файла {file_name} от {sender}...")
 
-                elif action == "CHUNK" and hasattr(self, "incoming_file"):
-                    # Декодируем и добавляем часть файла
-                    encoded_chunk = parts[4]
+                elif action == "CHUNK":
+                    # Строки base64 приходят только от передач без номера (старый протокол)
                     try:
-                        # Удаляем все пробелы и переносы строк, которые могли появиться при передаче
-                        encoded_chunk = encoded_chunk.replace(' ', '').replace('\n', '').replace('\r', '')
-
-                        # Проверяем, что длина строки кратна 4, иначе дополняем символами '='
-                        padding = 4 - (len(encoded_chunk) % 4) if len(encoded_chunk) % 4 != 0 else 0
-                        encoded_chunk += '=' * padding
-
-                        # Декодируем данные
-                        try:
-                            chunk_data = base64.b64decode(encoded_chunk)
-                            self.incoming_file["data"].extend(chunk_data)
-                        except Exception as e:
-                            print(f"[ОШИБКА] Не удалось декодировать часть файла: {e}")
-                            print(f"Длина части: {len(encoded_chunk)}, Первые 20 символов: {encoded_chunk[:20]}")
+                        incoming_files.write_text((FILE_PERSONAL, sender, recipient, None), parts[4])
                     except Exception as e:
-                        print(f"[ОШИБКА] Ошибка обработки части файла: {e}")
+                        print(f"[ОШИБКА] Не удалось декодировать часть файла: {e}")
 
-                elif action == "END" and hasattr(self, "incoming_file"):
-                    file_name = parts[4]
-
-                    # Убеждаемся, что директория downloads существует
-                    os.makedirs("downloads", exist_ok=True)
+                elif action == "END":
+                    # END:отправитель:получатель:имя[:номер передачи]
+                    end_info = parts[4].split(":")
+                    file_name = end_info[0]
+                    transfer_id = int(end_info[1]) if len(end_info) > 1 else None
 
                     try:
-                        # Сохраняем полный файл
-                        with open(self.incoming_file["path"], "wb") as f:
-                            f.write(self.incoming_file["data"])
+                        # Файл уже на диске: остается проверить размер и переименовать
+                        path = incoming_files.finish((FILE_PERSONAL, sender, recipient, transfer_id))
+                        if path is None:
+                            return
 
-                        print(f"[ФАЙЛ] Сохранен файл {file_name} от {sender} в {self.incoming_file['path']}")
+                        print(f"[ФАЙЛ] Сохранен файл {file_name} от {sender} в {path}")
 
                         # Проверяем, является ли файл изображением
                         is_image = file_name.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp'))
@@ -2744,7 +3036,7 @@ class ChatWindow(QtWidgets.QWidget):
                                                        f"{sender}: [Вложение: {file_name}]")
 
                             # Создаем уменьшенную копию изображения
-                            self.create_scaled_image(self.incoming_file["path"])
+                            self.create_scaled_image(path)
                         else:
                             self.update_ui_signal.emit("display_message",
                                                        f"Система: Файл {file_name} от {sender} получен и сохранен в папке downloads")
@@ -2756,9 +3048,6 @@ class ChatWindow(QtWidgets.QWidget):
                         self.update_ui_signal.emit("display_message",
                                                    f"Система: Ошибка при сохранении файла {file_name}: {str(e)}")
 
-                    # Очищаем
-                    del self.incoming_file
-
             return
 
         # Обработка уведомлений о редактировании и удалении сообщений
@@ -2818,7 +3107,7 @@ class ChatWindow(QtWidgets.QWidget):
         # Убеждаемся, что одновременно активен только один тип чата
         if self.current_chat_with and self.current_group:
             print("[WARNING] Both personal and group chat active - prioritizing group")
-            self.current_chat_with = None
+            self.close_personal_chat()
 
         def auto_scroll():
             """Функция для автоматической прокрутки"""
@@ -3400,7 +3689,9 @@ class ChatWindow(QtWidgets.QWidget):
                             content = f"[Вложение: {file_name}]"
 
                         # Потом отправляем файл
-                        success = self.client.send_group_file(self.current_group['id'], self.current_attachment)
+                        success = self.client.send_group_file(self.current_group['id'], self.current_attachment,
+                                                              on_progress=self.file_progress_signal.emit,
+                                                              on_done=self.file_sent_signal.emit)
                         if not success:
                             print(f"[ERROR] Failed to send file to group {self.current_group['id']}")
 
@@ -3521,7 +3812,6 @@ class ChatWindow(QtWidgets.QWidget):
         try:
             # Получаем информацию о файле
             file_name = os.path.basename(file_path)
-            file_size = os.path.getsize(file_path)
 
             # Создаем директорию downloads, если она не существует
             os.makedirs("downloads", exist_ok=True)
@@ -3537,36 +3827,9 @@ class ChatWindow(QtWidgets.QWidget):
                 if file_name.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')):
                     self.create_scaled_image(destination)
 
-            # Уведомляем получателя о входящем файле
-            file_info = f"FILE_TRANSFER:START:{self.username}:{recipient}:{file_name}:{file_size}"
-            self.client.send_message(file_info)
-
-            # Читаем и отправляем файл по частям
-            with open(file_path, 'rb') as f:
-                chunk_size = 4096  # 4KB части
-                while True:
-                    chunk = f.read(chunk_size)
-                    if not chunk:
-                        break
-
-                # Кодируем часть в base64, убедившись что нет переносов строк
-                encoded_chunk = base64.b64encode(chunk).decode('utf-8').replace('\n', '')
-
-                # Разбиваем большие части на более мелкие для надежной передачи
-                max_msg_size = 900  # Максимальный размер сообщения
-                for i in range(0, len(encoded_chunk), max_msg_size):
-                    sub_chunk = encoded_chunk[i:i + max_msg_size]
-                    chunk_msg = f"FILE_TRANSFER:CHUNK:{self.username}:{recipient}:{sub_chunk}"
-                    self.client.send_message(chunk_msg)
-
-                    # Добавляем небольшую задержку, чтобы не перегружать сеть
-                    QtCore.QThread.msleep(20)
-
-            # Уведомляем о завершении
-            end_msg = f"FILE_TRANSFER:END:{self.username}:{recipient}:{file_name}"
-            self.client.send_message(end_msg)
-
-            print(f"[ФАЙЛ] Отправлен {file_name} пользователю {recipient}")
+            # Файл уходит в фоновом потоке, ход отправки показывается полосой под чатом
+            FileSender(self.client.client, FILE_PERSONAL, self.username, recipient, file_path,
+                       on_progress=self.file_progress_signal.emit, on_done=self.file_sent_signal.emit).start()
 
         except Exception as e:
             print(f"[ОШИБКА] Не удалось отправить файл: {e}")
@@ -3576,6 +3839,29 @@ class ChatWindow(QtWidgets.QWidget):
         </div>
         """)
 
+    def update_file_progress(self, sender):
+        """Полоса хода отправки файла (слот file_progress_signal)"""
+        bar = self.file_progress_bars.get(sender.transfer_id)
+        if bar is None:
+            bar = QtWidgets.QProgressBar(self)
+            bar.setFormat(f"{sender.name}: %p%")
+            bar.setMaximumHeight(18)
+            self.chat_layout.insertWidget(self.chat_layout.count() - 1, bar)
+            self.file_progress_bars[sender.transfer_id] = bar
+        bar.setValue(int(sender.sent * 100 / sender.size) if sender.size else 100)
+
+    def finish_file_transfer(self, sender, error):
+        """Отправка файла завершена (слот file_sent_signal)"""
+        bar = self.file_progress_bars.pop(sender.transfer_id, None)
+        if bar is not None:
+            bar.deleteLater()
+        if error is not None:
+            self.text_display.append(f"""
+        <div style='margin: 10px 0; text-align: center; color: red;'>
+            Не удалось отправить файл {sender.name}: {error}
+        </div>
+        """)
+
     def open_attachment_dialog(self):
         """Открывает диалог выбора вложения"""
         dialog = AttachmentDialog(self)
@@ -3903,6 +4189,7 @@ class ChatWindow(QtWidgets.QWidget):
     def open_friend_search(self):
         if self.connection:
             dialog = FriendSearchDialog(self.connection, self.username)
+            dialog.friendshipChanged.connect(self.client.send_friendship_changed)
             dialog.exec_()
             self.load_friends()
 
@@ -3910,6 +4197,8 @@ class ChatWindow(QtWidgets.QWidget):
         if self.connection:
             dialog = NotificationDialog(self.connection, self.username)
             dialog.friendsUpdated.connect(self.load_friends)
+            dialog.friendshipChanged.connect(self.client.send_friendship_changed)
+            dialog.groupMembershipChanged.connect(self.client.send_group_members_changed)
 
             # Подключаем сигнал для открытия чата
             dialog.openChatRequested.connect(self.open_chat_with)
@@ -3946,73 +4235,31 @@ class ChatWindow(QtWidgets.QWidget):
             friend_requests_count = cursor.fetchone()[0]
 
             # Приглашения в группы
-            # Проверяем существование таблицы group_invites
-            cursor.execute("""
-                SELECT EXISTS (
-                    SELECT FROM information_schema.tables 
-                    WHERE table_name = 'group_invites'
-                )
-            """)
-            group_invites_table_exists = cursor.fetchone()[0]
-
-            group_invites_count = 0
-            if group_invites_table_exists:
-                cursor.execute(
-                    "SELECT COUNT(*) FROM group_invites WHERE invitee = %s AND status = 'pending'",
-                    (self.username,)
-                )
-                group_invites_count = cursor.fetchone()[0]
+            cursor.execute(
+                "SELECT COUNT(*) FROM group_invites WHERE invitee = %s AND status = 'pending'",
+                (self.username,)
+            )
+            group_invites_count = cursor.fetchone()[0]
 
             # Пропущенные звонки
-            # Проверяем существование таблицы call_logs и колонки notification_seen
-            cursor.execute("""
-                SELECT EXISTS (
-                    SELECT FROM information_schema.tables 
-                    WHERE table_name = 'call_logs'
-                )
-            """)
-            call_logs_exists = cursor.fetchone()[0]
-
-            missed_calls_count = 0
-            if call_logs_exists:
-                cursor.execute("""
-                    SELECT EXISTS (
-                        SELECT FROM information_schema.columns 
-                        WHERE table_name = 'call_logs' AND column_name = 'notification_seen'
-                    )
-                """)
-                has_notification_seen = cursor.fetchone()[0]
-
-                if has_notification_seen:
-                    cursor.execute(
-                        """
-                        SELECT COUNT(*) FROM call_logs 
-                        WHERE recipient = %s AND status = 'missed' AND notification_seen = FALSE
-                        """,
-                        (self.username,)
-                    )
-                    missed_calls_count = cursor.fetchone()[0]
+            cursor.execute(
+                """
+                SELECT COUNT(*) FROM call_logs 
+                WHERE recipient = %s AND status = 'missed' AND notification_seen = FALSE
+                """,
+                (self.username,)
+            )
+            missed_calls_count = cursor.fetchone()[0]
 
             # Непрочитанные сообщения
-            # Проверяем наличие колонки read в таблице messages
-            cursor.execute("""
-                SELECT EXISTS (
-                    SELECT FROM information_schema.columns 
-                    WHERE table_name = 'messages' AND column_name = 'read'
-                )
-            """)
-            has_read_column = cursor.fetchone()[0]
-
-            unread_messages_count = 0
-            if has_read_column:
-                cursor.execute(
-                    """
-                    SELECT COUNT(*) FROM messages 
-                    WHERE receiver = %s AND read = FALSE
-                    """,
-                    (self.username,)
-                )
-                unread_messages_count = cursor.fetchone()[0]
+            cursor.execute(
+                """
+                SELECT COUNT(*) FROM messages 
+                WHERE receiver = %s AND read = FALSE
+                """,
+                (self.username,)
+            )
+            unread_messages_count = cursor.fetchone()[0]
 
             # Общее количество уведомлений
             total_count = friend_requests_count + group_invites_count + missed_calls_count + unread_messages_count
@@ -4034,6 +4281,9 @@ class ChatWindow(QtWidgets.QWidget):
         # Отправляем статус "не в сети" при закрытии
         if hasattr(self, 'client') and hasattr(self.client, 'send_message'):
             self.client.send_message(f"STATUS_OFFLINE:{self.username}")
+        # Недополученные файлы не оставляем во временных файлах
+        if hasattr(self, 'client') and hasattr(self.client, 'incoming_files'):
+            self.client.incoming_files.abort_all()
         event.accept()
 
     def load_friends(self):
@@ -4178,6 +4428,11 @@ class ChatWindow(QtWidgets.QWidget):
         friend_btn.clicked.connect(lambda: self.open_chat_with(friend_name))
         self.friends_layout.addWidget(friend_btn)
 
+    def close_personal_chat(self):
+        """Закрывает личный чат; сервер перестает направлять строки "имя: текст" собеседнику"""
+        self.current_chat_with = None
+        self.client.close_chat()
+
     def open_chat_with(self, friend_name):
         """Открывает чат с указанным пользователем и закрывает групповой чат"""
         print(f"[CHAT] Opening personal chat with {friend_name}")
@@ -4198,6 +4453,7 @@ class ChatWindow(QtWidgets.QWidget):
             self.content_stack.setCurrentIndex(1)
 
         self.current_chat_with = friend_name
+        self.client.open_chat(friend_name)
         # Обновляем заголовок чата с именем собеседника
         self.update_chat_header(friend_name)
         self.text_display.clear()
@@ -4218,7 +4474,7 @@ class ChatWindow(QtWidgets.QWidget):
         # Закрываем личный чат при открытии группового
         if self.current_chat_with:
             print(f"[CHAT] Closing personal chat with {self.current_chat_with} to open group chat")
-            self.current_chat_with = None
+            self.close_personal_chat()
 
         # Переключаемся на экран чата
         if self.content_stack.currentIndex() == 0:
@@ -4348,7 +4604,7 @@ class ChatWindow(QtWidgets.QWidget):
 
         if self.current_chat_with:
             print(f"[CHAT] Closing personal chat with: {self.current_chat_with}")
-            self.current_chat_with = None
+            self.close_personal_chat()
 
         self.text_display.clear()
         self.setWindowTitle("Voice Chat")
@@ -0,0 +1,268 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager, asynccontextmanager
+
+import pg8000
+
+
+class PoolTimeoutError(Exception):
+    """Не удалось получить соединение из пула за отведенное время"""
+
+
+class PoolClosedError(Exception):
+    """Пул соединений уже закрыт"""
+
+
+class ConnectionPool:
+    """Ограниченный потокобезопасный пул соединений PostgreSQL (pg8000).
+
+    Держит от min_size до max_size соединений. Соединение, простоявшее
+    без дела дольше health_check_interval, перед выдачей проверяется
+    запросом SELECT 1 и при ошибке пересоздается. При возврате в пул
+    незавершенная транзакция откатывается, чтобы ошибка одного обработчика
+    не влияла на другие.
+    """
+    def __init__(self, db_config, min_size=2, max_size=20, timeout=10.0,
+                 health_check_interval=30.0, connect=None):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError(f"Invalid pool size: min={min_size}, max={max_size}")
+
+        self.db_config = db_config
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self._connect = connect or (lambda: pg8000.connect(**db_config))
+
+        self._cond = threading.Condition()
+        self._idle = deque()  # (connection, время последнего использования)
+        self._size = 0
+        self._closed = False
+
+        # Статистика
+        self._in_use = 0
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_time_total = 0.0
+        self._wait_time_max = 0.0
+        self._timeouts = 0
+        self._created = 0
+        self._discarded = 0
+
+        for _ in range(min_size):
+            connection = self._connect()
+            self._created += 1
+            self._size += 1
+            self._idle.append((connection, time.monotonic()))
+
+    def acquire(self, timeout=None):
+        """Берет соединение из пула, при необходимости ожидая освобождения"""
+        timeout = self.timeout if timeout is None else timeout
+        wait_started = None
+        connection = None
+        last_used = None
+
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolClosedError("Connection pool is closed")
+                if self._idle:
+                    # LIFO: чаще выдаем "теплые" соединения
+                    connection, last_used = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    # Резервируем место, само соединение создаем вне блокировки
+                    self._size += 1
+                    break
+
+                if wait_started is None:
+                    wait_started = time.monotonic()
+                    self._waits += 1
+                remaining = wait_started + timeout - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    self._record_wait(wait_started)
+                    raise PoolTimeoutError(f"No free database connection after {timeout:.1f}s")
+                self._cond.wait(remaining)
+
+            if wait_started is not None:
+                self._record_wait(wait_started)
+            self._in_use += 1
+            self._checkouts += 1
+
+        try:
+            if connection is None:
+                connection = self._new_connection()
+            elif time.monotonic() - last_used > self.health_check_interval and not self._is_healthy(connection):
+                print("[DB POOL] Replacing unhealthy connection")
+                self._close_quietly(connection)
+                with self._cond:
+                    self._discarded += 1
+                connection = self._new_connection()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+        return connection
+
+    def release(self, connection, discard=False):
+        """Возвращает соединение в пул (discard=True - закрыть и не возвращать)"""
+        if not discard:
+            try:
+                # Откатываем то, что обработчик не зафиксировал
+                connection.rollback()
+            except Exception as e:
+                print(f"[DB POOL] Discarding broken connection: {e}")
+                discard = True
+
+        with self._cond:
+            self._in_use -= 1
+            if discard or self._closed:
+                self._size -= 1
+                if discard:
+                    self._discarded += 1
+            else:
+                self._idle.append((connection, time.monotonic()))
+            self._cond.notify()
+
+        if discard or self._closed:
+            self._close_quietly(connection)
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """Контекст: соединение берется сразу и возвращается при выходе"""
+        connection = self.acquire(timeout)
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    @contextmanager
+    def session(self):
+        """Контекст: ленивая сессия, соединение берется при первом запросе"""
+        session = PoolSession(self)
+        try:
+            yield session
+        finally:
+            session.close()
+
+    async def acquire_async(self, timeout=None):
+        """Асинхронная выдача соединения: ожидание не блокирует цикл событий"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.acquire, timeout)
+
+    async def release_async(self, connection, discard=False):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.release, connection, discard)
+
+    @asynccontextmanager
+    async def connection_async(self, timeout=None):
+        connection = await self.acquire_async(timeout)
+        try:
+            yield connection
+        finally:
+            await self.release_async(connection)
+
+    def stats(self):
+        """Снимок статистики пула для подбора его размера"""
+        with self._cond:
+            return {
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._in_use,
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "checkouts": self._checkouts,
+                "waits": self._waits,
+                "wait_time_total": self._wait_time_total,
+                "wait_time_avg": self._wait_time_total / self._waits if self._waits else 0.0,
+                "wait_time_max": self._wait_time_max,
+                "timeouts": self._timeouts,
+                "created": self._created,
+                "discarded": self._discarded,
+            }
+
+    def close(self):
+        """Закрывает пул и все свободные соединения"""
+        with self._cond:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+            self._cond.notify_all()
+
+        for connection, _ in idle:
+            self._close_quietly(connection)
+
+    def _new_connection(self):
+        connection = self._connect()
+        with self._cond:
+            self._created += 1
+        return connection
+
+    def _record_wait(self, wait_started):
+        waited = time.monotonic() - wait_started
+        self._wait_time_total += waited
+        self._wait_time_max = max(self._wait_time_max, waited)
+
+    @staticmethod
+    def _is_healthy(connection):
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+            cursor.close()
+            connection.rollback()
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _close_quietly(connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+
+class PoolSession:
+    """Ленивая сессия поверх пула с интерфейсом соединения pg8000.
+
+    Обработчики вызывают cursor()/prepare()/commit()/rollback() как у
+    обычного соединения; соединение берется из пула только при первом
+    запросе, поэтому сообщения без обращения к БД пул не занимают.
+    """
+    def __init__(self, pool):
+        self.pool = pool
+        self.connection = None
+
+    def pooled_connection(self):
+        """Соединение пула, на котором выполняются запросы сессии (берется при первом вызове)"""
+        if self.connection is None:
+            self.connection = self.pool.acquire()
+        return self.connection
+
+    def cursor(self):
+        return self.pooled_connection().cursor()
+
+    def prepare(self, sql):
+        return self.pooled_connection().prepare(sql)
+
+    def commit(self):
+        if self.connection is not None:
+            self.connection.commit()
+
+    def rollback(self):
+        if self.connection is not None:
+            self.connection.rollback()
+
+    def close(self):
+        if self.connection is not None:
+            connection = self.connection
+            self.connection = None
+            self.pool.release(connection)
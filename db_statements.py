@@ -0,0 +1,126 @@
+import re
+import threading
+import weakref
+
+from db_pool import PoolSession
+
+# SQLSTATE "подготовленный оператор не существует" (например, после DISCARD ALL)
+INVALID_STATEMENT_NAME = "26000"
+
+
+class PreparedStatements:
+    """Реестр частых запросов, подготовленных на каждом соединении.
+
+    Запрос регистрируется один раз под именем в обычном виде (параметры
+    %s). На соединении он готовится (pg8000 Connection.prepare) при первом
+    выполнении и дальше выполняется по имени: PostgreSQL не разбирает и не
+    планирует его заново. Подготовленные запросы хранятся по соединению
+    через слабые ссылки, поэтому соединение, пересозданное пулом, начинает
+    с пустого набора. Если сервер потерял подготовленный запрос, он
+    забывается и готовится заново при следующем выполнении. Соединения без
+    prepare (другой драйвер) и выключенный реестр (enabled=False)
+    выполняют запрос обычным курсором. Для сессии пула (PoolSession)
+    запросы готовятся на взятом ею соединении пула: сессия живет одно
+    сообщение, а соединение - пока его не пересоздаст пул.
+    """
+    def __init__(self, statements=None, enabled=True):
+        self.enabled = enabled
+        self._sql = {}
+        self._named = {}  # имя -> текст с параметрами :p0, :p1... для prepare
+        self._lock = threading.Lock()
+        self._prepared = weakref.WeakKeyDictionary()  # соединение -> {имя: PreparedStatement}
+
+        # Статистика
+        self._prepares = 0
+        self._executions = 0
+        self._fallbacks = 0
+        self._invalidations = 0
+
+        for name, sql in (statements or {}).items():
+            self.register(name, sql)
+
+    def register(self, name, sql):
+        counter = iter(range(sql.count("%s")))
+        with self._lock:
+            self._sql[name] = sql
+            self._named[name] = re.sub(r"%s", lambda m: f":p{next(counter)}", sql)
+        return name
+
+    def execute(self, connection, name, *params):
+        """Выполняет запрос; возвращает список строк результата (пустой, если строк нет)"""
+        if self.enabled and isinstance(connection, PoolSession):
+            connection = connection.pooled_connection()
+        if not self.enabled or not hasattr(connection, "prepare"):
+            return self._execute_plain(connection, name, params)
+
+        statement = self._statement(connection, name)
+        try:
+            rows = statement.run(**{f"p{i}": value for i, value in enumerate(params)})
+        except Exception as e:
+            if self._is_invalid_statement(e):
+                # Транзакция уже прервана - повторять нечего, следующий вызов подготовит запрос заново
+                self.forget(connection, name)
+            raise
+        with self._lock:
+            self._executions += 1
+        return list(rows or ())
+
+    def fetchone(self, connection, name, *params):
+        rows = self.execute(connection, name, *params)
+        return rows[0] if rows else None
+
+    def forget(self, connection, name=None):
+        """Забывает подготовленные запросы соединения (все или один)"""
+        with self._lock:
+            prepared = self._prepared.get(connection)
+            if prepared is None:
+                return
+            if name is None:
+                del self._prepared[connection]
+            else:
+                prepared.pop(name, None)
+            self._invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "statements": len(self._sql),
+                "connections": len(self._prepared),
+                "prepares": self._prepares,
+                "executions": self._executions,
+                "fallbacks": self._fallbacks,
+                "invalidations": self._invalidations,
+            }
+
+    def _statement(self, connection, name):
+        # Соединение в каждый момент используется одним потоком, блокировка - только для словарей
+        with self._lock:
+            prepared = self._prepared.get(connection)
+            if prepared is None:
+                prepared = self._prepared[connection] = {}
+            statement = prepared.get(name)
+            sql = self._named[name]
+        if statement is None:
+            statement = connection.prepare(sql)
+            with self._lock:
+                prepared[name] = statement
+                self._prepares += 1
+        return statement
+
+    def _execute_plain(self, connection, name, params):
+        with self._lock:
+            sql = self._sql[name]
+            self._fallbacks += 1
+        cursor = connection.cursor()
+        try:
+            cursor.execute(sql, params)
+            if getattr(cursor, "description", None) is None:
+                return []
+            return list(cursor.fetchall())
+        finally:
+            cursor.close()
+
+    @staticmethod
+    def _is_invalid_statement(error):
+        details = error.args[0] if error.args else None
+        return isinstance(details, dict) and details.get("C") == INVALID_STATEMENT_NAME
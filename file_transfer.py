@@ -0,0 +1,322 @@
+import base64
+import hashlib
+import itertools
+import os
+import queue
+import random
+import tempfile
+import threading
+
+from protocol import (FILE_GROUP, FILE_HEADER, FRAME_FILE, file_chunk_header, send_binary,
+                      supports_file_blobs, supports_file_frames)
+
+# Размер части файла в кадре FRAME_FILE
+FILE_CHUNK_SIZE = 256 * 1024
+# Старый протокол: строки FILE_TRANSFER:CHUNK по столько символов base64
+TEXT_CHUNK_SIZE = 900
+# Папка принятых файлов
+DOWNLOADS_DIR = "downloads"
+# Сколько ждать ответа сервера на FILE_OFFER и подтверждения FILE_STORED, секунд
+REPLY_TIMEOUT = 30
+
+# Номер передачи уникален для отправителя; случайное начало - чтобы не совпасть с передачами до переподключения
+_transfer_ids = itertools.count(random.randrange(1 << 30))
+# Передачи, ждущие ответа сервера (FILE_ACCEPT / FILE_STORED / FILE_REJECT), по номеру
+_pending = {}
+_pending_lock = threading.Lock()
+
+
+def file_digest(path):
+    """SHA-256 файла в hex"""
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(FILE_CHUNK_SIZE)
+            if not data:
+                break
+            hasher.update(data)
+    return hasher.hexdigest()
+
+
+def dispatch_file_reply(message):
+    """Передает ответ сервера (FILE_ACCEPT/FILE_STORED/FILE_REJECT:номер:...) ждущей передаче"""
+    parts = message.split(":", 2)
+    try:
+        transfer_id = int(parts[1])
+    except (IndexError, ValueError):
+        return False
+    with _pending_lock:
+        sender = _pending.get(transfer_id)
+    if sender is None:
+        return False
+    sender._replies.put((parts[0], parts[2] if len(parts) > 2 else ""))
+    return True
+
+
+class FileSender:
+    """Отправляет файл в фоновом потоке.
+
+    Если сервер понимает кадры FRAME_FILE (протокол 5), между текстовыми
+    START и END идут части по FILE_CHUNK_SIZE байт без base64, сервер
+    пересылает их не разбирая; номер передачи дописывается в конец START и
+    END. Со старым сервером файл уходит прежними строками CHUNK с base64.
+    Сервер версии 6 хранит файлы по SHA-256: вместо START отправляется
+    FILE_OFFER с хешем, и части идут только с того места, которое сервер
+    назвал в FILE_ACCEPT (ничего, если такой файл у него уже есть; остаток,
+    если прошлая отправка оборвалась). Файл получателям раздает сервер.
+    on_progress(передача) после каждой части и on_done(передача, ошибка или
+    None) вызываются из потока отправки; отправлено байт - в sent.
+    """
+    def __init__(self, sock, kind, sender, target, path, on_progress=None, on_done=None,
+                 chunk_size=FILE_CHUNK_SIZE):
+        self.sock = sock
+        self.kind = kind
+        self.sender = sender
+        self.target = target
+        self.path = path
+        self.name = os.path.basename(path)
+        self.size = os.path.getsize(path)
+        self.transfer_id = next(_transfer_ids) & 0xFFFFFFFF
+        self.chunk_size = chunk_size
+        self.sent = 0
+        self._on_progress = on_progress
+        self._on_done = on_done
+        self._cancelled = False
+        self._thread = None
+        self._replies = queue.Queue()
+
+    @property
+    def prefix(self):
+        return "GROUP_FILE_TRANSFER" if self.kind == FILE_GROUP else "FILE_TRANSFER"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+        return self
+
+    def cancel(self):
+        self._cancelled = True
+
+    def join(self, timeout=None):
+        if self._thread:
+            self._thread.join(timeout)
+
+    def run(self):
+        if supports_file_blobs(self.sock):
+            self._run_offer()
+            return
+        error = None
+        binary = supports_file_frames(self.sock)
+        suffix = f":{self.transfer_id}" if binary else ""
+        try:
+            self._send_text(f"{self.prefix}:START:{self.sender}:{self.target}:{self.name}:{self.size}{suffix}")
+            with open(self.path, "rb") as f:
+                if binary:
+                    self._send_frames(f)
+                else:
+                    self._send_lines(f)
+            if self._cancelled:
+                raise ConnectionError("Transfer cancelled")
+            self._send_text(f"{self.prefix}:END:{self.sender}:{self.target}:{self.name}{suffix}")
+            print(f"[FILE] Sent {self.name} ({self.size} bytes) to {self.target}")
+        except Exception as e:
+            error = e
+            print(f"[FILE ERROR] Failed to send {self.name} to {self.target}: {e}")
+        if self._on_done:
+            self._on_done(self, error)
+
+    def _run_offer(self):
+        error = None
+        with _pending_lock:
+            _pending[self.transfer_id] = self
+        try:
+            digest = file_digest(self.path)
+            command = "GROUP_FILE_OFFER" if self.kind == FILE_GROUP else "FILE_OFFER"
+            self._send_text(f"{command}:{self.sender}:{self.target}:{self.name}:{self.size}:{digest}:"
+                            f"{self.transfer_id}")
+            offset = int(self._wait_reply("FILE_ACCEPT"))
+            if offset < self.size:
+                if offset:
+                    print(f"[FILE] Resuming {self.name} from {offset} bytes")
+                with open(self.path, "rb") as f:
+                    f.seek(offset)
+                    self._progress(offset)
+                    self._send_frames(f)
+                if self._cancelled:
+                    raise ConnectionError("Transfer cancelled")
+            else:
+                self._progress(self.size)
+                print(f"[FILE] {self.name} is already stored on the server")
+            self._wait_reply("FILE_STORED")
+            print(f"[FILE] Sent {self.name} ({self.size} bytes) to {self.target}")
+        except Exception as e:
+            error = e
+            print(f"[FILE ERROR] Failed to send {self.name} to {self.target}: {e}")
+        finally:
+            with _pending_lock:
+                _pending.pop(self.transfer_id, None)
+        if self._on_done:
+            self._on_done(self, error)
+
+    def _wait_reply(self, expected):
+        try:
+            reply, value = self._replies.get(timeout=REPLY_TIMEOUT)
+        except queue.Empty:
+            raise ConnectionError(f"No {expected} from server")
+        if reply != expected:
+            raise ConnectionError(f"Server rejected the file: {value}")
+        return value
+
+    def _send_frames(self, f):
+        # Один буфер на всю передачу: заголовок части + данные, прочитанные прямо в него
+        header = file_chunk_header(self.kind, self.sender, self.target, self.transfer_id, 0)
+        sender_size, target_size = FILE_HEADER.unpack_from(header)[3:]
+        buffer = bytearray(len(header) + self.chunk_size)
+        buffer[:len(header)] = header
+        view = memoryview(buffer)
+        while not self._cancelled:
+            size = f.readinto(view[len(header):])
+            if not size:
+                break
+            FILE_HEADER.pack_into(buffer, 0, self.kind, self.transfer_id, self.sent, sender_size, target_size)
+            send_binary(self.sock, FRAME_FILE, view[:len(header) + size])
+            self._progress(size)
+
+    def _send_lines(self, f):
+        # Кратно 675 байтам (ровно 900 символов base64): каждая строка декодируется отдельно
+        read_size = TEXT_CHUNK_SIZE // 4 * 3 * 64
+        while not self._cancelled:
+            chunk = f.read(read_size)
+            if not chunk:
+                break
+            encoded = base64.b64encode(chunk).decode("ascii")
+            lines = [f"{self.prefix}:CHUNK:{self.sender}:{self.target}:{encoded[i:i + TEXT_CHUNK_SIZE]}\n"
+                     for i in range(0, len(encoded), TEXT_CHUNK_SIZE)]
+            for line in lines:
+                self.sock.send(line.encode("utf-8"))
+            self._progress(len(chunk))
+
+    def _send_text(self, message):
+        self.sock.send(f"{message}\n".encode("utf-8"))
+
+    def _progress(self, size):
+        self.sent += size
+        if self._on_progress:
+            self._on_progress(self)
+
+
+class IncomingFile:
+    """Принимаемый файл: данные пишутся во временный файл в той же папке, что и итоговый"""
+    def __init__(self, name, size, sender, directory, digest=None):
+        self.name = name
+        self.size = size
+        self.sender = sender
+        # SHA-256 из START (файл из хранилища сервера) - сверяется по мере приема
+        self.digest = digest
+        self._hasher = hashlib.sha256() if digest else None
+        self.path = os.path.join(directory, name)
+        fd, self.temp_path = tempfile.mkstemp(prefix=f".{name}.", suffix=".part", dir=directory)
+        self._file = os.fdopen(fd, "wb")
+        self.received = 0
+
+    def write(self, data):
+        self._file.write(data)
+        if self._hasher:
+            self._hasher.update(data)
+        self.received += len(data)
+
+    def commit(self):
+        """Переименовывает готовый файл на место итогового; ValueError, если пришло не все"""
+        self._file.close()
+        if self.size and self.received != self.size:
+            self.discard()
+            raise ValueError(f"received {self.received} of {self.size} bytes")
+        if self._hasher and self._hasher.hexdigest() != self.digest:
+            self.discard()
+            raise ValueError("checksum mismatch")
+        os.replace(self.temp_path, self.path)
+        return self.path
+
+    def discard(self):
+        self._file.close()
+        try:
+            os.remove(self.temp_path)
+        except OSError:
+            pass
+
+
+class FileReceiver:
+    """Входящие передачи файлов по ключу (вид, отправитель, адресат, номер передачи).
+
+    Каждая передача пишется в свой временный файл, поэтому память не
+    зависит от размера файла, а передач одновременно может быть сколько
+    угодно. finish() проверяет размер (и SHA-256, если он пришел в START) и
+    атомарно (os.replace) ставит файл на место: недописанных файлов под настоящим именем не бывает. Номер
+    передачи None - передача строками CHUNK без номера (старый протокол).
+    Методы вызываются из сетевых потоков клиента.
+    """
+    def __init__(self, directory=DOWNLOADS_DIR):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._transfers = {}
+
+    def start(self, key, name, size, sender, digest=None):
+        # Имя приходит от другого пользователя - путь из него не берем
+        name = os.path.basename(name.replace("\\", "/"))
+        if name in ("", ".", ".."):
+            raise ValueError(f"Invalid file name: {name!r}")
+        os.makedirs(self.directory, exist_ok=True)
+        incoming = IncomingFile(name, size, sender, self.directory, digest)
+        with self._lock:
+            previous = self._transfers.pop(key, None)
+            self._transfers[key] = incoming
+        if previous is not None:
+            previous.discard()
+        return incoming
+
+    def get(self, key):
+        with self._lock:
+            return self._transfers.get(key)
+
+    def write(self, key, offset, data):
+        """Часть из кадра FRAME_FILE; часть не по порядку отменяет передачу"""
+        incoming = self.get(key)
+        if incoming is None:
+            return False
+        if offset != incoming.received:
+            print(f"[FILE ERROR] {incoming.name}: chunk at {offset}, expected {incoming.received}, dropping transfer")
+            self.abort(key)
+            return False
+        incoming.write(data)
+        return True
+
+    def write_text(self, key, encoded):
+        """Строка CHUNK старого протокола (base64)"""
+        incoming = self.get(key)
+        if incoming is None:
+            return False
+        # Пробелы и переносы могли появиться при передаче, недостающее выравнивание дополняем '='
+        encoded = encoded.replace(' ', '').replace('\n', '').replace('\r', '')
+        encoded += '=' * (-len(encoded) % 4)
+        incoming.write(base64.b64decode(encoded))
+        return True
+
+    def finish(self, key):
+        """Путь к сохраненному файлу; None, если передача неизвестна"""
+        with self._lock:
+            incoming = self._transfers.pop(key, None)
+        if incoming is None:
+            return None
+        return incoming.commit()
+
+    def abort(self, key):
+        with self._lock:
+            incoming = self._transfers.pop(key, None)
+        if incoming is not None:
+            incoming.discard()
+
+    def abort_all(self):
+        with self._lock:
+            transfers, self._transfers = list(self._transfers.values()), {}
+        for incoming in transfers:
+            incoming.discard()
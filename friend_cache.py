@@ -0,0 +1,106 @@
+import threading
+import time
+from collections import OrderedDict
+
+FRIENDS_QUERY = """
+    SELECT
+        CASE
+            WHEN user1 = %s THEN user2
+            ELSE user1
+        END as friend
+    FROM friends
+    WHERE user1 = %s OR user2 = %s
+"""
+
+
+class FriendGraphCache:
+    """Кэш графа дружбы: множество друзей для каждого пользователя.
+
+    Список друзей загружается из БД при первом обращении к пользователю
+    и дальше проверки дружбы выполняются без запросов. Хранится не больше
+    max_users пользователей (вытесняются давно не использованные).
+    Записи сбрасываются по событию добавления/удаления друга (invalidate)
+    и, на случай изменений в обход сервера, по истечении ttl секунд.
+    """
+    def __init__(self, max_users=10000, ttl=300.0, statements=None):
+        self.max_users = max_users
+        self.ttl = ttl
+        # PreparedStatements: запрос списка друзей готовится один раз на соединении
+        self.statements = statements
+        if statements is not None:
+            statements.register("friends_of", FRIENDS_QUERY)
+        self._lock = threading.Lock()
+        self._friends = OrderedDict()  # username -> (frozenset друзей, время загрузки)
+        self._generation = 0  # растет при каждом сбросе, чтобы не сохранить устаревшую загрузку
+
+        # Статистика
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._invalidations = 0
+
+    def friends_of(self, username, db_connection):
+        """Возвращает frozenset друзей пользователя"""
+        with self._lock:
+            entry = self._friends.get(username)
+            if entry is not None and time.monotonic() - entry[1] < self.ttl:
+                self._friends.move_to_end(username)
+                self._hits += 1
+                return entry[0]
+            self._misses += 1
+            generation = self._generation
+
+        friends = self._load(username, db_connection)
+
+        with self._lock:
+            # Если за время запроса дружба менялась, результат не кэшируем
+            if generation == self._generation:
+                self._friends[username] = (friends, time.monotonic())
+                self._friends.move_to_end(username)
+                while len(self._friends) > self.max_users:
+                    self._friends.popitem(last=False)
+                    self._evictions += 1
+        return friends
+
+    def are_friends(self, user1, user2, db_connection):
+        """Проверяет дружбу, загружая из БД не больше одного списка"""
+        with self._lock:
+            # Если список второго пользователя уже в кэше, используем его
+            if user1 not in self._friends and user2 in self._friends:
+                user1, user2 = user2, user1
+        return user2 in self.friends_of(user1, db_connection)
+
+    def invalidate(self, *usernames):
+        """Сбрасывает списки друзей пользователей (после добавления/удаления друга)"""
+        with self._lock:
+            self._generation += 1
+            for username in usernames:
+                if self._friends.pop(username, None) is not None:
+                    self._invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._friends.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "users": len(self._friends),
+                "max_users": self.max_users,
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+                "invalidations": self._invalidations,
+            }
+
+    def _load(self, username, db_connection):
+        params = (username, username, username)
+        if self.statements is not None:
+            return frozenset(row[0] for row in self.statements.execute(db_connection, "friends_of", *params))
+        cursor = db_connection.cursor()
+        try:
+            cursor.execute(FRIENDS_QUERY, params)
+            return frozenset(row[0] for row in cursor.fetchall())
+        finally:
+            cursor.close()
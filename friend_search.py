@@ -557,6 +557,8 @@ class ProfileDialog(QtWidgets.QDialog):
 
 
 class FriendSearchDialog(QtWidgets.QDialog):
+    friendshipChanged = QtCore.pyqtSignal(str)  # имя нового друга
+
     def __init__(self, connection, current_username):
         super().__init__()
         self.connection = connection
@@ -956,6 +958,7 @@ class FriendSearchDialog(QtWidgets.QDialog):
                         )
 
                         self.connection.commit()
+                        self.friendshipChanged.emit(username)
                         QtWidgets.QMessageBox.information(
                             self,
                             "Успех",
@@ -5,6 +5,7 @@ import os
 
 class FriendsDialog(QtWidgets.QDialog):
     friendsUpdated = QtCore.pyqtSignal()
+    friendshipChanged = QtCore.pyqtSignal(str)  # имя пользователя, с которым изменилась дружба
 
     def __init__(self, connection, current_username, parent=None):
         super().__init__(parent)
@@ -221,6 +222,7 @@ class FriendsDialog(QtWidgets.QDialog):
 
             # Отправляем сигнал об обновлении списка друзей
             self.friendsUpdated.emit()
+            self.friendshipChanged.emit(friend_name)
 
         except Exception as e:
             print(f"[ERROR] Failed to remove friend: {e}")
@@ -0,0 +1,90 @@
+import threading
+import time
+from collections import OrderedDict
+
+MEMBERS_QUERY = "SELECT username, role FROM group_members WHERE group_id = %s"
+
+
+class GroupMembershipCache:
+    """Кэш состава групп: {username: role} для каждой группы.
+
+    Состав группы загружается из БД одним запросом при первом обращении,
+    после чего проверки членства и роли выполняются без запросов.
+    Хранится не больше max_groups групп (вытесняются давно не
+    использованные). Запись сбрасывается по событию изменения состава
+    (invalidate) и, на случай изменений в обход сервера, через ttl секунд.
+    """
+    def __init__(self, max_groups=5000, ttl=300.0, statements=None):
+        self.max_groups = max_groups
+        self.ttl = ttl
+        # PreparedStatements: запрос состава группы готовится один раз на соединении
+        self.statements = statements
+        if statements is not None:
+            statements.register("group_members", MEMBERS_QUERY)
+        self._lock = threading.Lock()
+        self._members = OrderedDict()  # group_id -> ({username: role}, время загрузки)
+        self._generation = 0
+
+        # Статистика
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._invalidations = 0
+
+    def members(self, group_id, db_connection):
+        """Возвращает словарь {username: role} участников группы (не изменять)"""
+        with self._lock:
+            entry = self._members.get(group_id)
+            if entry is not None and time.monotonic() - entry[1] < self.ttl:
+                self._members.move_to_end(group_id)
+                self._hits += 1
+                return entry[0]
+            self._misses += 1
+            generation = self._generation
+
+        members = self._load(group_id, db_connection)
+
+        with self._lock:
+            # Если за время запроса состав менялся, результат не кэшируем
+            if generation == self._generation:
+                self._members[group_id] = (members, time.monotonic())
+                self._members.move_to_end(group_id)
+                while len(self._members) > self.max_groups:
+                    self._members.popitem(last=False)
+                    self._evictions += 1
+        return members
+
+    def role_of(self, group_id, username, db_connection):
+        """Роль пользователя в группе или None, если он не участник"""
+        return self.members(group_id, db_connection).get(username)
+
+    def is_member(self, group_id, username, db_connection):
+        return username in self.members(group_id, db_connection)
+
+    def invalidate(self, group_id):
+        """Сбрасывает состав группы (после вступления, выхода, исключения, удаления)"""
+        with self._lock:
+            self._generation += 1
+            if self._members.pop(group_id, None) is not None:
+                self._invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "groups": len(self._members),
+                "max_groups": self.max_groups,
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+                "invalidations": self._invalidations,
+            }
+
+    def _load(self, group_id, db_connection):
+        if self.statements is not None:
+            return {row[0]: row[1] for row in self.statements.execute(db_connection, "group_members", group_id)}
+        cursor = db_connection.cursor()
+        try:
+            cursor.execute(MEMBERS_QUERY, (group_id,))
+            return {row[0]: row[1] for row in cursor.fetchall()}
+        finally:
+            cursor.close()
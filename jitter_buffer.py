@@ -0,0 +1,211 @@
+import math
+import threading
+import time
+
+from media_transport import media_age_ms
+
+# Результат выборки блока для воспроизведения
+PLAYOUT_FRAME = "frame"  # блок получен вовремя
+PLAYOUT_CONCEAL = "conceal"  # блок не пришел к своему сроку - маскируем потерю
+PLAYOUT_SILENCE = "silence"  # буфер еще набирает запас (начало речи, пауза)
+
+# Границы задержки буфера в блоках
+MIN_DELAY_FRAMES = 2
+MAX_DELAY_FRAMES = 15
+# После стольких подряд маскированных блоков считаем, что собеседник замолчал, и снова копим запас
+MAX_CONCEALED_FRAMES = 5
+# Коэффициент сглаживания оценок джиттера и задержки (как в RFC 3550)
+JITTER_GAIN = 1 / 16
+
+
+class JitterBuffer:
+    """Адаптивный буфер джиттера принятого аудио.
+
+    Сетевые потоки кладут пакеты push(), поток воспроизведения раз в
+    длительность блока забирает их pop(). Пакеты по UDP приходят с номером
+    и временем отправки от отправителя, по этому номеру восстанавливается
+    порядок и определяются потери. Пакетам по TCP (порядок гарантирован)
+    номер присваивается при приеме. Целевая задержка подстраивается под
+    измеренный разброс интервалов прихода: при ровной сети буфер держит
+    MIN_DELAY_FRAMES блоков, при неровной - больше, но не больше
+    MAX_DELAY_FRAMES. Блок, не пришедший к своему сроку, маскируется
+    (PLAYOUT_CONCEAL); пришедший после этого отбрасывается как опоздавший.
+
+    block_bytes задает размер блока для PCM, который по старому протоколу
+    приходит произвольными порциями; для кодеков с пакетами (Opus) - None.
+
+    Маркер паузы отправителя (push с pause=True) воспроизводится как обычный
+    блок, после него буфер не маскирует отсутствие пакетов, а снова копит
+    запас к началу следующей фразы.
+    """
+    def __init__(self, frame_duration, block_bytes=None):
+        self._lock = threading.Lock()
+        self.configure(frame_duration, block_bytes)
+
+    def configure(self, frame_duration, block_bytes=None):
+        """Задает длительность и размер блока (при смене кодека) и очищает буфер"""
+        with self._lock:
+            self.frame_duration = frame_duration
+            self.block_bytes = block_bytes
+            self._reset()
+
+    def reset(self):
+        with self._lock:
+            self._reset()
+
+    def _reset(self):
+        self._clear()
+        self._last_arrival = None
+        self._jitter = 0.0
+        self._target = MIN_DELAY_FRAMES
+
+        # Статистика
+        self.received = 0
+        self.played = 0
+        self.concealed = 0
+        self.late = 0
+        self._delay_avg = 0.0
+        self._transit_avg = None
+
+    def _clear(self):
+        self._frames = {}  # номер -> (пакет, время прихода, время отправки, маркер паузы)
+        self._pending = bytearray()
+        self._sequenced = False  # номера от отправителя (UDP)
+        self._next_seq = 0  # следующий номер при приеме по TCP
+        self._highest = None  # старший принятый номер (UDP), с учетом переполнения
+        self._play_seq = 0
+        self._playing = False
+        self._concealed_run = 0
+
+    def push(self, data, seq=None, sent_at=None, pause=False):
+        """Принимает аудио из сети: seq и sent_at - из заголовка UDP-пакета"""
+        with self._lock:
+            if seq is not None:
+                self._push_frame(bytes(data), seq, sent_at, pause)
+                return
+            if self.block_bytes is None or pause:
+                # Маркер паузы не склеивается с PCM: недобранный хвост речи уже не придет
+                self._pending.clear()
+                self._push_frame(bytes(data), pause=pause)
+                return
+            self._pending += data
+            while len(self._pending) >= self.block_bytes:
+                self._push_frame(bytes(self._pending[:self.block_bytes]))
+                del self._pending[:self.block_bytes]
+
+    def _push_frame(self, frame, seq=None, sent_at=None, pause=False):
+        if (seq is not None) != self._sequenced:
+            # Смена транспорта (UDP <-> TCP): нумерация другая, начинаем заново
+            self._clear()
+            self._sequenced = seq is not None
+
+        now = time.monotonic()
+        if self._last_arrival is not None:
+            # Отклонение интервала прихода от длительности блока
+            deviation = abs((now - self._last_arrival) - self.frame_duration)
+            self._jitter += (deviation - self._jitter) * JITTER_GAIN
+            self._target = min(MAX_DELAY_FRAMES,
+                               MIN_DELAY_FRAMES + math.ceil(3 * self._jitter / self.frame_duration))
+        self._last_arrival = now
+        self.received += 1
+
+        if seq is None:
+            if self._concealed_run and len(self._frames) >= self._target:
+                # Место этого блока уже занято маскировкой - воспроизводить его поздно
+                self._concealed_run -= 1
+                self.late += 1
+                return
+            seq = self._next_seq
+            self._next_seq += 1
+        else:
+            seq = self._unwrap(seq)
+            if seq < self._play_seq or seq in self._frames:
+                self.late += 1
+                return
+
+        self._frames[seq] = (frame, now, sent_at, pause)
+        while len(self._frames) > MAX_DELAY_FRAMES:
+            oldest = min(self._frames)
+            del self._frames[oldest]
+            self._play_seq = max(self._play_seq, oldest + 1)
+            self.late += 1
+
+    def _unwrap(self, seq):
+        """16-битный номер пакета -> монотонный номер"""
+        if self._highest is None:
+            self._highest = seq
+            return seq
+        delta = (seq - self._highest) & 0xFFFF
+        if delta >= 0x8000:
+            delta -= 0x10000
+        extended = self._highest + delta
+        self._highest = max(self._highest, extended)
+        return extended
+
+    def pop(self):
+        """Блок для воспроизведения: (PLAYOUT_*, пакет или None)"""
+        with self._lock:
+            if not self._playing:
+                if len(self._frames) < self._target:
+                    return PLAYOUT_SILENCE, None
+                self._playing = True
+                self._play_seq = min(self._frames)
+
+            # Задержка выросла выше цели (например, после всплеска) - догоняем, пропуская блок
+            if len(self._frames) > self._target + MIN_DELAY_FRAMES:
+                if self._frames.pop(self._play_seq, None) is not None:
+                    self.late += 1
+                self._play_seq += 1
+
+            entry = self._frames.pop(self._play_seq, None)
+            if entry is None:
+                return self._conceal()
+
+            self._play_seq += 1
+            self._concealed_run = 0
+            self.played += 1
+            frame, arrival, sent_at, pause = entry
+            if pause and not self._frames:
+                # Собеседник замолчал: дальше тишина, а не потери
+                self._playing = False
+            self._delay_avg += ((time.monotonic() - arrival) - self._delay_avg) * JITTER_GAIN
+            if sent_at is not None:
+                transit = media_age_ms(sent_at)
+                if transit is not None:
+                    if self._transit_avg is None:
+                        self._transit_avg = float(transit)
+                    self._transit_avg += (transit - self._transit_avg) * JITTER_GAIN
+            return PLAYOUT_FRAME, frame
+
+    def _conceal(self):
+        if self._sequenced and self._frames:
+            # Пакет потерян, следующие уже есть - маскируем и идем дальше
+            self._play_seq += 1
+            self.concealed += 1
+            return PLAYOUT_CONCEAL, None
+
+        self._concealed_run += 1
+        if self._concealed_run > MAX_CONCEALED_FRAMES:
+            # Долгая пауза - это не потери, а тишина; копим запас заново
+            self._playing = False
+            self._concealed_run = 0
+            return PLAYOUT_SILENCE, None
+        if self._sequenced:
+            self._play_seq += 1
+        self.concealed += 1
+        return PLAYOUT_CONCEAL, None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "depth": len(self._frames),
+                "target": self._target,
+                "jitter_ms": self._jitter * 1000,
+                "delay_ms": self._delay_avg * 1000,
+                # От отправки до воспроизведения (только для UDP, при синхронизированных часах)
+                "transit_ms": self._transit_avg,
+                "received": self.received,
+                "played": self.played,
+                "concealed": self.concealed,
+                "late": self.late,
+            }
@@ -0,0 +1,158 @@
+import asyncio
+import socket
+import threading
+import time
+
+from media_transport import (MAX_DATAGRAM_SIZE, MEDIA_PEER_TIMEOUT, media_timestamp, new_media_token,
+                             pack_media, unpack_media)
+
+
+class MediaSession:
+    """UDP-сессия одного участника звонка"""
+    __slots__ = ("token", "call_key", "username", "addr", "last_seen", "out_seq", "received", "sent")
+
+    def __init__(self, token, call_key, username):
+        self.token = token
+        self.call_key = call_key  # ("call", call_id) или ("group", group_id)
+        self.username = username
+        self.addr = None
+        self.last_seen = 0.0
+        self.out_seq = 0
+        self.received = 0
+        self.sent = 0
+
+    def active(self, timeout=MEDIA_PEER_TIMEOUT):
+        return self.addr is not None and time.monotonic() - self.last_seen < timeout
+
+
+class MediaRelay:
+    """Серверная пересылка аудио звонков по UDP.
+
+    Участнику звонка выдается токен (issue), по которому сервер узнает
+    отправителя пакета и запоминает его адрес. Принятое аудио передается в
+    on_audio(сессия, номер, время отправки, аудио), который решает, кому
+    его переслать (send). Получателю, от которого давно не было пакетов,
+    send отказывает - вызывающий код отправляет аудио по TCP.
+    """
+    def __init__(self, on_audio):
+        self.on_audio = on_audio
+        self._lock = threading.Lock()
+        self._sessions = {}  # token -> MediaSession
+        self._by_member = {}  # (call_key, username) -> MediaSession
+        self._sendto = None
+
+        # Статистика
+        self.unknown_packets = 0
+
+    def issue(self, call_key, username):
+        """Выдает (или возвращает уже выданный) токен участнику звонка, в hex"""
+        with self._lock:
+            session = self._by_member.get((call_key, username))
+            if session is None:
+                session = MediaSession(new_media_token(), call_key, username)
+                self._sessions[session.token] = session
+                self._by_member[(call_key, username)] = session
+            return session.token.hex()
+
+    def revoke(self, call_key, username=None):
+        """Закрывает сессии звонка (или одного участника)"""
+        with self._lock:
+            for key, session in list(self._by_member.items()):
+                if key[0] == call_key and (username is None or key[1] == username):
+                    del self._by_member[key]
+                    self._sessions.pop(session.token, None)
+
+    def session_for(self, call_key, username):
+        with self._lock:
+            return self._by_member.get((call_key, username))
+
+    def send(self, session, payload, timestamp=None):
+        """Отправляет аудио участнику; False - UDP-адрес неизвестен или устарел"""
+        if session is None or self._sendto is None or not session.active():
+            return False
+        session.out_seq = (session.out_seq + 1) & 0xFFFF
+        if timestamp is None:
+            timestamp = media_timestamp()
+        try:
+            self._sendto(pack_media(session.token, session.out_seq, timestamp, payload), session.addr)
+        except OSError as e:
+            print(f"[MEDIA] Failed to send to {session.username}: {e}")
+            return False
+        session.sent += 1
+        return True
+
+    def handle_datagram(self, data, addr):
+        packet = unpack_media(data)
+        session = None
+        if packet is not None:
+            with self._lock:
+                session = self._sessions.get(packet[0])
+        if session is None:
+            self.unknown_packets += 1
+            return
+
+        token, seq, timestamp, payload = packet
+        session.addr = addr
+        session.last_seen = time.monotonic()
+        if not payload:
+            # Регистрация адреса: подтверждаем, что UDP проходит
+            try:
+                self._sendto(pack_media(token, 0, timestamp), addr)
+            except OSError as e:
+                print(f"[MEDIA] Failed to answer {session.username}: {e}")
+            return
+
+        session.received += 1
+        try:
+            self.on_audio(session, seq, timestamp, payload)
+        except Exception as e:
+            print(f"[MEDIA ERROR] {e}")
+
+    def stats(self):
+        with self._lock:
+            sessions = list(self._sessions.values())
+        return {
+            "sessions": len(sessions),
+            "active": sum(1 for session in sessions if session.active()),
+            "received": sum(session.received for session in sessions),
+            "sent": sum(session.sent for session in sessions),
+            "unknown": self.unknown_packets,
+        }
+
+    # --- запуск ---
+
+    def serve_thread(self, host, port):
+        """Прием в отдельном потоке (потоковый режим сервера)"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((host, port))
+        self._sendto = sock.sendto
+
+        def receive_loop():
+            while True:
+                try:
+                    data, addr = sock.recvfrom(MAX_DATAGRAM_SIZE)
+                except OSError as e:
+                    print(f"[MEDIA ERROR] {e}")
+                    return
+                self.handle_datagram(data, addr)
+
+        thread = threading.Thread(target=receive_loop, daemon=True)
+        thread.start()
+        return thread
+
+    async def serve_async(self, host, port):
+        """Прием в цикле событий (asyncio режим)"""
+        loop = asyncio.get_running_loop()
+        relay = self
+
+        class MediaProtocol(asyncio.DatagramProtocol):
+            def datagram_received(self, data, addr):
+                relay.handle_datagram(data, addr)
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((host, port))
+        # Отправка идет и из других потоков (обработчики, микшер), поэтому пишем
+        # прямо в сокет: transport.sendto не потокобезопасен
+        self._sendto = sock.sendto
+        transport, _ = await loop.create_datagram_endpoint(MediaProtocol, sock=sock)
+        return transport
@@ -0,0 +1,121 @@
+import os
+import socket
+import struct
+import threading
+import time
+
+# Медиапакет UDP: [токен сессии: 8 байт][номер: 2 байта][время отправки, мс: 4 байта][аудио]
+# Пакет без аудио - регистрация/проверка связи; сервер отвечает на него таким же пустым пакетом.
+MEDIA_HEADER = struct.Struct("!8sHI")
+MEDIA_TOKEN_SIZE = 8
+MAX_DATAGRAM_SIZE = 65507
+
+# Как часто клиент подтверждает свой адрес, пока в звонке, сек
+MEDIA_KEEPALIVE_INTERVAL = 2.0
+# Сколько ждать ответа сервера, прежде чем считать UDP недоступным, сек
+MEDIA_PEER_TIMEOUT = 6.0
+
+
+def new_media_token():
+    return os.urandom(MEDIA_TOKEN_SIZE)
+
+
+def media_timestamp():
+    """Время отправки в мс (по модулю 2^32) для оценки задержки получателем"""
+    return int(time.time() * 1000) & 0xFFFFFFFF
+
+
+def media_age_ms(timestamp):
+    """Сколько мс прошло с момента отправки; None, если часы отправителя впереди"""
+    age = (media_timestamp() - timestamp) & 0xFFFFFFFF
+    return age if age < 0x80000000 else None
+
+
+def pack_media(token, seq, timestamp, payload=b""):
+    return MEDIA_HEADER.pack(token, seq & 0xFFFF, timestamp & 0xFFFFFFFF) + bytes(payload)
+
+
+def unpack_media(data):
+    """Возвращает (токен, номер, время, аудио) или None для чужого пакета"""
+    if len(data) < MEDIA_HEADER.size:
+        return None
+    token, seq, timestamp = MEDIA_HEADER.unpack_from(data)
+    return token, seq, timestamp, memoryview(data)[MEDIA_HEADER.size:]
+
+
+class MediaChannel:
+    """Клиентская сторона передачи аудио звонка по UDP.
+
+    Токен сессии выдает сервер в сигнале звонка. Канал регистрирует адрес
+    клиента пустыми пакетами и считается готовым (ready), пока сервер
+    отвечает на них; до этого и после потери связи аудио идет по TCP.
+    on_audio(номер, время отправки, аудио) вызывается из потока приема.
+    """
+    def __init__(self, host, port, token_hex, on_audio):
+        self.address = (host, port)
+        self.token = bytes.fromhex(token_hex)
+        self.on_audio = on_audio
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.settimeout(MEDIA_KEEPALIVE_INTERVAL)
+        self._seq = 0
+        self._last_reply = 0.0
+        self._running = False
+
+        # Статистика
+        self.sent = 0
+        self.received = 0
+
+    @property
+    def ready(self):
+        return self._running and time.monotonic() - self._last_reply < MEDIA_PEER_TIMEOUT
+
+    def start(self):
+        self._running = True
+        self._send_keepalive()
+        threading.Thread(target=self._receive_loop, daemon=True).start()
+        threading.Thread(target=self._keepalive_loop, daemon=True).start()
+
+    def send(self, payload):
+        self._seq = (self._seq + 1) & 0xFFFF
+        self.sock.sendto(pack_media(self.token, self._seq, media_timestamp(), payload), self.address)
+        self.sent += 1
+
+    def close(self):
+        self._running = False
+        try:
+            self.sock.close()
+        except Exception:
+            pass
+
+    def _send_keepalive(self):
+        try:
+            self.sock.sendto(pack_media(self.token, 0, media_timestamp()), self.address)
+        except OSError as e:
+            print(f"[MEDIA] Keepalive failed: {e}")
+
+    def _keepalive_loop(self):
+        while self._running:
+            time.sleep(MEDIA_KEEPALIVE_INTERVAL)
+            if self._running:
+                self._send_keepalive()
+
+    def _receive_loop(self):
+        while self._running:
+            try:
+                data, addr = self.sock.recvfrom(MAX_DATAGRAM_SIZE)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+
+            packet = unpack_media(data)
+            if packet is None or packet[0] != self.token:
+                continue
+            self._last_reply = time.monotonic()
+            token, seq, timestamp, payload = packet
+            if payload:
+                self.received += 1
+                try:
+                    self.on_audio(seq, timestamp, payload)
+                except Exception as e:
+                    print(f"[MEDIA] Error handling audio: {e}")
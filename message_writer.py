@@ -0,0 +1,306 @@
+import datetime
+import json
+import os
+import threading
+import time
+from collections import deque
+
+# Таблицы, которые пишутся пакетами, и их колонки (в порядке значений строки)
+TABLE_COLUMNS = {
+    "messages": ("sender", "receiver", "content", "read", "timestamp"),
+    "group_messages": ("group_id", "sender", "content", "timestamp"),
+}
+# Пауза перед повтором, если база недоступна, сек
+RETRY_DELAY = 1.0
+
+
+class _Entry:
+    """Строка в очереди: таблица, значения, конец ее записи в журнале и время постановки"""
+    __slots__ = ("table", "values", "end", "queued_at")
+
+    def __init__(self, table, values, end, queued_at):
+        self.table = table
+        self.values = values
+        self.end = end
+        self.queued_at = queued_at
+
+
+class MessageWriter:
+    """Отложенная запись сообщений в БД пакетами (write-behind).
+
+    submit() дописывает строку в локальный журнал (spool/messages.log),
+    ставит ее в очередь и сразу возвращается, поэтому обработчик пересылает
+    сообщение, не дожидаясь базы. Поток записи раз в flush_interval секунд
+    или по накоплении batch_size строк вставляет их одним многострочным
+    INSERT ... VALUES на таблицу в одной транзакции. Поток один и берет
+    строки по порядку, поэтому порядок сообщений в переписке сохраняется.
+
+    После фиксации транзакции в messages.offset записывается, до какого
+    места журнал уже в базе; когда в базе все, журнал обнуляется. При
+    запуске строки после этого места записываются заново - сообщения,
+    принятые до падения сервера, не теряются (пакет, упавший между
+    фиксацией и записью смещения, может повториться). Если пакет не
+    вставился, строки повторяются по одной: строка с неверными данными
+    отбрасывается, а при недоступной базе запись ждет и повторяется.
+
+    Журнал сбрасывается в ОС (flush) на каждой строке, а на диск (fsync) -
+    раз на пакет, перед его вставкой: при падении процесса строки не
+    теряются, при падении ОС или отключении питания могут пропасть строки
+    последних flush_interval секунд.
+    """
+    def __init__(self, db_pool, spool_dir="spool", batch_size=200, flush_interval=0.05):
+        self.db_pool = db_pool
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        os.makedirs(spool_dir, exist_ok=True)
+        self._log_path = os.path.join(spool_dir, "messages.log")
+        self._offset_path = os.path.join(spool_dir, "messages.offset")
+
+        self._cond = threading.Condition()
+        self._queue = deque()
+        self._in_flight = 0  # взято потоком записи, но еще не в базе
+        self._closed = False
+
+        # Статистика
+        self._rows = 0
+        self._batches = 0
+        self._max_batch = 0
+        self._dropped = 0
+        self._retries = 0
+        self._latency_total = 0.0  # от submit до фиксации в базе, сумма по строкам
+        self._latency_max = 0.0
+        self._replayed = 0
+
+        self._replay()
+        self._log = open(self._log_path, "ab")
+        self._thread = threading.Thread(target=self._run, name="message-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, table, *values):
+        """Ставит строку в очередь записи; значения - в порядке TABLE_COLUMNS[table]"""
+        columns = TABLE_COLUMNS[table]
+        if len(values) == len(columns) - 1:
+            # Время сообщения - момент приема, а не момент записи пакета
+            values += (datetime.datetime.now(),)
+        line = json.dumps({"table": table, "values": [_encode(v) for v in values]}, ensure_ascii=False)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Message writer is closed")
+            # Запись и flush на каждую строку: после падения процесса строка останется в журнале,
+            # fsync - раз на пакет в потоке записи
+            self._log.write(line.encode("utf-8") + b"\n")
+            self._log.flush()
+            self._queue.append(_Entry(table, values, self._log.tell(), time.monotonic()))
+            if len(self._queue) >= self.batch_size:
+                self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """Ждет, пока все поставленные строки окажутся в базе; False по истечении timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._cond.notify_all()
+            while self._queue or self._in_flight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self, timeout=10.0):
+        """Записывает оставшееся и останавливает поток; недописанное остается в журнале"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        with self._cond:
+            self._log.close()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "queue_depth": len(self._queue) + self._in_flight,
+                "rows": self._rows,
+                "batches": self._batches,
+                "avg_batch": self._rows / self._batches if self._batches else 0.0,
+                "max_batch": self._max_batch,
+                "flush_latency_avg": self._latency_total / self._rows if self._rows else 0.0,
+                "flush_latency_max": self._latency_max,
+                "dropped": self._dropped,
+                "retries": self._retries,
+                "replayed": self._replayed,
+            }
+
+    def _run(self):
+        while True:
+            with self._cond:
+                # Пакет собирается, пока не наберется batch_size строк или не пройдет flush_interval
+                while not self._queue and not self._closed:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                deadline = self._queue[0].queued_at + self.flush_interval
+                while len(self._queue) < self.batch_size and not self._closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+                self._in_flight = len(batch)
+                log_fd = self._log.fileno()
+
+            # fsync вне блокировки, чтобы не задерживать submit()
+            try:
+                os.fsync(log_fd)
+            except OSError as e:
+                print(f"[WRITE BEHIND] Failed to sync spool: {e}")
+
+            written = self._write(batch)
+
+            with self._cond:
+                self._in_flight = 0
+                # Недописанные (база недоступна) возвращаются в начало очереди в том же порядке
+                self._queue.extendleft(reversed(batch[written:]))
+                if written:
+                    self._committed(batch[written - 1].end)
+                if written < len(batch):
+                    self._retries += 1
+                self._cond.notify_all()
+            if written < len(batch):
+                if self._closed:
+                    return
+                time.sleep(RETRY_DELAY)
+
+    def _write(self, batch):
+        """Вставляет пакет; возвращает, сколько строк с начала пакета обработано"""
+        try:
+            with self.db_pool.connection() as connection:
+                try:
+                    self._insert(connection, batch)
+                    connection.commit()
+                    self._record(batch)
+                    return len(batch)
+                except Exception as e:
+                    connection.rollback()
+                    if len(batch) == 1:
+                        return self._write_one(connection, batch[0], e)
+                    print(f"[WRITE BEHIND] Batch of {len(batch)} rows failed, retrying row by row: {e}")
+                # По одной: плохая строка не должна задерживать остальные
+                for index, entry in enumerate(batch):
+                    try:
+                        self._insert(connection, [entry])
+                        connection.commit()
+                        self._record([entry])
+                    except Exception as e:
+                        connection.rollback()
+                        if not self._write_one(connection, entry, e):
+                            return index
+                return len(batch)
+        except Exception as e:
+            print(f"[WRITE BEHIND] Database unavailable, {len(batch)} rows kept in the queue: {e}")
+            return 0
+
+    def _write_one(self, connection, entry, error):
+        """Строка не вставилась: если база жива, дело в данных - строка отбрасывается (1), иначе 0"""
+        cursor = connection.cursor()
+        try:
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+        except Exception:
+            return 0
+        finally:
+            cursor.close()
+        print(f"[WRITE BEHIND] Dropping {entry.table} row {entry.values[:2]}: {error}")
+        with self._cond:
+            self._dropped += 1
+        return 1
+
+    @staticmethod
+    def _insert(connection, batch):
+        # Одна многострочная вставка на таблицу, таблицы - в порядке первой строки
+        by_table = {}
+        for entry in batch:
+            by_table.setdefault(entry.table, []).append(entry.values)
+        cursor = connection.cursor()
+        try:
+            for table, rows in by_table.items():
+                columns = TABLE_COLUMNS[table]
+                placeholders = "(" + ", ".join(["%s"] * len(columns)) + ")"
+                cursor.execute(
+                    f"INSERT INTO {table} ({', '.join(columns)}) VALUES {', '.join([placeholders] * len(rows))}",
+                    [value for row in rows for value in row]
+                )
+        finally:
+            cursor.close()
+
+    def _record(self, batch):
+        now = time.monotonic()
+        with self._cond:
+            self._rows += len(batch)
+            self._batches += 1
+            self._max_batch = max(self._max_batch, len(batch))
+            for entry in batch:
+                latency = now - entry.queued_at
+                self._latency_total += latency
+                self._latency_max = max(self._latency_max, latency)
+
+    def _committed(self, end):
+        """Запоминает, до какого места журнал в базе; вызывается под self._cond"""
+        if not self._queue and not self._in_flight and end == self._log.tell():
+            # В базе все: журнал начинается заново
+            self._log.truncate(0)
+            self._log.seek(0)
+            end = 0
+        temp_path = f"{self._offset_path}.tmp"
+        with open(temp_path, "w") as f:
+            f.write(str(end))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self._offset_path)
+
+    def _replay(self):
+        """Ставит в очередь строки журнала, не попавшие в базу до остановки сервера"""
+        try:
+            with open(self._offset_path) as f:
+                offset = int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            offset = 0
+        try:
+            with open(self._log_path, "rb") as f:
+                if offset > os.fstat(f.fileno()).st_size:
+                    # Журнал обнулен, а новое смещение записать не успели
+                    offset = 0
+                f.seek(offset)
+                data = f.read()
+        except OSError:
+            return
+
+        end = offset
+        for line in data.split(b"\n")[:-1]:
+            end += len(line) + 1
+            try:
+                record = json.loads(line)
+                values = tuple(_decode(v) for v in record["values"])
+                TABLE_COLUMNS[record["table"]]
+            except (ValueError, KeyError, TypeError):
+                print(f"[WRITE BEHIND] Skipping corrupt spool line at {end - len(line) - 1}")
+                continue
+            self._queue.append(_Entry(record["table"], values, end, time.monotonic()))
+        if end < offset + len(data):
+            # Недописанная последняя строка (падение во время записи) отрезается
+            with open(self._log_path, "r+b") as f:
+                f.truncate(end)
+        self._replayed = len(self._queue)
+        if self._replayed:
+            print(f"[WRITE BEHIND] Replaying {self._replayed} spooled rows")
+
+
+def _encode(value):
+    if isinstance(value, datetime.datetime):
+        return {"datetime": value.isoformat()}
+    return value
+
+
+def _decode(value):
+    if isinstance(value, dict) and "datetime" in value:
+        return datetime.datetime.fromisoformat(value["datetime"])
+    return value
@@ -6,8 +6,10 @@ import os
 
 class NotificationDialog(QtWidgets.QDialog):
     friendsUpdated = QtCore.pyqtSignal()
+    friendshipChanged = QtCore.pyqtSignal(str)  # имя нового друга
     openChatRequested = QtCore.pyqtSignal(str)  # Сигнал для открытия чата
     groupsUpdated = QtCore.pyqtSignal()
+    groupMembershipChanged = QtCore.pyqtSignal(int)  # id группы, в которую вступил пользователь
     def __init__(self, connection, current_username):
         super().__init__()
         self.connection = connection
@@ -432,32 +434,6 @@ class NotificationDialog(QtWidgets.QDialog):
         try:
             cursor = self.connection.cursor()
 
-            # Проверяем существование таблицы group_invites
-            cursor.execute("""
-                SELECT EXISTS (
-                    SELECT FROM information_schema.tables 
-                    WHERE table_name = 'group_invites'
-                )
-            """)
-            table_exists = cursor.fetchone()[0]
-
-            if not table_exists:
-                # Создаем таблицу group_invites
-                cursor.execute("""
-                    CREATE TABLE group_invites (
-                        id VARCHAR(50) PRIMARY KEY,
-                        group_id INTEGER REFERENCES groups(id) ON DELETE CASCADE,
-                        inviter VARCHAR(50) REFERENCES users(username),
-                        invitee VARCHAR(50) REFERENCES users(username),
-                        status VARCHAR(20) DEFAULT 'pending',
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        responded_at TIMESTAMP
-                    )
-                """)
-                self.connection.commit()
-                self.add_no_notifications_label(self.group_invites_layout_inner)
-                return
-
             # Получаем приглашения в группы
             cursor.execute(
                 """
@@ -643,6 +619,9 @@ class NotificationDialog(QtWidgets.QDialog):
 
             self.connection.commit()
 
+            if status == "accepted":
+                self.groupMembershipChanged.emit(group_id)
+
             # Перезагружаем приглашения в группы
             self.load_group_invites()
 
@@ -663,68 +642,6 @@ class NotificationDialog(QtWidgets.QDialog):
         try:
             cursor = self.connection.cursor()
 
-            # Проверяем существование таблицы call_logs
-            cursor.execute("""
-                SELECT EXISTS (
-                    SELECT FROM information_schema.tables 
-                    WHERE table_name = 'call_logs'
-                )
-            """)
-            call_logs_exists = cursor.fetchone()[0]
-
-            if not call_logs_exists:
-                # Создаем таблицу call_logs с дополнительными полями
-                cursor.execute("""
-                    CREATE TABLE call_logs (
-                        id SERIAL PRIMARY KEY,
-                        caller VARCHAR(50) REFERENCES users(username),
-                        recipient VARCHAR(50) REFERENCES users(username),
-                        start_time TIMESTAMP,
-                        end_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        duration INTEGER NOT NULL,
-                        status VARCHAR(20) DEFAULT 'ended',
-                        timestamp BIGINT,
-                        notification_seen BOOLEAN DEFAULT FALSE
-                    )
-                """)
-                self.connection.commit()
-                self.add_no_notifications_label(self.missed_calls_layout_inner)
-                return
-
-            # Проверяем наличие колонки notification_seen
-            cursor.execute("""
-                SELECT EXISTS (
-                    SELECT FROM information_schema.columns 
-                    WHERE table_name = 'call_logs' AND column_name = 'notification_seen'
-                )
-            """)
-            has_notification_seen = cursor.fetchone()[0]
-
-            if not has_notification_seen:
-                # Добавляем колонку notification_seen
-                cursor.execute("""
-                    ALTER TABLE call_logs 
-                    ADD COLUMN notification_seen BOOLEAN DEFAULT FALSE
-                """)
-                self.connection.commit()
-
-            # Проверяем наличие колонки status
-            cursor.execute("""
-                SELECT EXISTS (
-                    SELECT FROM information_schema.columns 
-                    WHERE table_name = 'call_logs' AND column_name = 'status'
-                )
-            """)
-            has_status = cursor.fetchone()[0]
-
-            if not has_status:
-                # Добавляем колонку status
-                cursor.execute("""
-                    ALTER TABLE call_logs 
-                    ADD COLUMN status VARCHAR(20) DEFAULT 'ended'
-                """)
-                self.connection.commit()
-
             # Получаем пропущенные звонки
             cursor.execute(
                 """
@@ -757,23 +674,6 @@ class NotificationDialog(QtWidgets.QDialog):
         try:
             cursor = self.connection.cursor()
 
-            # Проверяем наличие колонки read в таблице messages
-            cursor.execute("""
-                SELECT EXISTS (
-                    SELECT FROM information_schema.columns 
-                    WHERE table_name = 'messages' AND column_name = 'read'
-                )
-            """)
-            has_read_column = cursor.fetchone()[0]
-
-            if not has_read_column:
-                # Добавляем колонку read
-                cursor.execute("""
-                    ALTER TABLE messages 
-                    ADD COLUMN read BOOLEAN DEFAULT TRUE
-                """)
-                self.connection.commit()
-
             # Получаем непрочитанные сообщения
             cursor.execute(
                 """
@@ -1159,6 +1059,9 @@ class NotificationDialog(QtWidgets.QDialog):
 
             self.connection.commit()
 
+            if status == "accepted":
+                self.friendshipChanged.emit(sender)
+
             # обновление списка
             self.load_friend_requests()
 
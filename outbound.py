@@ -0,0 +1,445 @@
+import asyncio
+import threading
+import time
+import weakref
+from collections import deque
+
+from protocol import FRAME_TEXT, FRAME_AUDIO, FRAME_SCREEN, FRAME_FILE, SCREEN_DELTA, SCREEN_HEADER
+
+# Потоки исходящих данных соединения
+STREAM_CHAT = "chat"  # команды и сообщения: никогда не отбрасываются
+STREAM_AUDIO = "audio"  # аудио звонков
+STREAM_SCREEN = "screen"  # части кадров демонстрации экрана (текстовый протокол) и прочие бинарные данные
+STREAM_SCREEN_FRAME = "screen_frame"  # целые кадры экрана FRAME_SCREEN
+STREAM_FILE = "file"  # части файлов: FRAME_FILE или строки FILE_TRANSFER:CHUNK
+
+# Политики переполнения
+NEVER_DROP = "never"
+DROP_OLDEST = "drop_oldest"
+WAIT_FOR_ROOM = "wait"  # отправитель не читает дальше, пока очередь не освободится (части файлов нельзя терять)
+
+# Сколько ждать места в очереди WAIT_FOR_ROOM, прежде чем считать получателя зависшим
+WAIT_FOR_ROOM_TIMEOUT = 30.0
+
+# Поток -> (политика, максимальная длина очереди)
+DEFAULT_POLICIES = {
+    STREAM_CHAT: (NEVER_DROP, None),
+    STREAM_AUDIO: (DROP_OLDEST, 50),  # ~1 сек аудио по 1024 сэмпла
+    STREAM_SCREEN: (DROP_OLDEST, 256),
+    STREAM_SCREEN_FRAME: (DROP_OLDEST, 4),  # медленный зритель получает свежие кадры, а не очередь старых
+    STREAM_FILE: (WAIT_FOR_ROOM, 8),  # до 2 МБ частей по 256 КБ на получателя
+}
+
+# Порядок выборки: аудио самое чувствительное к задержке, файлы никуда не спешат
+STREAM_PRIORITY = (STREAM_AUDIO, STREAM_CHAT, STREAM_SCREEN, STREAM_SCREEN_FRAME, STREAM_FILE)
+
+_live_queues = weakref.WeakSet()
+
+
+def live_queues():
+    """Все открытые очереди (для статистики)"""
+    return list(_live_queues)
+
+
+def send_on_stream(sock, data, stream, sender=None):
+    """Отправляет текстовые данные в указанный поток очереди (или напрямую, если очереди нет)"""
+    if isinstance(sock, OutboundQueue):
+        sock.send_stream(data, stream)
+        throttle_sender(sender, sock, stream)
+    else:
+        sock.send(data)
+
+
+def throttle_sender(sender, recipient, stream):
+    """Притормаживает отправителя, если очередь получателя в потоке WAIT_FOR_ROOM заполнена.
+
+    Отправитель-соединение (его очередь OutboundQueue) не читает следующие
+    данные, пока у получателя не освободится место (см.
+    OutboundQueue.wait_before_read); обработчик при этом не ждет. Без
+    соединения (раздача файла в своем потоке) ожидание идет здесь же.
+    """
+    if not isinstance(recipient, OutboundQueue) or recipient.has_room(stream):
+        return
+    if isinstance(sender, OutboundQueue):
+        sender.defer_reads(recipient, stream)
+    else:
+        recipient.wait_for_room(stream)
+
+
+def wait_before_read(sock):
+    """Потоковый режим: перед чтением ждет места у получателей, которым соединение отправляло файлы"""
+    if isinstance(sock, OutboundQueue):
+        sock.wait_before_read()
+
+
+async def wait_before_read_async(sock):
+    """asyncio режим: то же, ожидание в цикле событий, а не в потоке пула обработчиков"""
+    if isinstance(sock, OutboundQueue):
+        await sock.wait_before_read_async()
+
+
+class OutboundQueue:
+    """Ограниченная очередь исходящих данных соединения с отдельным писателем.
+
+    Обработчики кладут данные в очередь и сразу возвращаются, поэтому
+    медленный получатель не задерживает отправителя и остальных
+    получателей. Писатель (поток или задача asyncio) отправляет данные в
+    сокет. Для каждого потока данных задана политика переполнения:
+    аудио и кадры экрана вытесняют самые старые элементы (после
+    вытесненного кадра экрана разностные кадры той же демонстрации
+    отбрасываются до ключевого - иначе зритель наложит их на устаревший
+    холст), сообщения чата
+    не отбрасываются никогда, а части файлов ставятся всегда, но при
+    заполненной очереди соединение отправителя не читает дальше, пока
+    получатель ее не разберет (throttle_sender) - медленный получатель
+    притормаживает только отправителя файла. Получатель, не читавший
+    файлы WAIT_FOR_ROOM_TIMEOUT секунд, теряет их очередь (передача у него
+    не сойдется по размеру) и больше никого не притормаживает, пока не
+    разберет ее; соединение при этом не закрывается.
+
+    Интерфейс сокета сохранен: send/sendall ставят данные в поток чата,
+    send_frame - в поток по типу кадра; остальные атрибуты делегируются.
+    """
+    def __init__(self, sock, name=None, policies=None):
+        self.sock = sock
+        self.name = name
+        self.policies = dict(DEFAULT_POLICIES)
+        if policies:
+            self.policies.update(policies)
+
+        self._cond = threading.Condition()
+        self._queues = {stream: deque() for stream in self.policies}
+        self._closed = False
+        self._error = None
+        self._notify = None  # пробуждение писателя asyncio
+        self._room_waiters = []  # пробуждение отправителей asyncio, ждущих места в очереди
+        self._stalled = set()  # потоки WAIT_FOR_ROOM, которые получатель не читал дольше таймаута
+        self._deferred = {}  # очередь получателя -> поток, места в котором ждем перед следующим чтением
+        self._screen_resync = set()  # демонстрации, разностные кадры которых отбрасываются до ключевого
+
+        # Статистика
+        self.enqueued = {stream: 0 for stream in self.policies}
+        self.dropped = {stream: 0 for stream in self.policies}
+        self.max_depth = {stream: 0 for stream in self.policies}
+
+        _live_queues.add(self)
+
+    # --- интерфейс сокета ---
+
+    def send(self, data):
+        self._put(STREAM_CHAT, (None, bytes(data)))
+        return len(data)
+
+    def sendall(self, data):
+        self._put(STREAM_CHAT, (None, bytes(data)))
+
+    def send_frame(self, frame_type, payload):
+        """Бинарные данные: кадром для нового протокола, как есть для старого"""
+        if frame_type == FRAME_TEXT:
+            stream = STREAM_CHAT
+        elif frame_type == FRAME_AUDIO:
+            stream = STREAM_AUDIO
+        elif frame_type == FRAME_SCREEN:
+            stream = STREAM_SCREEN_FRAME
+        elif frame_type == FRAME_FILE:
+            stream = STREAM_FILE
+        else:
+            stream = STREAM_SCREEN
+        if not (isinstance(payload, memoryview) and payload.readonly):
+            payload = bytes(payload)
+        # Неизменяемый буфер (кадр из FrameDecoder) ставится во все очереди без копирования
+        self._put(stream, (frame_type, payload))
+
+    def send_stream(self, data, stream):
+        """Текстовые данные в указанный поток (например, части кадров экрана)"""
+        self._put(stream, (None, bytes(data)))
+
+    def close(self):
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            for queue in self._queues.values():
+                queue.clear()
+            self._cond.notify_all()
+            self._wake_room_waiters()
+        self._wake()
+        _live_queues.discard(self)
+        try:
+            self.sock.close()
+        except Exception:
+            pass
+
+    # --- ожидание места у получателя ---
+
+    def has_room(self, stream):
+        with self._cond:
+            return self._has_room(stream)
+
+    def wait_for_room(self, stream, timeout=WAIT_FOR_ROOM_TIMEOUT):
+        """Ждет места в потоке (блокирует поток); по таймауту сбрасывает очередь потока"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while not self._has_room(stream):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stall(stream)
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    async def wait_for_room_async(self, stream, timeout=WAIT_FOR_ROOM_TIMEOUT):
+        """То же для цикла событий: ожидание не занимает поток"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            room = loop.create_future()
+
+            def wake(room=room):
+                loop.call_soon_threadsafe(_resolve, room)
+
+            with self._cond:
+                if self._has_room(stream):
+                    return True
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    self._stall(stream)
+                    return False
+                self._room_waiters.append(wake)
+            try:
+                await asyncio.wait_for(room, remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    def defer_reads(self, recipient, stream):
+        """Запоминает получателя, места у которого соединение ждет перед следующим чтением"""
+        with self._cond:
+            self._deferred[recipient] = stream
+
+    def wait_before_read(self):
+        deferred = self._take_deferred()
+        deadline = time.monotonic() + WAIT_FOR_ROOM_TIMEOUT
+        for recipient, stream in deferred:
+            recipient.wait_for_room(stream, max(0.0, deadline - time.monotonic()))
+
+    async def wait_before_read_async(self):
+        deferred = self._take_deferred()
+        if deferred:
+            # Получатели ждутся одновременно: группа с несколькими медленными участниками ждет один таймаут
+            await asyncio.gather(*(recipient.wait_for_room_async(stream) for recipient, stream in deferred))
+
+    def _take_deferred(self):
+        with self._cond:
+            deferred, self._deferred = list(self._deferred.items()), {}
+        return deferred
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+    # --- писатели ---
+
+    def start_thread(self):
+        """Писатель в отдельном потоке (потоковый режим сервера)"""
+        thread = threading.Thread(target=self._run_thread, daemon=True)
+        thread.start()
+        return thread
+
+    def start_async(self, writer):
+        """Писатель-задача в цикле событий (asyncio режим); ждет drain() при заполненном буфере"""
+        loop = asyncio.get_running_loop()
+        wakeup = asyncio.Event()
+        loop_thread_id = threading.get_ident()
+
+        def notify():
+            if threading.get_ident() == loop_thread_id:
+                wakeup.set()
+            else:
+                loop.call_soon_threadsafe(wakeup.set)
+
+        self._notify = notify
+        return loop.create_task(self._run_async(writer, wakeup))
+
+    def _run_thread(self):
+        while True:
+            item = self._get(block=True)
+            if item is None:
+                return
+            if not self._write(item):
+                return
+
+    async def _run_async(self, writer, wakeup):
+        while True:
+            item = self._get(block=False)
+            if item is None:
+                if self._closed or self._error is not None:
+                    return
+                wakeup.clear()
+                # Повторная проверка: данные могли прийти до clear()
+                if self._depth() == 0:
+                    await wakeup.wait()
+                continue
+            if not self._write(item):
+                return
+            try:
+                await writer.drain()
+            except Exception as e:
+                self._fail(e)
+                return
+
+    def _write(self, item):
+        frame_type, payload = item
+        try:
+            if frame_type is None:
+                self.sock.sendall(payload)
+            elif hasattr(self.sock, "send_frame"):
+                self.sock.send_frame(frame_type, payload)
+            else:
+                self.sock.sendall(payload)
+            return True
+        except Exception as e:
+            self._fail(e)
+            return False
+
+    def _fail(self, error):
+        print(f"[OUTBOUND] Writer for {self.name} stopped: {error}")
+        with self._cond:
+            self._error = error
+            for queue in self._queues.values():
+                queue.clear()
+            self._cond.notify_all()
+            self._wake_room_waiters()
+
+    # --- очередь ---
+
+    def _put(self, stream, item):
+        with self._cond:
+            if self._closed:
+                raise ConnectionError("Connection is closed")
+            if self._error is not None:
+                raise ConnectionError(f"Connection failed: {self._error}")
+
+            queue = self._queues[stream]
+            policy, limit = self.policies[stream]
+            if limit is not None and len(queue) >= limit and (policy == DROP_OLDEST or stream in self._stalled):
+                # Зависший получатель файлов не притормаживает отправителей: лишнее отбрасывается
+                dropped = queue.popleft()
+                self.dropped[stream] += 1
+                if dropped[0] == FRAME_SCREEN:
+                    self._resync_screen(queue, stream, _screen_key(dropped[1])[1])
+            if item[0] == FRAME_SCREEN and self._screen_resync:
+                delta, key = _screen_key(item[1])
+                if key in self._screen_resync:
+                    if delta:
+                        self.dropped[stream] += 1
+                        return
+                    self._screen_resync.discard(key)
+            # WAIT_FOR_ROOM: часть ставится и сверх лимита, отправителя притормаживает throttle_sender
+            queue.append(item)
+            self.enqueued[stream] += 1
+            if len(queue) > self.max_depth[stream]:
+                self.max_depth[stream] = len(queue)
+            self._cond.notify_all()
+        self._wake()
+
+    def _get(self, block):
+        with self._cond:
+            while True:
+                for stream in STREAM_PRIORITY:
+                    queue = self._queues.get(stream)
+                    if queue:
+                        item = queue.popleft()
+                        if self.policies[stream][0] == WAIT_FOR_ROOM:
+                            if not queue:
+                                # Получатель разобрал очередь - снова притормаживает отправителей
+                                self._stalled.discard(stream)
+                            if self._has_room(stream):
+                                # В очереди освободилось место
+                                self._cond.notify_all()
+                                self._wake_room_waiters()
+                        return item
+                if self._closed or self._error is not None or not block:
+                    return None
+                self._cond.wait()
+
+    def _resync_screen(self, queue, stream, key):
+        """Кадр демонстрации key вытеснен: ее разностные кадры не нужны до ключевого; под self._cond"""
+        if key is None:
+            return
+        kept = deque()
+        keyframe_queued = False
+        for item in queue:
+            if not keyframe_queued and item[0] == FRAME_SCREEN:
+                delta, item_key = _screen_key(item[1])
+                if item_key == key:
+                    if delta:
+                        self.dropped[stream] += 1
+                        continue
+                    keyframe_queued = True
+            kept.append(item)
+        queue.clear()
+        queue.extend(kept)
+        if not keyframe_queued:
+            self._screen_resync.add(key)
+
+    def _has_room(self, stream):
+        """Вызывается под self._cond"""
+        limit = self.policies[stream][1]
+        return (self._closed or self._error is not None or stream in self._stalled
+                or limit is None or len(self._queues[stream]) < limit)
+
+    def _stall(self, stream):
+        """Получатель не читает поток: его очередь сбрасывается, соединение остается; под self._cond"""
+        queue = self._queues[stream]
+        print(f"[OUTBOUND] {self.name} is not reading {stream} data, dropping {len(queue)} queued items")
+        self.dropped[stream] += len(queue)
+        queue.clear()
+        self._stalled.add(stream)
+        self._cond.notify_all()
+        self._wake_room_waiters()
+
+    def _wake_room_waiters(self):
+        """Вызывается под self._cond"""
+        waiters, self._room_waiters = self._room_waiters, []
+        for wake in waiters:
+            try:
+                wake()
+            except RuntimeError:
+                # Цикл событий уже остановлен
+                pass
+
+    def _wake(self):
+        if self._notify is not None:
+            try:
+                self._notify()
+            except RuntimeError:
+                # Цикл событий уже остановлен
+                pass
+
+    def _depth(self):
+        with self._cond:
+            return sum(len(queue) for queue in self._queues.values())
+
+    def stats(self):
+        """Глубина очередей и счетчики отброшенных элементов по потокам"""
+        with self._cond:
+            return {
+                "name": self.name,
+                "depth": {stream: len(queue) for stream, queue in self._queues.items()},
+                "max_depth": dict(self.max_depth),
+                "enqueued": dict(self.enqueued),
+                "dropped": dict(self.dropped),
+            }
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+def _screen_key(payload):
+    """(разностный ли, демонстрация) кадра FRAME_SCREEN; демонстрация - вид, отправитель и адресат"""
+    if len(payload) < SCREEN_HEADER.size:
+        return False, None
+    kind, _, sender_size, target_size = SCREEN_HEADER.unpack_from(payload)
+    names_end = SCREEN_HEADER.size + sender_size + target_size
+    return bool(kind & SCREEN_DELTA), (kind & ~SCREEN_DELTA, sender_size, bytes(payload[SCREEN_HEADER.size:names_end]))
@@ -0,0 +1,389 @@
+import socket
+import struct
+import threading
+
+# Версии протокола:
+# 1 - устаревший: текстовые строки через '\n' вперемешку с сырыми бинарными данными
+# 2 - кадровый: [тип кадра: 1 байт][длина: 4 байта, big-endian][полезная нагрузка]
+# 3 - кадровый + кадры экрана FRAME_SCREEN (вместо SCREEN_DATA_* с base64)
+# 4 - разностные кадры экрана (только изменившиеся плитки, SCREEN_DELTA)
+# 5 - части файлов кадрами FRAME_FILE (вместо FILE_TRANSFER:CHUNK с base64)
+# 6 - файлы загружаются в хранилище сервера по SHA-256 (FILE_OFFER), с продолжением после обрыва
+PROTOCOL_LEGACY = 1
+PROTOCOL_FRAMED = 2
+PROTOCOL_SCREEN_FRAMES = 3
+PROTOCOL_SCREEN_TILES = 4
+PROTOCOL_FILE_FRAMES = 5
+PROTOCOL_FILE_BLOBS = 6
+PROTOCOL_VERSION = PROTOCOL_FILE_BLOBS
+
+# Приветствие клиента и ответ сервера: магическая последовательность + версия.
+# Начинается с 0xFF, поэтому старый сервер не может принять его за текст
+# (UnicodeDecodeError) и просто отбрасывает как "аудио" вне звонка.
+HELLO_MAGIC = b"\xffVOLUM"
+HELLO_SIZE = len(HELLO_MAGIC) + 1
+HANDSHAKE_TIMEOUT = 2.0
+
+# Типы кадров
+FRAME_TEXT = 1  # UTF-8 команды/сообщения (как строки старого протокола, с '\n')
+FRAME_AUDIO = 2  # PCM аудио звонков
+FRAME_BINARY = 3  # прочие бинарные данные (экран, файлы)
+FRAME_SCREEN = 4  # кадр демонстрации экрана: SCREEN_HEADER + имена + изображение (версия 3)
+FRAME_FILE = 5  # часть файла: FILE_HEADER + имена + данные (версия 5)
+FRAME_TYPES = (FRAME_TEXT, FRAME_AUDIO, FRAME_BINARY, FRAME_SCREEN, FRAME_FILE)
+
+FRAME_HEADER = struct.Struct("!BI")
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+# Кадры больше этого размера отправляются без склейки заголовка с данными
+SCATTER_MIN_SIZE = 16384
+
+# Кадр экрана: вид демонстрации, номер кадра, длины имени отправителя и адресата (UTF-8),
+# затем сами имена и изображение. Адресат - имя получателя или номер группы
+SCREEN_PERSONAL = 0
+SCREEN_GROUP = 1
+# Флаг в байте вида: изображение - разностный кадр screen_codec, а не JPEG
+SCREEN_DELTA = 0x80
+SCREEN_HEADER = struct.Struct("!BIBB")
+
+# Часть файла: вид передачи, номер передачи, смещение части в файле, длины имени
+# отправителя и адресата (UTF-8), затем имена и данные. Адресат - имя получателя или номер группы
+FILE_PERSONAL = 0
+FILE_GROUP = 1
+FILE_HEADER = struct.Struct("!BIQBB")
+
+# Размер чтения из сокета для кадрового протокола
+RECV_BUFFER_SIZE = 262144
+
+
+class FrameError(Exception):
+    """Нарушение кадрового протокола (неизвестный тип или слишком длинный кадр)"""
+
+
+def encode_frame(frame_type, payload):
+    """Собирает кадр: заголовок + полезная нагрузка"""
+    return FRAME_HEADER.pack(frame_type, len(payload)) + bytes(payload)
+
+
+def pack_screen_frame(kind, sender, target, frame_id, image, delta=False):
+    """Нагрузка кадра FRAME_SCREEN"""
+    sender = sender.encode("utf-8")
+    target = str(target).encode("utf-8")
+    flags = SCREEN_DELTA if delta else 0
+    header = SCREEN_HEADER.pack(kind | flags, frame_id & 0xFFFFFFFF, len(sender), len(target))
+    return b"".join((header, sender, target, image))
+
+
+def unpack_screen_frame(payload):
+    """(вид, отправитель, адресат, номер кадра, изображение, разностный ли) или None для поврежденного кадра.
+
+    Изображение возвращается срезом memoryview без копирования.
+    """
+    if len(payload) < SCREEN_HEADER.size:
+        return None
+    kind, frame_id, sender_size, target_size = SCREEN_HEADER.unpack_from(payload)
+    delta = bool(kind & SCREEN_DELTA)
+    kind &= ~SCREEN_DELTA
+    view = memoryview(payload)
+    start = SCREEN_HEADER.size
+    image_start = start + sender_size + target_size
+    if kind not in (SCREEN_PERSONAL, SCREEN_GROUP) or image_start > len(view):
+        return None
+    try:
+        sender = str(view[start:start + sender_size], "utf-8")
+        target = str(view[start + sender_size:image_start], "utf-8")
+    except UnicodeDecodeError:
+        return None
+    return kind, sender, target, frame_id, view[image_start:], delta
+
+
+def file_chunk_header(kind, sender, target, transfer_id, offset):
+    """Заголовок кадра FRAME_FILE с именами; за ним идут данные части"""
+    sender = sender.encode("utf-8")
+    target = str(target).encode("utf-8")
+    header = FILE_HEADER.pack(kind, transfer_id & 0xFFFFFFFF, offset, len(sender), len(target))
+    return b"".join((header, sender, target))
+
+
+def pack_file_chunk(kind, sender, target, transfer_id, offset, data):
+    """Нагрузка кадра FRAME_FILE"""
+    return file_chunk_header(kind, sender, target, transfer_id, offset) + bytes(data)
+
+
+def unpack_file_chunk(payload):
+    """(вид, отправитель, адресат, номер передачи, смещение, данные) или None для поврежденного кадра.
+
+    Данные возвращаются срезом memoryview без копирования.
+    """
+    if len(payload) < FILE_HEADER.size:
+        return None
+    kind, transfer_id, offset, sender_size, target_size = FILE_HEADER.unpack_from(payload)
+    view = memoryview(payload)
+    start = FILE_HEADER.size
+    data_start = start + sender_size + target_size
+    if kind not in (FILE_PERSONAL, FILE_GROUP) or data_start > len(view):
+        return None
+    try:
+        sender = str(view[start:start + sender_size], "utf-8")
+        target = str(view[start + sender_size:data_start], "utf-8")
+    except UnicodeDecodeError:
+        return None
+    return kind, sender, target, transfer_id, offset, view[data_start:]
+
+
+def sendall_parts(sock, parts):
+    """Отправляет части подряд без склейки в один буфер.
+
+    Сокет с send_parts (asyncio) получает части как есть, обычный сокет
+    отправляет их через sendmsg (scatter-gather); без sendmsg (Windows)
+    части склеиваются.
+    """
+    send_parts = getattr(sock, "send_parts", None)
+    if send_parts is not None:
+        send_parts(parts)
+        return
+    sendmsg = getattr(sock, "sendmsg", None)
+    if sendmsg is None:
+        sock.sendall(b"".join(parts))
+        return
+
+    views = [memoryview(part).cast("B") for part in parts]
+    while views:
+        sent = sendmsg(views)
+        while views and sent >= len(views[0]):
+            sent -= len(views[0])
+            views.pop(0)
+        if views and sent:
+            views[0] = views[0][sent:]
+
+
+class FrameDecoder:
+    """Потоковый разборщик кадров.
+
+    feed() принимает очередную порцию байт из recv и возвращает список
+    (тип, memoryview только для чтения) полностью полученных кадров. Кадры,
+    целиком лежащие в порции, возвращаются срезами memoryview без
+    копирования. Кадр, пришедший по частям, собирается в один растущий
+    буфер: в него дописывается только недостающее до конца кадра, и
+    готовый буфер отдается как есть, без копии. Каждый байт копируется не
+    больше одного раза, сколько бы частей ни было.
+    """
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self._pending = bytearray()
+
+    def feed(self, data):
+        view = memoryview(data)
+        frames = []
+        offset = 0
+        if self._pending:
+            offset = self._fill_pending(view, frames)
+            if self._pending:
+                return frames
+
+        total = len(view)
+        while total - offset >= FRAME_HEADER.size:
+            frame_type, length = self._header(view, offset)
+            start = offset + FRAME_HEADER.size
+            end = start + length
+            if end > total:
+                break
+
+            frames.append((frame_type, view[start:end].toreadonly()))
+            offset = end
+
+        if offset < total:
+            self._pending = bytearray(view[offset:])
+
+        return frames
+
+    def _fill_pending(self, view, frames):
+        """Дописывает в незавершенный кадр начало порции; возвращает, сколько байт порции взято"""
+        taken = 0
+        if len(self._pending) < FRAME_HEADER.size:
+            taken = min(FRAME_HEADER.size - len(self._pending), len(view))
+            self._pending += view[:taken]
+            if len(self._pending) < FRAME_HEADER.size:
+                return taken
+
+        frame_type, length = self._header(self._pending, 0)
+        need = FRAME_HEADER.size + length - len(self._pending)
+        size = min(need, len(view) - taken)
+        self._pending += view[taken:taken + size]
+        taken += size
+        if size == need:
+            # Буфер отдается вместе с кадром, следующий незавершенный кадр начнется в новом
+            frames.append((frame_type, memoryview(self._pending)[FRAME_HEADER.size:].toreadonly()))
+            self._pending = bytearray()
+        return taken
+
+    def _header(self, buffer, offset):
+        frame_type, length = FRAME_HEADER.unpack_from(buffer, offset)
+        if frame_type not in FRAME_TYPES:
+            raise FrameError(f"Unknown frame type {frame_type}")
+        if length > self.max_frame_size:
+            raise FrameError(f"Frame too large: {length} bytes")
+        return frame_type, length
+
+
+class FramedSocket:
+    """Обертка сокета для кадрового протокола.
+
+    send()/sendall() отправляют данные как текстовый кадр, поэтому
+    существующий код вида sock.send(f"...\\n".encode()) работает без
+    изменений. Бинарные данные отправляются через send_frame().
+    Остальные атрибуты (recv, close, setsockopt, ...) делегируются сокету.
+    version - согласованная версия протокола.
+    """
+    framed = True
+
+    def __init__(self, sock, version=PROTOCOL_FRAMED):
+        self.sock = sock
+        self.version = version
+        self._send_lock = threading.Lock()
+
+    def send_frame(self, frame_type, payload):
+        # Блокировка: кадры из разных потоков не должны перемешиваться
+        if len(payload) < SCATTER_MIN_SIZE:
+            frame = encode_frame(frame_type, payload)
+            with self._send_lock:
+                self.sock.sendall(frame)
+            return
+        # Крупный кадр (экран): заголовок и данные уходят без копирования данных
+        header = FRAME_HEADER.pack(frame_type, len(payload))
+        with self._send_lock:
+            sendall_parts(self.sock, (header, payload))
+
+    def send(self, data):
+        self.send_frame(FRAME_TEXT, data)
+        return len(data)
+
+    def sendall(self, data):
+        self.send_frame(FRAME_TEXT, data)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+def is_framed(sock):
+    return getattr(sock, "framed", False)
+
+
+def protocol_version(sock):
+    if not is_framed(sock):
+        return PROTOCOL_LEGACY
+    return getattr(sock, "version", PROTOCOL_FRAMED)
+
+
+def supports_screen_frames(sock):
+    """Понимает ли другая сторона кадры FRAME_SCREEN"""
+    return protocol_version(sock) >= PROTOCOL_SCREEN_FRAMES
+
+
+def supports_screen_tiles(sock):
+    """Понимает ли другая сторона разностные кадры экрана (SCREEN_DELTA)"""
+    return protocol_version(sock) >= PROTOCOL_SCREEN_TILES
+
+
+def supports_file_frames(sock):
+    """Понимает ли другая сторона части файлов FRAME_FILE"""
+    return protocol_version(sock) >= PROTOCOL_FILE_FRAMES
+
+
+def supports_file_blobs(sock):
+    """Принимает ли сервер файлы в хранилище (FILE_OFFER, продолжение загрузки)"""
+    return protocol_version(sock) >= PROTOCOL_FILE_BLOBS
+
+
+def send_binary(sock, frame_type, data):
+    """Отправляет бинарные данные: кадром для нового протокола, как есть для старого.
+
+    Объекты с send_frame (FramedSocket, очередь исходящих данных сервера)
+    сами решают, как отправить данные данного типа.
+    """
+    send_frame = getattr(sock, "send_frame", None)
+    if send_frame is not None:
+        send_frame(frame_type, data)
+    else:
+        sock.sendall(data)
+
+
+def make_hello(version=PROTOCOL_VERSION):
+    return HELLO_MAGIC + bytes([version])
+
+
+def parse_hello(data):
+    """Проверяет, начинается ли порция с приветствия.
+
+    Возвращает (версия, остаток данных) или (None, data), если это
+    обычные данные старого протокола.
+    """
+    if len(data) >= HELLO_SIZE and data[:len(HELLO_MAGIC)] == HELLO_MAGIC:
+        return data[len(HELLO_MAGIC)], data[HELLO_SIZE:]
+    return None, data
+
+
+class ServerHandshake:
+    """Серверная сторона согласования протокола.
+
+    Протокол определяется по первым байтам соединения: клиент нового
+    протокола начинает с приветствия, старый клиент сразу шлет текст.
+    """
+    def __init__(self):
+        self.done = False
+        self.decoder = None
+        self._head = b""
+
+    def accept(self, data, sock):
+        """Возвращает (сокет, данные без приветствия).
+
+        Для кадрового протокола отвечает клиенту, оборачивает сокет в
+        FramedSocket и создает self.decoder.
+        """
+        data = self._head + bytes(data)
+        self._head = b""
+
+        # Приветствие пришло не целиком - ждем продолжения
+        if len(data) < HELLO_SIZE and HELLO_MAGIC[:len(data)] == data[:len(HELLO_MAGIC)]:
+            self._head = data
+            return sock, b""
+
+        self.done = True
+        version, rest = parse_hello(data)
+        if version is None:
+            return sock, data
+
+        version = min(version, PROTOCOL_VERSION)
+        sock.sendall(make_hello(version))
+        if version < PROTOCOL_FRAMED:
+            return sock, rest
+
+        self.decoder = FrameDecoder()
+        return FramedSocket(sock, version), rest
+
+
+def client_handshake(sock, timeout=HANDSHAKE_TIMEOUT):
+    """Согласует версию протокола со стороны клиента.
+
+    Возвращает FramedSocket, если сервер поддерживает кадровый протокол,
+    иначе исходный сокет (старый сервер на приветствие не отвечает).
+    """
+    previous_timeout = sock.gettimeout()
+    try:
+        sock.sendall(make_hello())
+        sock.settimeout(timeout)
+        reply = b""
+        while len(reply) < HELLO_SIZE:
+            chunk = sock.recv(HELLO_SIZE - len(reply))
+            if not chunk:
+                break
+            reply += chunk
+        version, _ = parse_hello(reply)
+        if version is not None and version >= PROTOCOL_FRAMED:
+            return FramedSocket(sock, version)
+        if reply:
+            print("[PROTOCOL] Unexpected handshake reply, falling back to legacy protocol")
+    except socket.timeout:
+        print("[PROTOCOL] Server did not answer handshake, using legacy protocol")
+    finally:
+        sock.settimeout(previous_timeout)
+    return sock
@@ -0,0 +1,370 @@
+import ctypes
+import ctypes.util
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+try:
+    import mss
+except ImportError:  # захват через XShm или pyautogui
+    mss = None
+
+# Бэкенды захвата экрана в порядке предпочтения для "auto"
+CAPTURE_XSHM = "xshm"  # X11 MIT-SHM: сервер пишет снимок в общую память, без копий на стороне клиента
+CAPTURE_MSS = "mss"  # библиотека mss (Windows, macOS, X11), один объект на всю демонстрацию
+CAPTURE_PYAUTOGUI = "pyautogui"  # новый PIL-снимок на каждый кадр
+CAPTURE_BACKENDS = (CAPTURE_XSHM, CAPTURE_MSS, CAPTURE_PYAUTOGUI)
+
+# Готовых кадров в кольце: один пишет захват, один ждет в очереди, один сжимается, один у предпросмотра
+CAPTURE_BUFFERS = 4
+# Размер захватываемого окна перепроверяется раз в столько секунд
+WINDOW_GEOMETRY_INTERVAL = 1.0
+
+
+class CaptureError(Exception):
+    pass
+
+
+class CaptureBackend:
+    """Источник снимков экрана.
+
+    grab() возвращает массив (высота, ширина, каналы) в порядке color_order;
+    массив может указывать на внутренний буфер бэкенда и действителен до
+    следующего grab(). region - (x, y, ширина, высота) в координатах экрана.
+    """
+    name = None
+    color_order = "BGRA"
+
+    def __init__(self, region=None):
+        self.region = region
+
+    def grab(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class PyAutoGuiCapture(CaptureBackend):
+    """Снимок через pyautogui: новое PIL-изображение и копия в NumPy на каждый кадр"""
+    name = CAPTURE_PYAUTOGUI
+    color_order = "RGB"
+
+    def __init__(self, region=None):
+        super().__init__(region)
+        import pyautogui
+        self._pyautogui = pyautogui
+
+    def grab(self):
+        screenshot = self._pyautogui.screenshot(region=self.region)
+        return np.asarray(screenshot)
+
+
+class MssCapture(CaptureBackend):
+    """Снимок через mss: соединение с экраном открывается один раз, данные BGRA без копии в NumPy"""
+    name = CAPTURE_MSS
+
+    def __init__(self, region=None):
+        super().__init__(region)
+        if mss is None:
+            raise CaptureError("mss is not installed")
+        self._mss = mss.mss()
+        if region:
+            x, y, width, height = region
+            self._monitor = {"left": x, "top": y, "width": width, "height": height}
+        else:
+            self._monitor = self._mss.monitors[0]  # все мониторы, как у pyautogui
+
+    def grab(self):
+        shot = self._mss.grab(self._monitor)
+        return np.frombuffer(shot.raw, np.uint8).reshape(shot.height, shot.width, 4)
+
+    def close(self):
+        self._mss.close()
+
+
+# --- X11 MIT-SHM через ctypes ---
+
+_ZPIXMAP = 2
+_ALL_PLANES = 0xFFFFFFFF
+_IPC_PRIVATE = 0
+_IPC_CREAT = 0o1000
+_IPC_RMID = 0
+
+
+class _XImage(ctypes.Structure):
+    _fields_ = [
+        ("width", ctypes.c_int), ("height", ctypes.c_int), ("xoffset", ctypes.c_int),
+        ("format", ctypes.c_int), ("data", ctypes.c_void_p), ("byte_order", ctypes.c_int),
+        ("bitmap_unit", ctypes.c_int), ("bitmap_bit_order", ctypes.c_int), ("bitmap_pad", ctypes.c_int),
+        ("depth", ctypes.c_int), ("bytes_per_line", ctypes.c_int), ("bits_per_pixel", ctypes.c_int),
+        ("red_mask", ctypes.c_ulong), ("green_mask", ctypes.c_ulong), ("blue_mask", ctypes.c_ulong),
+        # Дальше obdata и таблица функций - они не нужны
+    ]
+
+
+class _XShmSegmentInfo(ctypes.Structure):
+    _fields_ = [
+        ("shmseg", ctypes.c_ulong), ("shmid", ctypes.c_int),
+        ("shmaddr", ctypes.c_void_p), ("readOnly", ctypes.c_int),
+    ]
+
+
+class _XWindowAttributes(ctypes.Structure):
+    _fields_ = [
+        ("x", ctypes.c_int), ("y", ctypes.c_int), ("width", ctypes.c_int), ("height", ctypes.c_int),
+        ("border_width", ctypes.c_int), ("depth", ctypes.c_int), ("visual", ctypes.c_void_p),
+        ("root", ctypes.c_ulong), ("class_", ctypes.c_int), ("bit_gravity", ctypes.c_int),
+        ("win_gravity", ctypes.c_int), ("backing_store", ctypes.c_int), ("backing_planes", ctypes.c_ulong),
+        ("backing_pixel", ctypes.c_ulong), ("save_under", ctypes.c_int), ("colormap", ctypes.c_ulong),
+        ("map_installed", ctypes.c_int), ("map_state", ctypes.c_int), ("all_event_masks", ctypes.c_long),
+        ("your_event_mask", ctypes.c_long), ("do_not_propagate_mask", ctypes.c_long),
+        ("override_redirect", ctypes.c_int), ("screen", ctypes.c_void_p),
+    ]
+
+
+_XErrorHandler = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p)
+_x11 = None
+
+
+def _load_x11():
+    """(libX11, libXext, libc) с объявленными сигнатурами; загружаются один раз"""
+    global _x11
+    if _x11 is not None:
+        return _x11
+    if not sys.platform.startswith("linux"):
+        raise CaptureError("XShm capture is only available on Linux/X11")
+    paths = [ctypes.util.find_library(name) for name in ("X11", "Xext", "c")]
+    if not all(paths):
+        raise CaptureError("libX11/libXext not found")
+    xlib, xext, libc = (ctypes.CDLL(path, use_errno=True) for path in paths)
+
+    xlib.XOpenDisplay.argtypes = [ctypes.c_char_p]
+    xlib.XOpenDisplay.restype = ctypes.c_void_p
+    xlib.XCloseDisplay.argtypes = [ctypes.c_void_p]
+    xlib.XDefaultRootWindow.argtypes = [ctypes.c_void_p]
+    xlib.XDefaultRootWindow.restype = ctypes.c_ulong
+    xlib.XGetWindowAttributes.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.POINTER(_XWindowAttributes)]
+    xlib.XSync.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    xlib.XFree.argtypes = [ctypes.c_void_p]
+    xlib.XSetErrorHandler.argtypes = [_XErrorHandler]
+    xlib.XSetErrorHandler.restype = ctypes.c_void_p
+
+    xext.XShmQueryExtension.argtypes = [ctypes.c_void_p]
+    xext.XShmCreateImage.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int,
+                                     ctypes.c_void_p, ctypes.POINTER(_XShmSegmentInfo), ctypes.c_uint, ctypes.c_uint]
+    xext.XShmCreateImage.restype = ctypes.POINTER(_XImage)
+    xext.XShmAttach.argtypes = [ctypes.c_void_p, ctypes.POINTER(_XShmSegmentInfo)]
+    xext.XShmDetach.argtypes = [ctypes.c_void_p, ctypes.POINTER(_XShmSegmentInfo)]
+    xext.XShmGetImage.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.POINTER(_XImage),
+                                  ctypes.c_int, ctypes.c_int, ctypes.c_ulong]
+
+    libc.shmget.argtypes = [ctypes.c_int, ctypes.c_size_t, ctypes.c_int]
+    libc.shmat.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int]
+    libc.shmat.restype = ctypes.c_void_p
+    libc.shmdt.argtypes = [ctypes.c_void_p]
+    libc.shmctl.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p]
+
+    # Обработчик Xlib по умолчанию завершает процесс при любой ошибке (например, окно закрыто)
+    state = {"error": 0}
+
+    def on_error(display, event):
+        state["error"] += 1
+        return 0
+
+    handler = _XErrorHandler(on_error)
+    xlib.XSetErrorHandler(handler)
+    _x11 = (xlib, xext, libc, state, handler)
+    return _x11
+
+
+class XShmCapture(CaptureBackend):
+    """Захват X11 через MIT-SHM.
+
+    Изображение размещается в сегменте общей памяти один раз; на каждый
+    кадр X-сервер копирует в него экран (XShmGetImage), а grab() возвращает
+    NumPy-представление этого сегмента без выделения памяти. window - id
+    окна X11: захватывается только оно (его размер перепроверяется раз в
+    WINDOW_GEOMETRY_INTERVAL).
+    """
+    name = CAPTURE_XSHM
+
+    def __init__(self, region=None, window=None):
+        super().__init__(region)
+        self._xlib, self._xext, self._libc, self._errors, _ = _load_x11()
+        self._display = self._xlib.XOpenDisplay(None)
+        if not self._display:
+            raise CaptureError("Cannot open X display")
+        self._image = None
+        self._shminfo = None
+        try:
+            if not self._xext.XShmQueryExtension(self._display):
+                raise CaptureError("MIT-SHM extension is not available")
+            self._drawable = window or self._xlib.XDefaultRootWindow(self._display)
+            self._window = window
+            self._setup()
+        except Exception:
+            self.close()
+            raise
+
+    def _attributes(self):
+        attributes = _XWindowAttributes()
+        if not self._xlib.XGetWindowAttributes(self._display, self._drawable, ctypes.byref(attributes)):
+            raise CaptureError(f"Cannot get attributes of window {self._drawable:#x}")
+        return attributes
+
+    def _setup(self):
+        attributes = self._attributes()
+        if self.region and not self._window:
+            x, y, width, height = self.region
+            # Область за краем экрана XShmGetImage не отдаст - обрезаем
+            x, y = max(0, min(x, attributes.width - 1)), max(0, min(y, attributes.height - 1))
+            width, height = min(width, attributes.width - x), min(height, attributes.height - y)
+        else:
+            x, y, width, height = 0, 0, attributes.width, attributes.height
+        self._origin = (x, y)
+        self._size = (width, height)
+        self._checked_at = time.monotonic()
+
+        shminfo = _XShmSegmentInfo()
+        image = self._xext.XShmCreateImage(self._display, attributes.visual, attributes.depth, _ZPIXMAP,
+                                           None, ctypes.byref(shminfo), width, height)
+        if not image:
+            raise CaptureError("XShmCreateImage failed")
+        self._image, self._shminfo = image, shminfo
+        if image.contents.bits_per_pixel != 32:
+            raise CaptureError(f"Unsupported pixel format: {image.contents.bits_per_pixel} bpp")
+        # Порядок байтов пикселя (little-endian TrueColor): обычно B, G, R, X
+        if image.contents.red_mask == 0xFF0000:
+            self.color_order = "BGRA"
+        elif image.contents.red_mask == 0xFF:
+            self.color_order = "RGBA"
+        else:
+            raise CaptureError(f"Unsupported visual: red mask {image.contents.red_mask:#x}")
+
+        size = image.contents.bytes_per_line * height
+        shminfo.shmid = self._libc.shmget(_IPC_PRIVATE, size, _IPC_CREAT | 0o600)
+        if shminfo.shmid < 0:
+            raise CaptureError(f"shmget failed: {os.strerror(ctypes.get_errno())}")
+        address = self._libc.shmat(shminfo.shmid, None, 0)
+        if address in (None, ctypes.c_void_p(-1).value):
+            self._libc.shmctl(shminfo.shmid, _IPC_RMID, None)
+            shminfo.shmid = -1
+            raise CaptureError(f"shmat failed: {os.strerror(ctypes.get_errno())}")
+        shminfo.shmaddr = address
+        image.contents.data = address
+        shminfo.readOnly = 0
+
+        errors = self._errors["error"]
+        self._xext.XShmAttach(self._display, ctypes.byref(shminfo))
+        self._xlib.XSync(self._display, 0)
+        # Сегмент удалится сам, когда его отпустят и X-сервер, и мы
+        self._libc.shmctl(shminfo.shmid, _IPC_RMID, None)
+        if self._errors["error"] != errors:
+            raise CaptureError("XShmAttach failed (remote X server?)")
+
+        row = (ctypes.c_uint8 * size).from_address(address)
+        self._frame = (np.ctypeslib.as_array(row)
+                       .reshape(height, image.contents.bytes_per_line)[:, :width * 4]
+                       .reshape(height, width, 4))
+
+    def _release(self):
+        if self._shminfo is not None and self._shminfo.shmaddr:
+            self._xext.XShmDetach(self._display, ctypes.byref(self._shminfo))
+            self._xlib.XSync(self._display, 0)
+            self._libc.shmdt(ctypes.c_void_p(self._shminfo.shmaddr))
+        if self._image:
+            # Данные - общая память, Xlib освобождает только структуру
+            self._image.contents.data = None
+            self._xlib.XFree(self._image)
+        self._image = None
+        self._shminfo = None
+        self._frame = None
+
+    def grab(self):
+        if self._window and time.monotonic() - self._checked_at >= WINDOW_GEOMETRY_INTERVAL:
+            self._checked_at = time.monotonic()
+            attributes = self._attributes()
+            if (attributes.width, attributes.height) != self._size:
+                self._release()
+                self._setup()
+
+        errors = self._errors["error"]
+        x, y = self._origin
+        ok = self._xext.XShmGetImage(self._display, self._drawable, self._image, x, y, _ALL_PLANES)
+        if not ok or self._errors["error"] != errors:
+            raise CaptureError("XShmGetImage failed (window closed or resized?)")
+        return self._frame
+
+    def close(self):
+        if self._display:
+            self._release()
+            self._xlib.XCloseDisplay(self._display)
+            self._display = None
+
+
+def create_capture_backend(backend="auto", region=None, window=None):
+    """Создает бэкенд захвата; "auto" - первый доступный из CAPTURE_BACKENDS"""
+    if window and backend not in ("auto", CAPTURE_XSHM):
+        raise CaptureError("Window capture requires the xshm backend")
+    names = (CAPTURE_XSHM,) if window else CAPTURE_BACKENDS
+    if backend != "auto":
+        names = (backend,)
+
+    errors = []
+    for name in names:
+        try:
+            if name == CAPTURE_XSHM:
+                return XShmCapture(region, window)
+            if name == CAPTURE_MSS:
+                return MssCapture(region)
+            if name == CAPTURE_PYAUTOGUI:
+                return PyAutoGuiCapture(region)
+            raise CaptureError(f"Unknown capture backend: {name}")
+        except Exception as e:
+            errors.append(f"{name}: {e}")
+    raise CaptureError("No screen capture backend available (" + "; ".join(errors) + ")")
+
+
+class ScreenGrabber:
+    """Снимок экрана в BGR нужного масштаба без выделения памяти на каждый кадр.
+
+    Масштабирование делается до преобразования цвета (по меньшему кадру), оба
+    шага пишут в заранее выделенные буферы; результат - один из
+    CAPTURE_BUFFERS кадров кольца, он не перезаписывается, пока захват не
+    пройдет кольцо по кругу.
+    """
+    _CONVERSIONS = {"BGRA": cv2.COLOR_BGRA2BGR, "RGB": cv2.COLOR_RGB2BGR, "RGBA": cv2.COLOR_RGBA2BGR}
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._scaled = None
+        self._ring = []
+        self._next = 0
+
+    @property
+    def name(self):
+        return self.backend.name
+
+    def capture(self, scale_factor=1.0):
+        frame = self.backend.grab()
+        h, w = frame.shape[:2]
+        size = (max(1, int(w * scale_factor)), max(1, int(h * scale_factor)))
+        out_shape = (size[1], size[0], 3)
+        if not self._ring or self._ring[0].shape != out_shape:
+            self._ring = [np.empty(out_shape, np.uint8) for _ in range(CAPTURE_BUFFERS)]
+            self._scaled = np.empty((size[1], size[0], frame.shape[2]), np.uint8)
+        out = self._ring[self._next]
+        self._next = (self._next + 1) % len(self._ring)
+
+        if size != (w, h):
+            cv2.resize(frame, size, dst=self._scaled, interpolation=cv2.INTER_AREA)
+            frame = self._scaled
+        cv2.cvtColor(frame, self._CONVERSIONS[self.backend.color_order], dst=out)
+        return out
+
+    def close(self):
+        self.backend.close()
@@ -0,0 +1,196 @@
+import math
+import struct
+import time
+
+import cv2
+import numpy as np
+
+# Сторона плитки в пикселях (кратна 16, поэтому блоки JPEG не выходят за границы плиток)
+TILE_SIZE = 64
+# Полный кадр отправляется не реже, чем раз в столько секунд (новые зрители, потерянные кадры)
+KEYFRAME_INTERVAL = 2.0
+# Если изменилась большая доля плиток, полный кадр выходит не дороже
+MAX_DELTA_TILES_RATIO = 0.5
+
+# Разностный кадр: ширина, высота исходного кадра, сторона плитки, число плиток,
+# затем номера плиток (построчно, !H) и JPEG мозаики из этих плиток
+DELTA_HEADER = struct.Struct("!HHBH")
+
+# Декодирование сразу в RGB появилось в OpenCV 4.10; в старых версиях - BGR и преобразование на месте
+_IMREAD_RGB = getattr(cv2, "IMREAD_COLOR_RGB", None)
+
+
+def decode_jpeg(data, rgb=False):
+    """JPEG -> кадр BGR (или RGB при rgb=True), None, если данные повреждены"""
+    buffer = np.frombuffer(data, np.uint8)
+    if rgb and _IMREAD_RGB is not None:
+        return cv2.imdecode(buffer, _IMREAD_RGB)
+    image = cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+    if rgb and image is not None:
+        cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=image)
+    return image
+
+
+def _tile_grid(frame, tile_size):
+    """Кадр, дополненный до целого числа плиток, и его вид (строки, столбцы, tile, tile, каналы)"""
+    h, w = frame.shape[:2]
+    rows, cols = math.ceil(h / tile_size), math.ceil(w / tile_size)
+    pad_h, pad_w = rows * tile_size - h, cols * tile_size - w
+    if pad_h or pad_w:
+        frame = np.pad(frame, ((0, pad_h), (0, pad_w), (0, 0)), mode="edge")
+    frame = np.ascontiguousarray(frame)
+    grid = frame.reshape(rows, tile_size, cols, tile_size, frame.shape[2])
+    return frame, grid
+
+
+class TileEncoder:
+    """Кодирует кадры экрана: полный JPEG (ключевой кадр) или только изменившиеся плитки.
+
+    encode() возвращает (данные, разностный ли кадр) или None, если экран
+    не изменился. Ключевой кадр - обычный JPEG, его понимают и старые клиенты.
+    """
+    def __init__(self, quality, tile_size=TILE_SIZE, keyframe_interval=KEYFRAME_INTERVAL):
+        self.quality = quality
+        self.tile_size = tile_size
+        self.keyframe_interval = keyframe_interval
+        self._previous = None
+        self._last_keyframe = 0.0
+
+        # Статистика
+        self.keyframes = 0
+        self.deltas = 0
+        self.skipped = 0
+        self.bytes_sent = 0
+
+    def force_keyframe(self):
+        """Следующий кадр - ключевой (зритель пропустил разностный кадр); можно вызывать из любого потока"""
+        self._previous = None
+
+    def encode(self, frame):
+        now = time.monotonic()
+        padded, grid = _tile_grid(frame, self.tile_size)
+
+        # Один раз: force_keyframe() из другого потока может сбросить _previous во время сравнения
+        previous = self._previous
+        if (previous is None or previous.shape != padded.shape
+                or now - self._last_keyframe >= self.keyframe_interval):
+            return self._keyframe(frame, padded, now)
+
+        previous_grid = previous.reshape(grid.shape)
+        dirty = np.any(grid != previous_grid, axis=(1, 3, 4))
+        rows, cols = np.nonzero(dirty)
+        if len(rows) == 0:
+            self.skipped += 1
+            return None
+        if len(rows) > dirty.size * MAX_DELTA_TILES_RATIO:
+            return self._keyframe(frame, padded, now)
+
+        # Изменившиеся плитки складываются в мозаику и сжимаются одним JPEG
+        tiles = grid[rows, :, cols]  # (n, tile, tile, каналы)
+        count = len(tiles)
+        mosaic_cols = math.ceil(math.sqrt(count))
+        mosaic_rows = math.ceil(count / mosaic_cols)
+        if mosaic_rows * mosaic_cols > count:
+            filler = np.zeros((mosaic_rows * mosaic_cols - count,) + tiles.shape[1:], dtype=tiles.dtype)
+            tiles = np.concatenate((tiles, filler))
+        size = self.tile_size
+        mosaic = (tiles.reshape(mosaic_rows, mosaic_cols, size, size, -1)
+                  .swapaxes(1, 2)
+                  .reshape(mosaic_rows * size, mosaic_cols * size, -1))
+        ok, jpeg = cv2.imencode('.jpg', mosaic, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        if not ok:
+            return None
+
+        indices = (rows * dirty.shape[1] + cols).astype(">u2")
+        h, w = frame.shape[:2]
+        data = DELTA_HEADER.pack(w, h, size, count) + indices.tobytes() + jpeg.tobytes()
+        self._remember(padded)
+        self.deltas += 1
+        self.bytes_sent += len(data)
+        return data, True
+
+    def _remember(self, padded):
+        """Копия кадра для сравнения: входной кадр может быть буфером, который захват перезапишет"""
+        if self._previous is None or self._previous.shape != padded.shape:
+            self._previous = padded.copy()
+        else:
+            np.copyto(self._previous, padded)
+
+    def _keyframe(self, frame, padded, now):
+        ok, jpeg = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        if not ok:
+            return None
+        self._remember(padded)
+        self._last_keyframe = now
+        self.keyframes += 1
+        data = jpeg.tobytes()
+        self.bytes_sent += len(data)
+        return data, False
+
+
+class TileDecoder:
+    """Собирает изображение из ключевых и разностных кадров на постоянном холсте.
+
+    С rgb=True холст хранится в RGB - его можно отдавать Qt без преобразования цветов.
+    Если передан номер кадра, пропуск в нумерации перед разностным кадром
+    (кадр отброшен по дороге) означает, что холст устарел: разностные кадры
+    пропускаются до ключевого, а waiting_keyframe становится True.
+    """
+    def __init__(self, rgb=False):
+        self.rgb = rgb
+        self._canvas = None
+        self._grid = None
+        self._size = None  # (ширина, высота) исходного кадра
+        self._tile_size = None
+        self._frame_id = None  # номер последнего полученного кадра
+        self.waiting_keyframe = False
+
+    def decode(self, data, delta, frame_id=None):
+        """Кадр BGR (RGB) или None (поврежден, пропущен кадр или нет ключевого кадра)"""
+        if frame_id is not None:
+            expected = None if self._frame_id is None else (self._frame_id + 1) & 0xFFFFFFFF
+            self._frame_id = frame_id
+            if delta and frame_id != expected:
+                self.waiting_keyframe = True
+
+        if not delta:
+            frame = decode_jpeg(data, self.rgb)
+            if frame is None:
+                return None
+            # Холст в разметке плиток задается первым разностным кадром
+            self._canvas = frame
+            self._grid = None
+            self._size = (frame.shape[1], frame.shape[0])
+            self.waiting_keyframe = False
+            return frame
+
+        if self._canvas is None:
+            self.waiting_keyframe = True
+        if self.waiting_keyframe or len(data) < DELTA_HEADER.size:
+            return None
+        w, h, tile_size, count = DELTA_HEADER.unpack_from(data)
+        if (w, h) != self._size:
+            return None  # размер экрана сменился - ждем ключевой кадр
+        offset = DELTA_HEADER.size
+        indices = np.frombuffer(data, dtype=">u2", count=count, offset=offset)
+        offset += count * 2
+        mosaic = decode_jpeg(memoryview(data)[offset:], self.rgb)
+        if mosaic is None:
+            # Плитки этого кадра потеряны - следующие наложились бы на устаревший холст
+            self.waiting_keyframe = True
+            return None
+
+        if self._grid is None or self._tile_size != tile_size:
+            self._canvas, self._grid = _tile_grid(self._canvas, tile_size)
+            self._tile_size = tile_size
+        rows, cols = np.divmod(indices.astype(np.int64), self._grid.shape[2])
+        if count and rows.max() >= self._grid.shape[0]:
+            self.waiting_keyframe = True
+            return None
+
+        mosaic_cols = mosaic.shape[1] // tile_size
+        tiles = (mosaic.reshape(mosaic.shape[0] // tile_size, tile_size, mosaic_cols, tile_size, -1)
+                 .swapaxes(1, 2)
+                 .reshape(-1, tile_size, tile_size, mosaic.shape[2]))
+        self._grid[rows, :, cols] = tiles[:count]
+        return self._canvas[:h, :w]
@@ -0,0 +1,214 @@
+import base64
+import threading
+import time
+from collections import deque
+
+import cv2
+import numpy as np
+from PyQt5.QtGui import QImage
+
+from screen_codec import TileDecoder
+
+# Разностных кадров в очереди больше этого - декодер безнадежно отстал, ждем ключевой кадр
+MAX_QUEUED_FRAMES = 64
+# Буферов готовых изображений: одно пишет декодер, одно ждет в почтовом ящике, одно рисует GUI
+VIEW_BUFFERS = 3
+
+
+class LatestFrameMailbox:
+    """Почтовый ящик на одно изображение между потоком декодера и GUI.
+
+    put() заменяет еще не забранное изображение и возвращает True, только
+    если ящик был пуст, - тогда GUI надо уведомить; так в очереди событий GUI
+    не бывает больше одного кадра. take() отдает изображение и запоминает
+    его буфер как занятый до следующего take().
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = None  # (номер буфера, буфер, QImage)
+        self._taken = None  # то, что сейчас рисует GUI: буфер жив, пока его не сменит следующий take()
+        self.replaced = 0
+
+    def put(self, item):
+        with self._lock:
+            was_empty = self._pending is None
+            if not was_empty:
+                self.replaced += 1
+            self._pending = item
+            return was_empty
+
+    def take(self):
+        with self._lock:
+            item, self._pending = self._pending, None
+            if item is None:
+                return None
+            self._taken = item
+            return item[2]
+
+    def free_buffer(self):
+        """Номер буфера, который не ждет в ящике и не рисуется"""
+        with self._lock:
+            busy = {item[0] for item in (self._taken, self._pending) if item is not None}
+        return next(index for index in range(VIEW_BUFFERS) if index not in busy)
+
+
+class ScreenDecodeWorker:
+    """Поток, который готовит кадры демонстрации экрана к отрисовке.
+
+    Принимает сжатые кадры (submit) и кадры BGR для предпросмотра у
+    отправителя (submit_raw), декодирует JPEG сразу в RGB на холст
+    TileDecoder, масштабирует под размер окна в заранее выделенные буферы и
+    кладет готовый QImage в LatestFrameMailbox. GUI только забирает его
+    (take) и рисует без масштабирования. Разностные кадры декодируются все
+    и по порядку (иначе холст испортится), кадры до последнего ключевого в
+    очереди пропускаются. on_ready() вызывается из потока декодера, когда в
+    пустом ящике появился кадр. on_keyframe_needed() вызывается оттуда же,
+    когда декодер заметил пропуск в номерах кадров и ждет ключевой кадр.
+    """
+    def __init__(self, on_ready, name="SCREEN VIEW", on_keyframe_needed=None):
+        self._on_ready = on_ready
+        self._on_keyframe_needed = on_keyframe_needed
+        self.name = name
+        self.mailbox = LatestFrameMailbox()
+        self._decoder = TileDecoder(rgb=True)
+        self._queue = deque()  # (данные, разностный ли, кадр BGR или None, номер кадра); (None, False, None, None) - перерисовка
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+
+        self._view_size = None  # (ширина, высота) области отображения
+        self._last_frame = None  # (кадр, BGR ли) - перерисовывается при изменении размера окна
+        self._buffers = []
+        self._buffer_shape = None
+
+        # Статистика
+        self.decoded = 0
+        self.skipped = 0
+        self.decode_time = 0.0
+
+    @property
+    def running(self):
+        return self._running
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._queue.clear()
+            self._cond.notify()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join(timeout=1.0)
+        self._thread = None
+
+    def set_view_size(self, width, height):
+        """Размер области отображения (вызывается из GUI при изменении размера)"""
+        view_size = (width, height) if width > 0 and height > 0 else None
+        if view_size != self._view_size:
+            self._view_size = view_size
+            self._put((None, False, None, None), keyframe=False)  # перемасштабировать последний кадр
+
+    def submit(self, data, delta, frame_id=None):
+        """Сжатый кадр: JPEG, разностный кадр или строка base64 старого протокола"""
+        self._put((data, delta, None, frame_id), keyframe=not delta)
+
+    def submit_raw(self, frame):
+        """Кадр BGR (предпросмотр у отправителя) - старые кадры в очереди не нужны"""
+        self._put((None, False, frame, None), keyframe=True)
+
+    def take(self):
+        """Готовый QImage для GUI или None"""
+        return self.mailbox.take()
+
+    def _put(self, item, keyframe):
+        with self._cond:
+            if not self._running:
+                return
+            if keyframe:
+                # Ключевой кадр заменяет холст целиком - все, что перед ним, можно не декодировать
+                self.skipped += len(self._queue)
+                self._queue.clear()
+            elif len(self._queue) >= MAX_QUEUED_FRAMES:
+                print(f"[{self.name}] Decoder is behind, waiting for a keyframe")
+                self.skipped += len(self._queue)
+                self._queue.clear()
+                self._decoder = TileDecoder(rgb=True)
+            self._queue.append(item)
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and not self._queue:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                data, delta, raw, frame_id = self._queue.popleft()
+                backlog = bool(self._queue)
+            try:
+                started = time.monotonic()
+                if raw is not None:
+                    self._publish(raw, bgr=True)
+                    continue
+                if data is None:
+                    if self._last_frame is not None and not backlog:
+                        self._publish(*self._last_frame)
+                    continue
+                if isinstance(data, str):
+                    data = base64.b64decode(data)
+                decoder = self._decoder  # _put может заменить декодер, пока этот кадр декодируется
+                waiting = decoder.waiting_keyframe
+                frame = decoder.decode(data, delta, frame_id)
+                self.decoded += 1
+                if decoder.waiting_keyframe and not waiting and self._on_keyframe_needed:
+                    print(f"[{self.name}] Missed a screen frame, requesting a keyframe")
+                    self._on_keyframe_needed()
+                # При очереди кадров холст обновляется, а масштабируется и рисуется только последний
+                if frame is not None and not backlog:
+                    self._publish(frame, bgr=False)
+                self.decode_time += time.monotonic() - started
+            except Exception as e:
+                print(f"[{self.name} ERROR] Error decoding frame: {e}")
+
+    def _publish(self, frame, bgr):
+        self._last_frame = (frame, bgr)
+        h, w = frame.shape[:2]
+        if h == 0 or w == 0:
+            return
+        if self._view_size:
+            view_w, view_h = self._view_size
+            scale = min(view_w / w, view_h / h)
+            size = (max(1, int(w * scale)), max(1, int(h * scale)))
+        else:
+            size = (w, h)
+
+        shape = (size[1], size[0], 3)
+        if shape != self._buffer_shape:
+            # Буферы выделяются заново только при изменении размера окна или кадра
+            self._buffers = [np.empty(shape, np.uint8) for _ in range(VIEW_BUFFERS)]
+            self._buffer_shape = shape
+        index = self.mailbox.free_buffer()
+        buffer = self._buffers[index]
+
+        if size == (w, h):
+            np.copyto(buffer, frame)
+        else:
+            interpolation = cv2.INTER_AREA if size[0] < w else cv2.INTER_LINEAR
+            cv2.resize(frame, size, dst=buffer, interpolation=interpolation)
+        if bgr:
+            cv2.cvtColor(buffer, cv2.COLOR_BGR2RGB, dst=buffer)
+
+        image = QImage(buffer.data, size[0], size[1], buffer.strides[0], QImage.Format_RGB888)
+        if self.mailbox.put((index, buffer, image)):
+            self._on_ready()
+
+    def stats(self):
+        return {
+            "decoded": self.decoded,
+            "skipped": self.skipped,
+            "replaced": self.mailbox.replaced,
+            "decode_ms": self.decode_time / self.decoded * 1000 if self.decoded else 0.0,
+        }
@@ -0,0 +1,435 @@
+import threading
+import time
+from collections import deque
+
+# Пределы, в которых контроллер меняет параметры демонстрации
+MIN_FPS = 2
+MAX_FPS = 30
+MIN_QUALITY = 20
+MAX_QUALITY = 70
+MIN_SCALE = 0.25
+MAX_SCALE = 1.0
+SCALE_STEP = 0.125
+QUALITY_STEP = 10
+# Ниже этой частоты при перегрузке сети снижается качество, а не FPS
+QUALITY_FIRST_FPS = 5
+
+# Контроллер пересматривает параметры раз в столько секунд
+CONTROL_INTERVAL = 1.0
+# Параметры растут только после стольких спокойных интервалов подряд
+RECOVERY_INTERVALS = 3
+# Перегрузка сети: отправка занимает больше этой доли интервала между кадрами
+SEND_BUSY_RATIO = 0.5
+# Запас для роста: отправка и сжатие укладываются в эту долю интервала
+HEADROOM_RATIO = 0.25
+# Неподтвержденных кадров больше этого - зритель (или путь до него) не успевает
+MAX_FRAMES_IN_FLIGHT = 3
+# Зритель, не подтверждавший кадры столько секунд, не учитывается (ушел или старый клиент)
+ACK_VIEWER_TIMEOUT = 3.0
+# Коэффициент сглаживания измерений
+SMOOTHING = 0.2
+# Статистика стадий выводится раз в столько секунд
+STATS_INTERVAL = 5.0
+
+
+class FrameQueue:
+    """Очередь между стадиями конвейера.
+
+    С drop_stale=True put() никогда не ждет: при переполнении выбрасывается
+    самый старый кадр (следующей стадии нужен только свежий экран). Без
+    drop_stale put() ждет места - так кодер не выбрасывает разностные кадры,
+    без которых зритель не соберет изображение.
+    """
+    def __init__(self, maxsize=1, drop_stale=True):
+        self.maxsize = maxsize
+        self.drop_stale = drop_stale
+        self._items = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self.dropped = 0
+
+    def put(self, item):
+        """False, если очередь закрыта"""
+        with self._cond:
+            while not self.drop_stale and len(self._items) >= self.maxsize and not self._closed:
+                self._cond.wait()
+            if self._closed:
+                return False
+            if len(self._items) >= self.maxsize:
+                self._items.popleft()
+                self.dropped += 1
+            self._items.append(item)
+            self._cond.notify_all()
+            return True
+
+    def get(self, timeout=None):
+        """Очередной кадр или None (таймаут или очередь закрыта)"""
+        with self._cond:
+            if not self._items and not self._closed:
+                self._cond.wait(timeout)
+            if not self._items:
+                return None
+            item = self._items.popleft()
+            self._cond.notify_all()
+            return item
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._items.clear()
+            self._cond.notify_all()
+
+
+class StageStats:
+    """Счетчики одной стадии: кадры, время работы, байты"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.frames = 0
+        self.busy = 0.0
+        self.bytes = 0
+        self._window = (time.monotonic(), 0, 0.0, 0)
+
+    def record(self, seconds, nbytes=0):
+        with self._lock:
+            self.frames += 1
+            self.busy += seconds
+            self.bytes += nbytes
+
+    def snapshot(self):
+        """fps, мс на кадр и байт/с с предыдущего снимка"""
+        with self._lock:
+            now = time.monotonic()
+            started, frames, busy, nbytes = self._window
+            self._window = (now, self.frames, self.busy, self.bytes)
+            elapsed = max(now - started, 1e-6)
+            count = self.frames - frames
+            return {
+                "frames": self.frames,
+                "fps": count / elapsed,
+                "ms": (self.busy - busy) / count * 1000 if count else 0.0,
+                "bytes_per_sec": (self.bytes - nbytes) / elapsed,
+            }
+
+
+class AdaptiveController:
+    """Подбирает FPS, масштаб и качество JPEG демонстрации экрана.
+
+    Сигналы перегрузки: отправка кадра блокируется дольше SEND_BUSY_RATIO
+    интервала (переполнен буфер сокета), зритель не подтверждает больше
+    MAX_FRAMES_IN_FLIGHT кадров (SCREEN_ACK), захват и сжатие не укладываются
+    в интервал между кадрами. При перегрузке сети сначала снижается FPS (до
+    QUALITY_FIRST_FPS), затем качество, затем масштаб; при нехватке
+    процессора - FPS до достижимого и масштаб. После RECOVERY_INTERVALS
+    спокойных интервалов параметры растут по шагу: FPS до QUALITY_FIRST_FPS,
+    качество, масштаб, затем FPS до MAX_FPS.
+    """
+    def __init__(self, fps, scale_factor, quality, adaptive=True):
+        self.fps = fps
+        self.scale_factor = scale_factor
+        self.quality = quality
+        self.adaptive = adaptive
+        self._lock = threading.Lock()
+        self._last_update = time.monotonic()
+        self._calm_intervals = 0
+
+        # Измерения
+        self.send_time = None  # сглаженное время отправки кадра, с
+        self.work_time = None  # сглаженное время самой медленной из стадий захвата и сжатия, с
+        self.ack_time = None  # сглаженное время от отправки до подтверждения, с
+        self._sent_at = {}  # номер кадра -> время отправки
+        self._last_sent = None
+        self._viewers = {}  # зритель -> (последний подтвержденный номер, время подтверждения)
+
+        # Статистика
+        self.decreases = 0
+        self.increases = 0
+
+    def on_work(self, seconds):
+        """Время кадра на самой медленной стадии захвата и сжатия (они идут параллельно)"""
+        with self._lock:
+            self.work_time = _smooth(self.work_time, seconds)
+
+    def on_sent(self, frame_id, seconds):
+        with self._lock:
+            self.send_time = _smooth(self.send_time, seconds)
+            self._last_sent = frame_id
+            self._sent_at[frame_id] = time.monotonic()
+            while len(self._sent_at) > 64:
+                del self._sent_at[next(iter(self._sent_at))]
+
+    def on_ack(self, viewer, frame_id):
+        """Зритель получил кадр frame_id"""
+        with self._lock:
+            now = time.monotonic()
+            sent_at = self._sent_at.get(frame_id)
+            if sent_at is not None:
+                self.ack_time = _smooth(self.ack_time, now - sent_at)
+            previous = self._viewers.get(viewer)
+            if previous is None or frame_id >= previous[0]:
+                self._viewers[viewer] = (frame_id, now)
+
+    def frames_in_flight(self):
+        """Отставание самого медленного зрителя или None, если подтверждений нет"""
+        with self._lock:
+            return self._frames_in_flight(time.monotonic())
+
+    def _frames_in_flight(self, now):
+        for viewer, (_, acked_at) in list(self._viewers.items()):
+            if now - acked_at > ACK_VIEWER_TIMEOUT:
+                del self._viewers[viewer]
+        if not self._viewers or self._last_sent is None:
+            return None
+        return self._last_sent - min(frame_id for frame_id, _ in self._viewers.values())
+
+    def maybe_update(self):
+        """Раз в CONTROL_INTERVAL пересматривает параметры; True, если они изменились"""
+        now = time.monotonic()
+        if not self.adaptive or now - self._last_update < CONTROL_INTERVAL:
+            return False
+        with self._lock:
+            self._last_update = now
+            interval = 1.0 / self.fps
+            in_flight = self._frames_in_flight(now)
+            network_busy = ((self.send_time is not None and self.send_time > interval * SEND_BUSY_RATIO)
+                            or (in_flight is not None and in_flight > MAX_FRAMES_IN_FLIGHT))
+            cpu_busy = self.work_time is not None and self.work_time > interval
+
+            if network_busy or cpu_busy:
+                self._calm_intervals = 0
+                return self._decrease(network_busy)
+
+            headroom = ((self.send_time is None or self.send_time < interval * HEADROOM_RATIO)
+                        and (self.work_time is None or self.work_time < interval * HEADROOM_RATIO * 2)
+                        and (in_flight is None or in_flight <= 1))
+            self._calm_intervals = self._calm_intervals + 1 if headroom else 0
+            if self._calm_intervals < RECOVERY_INTERVALS:
+                return False
+            self._calm_intervals = 0
+            return self._increase()
+
+    def _decrease(self, network_busy):
+        fps, scale, quality = self.fps, self.scale_factor, self.quality
+        if network_busy:
+            if self.fps > QUALITY_FIRST_FPS:
+                self.fps = max(QUALITY_FIRST_FPS, int(self.fps * 0.7))
+            elif self.quality > MIN_QUALITY:
+                self.quality = max(MIN_QUALITY, self.quality - QUALITY_STEP)
+            elif self.fps > MIN_FPS:
+                self.fps = max(MIN_FPS, self.fps - 1)
+            else:
+                self.scale_factor = max(MIN_SCALE, self.scale_factor - SCALE_STEP)
+        else:
+            # Процессор не успевает: частота, которую он держит, а дальше меньший кадр
+            achievable = int(1.0 / self.work_time)
+            if achievable >= QUALITY_FIRST_FPS and achievable < self.fps:
+                self.fps = max(MIN_FPS, achievable)
+            else:
+                self.fps = max(MIN_FPS, min(self.fps, QUALITY_FIRST_FPS))
+                self.scale_factor = max(MIN_SCALE, self.scale_factor - SCALE_STEP)
+                self.work_time = None  # время кадра другого размера измеряется заново
+        changed = (fps, scale, quality) != (self.fps, self.scale_factor, self.quality)
+        if changed:
+            self.decreases += 1
+        return changed
+
+    def _increase(self):
+        fps, scale, quality = self.fps, self.scale_factor, self.quality
+        if self.fps < QUALITY_FIRST_FPS:
+            self.fps += 1
+        elif self.quality < MAX_QUALITY:
+            self.quality = min(MAX_QUALITY, self.quality + QUALITY_STEP)
+        elif self.scale_factor < MAX_SCALE:
+            self.scale_factor = min(MAX_SCALE, self.scale_factor + SCALE_STEP)
+            self.work_time = None
+        elif self.fps < MAX_FPS:
+            self.fps = min(MAX_FPS, self.fps + 2)
+        changed = (fps, scale, quality) != (self.fps, self.scale_factor, self.quality)
+        if changed:
+            self.increases += 1
+        return changed
+
+
+def _smooth(average, value):
+    return value if average is None else average + (value - average) * SMOOTHING
+
+
+class ScreenPipeline:
+    """Конвейер демонстрации экрана: захват -> сжатие -> отправка в отдельных потоках.
+
+    capture(scale_factor) возвращает кадр BGR, encode(frame, quality) -
+    (данные, разностный ли) или None, если экран не изменился, send(data,
+    delta) - номер отправленного кадра или None (кадр пропущен); ошибка
+    соединения - ConnectionError. Медленная отправка не тормозит захват:
+    захват кладет кадры в очередь на одно место, и сжатие всегда берет
+    самый свежий. Параметры задает AdaptiveController. on_capture_stop()
+    вызывается в потоке захвата при его завершении (освободить источник).
+    """
+    def __init__(self, capture, encode, send, controller, name="SCREEN", on_stop=None, max_retries=3,
+                 on_capture_stop=None):
+        self._capture = capture
+        self._encode = encode
+        self._send = send
+        self.controller = controller
+        self.name = name
+        self._on_stop = on_stop
+        self._on_capture_stop = on_capture_stop
+        self.max_retries = max_retries
+
+        self.raw_frames = FrameQueue(1, drop_stale=True)
+        self.encoded_frames = FrameQueue(1, drop_stale=False)
+        self.capture_stats = StageStats()
+        self.encode_stats = StageStats()
+        self.send_stats = StageStats()
+        self.unchanged = 0
+
+        self._running = False
+        self._state_lock = threading.Lock()
+        self._threads = []
+        self._last_report = time.monotonic()
+
+    @property
+    def running(self):
+        return self._running
+
+    def start(self):
+        self._running = True
+        self._threads = [threading.Thread(target=target, daemon=True)
+                         for target in (self._capture_loop, self._encode_loop, self._send_loop)]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout=1.0):
+        """Останавливает стадии и ждет их не дольше timeout секунд в сумме"""
+        self._stop()
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join(timeout=max(0.0, deadline - time.monotonic()))
+        self._threads = []
+
+    def _stop(self):
+        with self._state_lock:
+            if not self._running:
+                return
+            self._running = False
+        self.raw_frames.close()
+        self.encoded_frames.close()
+        if time.monotonic() - self._last_report >= 1.0:
+            self.report()  # итог с последнего отчета (за слишком короткое окно скорости неточны)
+        if self._on_stop:
+            self._on_stop()
+
+    # --- стадии ---
+
+    def _capture_loop(self):
+        errors = 0
+        next_tick = time.monotonic()
+        while self._running:
+            try:
+                if self.controller.maybe_update():
+                    controller = self.controller
+                    print(f"[{self.name}] Adjusted to fps={controller.fps} scale={controller.scale_factor:.3f} "
+                          f"quality={controller.quality}")
+                if time.monotonic() - self._last_report >= STATS_INTERVAL:
+                    self.report()
+
+                started = time.monotonic()
+                frame = self._capture(self.controller.scale_factor)
+                self.capture_stats.record(time.monotonic() - started)
+                self.raw_frames.put((frame, time.monotonic() - started))
+                errors = 0
+            except Exception as e:
+                print(f"[{self.name} ERROR] Frame capture error: {e}")
+                errors += 1
+                if errors >= self.max_retries:
+                    break
+                time.sleep(1)
+
+            # Такт захвата не зависит от сжатия и отправки
+            next_tick += 1.0 / self.controller.fps
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_tick = time.monotonic()
+        self._stop()
+        if self._on_capture_stop:
+            try:
+                self._on_capture_stop()
+            except Exception as e:
+                print(f"[{self.name} ERROR] Error releasing capture: {e}")
+
+    def _encode_loop(self):
+        while self._running:
+            item = self.raw_frames.get(timeout=0.5)
+            if item is None:
+                continue
+            frame, capture_time = item
+            try:
+                started = time.monotonic()
+                encoded = self._encode(frame, self.controller.quality)
+                elapsed = time.monotonic() - started
+                self.controller.on_work(max(capture_time, elapsed))
+                if encoded is None:
+                    self.unchanged += 1
+                    continue
+                self.encode_stats.record(elapsed, len(encoded[0]))
+                self.encoded_frames.put(encoded)
+            except Exception as e:
+                print(f"[{self.name} ERROR] Frame encode error: {e}")
+
+    def _send_loop(self):
+        retry_count = 0
+        while self._running:
+            item = self.encoded_frames.get(timeout=0.5)
+            if item is None:
+                continue
+            data, delta = item
+            try:
+                started = time.monotonic()
+                frame_id = self._send(data, delta)
+                elapsed = time.monotonic() - started
+                retry_count = 0
+                if frame_id is None:
+                    continue
+                self.send_stats.record(elapsed, len(data))
+                self.controller.on_sent(frame_id, elapsed)
+            except ConnectionError as e:
+                print(f"[{self.name} ERROR] Connection error: {e}")
+                retry_count += 1
+                if retry_count >= self.max_retries:
+                    print(f"[{self.name} ERROR] Max retries reached, stopping")
+                    break
+                time.sleep(1)
+            except Exception as e:
+                print(f"[{self.name} ERROR] Frame send error: {e}")
+        self._stop()
+
+    # --- статистика ---
+
+    def stats(self):
+        controller = self.controller
+        return {
+            "capture": self.capture_stats.snapshot(),
+            "encode": self.encode_stats.snapshot(),
+            "send": self.send_stats.snapshot(),
+            "dropped": self.raw_frames.dropped,
+            "unchanged": self.unchanged,
+            "fps": controller.fps,
+            "scale_factor": controller.scale_factor,
+            "quality": controller.quality,
+            "in_flight": controller.frames_in_flight(),
+            "ack_ms": controller.ack_time * 1000 if controller.ack_time is not None else None,
+        }
+
+    def report(self):
+        self._last_report = time.monotonic()
+        stats = self.stats()
+        capture, encode, send = stats["capture"], stats["encode"], stats["send"]
+        ack = f"{stats['ack_ms']:.0f}ms" if stats["ack_ms"] is not None else "n/a"
+        print(f"[{self.name}] target fps={stats['fps']} scale={stats['scale_factor']:.3f} quality={stats['quality']} | "
+              f"capture {capture['fps']:.1f}fps {capture['ms']:.1f}ms dropped={stats['dropped']} | "
+              f"encode {encode['fps']:.1f}fps {encode['ms']:.1f}ms {encode['bytes_per_sec'] / 1024:.0f}KB/s "
+              f"unchanged={stats['unchanged']} | "
+              f"send {send['fps']:.1f}fps {send['ms']:.1f}ms {send['bytes_per_sec'] / 1024:.0f}KB/s "
+              f"in_flight={stats['in_flight']} ack={ack}")
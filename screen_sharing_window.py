@@ -1,42 +1,85 @@
+import os
 import sys
 from PyQt5 import QtWidgets, QtCore, QtGui
 import numpy as np
 import cv2
-import pyautogui
 import time
 import threading
 import socket
 import struct
 import zlib
 import base64
+from protocol import (FRAME_SCREEN, SCREEN_GROUP, SCREEN_PERSONAL, pack_screen_frame, send_binary,
+                      supports_screen_frames, supports_screen_tiles)
+from screen_capture import ScreenGrabber, create_capture_backend
+from screen_codec import TileEncoder
+from screen_decoder import ScreenDecodeWorker
+from screen_pipeline import AdaptiveController, ScreenPipeline
+
+# Подстройка FPS, масштаба и качества под сеть и процессор; 0 - параметры по умолчанию без изменений
+SCREEN_ADAPTIVE = os.environ.get("VOLUM_SCREEN_ADAPTIVE", "1") == "1"
+# Бэкенд захвата: auto, xshm, mss или pyautogui (см. screen_capture.py)
+SCREEN_CAPTURE_BACKEND = os.environ.get("VOLUM_SCREEN_CAPTURE", "auto")
+
+
+def parse_capture_region(value):
+    """ "x,y,ширина,высота" -> кортеж или None (весь экран)"""
+    try:
+        region = tuple(int(part) for part in value.split(","))
+    except ValueError:
+        region = ()
+    if len(region) != 4 or region[2] <= 0 or region[3] <= 0:
+        if value:
+            print(f"[SCREEN] Ignoring invalid capture region: {value}")
+        return None
+    return region
+
+
+# Демонстрация части экрана (VOLUM_SCREEN_REGION=x,y,ширина,высота) или одного окна X11 (VOLUM_SCREEN_WINDOW=id)
+SCREEN_CAPTURE_REGION = parse_capture_region(os.environ.get("VOLUM_SCREEN_REGION", ""))
+SCREEN_CAPTURE_WINDOW = int(os.environ.get("VOLUM_SCREEN_WINDOW", "0"), 0) or None
 
 
 class ScreenSharingWindow(QtWidgets.QDialog):
+    # Поток декодера положил готовый кадр в пустой почтовый ящик
+    frame_ready = QtCore.pyqtSignal()
+
     def __init__(self, username, friend_name, is_sender=False, parent=None):
         super().__init__(parent)
         self.username = username
         self.friend_name = friend_name
         self.is_sender = is_sender
         self.is_active = False
-        self.capture_thread = None
+        self.pipeline = None  # потоки захвата, сжатия и отправки
+        self.grabber = None  # источник снимков, живет в потоке захвата
+        self.capture_region = SCREEN_CAPTURE_REGION
+        self.capture_window = SCREEN_CAPTURE_WINDOW
+        self.controller = None
         self.client_socket = None
         self.parent = parent
 
         self.is_group_sharing = False
         self.group_id = None
 
-        # Настройки захвата экрана
-        self.fps = 15  # Снижаем FPS
-        self.quality = 30  # Снижаем качество сжатия JPEG
-        self.scale_factor = 0.5  # Уменьшаем масштаб
+        # Начальные настройки захвата экрана (дальше их подстраивает AdaptiveController)
+        self.fps = 15
+        self.quality = 30
+        self.scale_factor = 0.5
         self.frame_counter = 0
         self.chunk_size = 2000
         self.is_group_receiver = False
         self.group_id = None
         self.screen_sender = None
         self.group_screen_buffers = {}
+        # Разностное кодирование: отправитель шлет только изменившиеся плитки, получатель собирает холст
+        self.tile_encoder = TileEncoder(self.quality)
         self.setup_ui()
 
+        # Декодирование и масштабирование - в отдельном потоке, GUI только рисует готовый кадр
+        self.decode_worker = ScreenDecodeWorker(self.frame_ready.emit, on_keyframe_needed=self.request_keyframe)
+        self.frame_ready.connect(self.show_pending_frame)
+        self.decode_worker.start()
+
     def setup_ui(self):
         self.setWindowTitle("Демонстрация экрана")
         self.resize(800, 600)
@@ -51,6 +94,8 @@ class ScreenSharingWindow(QtWidgets.QDialog):
         self.screen_label = QtWidgets.QLabel()
         self.screen_label.setAlignment(QtCore.Qt.AlignCenter)
         self.screen_label.setStyleSheet("background-color: #000000; border-radius: 5px;")
+        # Размер метки задает окно, а не кадр (иначе большой кадр растягивает окно)
+        self.screen_label.setSizePolicy(QtWidgets.QSizePolicy.Ignored, QtWidgets.QSizePolicy.Ignored)
         self.layout.addWidget(self.screen_label)
 
         # Панель управления
@@ -93,93 +138,110 @@ class ScreenSharingWindow(QtWidgets.QDialog):
         if self.is_sender:
             self.client_socket = client_socket
             self.is_active = True
-            self.capture_thread = threading.Thread(target=self.capture_and_send_screen)
-            self.capture_thread.daemon = True
-            self.capture_thread.start()
-
-    def capture_and_send_group_screen(self):
-        """Захватывает экран и отправляет его всем участникам группы"""
-        retry_count = 0
-        max_retries = 3
-
-        try:
-            while self.is_active and self.is_group_sharing:
-                try:
-                    start_time = time.time()
-
-                    # Захват экрана
-                    screenshot = pyautogui.screenshot()
-                    frame = np.array(screenshot)
-                    frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
-
-                    # Масштабирование
-                    h, w = frame.shape[:2]
-                    frame = cv2.resize(frame, (int(w * self.scale_factor), int(h * self.scale_factor)))
-
-                    # Отображение в окне отправителя
-                    self.display_frame(frame)
-
-                    # Сжатие
-                    _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
-                    data = buffer.tobytes()
-
-                    # Проверяем размер данных
-                    if len(data) > 100000:  # Если больше 100KB, пропускаем кадр
-                        print(f"[GROUP SCREEN] Skipping large frame: {len(data)} bytes")
-                        time.sleep(1.0 / self.fps)
-                        continue
-
-                    encoded_data = base64.b64encode(data).decode('utf-8')
-                    chunks = [encoded_data[i:i + self.chunk_size] for i in range(0, len(encoded_data), self.chunk_size)]
-
-                    frame_id = self.frame_counter
-                    self.frame_counter += 1
-
-                    # Отправляем с проверкой соединения
-                    try:
-                        start_msg = f"GROUP_SCREEN_DATA_START:{self.username}:{self.group_id}:{frame_id}:{len(chunks)}"
-                        self.client_socket.send(start_msg.encode('utf-8') + b'\n')
-
-                        for i, chunk in enumerate(chunks):
-                            if not self.is_active or not self.is_group_sharing:
-                                break
-
-                            chunk_msg = f"GROUP_SCREEN_DATA_CHUNK:{self.username}:{self.group_id}:{frame_id}:{i}:{chunk}"
-                            self.client_socket.send(chunk_msg.encode('utf-8') + b'\n')
-                            time.sleep(0.01)
-
-                        if self.is_active and self.is_group_sharing:
-                            end_msg = f"GROUP_SCREEN_DATA_END:{self.username}:{self.group_id}:{frame_id}"
-                            self.client_socket.send(end_msg.encode('utf-8') + b'\n')
-
-                        retry_count = 0
-
-                    except ConnectionError as e:
-                        print(f"[GROUP SCREEN ERROR] Connection error: {e}")
-                        retry_count += 1
-                        if retry_count >= max_retries:
-                            print(f"[GROUP SCREEN ERROR] Max retries reached, stopping")
-                            break
-                        time.sleep(1)
-                        continue
-
-                    # Поддержание FPS
-                    elapsed = time.time() - start_time
-                    sleep_time = max(0, 1.0 / self.fps - elapsed)
-                    time.sleep(sleep_time)
-
-                except Exception as e:
-                    print(f"[GROUP SCREEN ERROR] Frame capture error: {e}")
-                    retry_count += 1
-                    if retry_count >= max_retries:
-                        break
-                    time.sleep(1)
+            self.start_pipeline(self.send_screen_frame, "SCREEN")
+
+    def start_pipeline(self, send, name):
+        """Запускает потоки захвата, сжатия и отправки кадров"""
+        self.tile_encoder = TileEncoder(self.quality)
+        self.controller = AdaptiveController(self.fps, self.scale_factor, self.quality, adaptive=SCREEN_ADAPTIVE)
+        self.pipeline = ScreenPipeline(self.capture_screen_frame, self.encode_screen_frame, send,
+                                       self.controller, name=name, on_stop=self.on_pipeline_stopped,
+                                       on_capture_stop=self.close_grabber)
+        self.pipeline.start()
+
+    def on_pipeline_stopped(self):
+        self.is_active = False
+        self.is_group_sharing = False
 
-        except Exception as e:
-            print(f"Ошибка группового захвата экрана: {e}")
-        finally:
-            self.is_active = False
-            self.is_group_sharing = False
+    def on_screen_ack(self, viewer, frame_id):
+        """Зритель подтвердил получение кадра (SCREEN_ACK)"""
+        if self.controller is not None:
+            self.controller.on_ack(viewer, frame_id)
+
+    def force_keyframe(self):
+        """Зритель пропустил разностный кадр (SCREEN_KEYFRAME) - следующим отправляется ключевой"""
+        self.tile_encoder.force_keyframe()
+
+    def request_keyframe(self):
+        """Декодер пропустил кадр - просим демонстрирующего прислать ключевой (из потока декодера)"""
+        client = getattr(self.parent, "client", None)
+        if client is None or self.is_sender:
+            return
+        if self.is_group_receiver:
+            client.request_screen_keyframe(self.screen_sender, self.group_id)
+        else:
+            client.request_screen_keyframe(self.friend_name)
+
+    def capture_screen_frame(self, scale_factor):
+        """Снимок экрана (области или окна) в BGR, уменьшенный до scale_factor"""
+        if self.grabber is None:
+            backend = create_capture_backend(SCREEN_CAPTURE_BACKEND, self.capture_region, self.capture_window)
+            print(f"[SCREEN] Capturing with {backend.name} backend")
+            self.grabber = ScreenGrabber(backend)
+        return self.grabber.capture(scale_factor)
+
+    def close_grabber(self):
+        if self.grabber is not None:
+            self.grabber.close()
+            self.grabber = None
+
+    def encode_screen_frame(self, frame, quality):
+        """(данные, разностный ли) для отправки или None, если экран не изменился.
+
+        Разностные кадры (только изменившиеся плитки) отправляются, если их
+        понимает сервер; иначе каждый кадр - полный JPEG.
+        """
+        # Отображение в окне отправителя (масштабирует поток декодера)
+        self.decode_worker.submit_raw(frame)
+
+        if supports_screen_tiles(self.client_socket):
+            self.tile_encoder.quality = quality
+            return self.tile_encoder.encode(frame)
+        _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        return buffer.tobytes(), False
+
+    def send_screen_frame(self, data, delta):
+        """Отправляет кадр личной демонстрации, возвращает его номер"""
+        return self.send_frame_data(SCREEN_PERSONAL, "SCREEN_DATA", self.friend_name, data, delta)
+
+    def send_group_screen_frame(self, data, delta):
+        """Отправляет кадр групповой демонстрации, возвращает его номер"""
+        return self.send_frame_data(SCREEN_GROUP, "GROUP_SCREEN_DATA", self.group_id, data, delta)
+
+    def send_frame_data(self, kind, prefix, target, data, delta):
+        binary = supports_screen_frames(self.client_socket)
+
+        # Проверяем размер данных (по текстовому протоколу большой кадр идет слишком долго)
+        if not binary and len(data) > 100000:  # Если больше 100KB, пропускаем кадр
+            print(f"[SCREEN] Skipping large frame: {len(data)} bytes")
+            return None
+
+        frame_id = self.frame_counter
+        self.frame_counter += 1
+
+        if binary:
+            # Весь кадр одним бинарным кадром: без base64 и пауз между частями
+            send_binary(self.client_socket, FRAME_SCREEN,
+                        pack_screen_frame(kind, self.username, target, frame_id, data, delta))
+            return frame_id
+
+        encoded_data = base64.b64encode(data).decode('utf-8')
+        chunks = [encoded_data[i:i + self.chunk_size] for i in range(0, len(encoded_data), self.chunk_size)]
+
+        start_msg = f"{prefix}_START:{self.username}:{target}:{frame_id}:{len(chunks)}"
+        self.client_socket.send(start_msg.encode('utf-8') + b'\n')
+
+        for i, chunk in enumerate(chunks):
+            if not self.is_active:  # Проверяем, не остановлена ли передача
+                return None
+
+            chunk_msg = f"{prefix}_CHUNK:{self.username}:{target}:{frame_id}:{i}:{chunk}"
+            self.client_socket.send(chunk_msg.encode('utf-8') + b'\n')
+            time.sleep(0.01)
+
+        end_msg = f"{prefix}_END:{self.username}:{target}:{frame_id}"
+        self.client_socket.send(end_msg.encode('utf-8') + b'\n')
+        return frame_id
 
     def setup_group_receiving(self, group_id, sender):
         """настройка окна для приема групповой демонстрации"""
@@ -223,9 +285,7 @@ class ScreenSharingWindow(QtWidgets.QDialog):
             # Обновляем информационную метку
             self.info_label.setText(f"Вы демонстрируете экран для группы")
 
-            self.capture_thread = threading.Thread(target=self.capture_and_send_group_screen)
-            self.capture_thread.daemon = True
-            self.capture_thread.start()
+            self.start_pipeline(self.send_group_screen_frame, "GROUP SCREEN")
 
     def receive_sharing(self, client_socket):
         """Начинает прием демонстрации экрана"""
@@ -233,104 +293,17 @@ class ScreenSharingWindow(QtWidgets.QDialog):
             self.client_socket = client_socket
             self.is_active = True
 
-    def capture_and_send_screen(self):
-        """Захватывает экран и отправляет его получателю"""
-        retry_count = 0
-        max_retries = 3
-
-        try:
-            while self.is_active:
-                try:
-                    start_time = time.time()
-
-                    # Захват экрана
-                    screenshot = pyautogui.screenshot()
-                    frame = np.array(screenshot)
-                    frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
-
-                    # Масштабирование
-                    h, w = frame.shape[:2]
-                    frame = cv2.resize(frame, (int(w * self.scale_factor), int(h * self.scale_factor)))
-
-                    # Отображение в окне отправителя
-                    self.display_frame(frame)
-
-                    # Сжатие
-                    _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
-                    data = buffer.tobytes()
-
-                    # Проверяем размер данных
-                    if len(data) > 100000:  # Если больше 100KB, пропускаем кадр
-                        print(f"[SCREEN] Skipping large frame: {len(data)} bytes")
-                        time.sleep(1.0 / self.fps)
-                        continue
-
-                    encoded_data = base64.b64encode(data).decode('utf-8')
-                    chunks = [encoded_data[i:i + self.chunk_size] for i in range(0, len(encoded_data), self.chunk_size)]
-
-                    frame_id = self.frame_counter
-                    self.frame_counter += 1
-
-                    # Отправляем с проверкой соединения
-                    try:
-                        start_msg = f"SCREEN_DATA_START:{self.username}:{self.friend_name}:{frame_id}:{len(chunks)}"
-                        self.client_socket.send(start_msg.encode('utf-8') + b'\n')
-
-                        for i, chunk in enumerate(chunks):
-                            if not self.is_active:  # Проверяем, не остановлена ли передача
-                                break
-
-                            chunk_msg = f"SCREEN_DATA_CHUNK:{self.username}:{self.friend_name}:{frame_id}:{i}:{chunk}"
-                            self.client_socket.send(chunk_msg.encode('utf-8') + b'\n')
-                            time.sleep(0.01)  # Увеличили задержку между частями
-
-                        if self.is_active:
-                            end_msg = f"SCREEN_DATA_END:{self.username}:{self.friend_name}:{frame_id}"
-                            self.client_socket.send(end_msg.encode('utf-8') + b'\n')
-
-                        retry_count = 0  # Сбрасываем счетчик при успешной отправке
-
-                    except ConnectionError as e:
-                        print(f"[SCREEN ERROR] Connection error: {e}")
-                        retry_count += 1
-                        if retry_count >= max_retries:
-                            print(f"[SCREEN ERROR] Max retries reached, stopping")
-                            break
-                        time.sleep(1)  # Ждем перед повтором
-                        continue
-
-                    # Поддержание FPS
-                    elapsed = time.time() - start_time
-                    sleep_time = max(0, 1.0 / self.fps - elapsed)
-                    time.sleep(sleep_time)
-
-                except Exception as e:
-                    print(f"[SCREEN ERROR] Frame capture error: {e}")
-                    retry_count += 1
-                    if retry_count >= max_retries:
-                        break
-                    time.sleep(1)
-
-        except Exception as e:
-            print(f"Ошибка захвата экрана: {e}")
-        finally:
-            self.is_active = False
-
     def process_group_screen_data(self, message):
         """обработка данных групповой демонстрации экрана"""
         try:
             # Проверяем, активно ли окно
             if not hasattr(self, 'is_active') or not self.is_active:
-                print(f"[GROUP SCREEN WINDOW] Window not active, ignoring data")
                 return
 
             # Проверяем, настроено ли окно для групповой демонстрации
             if not hasattr(self, 'is_group_receiver') or not self.is_group_receiver:
-                print(f"[GROUP SCREEN WINDOW] Not set up for group receiving, ignoring data")
                 return
 
-            print(f"[GROUP SCREEN WINDOW] Processing data: {message[:100]}...")
-
             if message.startswith("GROUP_SCREEN_DATA_START:"):
                 # Обработка начала кадра
                 parts = message.split(":", 4)
@@ -340,9 +313,6 @@ class ScreenSharingWindow(QtWidgets.QDialog):
                     frame_id = parts[3]
                     chunks_count = int(parts[4])
 
-                    print(
-                        f"[GROUP SCREEN WINDOW] START - sender: {sender}, group: {group_id}, frame: {frame_id}, chunks: {chunks_count}")
-
                     # Проверяем, что это наша группа и отправитель
                     if not hasattr(self, 'group_id') or self.group_id != group_id:
                         print(
@@ -363,7 +333,6 @@ class ScreenSharingWindow(QtWidgets.QDialog):
                         'received': 0,
                         'total_chunks': chunks_count
                     }
-                    print(f"[GROUP SCREEN WINDOW] Created buffer for frame {frame_id} with {chunks_count} chunks")
 
             elif message.startswith("GROUP_SCREEN_DATA_CHUNK:"):
                 # Обработка части кадра
@@ -389,11 +358,6 @@ class ScreenSharingWindow(QtWidgets.QDialog):
                         if 0 <= chunk_id_int < len(buffer['chunks']):
                             buffer['chunks'][chunk_id_int] = chunk_data
                             buffer['received'] += 1
-
-                            # Логируем прогресс для отладки
-                            if chunk_id_int % 10 == 0 or buffer['received'] == buffer['total_chunks']:
-                                print(
-                                    f"[GROUP SCREEN WINDOW] Frame {frame_id}: received {buffer['received']}/{buffer['total_chunks']} chunks")
                     else:
                         print(f"[GROUP SCREEN WINDOW] No buffer for frame {frame_id}")
 
@@ -405,8 +369,6 @@ class ScreenSharingWindow(QtWidgets.QDialog):
                     group_id = int(parts[2])
                     frame_id = parts[3]
 
-                    print(f"[GROUP SCREEN WINDOW] END - sender: {sender}, group: {group_id}, frame: {frame_id}")
-
                     # Проверяем, что это наша группа и отправитель
                     if not hasattr(self, 'group_id') or self.group_id != group_id:
                         return
@@ -417,33 +379,10 @@ class ScreenSharingWindow(QtWidgets.QDialog):
                     # Проверяем, есть ли у нас буфер для этого кадра
                     if hasattr(self, 'group_screen_buffers') and frame_id in self.group_screen_buffers:
                         buffer = self.group_screen_buffers[frame_id]
-                        print(
-                            f"[GROUP SCREEN WINDOW] Frame {frame_id} complete check: {buffer['received']}/{buffer['total_chunks']}")
 
                         if buffer['received'] == buffer['total_chunks']:
-                            # Собираем полный кадр
-                            complete_data = ''.join(buffer['chunks'])
-                            print(
-                                f"[GROUP SCREEN WINDOW] Assembled complete frame {frame_id}, data length: {len(complete_data)}")
-
-                            # Декодируем и отображаем
-                            try:
-                                import base64
-                                import numpy as np
-                                import cv2
-
-                                decoded_data = base64.b64decode(complete_data)
-                                np_arr = np.frombuffer(decoded_data, np.uint8)
-                                frame = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
-
-                                if frame is not None:
-                                    self.display_frame(frame)
-                                    print(f"[GROUP SCREEN WINDOW] ✓ Displayed frame {frame_id}")
-                                else:
-                                    print(f"[GROUP SCREEN WINDOW] ✗ Failed to decode frame {frame_id}")
-
-                            except Exception as e:
-                                print(f"[GROUP SCREEN WINDOW ERROR] Error decoding frame {frame_id}: {e}")
+                            # Собранный кадр (base64) декодирует и отображает поток декодера
+                            self.decode_worker.submit(''.join(buffer['chunks']), False)
 
                             # Удаляем буфер
                             del self.group_screen_buffers[frame_id]
@@ -458,77 +397,52 @@ class ScreenSharingWindow(QtWidgets.QDialog):
             import traceback
             traceback.print_exc()
 
-    def process_screen_data(self, frame_data):
-        """Обрабатывает полученные данные экрана"""
-        try:
-            # Декодируем данные из base64
-            decoded_data = base64.b64decode(frame_data)
+    def process_group_screen_frame(self, sender, group_id, image, delta=False, frame_id=None):
+        """Кадр групповой демонстрации, принятый бинарным кадром (FRAME_SCREEN)"""
+        if not self.is_active or not self.is_group_receiver:
+            return
+        if self.group_id != group_id or self.screen_sender != sender:
+            return
+        self.display_screen_frame(image, delta, frame_id)
 
-            # Преобразуем в изображение
-            np_arr = np.frombuffer(decoded_data, np.uint8)
-            frame = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
+    def display_screen_frame(self, image, delta, frame_id=None):
+        """Передает ключевой или разностный кадр потоку декодера (можно вызывать из любого потока)"""
+        self.decode_worker.submit(image, delta, frame_id)
 
-            if frame is not None:
-                self.display_frame(frame)
-        except Exception as e:
-            print(f"Ошибка обработки данных экрана: {e}")
+    def process_screen_data(self, frame_data):
+        """Обрабатывает полученные данные экрана (base64)"""
+        self.decode_worker.submit(frame_data, False)
 
     def display_frame(self, frame):
-        """функция отображения кадра"""
-        try:
-            if frame is None:
-                print(f"[GROUP SCREEN WINDOW] Cannot display None frame")
-                return
-
-            h, w = frame.shape[:2]
-            if h == 0 or w == 0:
-                print(f"[GROUP SCREEN WINDOW] Invalid frame dimensions: {w}x{h}")
-                return
-
-            bytes_per_line = 3 * w
-
-            # Преобразуем BGR (OpenCV) в RGB (Qt)
-            rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-
-            # Создаем QImage из данных numpy
-            from PyQt5.QtGui import QImage, QPixmap
-            from PyQt5.QtCore import Qt
-
-            q_img = QImage(rgb_frame.data, w, h, bytes_per_line, QImage.Format_RGB888)
-
-            # Получаем размеры label
-            if hasattr(self, 'screen_label'):
-                label_size = self.screen_label.size()
-
-                # Масштабируем изображение, сохраняя пропорции
-                pixmap = QPixmap.fromImage(q_img)
-                scaled_pixmap = pixmap.scaled(
-                    label_size.width(),
-                    label_size.height(),
-                    Qt.KeepAspectRatio,
-                    Qt.SmoothTransformation
-                )
-
-                # Устанавливаем изображение
-                self.screen_label.setPixmap(scaled_pixmap)
-                print(
-                    f"[GROUP SCREEN WINDOW] Frame displayed: {w}x{h} -> {scaled_pixmap.width()}x{scaled_pixmap.height()}")
-            else:
-                print(f"[GROUP SCREEN WINDOW] No screen_label available")
-
-        except Exception as e:
-            print(f"[GROUP SCREEN WINDOW ERROR] Error displaying frame: {e}")
-            import traceback
-            traceback.print_exc()
+        """Показывает кадр BGR (масштабирование - в потоке декодера)"""
+        if frame is None:
+            return
+        self.decode_worker.submit_raw(frame)
+
+    def show_pending_frame(self):
+        """Рисует последний готовый кадр из почтового ящика (главный поток)"""
+        image = self.decode_worker.take()
+        if image is not None:
+            self.screen_label.setPixmap(QtGui.QPixmap.fromImage(image))
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        # Кадры масштабируются под новый размер метки один раз, в потоке декодера
+        self.decode_worker.set_view_size(self.screen_label.width(), self.screen_label.height())
 
     def stop_sharing(self):
         """Останавливает демонстрацию экрана"""
         self.is_active = False
         self.is_group_sharing = False
 
-        if self.capture_thread:
-            self.capture_thread.join(timeout=1.0)
-            self.capture_thread = None
+        if self.pipeline:
+            self.pipeline.stop()
+            self.pipeline = None
+        if self.decode_worker.running:
+            self.decode_worker.stop()
+            stats = self.decode_worker.stats()
+            print(f"[SCREEN VIEW] decoded={stats['decoded']} skipped={stats['skipped']} "
+                  f"replaced={stats['replaced']} decode={stats['decode_ms']:.1f}ms")
 
         # Отправляем сигнал о завершении демонстрации
         if self.is_sender and self.client_socket:
@@ -1,9 +1,29 @@
 import socket
 import threading
-import pg8000
 import datetime
 import time
 import os
+import asyncio
+import argparse
+import base64
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from db_pool import ConnectionPool
+from audio_codec import CODEC_PCM, choose_codec, parse_codec_list, parse_comfort_noise
+from audio_mixer import GroupCallMixer, mixing_available
+from friend_cache import FriendGraphCache
+from db_statements import PreparedStatements
+from message_writer import MessageWriter
+from blob_store import BlobStore, BlobError
+from media_relay import MediaRelay
+from group_cache import GroupMembershipCache
+from outbound import (OutboundQueue, STREAM_CHAT, STREAM_AUDIO, STREAM_SCREEN, STREAM_SCREEN_FRAME, STREAM_FILE,
+                      DEFAULT_POLICIES, send_on_stream, throttle_sender, wait_before_read,
+                      wait_before_read_async, live_queues)
+from protocol import (ServerHandshake, FRAME_TEXT, FRAME_AUDIO, FRAME_BINARY, FRAME_SCREEN, FRAME_FILE, SCREEN_GROUP,
+                      FILE_PERSONAL, FILE_GROUP, RECV_BUFFER_SIZE, is_framed, send_binary, supports_screen_frames,
+                      supports_screen_tiles, supports_file_frames, pack_file_chunk, unpack_screen_frame,
+                      unpack_file_chunk)
 
 # Database configuration
 DB_CONFIG = {
@@ -14,6 +34,60 @@ DB_CONFIG = {
     "port": 5432
 }
 
+# Параметры пула соединений с БД
+DB_POOL_CONFIG = {
+    "min_size": 2,
+    "max_size": 20,
+    "timeout": 10.0,  # сек ожидания свободного соединения
+    "health_check_interval": 30.0  # сек простоя, после которых соединение проверяется
+}
+# Период вывода статистики сервера в лог, сек
+STATS_INTERVAL = 60
+# Схема БД описана миграциями Alembic (alembic/versions), сервер применяет их при запуске
+ALEMBIC_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "alembic.ini")
+
+# Кэш графа дружбы: сколько пользователей держать и через сколько секунд перечитывать
+FRIEND_CACHE_MAX_USERS = 10000
+FRIEND_CACHE_TTL = 300.0
+# Кэш состава групп
+GROUP_CACHE_MAX_GROUPS = 5000
+GROUP_CACHE_TTL = 300.0
+# Частые запросы готовятся один раз на каждом соединении пула (db_statements.py); 0 - обычные запросы
+PREPARED_STATEMENTS = os.environ.get("VOLUM_PREPARED_STATEMENTS", "1") == "1"
+# Сообщения чата пишутся в БД пакетами в фоне (message_writer.py); 0 - INSERT в обработчике, как раньше
+WRITE_BEHIND = os.environ.get("VOLUM_WRITE_BEHIND", "1") == "1"
+WRITE_BEHIND_BATCH_SIZE = 200  # строк в пакете
+WRITE_BEHIND_INTERVAL = 0.05  # сек, не дольше столько строка ждет пакета
+# Журнал еще не записанных в БД сообщений
+SPOOL_DIR = os.environ.get("VOLUM_SPOOL_DIR", "spool")
+# Размер части base64 при пересылке бинарного кадра экрана клиенту старого протокола
+SCREEN_TEXT_CHUNK_SIZE = 2000
+# Длина строки FILE_TRANSFER:CHUNK (base64) для получателя файла со старым протоколом
+FILE_TEXT_CHUNK_SIZE = 900
+# Хранилище файлов по SHA-256 (FILE_OFFER): каждый файл загружается один раз, недокачанные продолжаются
+BLOB_STORE_DIR = os.environ.get("VOLUM_BLOB_DIR", "blobs")
+# Размер части при раздаче файла из хранилища получателям
+BLOB_CHUNK_SIZE = 256 * 1024
+# Микширование групповых звонков на сервере: каждый участник получает один
+# смешанный поток вместо отдельного потока от каждого говорящего (нужен numpy)
+GROUP_CALL_MIXING = os.environ.get("VOLUM_GROUP_CALL_MIXING", "0") == "1"
+# Передача аудио звонков по UDP (порт MEDIA_PORT); клиенты без UDP продолжают работать по TCP
+UDP_MEDIA = os.environ.get("VOLUM_UDP_MEDIA", "0") == "1"
+
+# Адрес и порты серверов
+SERVER_HOST = "127.0.0.1"
+MAIN_PORT = 5555
+SCREEN_PORT = 5556
+GROUP_PORT = 5557
+GROUP_CALL_PORT = 5558
+MEDIA_PORT = 5559  # UDP
+
+# Режим работы: "asyncio" (все слушатели в одном цикле событий)
+# или "threaded" (прежний режим: отдельный поток на каждое соединение)
+SERVER_MODE = os.environ.get("VOLUM_SERVER_MODE", "asyncio")
+# Потоки для блокирующих обработчиков (запросы к БД) в asyncio режиме
+ASYNC_HANDLER_WORKERS = 32
+
 clients = {} # словарь для хранения информации о звонках
 calls = {} # словарь для хранения соединений демонстрации экрана
 screen_sharing_connections = {}
@@ -21,6 +95,10 @@ group_clients = {}  # Словарь для хранения соединени
 group_calls = {}  # Словарь для хранения активных групповых звонков
 group_call_clients = {}  # Словарь для хранения соединений групповых звонков
 user_status = {}  # {username: "online"/"offline"}
+group_screen_shares = {}  # {(group_id, sender): {'members': set, 'viewers': {username: screen_socket}}}
+group_screen_lock = threading.Lock()
+file_uploads = {}  # {(сокет отправителя, номер передачи): загрузка в хранилище} - см. handle_file_offer
+file_uploads_lock = threading.Lock()
 
 class ClientConnection:
     """управления соединениями клиента"""
@@ -33,35 +111,371 @@ class ClientConnection:
         self.call_partner = None
         self.is_in_group_call = False
         self.current_group_call_id = None
+        # Ожидание аудиопакета после заголовка GROUP_CALL_AUDIO
+        self.expecting_group_audio = False
+        self.group_audio_id = None
+        # Открытый личный чат (CHAT_OPEN): получатель строк "имя: текст"
+        self.chat_peer = None
+
+
+class ConnectionRegistry:
+    """Реестр соединений с индексами по имени пользователя.
+
+    Хранит основные соединения (clients), связи сокетов демонстрации экрана,
+    группового чата и групповых звонков. Все изменения выполняются под одной
+    блокировкой, поэтому индексы всегда согласованы со словарями соединений,
+    а поиск получателя при пересылке выполняется за O(1).
+    """
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.by_username = {}  # {username: ClientConnection}
+        self.by_username_lower = {}  # {username.lower(): ClientConnection}
+        self.group_socket_by_username = {}  # {username: group_socket}
+        self.group_call_socket_by_username = {}  # {username: group_call_socket}
+        self.group_sockets = {}  # {group_id: set(group_socket)} - кто открыл чат группы
+
+    # --- основные соединения ---
+
+    def register(self, client_socket, client_connection, username=None):
+        """Регистрирует (или переименовывает) основное соединение"""
+        with self.lock:
+            if username is not None:
+                self._unindex(client_connection)
+                client_connection.username = username
+            clients[client_socket] = client_connection
+            self._index(client_connection)
+        return client_connection
+
+    def unregister(self, client_socket):
+        """Удаляет основное соединение, возвращает его ClientConnection"""
+        with self.lock:
+            client_connection = clients.pop(client_socket, None)
+            if client_connection is not None:
+                self._unindex(client_connection)
+        return client_connection
+
+    def _index(self, client_connection):
+        username = client_connection.username
+        if username:
+            self.by_username[username] = client_connection
+            self.by_username_lower[username.lower()] = client_connection
+
+    def _unindex(self, client_connection):
+        username = client_connection.username
+        if not username:
+            return
+        if self.by_username.get(username) is client_connection:
+            del self.by_username[username]
+        if self.by_username_lower.get(username.lower()) is client_connection:
+            del self.by_username_lower[username.lower()]
+
+    def get(self, username, case_insensitive=False):
+        """Возвращает ClientConnection пользователя или None"""
+        if not username:
+            return None
+        if case_insensitive:
+            return self.by_username_lower.get(username.lower())
+        return self.by_username.get(username)
+
+    def socket_for(self, username, case_insensitive=False):
+        """Возвращает основной сокет пользователя или None"""
+        client_connection = self.get(username, case_insensitive)
+        return client_connection.main_socket if client_connection else None
+
+    def is_online(self, username):
+        return username is not None and username.lower() in self.by_username_lower
+
+    # --- демонстрация экрана ---
+
+    def link_screen(self, username, screen_socket):
+        """Привязывает сокет демонстрации экрана к основному соединению"""
+        with self.lock:
+            client_connection = self.by_username.get(username)
+            if client_connection is None:
+                return None
+            client_connection.screen_socket = screen_socket
+            screen_sharing_connections[screen_socket] = client_connection
+        return client_connection
+
+    def unlink_screen(self, screen_socket):
+        """Отвязывает сокет демонстрации экрана, возвращает ClientConnection владельца"""
+        with self.lock:
+            client_connection = screen_sharing_connections.pop(screen_socket, None)
+            if client_connection is not None and client_connection.screen_socket is screen_socket:
+                client_connection.screen_socket = None
+        return client_connection
+
+    def screen_socket_for(self, username, case_insensitive=False):
+        client_connection = self.get(username, case_insensitive)
+        return client_connection.screen_socket if client_connection else None
+
+    # --- групповой чат ---
+
+    def register_group(self, client_socket, username):
+        with self.lock:
+            # Повторная аутентификация на том же сокете начинается с чистого списка групп
+            self.unregister_group(client_socket)
+            group_clients[client_socket] = {
+                'username': username,
+                'joined_groups': set()
+            }
+            self.group_socket_by_username[username] = client_socket
+
+    def unregister_group(self, client_socket):
+        with self.lock:
+            client_data = group_clients.pop(client_socket, None)
+            if client_data is not None:
+                username = client_data['username']
+                if self.group_socket_by_username.get(username) is client_socket:
+                    del self.group_socket_by_username[username]
+                for group_id in client_data['joined_groups']:
+                    self._discard_group_socket(group_id, client_socket)
+        return client_data
+
+    def join_group(self, client_socket, group_id):
+        """Отмечает, что соединение группового чата открыло группу"""
+        with self.lock:
+            client_data = group_clients.get(client_socket)
+            if client_data is None:
+                return False
+            client_data['joined_groups'].add(group_id)
+            self.group_sockets.setdefault(group_id, set()).add(client_socket)
+            return True
+
+    def leave_group(self, client_socket, group_id):
+        """Возвращает True, если соединение было в группе"""
+        with self.lock:
+            client_data = group_clients.get(client_socket)
+            if client_data is None or group_id not in client_data['joined_groups']:
+                return False
+            client_data['joined_groups'].discard(group_id)
+            self._discard_group_socket(group_id, client_socket)
+            return True
+
+    def remove_from_group(self, group_id, username):
+        """Убирает пользователя из рассылки группы (после исключения)"""
+        with self.lock:
+            client_socket = self.group_socket_by_username.get(username)
+            if client_socket is not None:
+                self.leave_group(client_socket, group_id)
+
+    def group_sockets_for(self, group_id):
+        """Снимок соединений, открывших группу"""
+        with self.lock:
+            return list(self.group_sockets.get(group_id, ()))
+
+    def _discard_group_socket(self, group_id, client_socket):
+        sockets = self.group_sockets.get(group_id)
+        if sockets is not None:
+            sockets.discard(client_socket)
+            if not sockets:
+                del self.group_sockets[group_id]
+
+    # --- групповые звонки ---
+
+    def register_group_call(self, client_socket, username):
+        with self.lock:
+            group_call_clients[client_socket] = {
+                'username': username,
+                'current_group_call': None
+            }
+            self.group_call_socket_by_username[username] = client_socket
+
+    def unregister_group_call(self, client_socket):
+        with self.lock:
+            client_data = group_call_clients.pop(client_socket, None)
+            if client_data is not None:
+                username = client_data['username']
+                if self.group_call_socket_by_username.get(username) is client_socket:
+                    del self.group_call_socket_by_username[username]
+        return client_data
+
+
+registry = ConnectionRegistry()
+# Запросы на каждое сообщение; запросы кэшей друзей и групп они регистрируют сами
+statements = PreparedStatements({
+    "user_exists": "SELECT 1 FROM users WHERE username = %s",
+    "insert_message": "INSERT INTO messages (sender, receiver, content, read) VALUES (%s, %s, %s, %s)",
+    "insert_group_message": "INSERT INTO group_messages (group_id, sender, content) VALUES (%s, %s, %s) RETURNING id",
+}, enabled=PREPARED_STATEMENTS)
+friend_cache = FriendGraphCache(FRIEND_CACHE_MAX_USERS, FRIEND_CACHE_TTL, statements)
+group_cache = GroupMembershipCache(GROUP_CACHE_MAX_GROUPS, GROUP_CACHE_TTL, statements)
+group_call_mixer = None  # GroupCallMixer, если включено микширование
+media_relay = None  # MediaRelay, если включена передача аудио по UDP
+blob_store = None  # BlobStore, создается при первой загрузке файла
+message_writer = None  # MessageWriter, если включена отложенная запись сообщений
+blob_store_lock = threading.Lock()
+
+
+def start_group_call_mixer():
+    """Запускает микшер групповых звонков (без numpy остается прежняя пересылка)"""
+    global group_call_mixer
+    if not mixing_available():
+        print("[GROUP CALL MIXER] numpy is not installed, forwarding raw audio instead of mixing")
+        return
+    group_call_mixer = GroupCallMixer(group_call_participants, send_mixed_audio)
+    group_call_mixer.start()
+    print("[GROUP CALL MIXER] Server-side mixing of group calls is enabled")
+
+
+def start_message_writer(db_pool):
+    global message_writer
+    message_writer = MessageWriter(db_pool, SPOOL_DIR, WRITE_BEHIND_BATCH_SIZE, WRITE_BEHIND_INTERVAL)
+    print(f"[WRITE BEHIND] Messages are persisted in batches of up to {WRITE_BEHIND_BATCH_SIZE} rows "
+          f"every {WRITE_BEHIND_INTERVAL * 1000:.0f} ms (spool: {os.path.abspath(SPOOL_DIR)})")
+
+
+def get_blob_store():
+    global blob_store
+    with blob_store_lock:
+        if blob_store is None:
+            blob_store = BlobStore(BLOB_STORE_DIR)
+            print(f"[FILE] Blob store at {os.path.abspath(BLOB_STORE_DIR)}")
+        return blob_store
+
+
+def start_media_relay():
+    """Включает передачу аудио по UDP; слушатель запускается вместе с серверами"""
+    global media_relay
+    media_relay = MediaRelay(route_media_audio)
+
+
+def group_call_participants(group_id):
+    call = group_calls.get(group_id)
+    if call is None:
+        return {}
+    return dict(call['participants'])
+
+
+def send_mixed_audio(group_id, username, participant_socket, data):
+    send_call_audio(("group", group_id), username, participant_socket, data)
+
+
+def mix_group_call_audio(group_id, username, data, pause=False):
+    """Передает аудио в микшер; False - микширование выключено, нужно пересылать как раньше"""
+    if group_call_mixer is None:
+        return False
+    if pause:
+        group_call_mixer.pause(group_id, username)
+    else:
+        group_call_mixer.push(group_id, username, data)
+    return True
+
+
+def track_group_call_speaker(group_id, username, data):
+    """Отмечает, говорит ли участник группового звонка.
+
+    Возвращает None для аудио, "pause" для маркера паузы и "repeat" для
+    повторного маркера уже замолчавшего участника: его достаточно переслать
+    по UDP, где маркер мог потеряться.
+    """
+    call = group_calls.get(group_id)
+    if call is None:
+        return None
+    paused = call.setdefault('paused', set())
+    if parse_comfort_noise(data) is None:
+        paused.discard(username)
+        return None
+    if username in paused:
+        return "repeat"
+    paused.add(username)
+    return "pause"
+
+
+def remove_group_call_speaker(group_id, username):
+    if group_call_mixer is not None:
+        group_call_mixer.remove_speaker(group_id, username)
+    if media_relay is not None:
+        media_relay.revoke(("group", group_id), username)
+    call = group_calls.get(group_id)
+    if call is not None:
+        call.get('paused', set()).discard(username)
+
+
+def personal_call_key(user1, user2):
+    """Ключ медиасессии личного звонка (не зависит от того, кто звонил)"""
+    return ("call",) + tuple(sorted((user1.lower(), user2.lower())))
+
+
+def send_call_audio(call_key, username, tcp_socket, data, timestamp=None, udp_only=False):
+    """Отправляет аудио участнику звонка: по UDP, если у него активная медиасессия, иначе по TCP"""
+    if media_relay is not None:
+        if media_relay.send(media_relay.session_for(call_key, username), data, timestamp):
+            return
+    if tcp_socket is None or udp_only:
+        return
+    if parse_comfort_noise(data) is not None and not is_framed(tcp_socket):
+        return  # клиент старого протокола воспроизвел бы маркер паузы как звук
+    send_binary(tcp_socket, FRAME_AUDIO, data)
+
+
+def route_media_audio(session, seq, timestamp, payload):
+    """Пересылает аудио, принятое по UDP, остальным участникам звонка"""
+    kind = session.call_key[0]
+    if kind == "group":
+        group_id = session.call_key[1]
+        call = group_calls.get(group_id)
+        if call is None or session.username not in call['participants']:
+            return
+        pause = track_group_call_speaker(group_id, session.username, payload)
+        if mix_group_call_audio(group_id, session.username, payload, pause is not None):
+            return
+        for participant_username, participant_socket in list(call['participants'].items()):
+            if participant_username != session.username:
+                try:
+                    send_call_audio(session.call_key, participant_username, participant_socket, payload, timestamp,
+                                    udp_only=pause == "repeat")
+                except Exception as e:
+                    print(f"[MEDIA ERROR] Failed to forward to {participant_username}: {e}")
+    else:
+        sender_connection = registry.get(session.username, case_insensitive=True)
+        if not sender_connection or not sender_connection.is_in_call or not sender_connection.call_partner:
+            return
+        partner = sender_connection.call_partner
+        if personal_call_key(session.username, partner) != session.call_key:
+            return
+        send_call_audio(session.call_key, partner, registry.socket_for(partner, case_insensitive=True),
+                        payload, timestamp)
+
+
+def issue_call_media_sessions(caller, recipient):
+    """Выдает обоим участникам личного звонка токены UDP-сессии (сигнал media_session)"""
+    call_key = personal_call_key(caller, recipient)
+    for username, partner in ((caller, recipient), (recipient, caller)):
+        user_socket = registry.socket_for(username, case_insensitive=True)
+        if user_socket is None:
+            continue
+        token = media_relay.issue(call_key, username)
+        signal = f"CALL_SIGNAL:media_session:{partner}:{username}:{time.time()}:0:{token}:{MEDIA_PORT}\n"
+        try:
+            user_socket.send(signal.encode('utf-8'))
+        except Exception as e:
+            print(f"[MEDIA ERROR] Failed to send media session to {username}: {e}")
 
-def handle_group_call_client(client_socket, addr, db_connection):
+def handle_group_call_client(client_socket, addr, db_pool):
     """Обработчик клиентов группового звонка на порту 5558"""
     print(f"[GROUP CALL CONNECTION] {addr} connected to group call server.")
-    username = None
+    handshake = ServerHandshake()
 
     while True:
         try:
-            data = client_socket.recv(8192)
+            data = client_socket.recv(RECV_BUFFER_SIZE if handshake.decoder else 8192)
             if not data:
                 break
 
-            try:
-                message = data.decode('utf-8')
-                messages = message.strip().split('\n')
-
-                for msg in messages:
-                    if msg:
-                        if msg.startswith("GROUP_CALL_AUTH:"):
-                            handle_group_call_auth(msg, client_socket, db_connection)
-                        elif msg.startswith("GROUP_CALL_JOIN:"):
-                            handle_group_call_join(msg, client_socket, db_connection)
-                        elif msg.startswith("GROUP_CALL_LEAVE:"):
-                            handle_group_call_leave(msg, client_socket, db_connection)
+            if not handshake.done:
+                client_socket, data = handshake.accept(data, client_socket)
+                if handshake.done:
+                    client_socket = open_outbound_queue(client_socket, addr)
+                if not data:
+                    continue
 
-            except UnicodeDecodeError:
-                # Обработка аудиоданных для групповых звонков
-                if client_socket in group_call_clients:
-                    forward_group_call_audio(data, client_socket)
+            if handshake.decoder:
+                frames = handshake.decoder.feed(data)
+                if frames:
+                    run_with_session(db_pool, process_group_call_frames, frames, client_socket)
+            else:
+                run_with_session(db_pool, process_group_call_data, data, client_socket)
 
         except Exception as e:
             print(f"[GROUP CALL ERROR] {e}")
@@ -73,6 +487,40 @@ def handle_group_call_client(client_socket, addr, db_connection):
     print(f"[GROUP CALL DISCONNECT] {addr} disconnected from group call server.")
 
 
+def process_group_call_data(data, client_socket, db_connection):
+    """Разбирает порцию данных из сокета групповых звонков (общая для потокового и asyncio режимов)"""
+    try:
+        dispatch_group_call_text(data.decode('utf-8'), client_socket, db_connection)
+    except UnicodeDecodeError:
+        # Обработка аудиоданных для групповых звонков
+        if client_socket in group_call_clients:
+            forward_group_call_audio(data, client_socket)
+
+
+def process_group_call_frames(frames, client_socket, db_connection):
+    """Разбирает кадры сокета групповых звонков (кадровый протокол)"""
+    for frame_type, payload in frames:
+        if frame_type == FRAME_TEXT:
+            try:
+                dispatch_group_call_text(str(payload, 'utf-8'), client_socket, db_connection)
+            except UnicodeDecodeError:
+                print("[GROUP CALL ERROR] Invalid UTF-8 in text frame")
+        elif frame_type == FRAME_AUDIO and client_socket in group_call_clients:
+            forward_group_call_audio(payload, client_socket)
+
+
+def dispatch_group_call_text(message, client_socket, db_connection):
+    """Направляет текстовые команды групповых звонков в обработчики"""
+    for msg in message.strip().split('\n'):
+        if msg:
+            if msg.startswith("GROUP_CALL_AUTH:"):
+                handle_group_call_auth(msg, client_socket, db_connection)
+            elif msg.startswith("GROUP_CALL_JOIN:"):
+                handle_group_call_join(msg, client_socket, db_connection)
+            elif msg.startswith("GROUP_CALL_LEAVE:"):
+                handle_group_call_leave(msg, client_socket, db_connection)
+
+
 def handle_group_call_auth(message, client_socket, db_connection):
     """Аутентификация для группового звонка"""
     try:
@@ -85,10 +533,7 @@ def handle_group_call_auth(message, client_socket, db_connection):
         print(f"[GROUP CALL AUTH] Authenticating {username} for group calls")
 
         # Сохраняем соединение
-        group_call_clients[client_socket] = {
-            'username': username,
-            'current_group_call': None
-        }
+        registry.register_group_call(client_socket, username)
 
         # Отправляем подтверждение
         client_socket.send("GROUP_CALL_AUTH_SUCCESS\n".encode('utf-8'))
@@ -100,12 +545,13 @@ def handle_group_call_auth(message, client_socket, db_connection):
 def handle_group_call_join(message, client_socket, db_connection):
     """Присоединение к групповому звонку"""
     try:
-        # Формат: GROUP_CALL_JOIN:group_id
-        parts = message.split(":", 1)
+        # Формат: GROUP_CALL_JOIN:group_id[:кодеки через запятую]
+        parts = message.split(":", 2)
         if len(parts) < 2:
             return
 
         group_id = int(parts[1])
+        offered_codecs = parse_codec_list(parts[2]) if len(parts) > 2 else [CODEC_PCM]
 
         if client_socket not in group_call_clients:
             return
@@ -113,13 +559,7 @@ def handle_group_call_join(message, client_socket, db_connection):
         username = group_call_clients[client_socket]['username']
 
         # Проверяем членство в группе
-        cursor = db_connection.cursor()
-        cursor.execute(
-            "SELECT 1 FROM group_members WHERE group_id = %s AND username = %s",
-            (group_id, username)
-        )
-
-        if cursor.fetchone():
+        if group_cache.is_member(group_id, username, db_connection):
             # Добавляем к активному звонку
             if group_id not in group_calls:
                 group_calls[group_id] = {
@@ -128,22 +568,48 @@ def handle_group_call_join(message, client_socket, db_connection):
                     'status': 'active'
                 }
 
+            codec = select_group_call_codec(group_id, offered_codecs)
             group_calls[group_id]['participants'][username] = client_socket
             group_call_clients[client_socket]['current_group_call'] = group_id
 
-            # Отправляем подтверждение
-            client_socket.send(f"GROUP_CALL_JOINED:{group_id}\n".encode('utf-8'))
+            # Отправляем подтверждение с кодеком звонка; клиенту, который согласует
+            # кодек (новый протокол), - еще и токен UDP-сессии
+            joined = f"GROUP_CALL_JOINED:{group_id}:{codec}"
+            if media_relay is not None and len(parts) > 2:
+                joined += f":{media_relay.issue(('group', group_id), username)}:{MEDIA_PORT}"
+            client_socket.send(f"{joined}\n".encode('utf-8'))
             print(f"[GROUP CALL] {username} joined call in group {group_id}")
 
             # Обновляем статус звонка
             broadcast_group_call_status_to_call_clients(group_id)
 
-        cursor.close()
-
     except Exception as e:
         print(f"[GROUP CALL JOIN ERROR] {e}")
 
 
+def select_group_call_codec(group_id, offered_codecs):
+    """Кодек группового звонка для нового участника.
+
+    Кодек выбирает первый участник; при микшировании на сервере допускается
+    только PCM. Если новый участник не поддерживает кодек звонка, звонок
+    переводится на PCM и остальные участники получают GROUP_CALL_CODEC.
+    """
+    call = group_calls[group_id]
+    codec = call.get('codec')
+    if codec is None:
+        allowed = [CODEC_PCM] if group_call_mixer is not None else offered_codecs
+        codec = call['codec'] = choose_codec(offered_codecs, allowed)
+    elif codec not in offered_codecs:
+        codec = call['codec'] = CODEC_PCM
+        print(f"[GROUP CALL] Switching call in group {group_id} to {codec}")
+        for participant_username, participant_socket in list(call['participants'].items()):
+            try:
+                participant_socket.send(f"GROUP_CALL_CODEC:{group_id}:{codec}\n".encode('utf-8'))
+            except Exception as e:
+                print(f"[GROUP CALL ERROR] Failed to send codec to {participant_username}: {e}")
+    return codec
+
+
 def handle_group_call_leave(message, client_socket, db_connection):
     try:
         parts = message.split(":", 1)
@@ -161,14 +627,14 @@ def handle_group_call_leave(message, client_socket, db_connection):
         if group_id in group_calls and username in group_calls[group_id]['participants']:
             del group_calls[group_id]['participants'][username]
             group_call_clients[client_socket]['current_group_call'] = None
+            remove_group_call_speaker(group_id, username)
 
             # Обновляем состояние клиента
-            if client_socket in clients:
-                client_connection = clients[client_socket]
-                if hasattr(client_connection, 'is_in_group_call'):
-                    client_connection.is_in_group_call = False
-                    client_connection.current_group_call_id = None
-                    # Не сбрасываем is_in_call здесь, если это личный звонок
+            client_connection = registry.get(username)
+            if client_connection:
+                client_connection.is_in_group_call = False
+                client_connection.current_group_call_id = None
+                # Не сбрасываем is_in_call здесь, если это личный звонок
 
             # Если участников не осталось, завершаем звонок
             if not group_calls[group_id]['participants']:
@@ -197,6 +663,10 @@ def forward_group_call_audio(data, sender_socket):
             return
 
         sender_username = sender_info['username']
+        pause = track_group_call_speaker(group_id, sender_username, data)
+        if mix_group_call_audio(group_id, sender_username, data, pause is not None):
+            return
+
         participants = group_calls[group_id]['participants']
 
         print(f"[GROUP CALL AUDIO] Forwarding audio from {sender_username} to {len(participants) - 1} participants")
@@ -207,7 +677,8 @@ def forward_group_call_audio(data, sender_socket):
             if participant_username != sender_username and participant_socket != sender_socket:
                 try:
                     if participant_socket in group_call_clients:
-                        participant_socket.sendall(data)
+                        send_call_audio(("group", group_id), participant_username, participant_socket, data,
+                                        udp_only=pause == "repeat")
                         forwarded_count += 1
                         print(f"[GROUP CALL AUDIO] ✓ Forwarded to {participant_username}")
                 except Exception as e:
@@ -258,6 +729,7 @@ def cleanup_group_call_connection(client_socket):
         if group_id and group_id in group_calls:
             if username in group_calls[group_id]['participants']:
                 del group_calls[group_id]['participants'][username]
+                remove_group_call_speaker(group_id, username)
 
                 # Если участников не осталось, завершаем звонок
                 if not group_calls[group_id]['participants']:
@@ -266,7 +738,7 @@ def cleanup_group_call_connection(client_socket):
                 else:
                     broadcast_group_call_status_to_call_clients(group_id)
 
-        del group_call_clients[client_socket]
+        registry.unregister_group_call(client_socket)
         print(f"[GROUP CALL] Cleaned up connection for {username}")
 
 def handle_group_call_signal(message, client_socket, db_connection):
@@ -291,16 +763,9 @@ def handle_group_call_signal(message, client_socket, db_connection):
             return
 
         # Проверяем членство в группе
-        cursor = db_connection.cursor()
-        cursor.execute(
-            "SELECT 1 FROM group_members WHERE group_id = %s AND username = %s",
-            (group_id, username)
-        )
-        if not cursor.fetchone():
+        if not group_cache.is_member(group_id, username, db_connection):
             print(f"[GROUP CALL ERROR] User {username} is not a member of group {group_id}")
-            cursor.close()
             return
-        cursor.close()
 
         if action == "start":
             # Начинаем новый групповой звонок
@@ -338,6 +803,7 @@ def handle_group_call_signal(message, client_socket, db_connection):
                 del group_calls[group_id]['participants'][username]
                 client_connection.is_in_group_call = False
                 client_connection.current_group_call_id = None
+                remove_group_call_speaker(group_id, username)
 
                 print(f"[GROUP CALL] {username} left call in group {group_id}")
 
@@ -360,6 +826,10 @@ def handle_group_call_signal(message, client_socket, db_connection):
                         participant_connection.current_group_call_id = None
 
                 del group_calls[group_id]
+                if group_call_mixer is not None:
+                    group_call_mixer.remove_call(group_id)
+                if media_relay is not None:
+                    media_relay.revoke(("group", group_id))
                 print(f"[GROUP CALL] Call ended in group {group_id} by {username}")
                 # Обновляем статус для ВСЕХ участников группы
                 broadcast_group_call_status(group_id, db_connection)
@@ -371,13 +841,7 @@ def handle_group_call_signal(message, client_socket, db_connection):
 def broadcast_group_call_status(group_id, db_connection):
     """функция рассылки статуса группового звонка всем участникам группы"""
     try:
-        cursor = db_connection.cursor()
-        cursor.execute(
-            "SELECT username FROM group_members WHERE group_id = %s",
-            (group_id,)
-        )
-        group_members = [row[0] for row in cursor.fetchall()]
-        cursor.close()
+        group_members = group_cache.members(group_id, db_connection)
 
         # Формируем сообщение о статусе звонка
         if group_id in group_calls:
@@ -391,14 +855,13 @@ def broadcast_group_call_status(group_id, db_connection):
 
         # Отправляем статус участникам группы, а не только участникам звонка
         for member_username in group_members:
-            for client_socket, client_data in clients.items():
-                if hasattr(client_data, 'username') and client_data.username == member_username:
-                    try:
-                        client_socket.send(f"{status_message}\n".encode('utf-8'))
-                        print(f"[GROUP CALL] Sent status to group member {member_username}")
-                    except Exception as e:
-                        print(f"[GROUP CALL ERROR] Failed to send status to {member_username}: {e}")
-                    break
+            member_socket = registry.socket_for(member_username)
+            if member_socket:
+                try:
+                    member_socket.send(f"{status_message}\n".encode('utf-8'))
+                    print(f"[GROUP CALL] Sent status to group member {member_username}")
+                except Exception as e:
+                    print(f"[GROUP CALL ERROR] Failed to send status to {member_username}: {e}")
 
     except Exception as e:
         print(f"[GROUP CALL ERROR] Error broadcasting status: {e}")
@@ -417,6 +880,12 @@ def forward_group_audio_data(data, sender_socket):
             return
 
         sender_username = sender_connection.username
+        pause = track_group_call_speaker(group_id, sender_username, data)
+        if mix_group_call_audio(group_id, sender_username, data, pause is not None):
+            return
+        if pause == "repeat":
+            return  # по TCP первый маркер паузы уже доставлен
+
         participants = group_calls[group_id]['participants']
 
         print(f"[GROUP AUDIO] Forwarding audio from {sender_username} to {len(participants) - 1} participants")
@@ -427,7 +896,9 @@ def forward_group_audio_data(data, sender_socket):
             if participant_username != sender_username and participant_socket != sender_socket:
                 try:
                     if participant_socket in clients:
-                        participant_socket.sendall(data)
+                        if pause and not is_framed(participant_socket):
+                            continue
+                        send_binary(participant_socket, FRAME_AUDIO, data)
                         forwarded_count += 1
                         print(f"[GROUP AUDIO] ✓ Forwarded to {participant_username}")
                     else:
@@ -449,7 +920,7 @@ def forward_group_audio_data(data, sender_socket):
     except Exception as e:
         print(f"[GROUP AUDIO ERROR] Error forwarding audio: {e}")
 
-def handle_screen_sharing_connection(screen_socket, addr, db_connection):
+def handle_screen_sharing_connection(screen_socket, addr, db_pool):
     """Обрабатывает отдельное соединение для демонстрации экрана"""
     print(f"[SCREEN] New screen sharing connection from {addr}")
 
@@ -457,45 +928,28 @@ def handle_screen_sharing_connection(screen_socket, addr, db_connection):
     screen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1048576)
 
     buffer = ""
-    screen_data_buffers = {}
+    handshake = ServerHandshake()
 
     try:
         while True:
             try:
-                data = screen_socket.recv(65536)
+                data = screen_socket.recv(RECV_BUFFER_SIZE if handshake.decoder else 65536)
                 if not data:
                     break
 
-                try:
-                    # Пытаемся декодировать как текст
-                    buffer += data.decode('utf-8')
-                    messages = buffer.split('\n')
-                    buffer = messages[-1]
-
-                    for message in messages[:-1]:
-                        if message:
-                            print(f"[SCREEN] Received message: {message[:50]}...")
-
-                            if message.startswith("SCREEN_AUTH:"):
-                                handle_screen_auth(message, screen_socket, db_connection)
-                            elif message.startswith("SCREEN_CONTROL:"):
-                                handle_screen_control(message, screen_socket, db_connection)
-                            elif message.startswith("SCREEN_DATA_START:"):
-                                handle_screen_data_start(message, screen_socket, db_connection)
-                            elif message.startswith("SCREEN_DATA_CHUNK:"):
-                                handle_screen_data_chunk(message, screen_socket, db_connection)
-                            elif message.startswith("SCREEN_DATA_END:"):
-                                handle_screen_data_end(message, screen_socket, db_connection)
-                            elif message.startswith("GROUP_SCREEN_DATA_START:"):
-                                handle_group_screen_data_start(message, screen_socket, db_connection)
-                            elif message.startswith("GROUP_SCREEN_DATA_CHUNK:"):
-                                handle_group_screen_data_chunk(message, screen_socket, db_connection)
-                            elif message.startswith("GROUP_SCREEN_DATA_END:"):
-                                handle_group_screen_data_end(message, screen_socket, db_connection)
-
-                except UnicodeDecodeError:
-                    # Это бинарные данные
-                    handle_binary_screen_data(data, screen_socket, db_connection)
+                if not handshake.done:
+                    screen_socket, data = handshake.accept(data, screen_socket)
+                    if handshake.done:
+                        screen_socket = open_outbound_queue(screen_socket, addr)
+                    if not data:
+                        continue
+
+                if handshake.decoder:
+                    frames = handshake.decoder.feed(data)
+                    if frames:
+                        run_with_session(db_pool, process_screen_frames, frames, screen_socket)
+                else:
+                    buffer = run_with_session(db_pool, process_screen_data, data, buffer, screen_socket)
 
             except socket.timeout:
                 continue
@@ -514,42 +968,94 @@ def handle_screen_sharing_connection(screen_socket, addr, db_connection):
         print(f"[SCREEN] Screen sharing connection {addr} closed")
 
 
-def handle_group_client(client_socket, addr, db_connection):
+def process_screen_data(data, buffer, screen_socket, db_connection):
+    """Разбирает порцию данных демонстрации экрана, возвращает остаток незавершенной строки"""
+    try:
+        # Пытаемся декодировать как текст
+        buffer += data.decode('utf-8')
+        messages = buffer.split('\n')
+        buffer = messages[-1]
+
+        for message in messages[:-1]:
+            if message:
+                dispatch_screen_message(message, screen_socket, db_connection)
+
+    except UnicodeDecodeError:
+        # Это бинарные данные
+        handle_binary_screen_data(data, screen_socket, db_connection)
+
+    return buffer
+
+
+def process_screen_frames(frames, screen_socket, db_connection):
+    """Разбирает кадры демонстрации экрана: команды и бинарные данные разделены типом кадра"""
+    for frame_type, payload in frames:
+        if frame_type == FRAME_TEXT:
+            try:
+                text = str(payload, 'utf-8')
+            except UnicodeDecodeError:
+                print("[SCREEN ERROR] Invalid UTF-8 in text frame")
+                continue
+            for message in text.split('\n'):
+                if message:
+                    dispatch_screen_message(message, screen_socket, db_connection)
+        elif frame_type == FRAME_SCREEN:
+            handle_screen_frame(payload, screen_socket, db_connection)
+        else:
+            handle_binary_screen_data(payload, screen_socket, db_connection)
+
+
+def dispatch_screen_message(message, screen_socket, db_connection):
+    """Направляет текстовую команду демонстрации экрана в нужный обработчик"""
+    print(f"[SCREEN] Received message: {message[:50]}...")
+
+    if message.startswith("SCREEN_AUTH:"):
+        handle_screen_auth(message, screen_socket, db_connection)
+    elif message.startswith("SCREEN_CONTROL:"):
+        handle_screen_control(message, screen_socket, db_connection)
+    elif message.startswith("SCREEN_ACK:"):
+        handle_screen_ack(message, screen_socket, db_connection)
+    elif message.startswith("SCREEN_KEYFRAME:"):
+        handle_screen_keyframe_request(message, screen_socket, db_connection)
+    elif message.startswith("SCREEN_DATA_START:"):
+        handle_screen_data_start(message, screen_socket, db_connection)
+    elif message.startswith("SCREEN_DATA_CHUNK:"):
+        handle_screen_data_chunk(message, screen_socket, db_connection)
+    elif message.startswith("SCREEN_DATA_END:"):
+        handle_screen_data_end(message, screen_socket, db_connection)
+    elif message.startswith("GROUP_SCREEN_DATA_START:"):
+        handle_group_screen_data_start(message, screen_socket, db_connection)
+    elif message.startswith("GROUP_SCREEN_DATA_CHUNK:"):
+        handle_group_screen_data_chunk(message, screen_socket, db_connection)
+    elif message.startswith("GROUP_SCREEN_DATA_END:"):
+        handle_group_screen_data_end(message, screen_socket, db_connection)
+
+
+def handle_group_client(client_socket, addr, db_pool):
     """Модифицированный обработчик группового чата с поддержкой файлов"""
     print(f"[GROUP CONNECTION] {addr} connected to group chat.")
-    username = None
+    handshake = ServerHandshake()
 
     while True:
         try:
-            data = client_socket.recv(8192)  # Увеличиваем буфер для файлов
+            wait_before_read(client_socket)
+            data = client_socket.recv(RECV_BUFFER_SIZE if handshake.decoder else 8192)  # Увеличиваем буфер для файлов
             if not data:
                 break
 
-            try:
-                message = data.decode('utf-8')
-                messages = message.strip().split('\n')
-
-                for msg in messages:
-                    if msg:
-                        if msg.startswith("GROUP_AUTH:"):
-                            handle_group_auth(msg, client_socket, db_connection)
-                        elif msg.startswith("GROUP_MESSAGE:"):
-                            handle_group_message(msg, client_socket, db_connection)
-                        elif msg.startswith("GROUP_EDIT_MESSAGE:"):
-                            handle_group_edit_message(msg, client_socket, db_connection)
-                        elif msg.startswith("GROUP_DELETE_MESSAGE:"):
-                            handle_group_delete_message(msg, client_socket, db_connection)
-                        elif msg.startswith("GROUP_JOIN:"):
-                            handle_group_join(msg, client_socket, db_connection)
-                        elif msg.startswith("GROUP_LEAVE:"):
-                            handle_group_leave(msg, client_socket, db_connection)
-                        # Обработка групповых файлов
-                        elif msg.startswith("GROUP_FILE_TRANSFER:"):
-                            handle_group_file_transfer(msg, client_socket, db_connection)
+            if not handshake.done:
+                client_socket, data = handshake.accept(data, client_socket)
+                if handshake.done:
+                    client_socket = open_outbound_queue(client_socket, addr)
+                if not data:
+                    continue
 
-            except UnicodeDecodeError:
-                # Обработка бинарных данных если нужно
-                pass
+            if handshake.decoder:
+                frames = handshake.decoder.feed(data)
+                if frames:
+                    run_with_session(db_pool, process_group_frames, frames, client_socket)
+            else:
+                run_with_session(db_pool, process_group_data, data, client_socket)
 
         except Exception as e:
             print(f"[GROUP ERROR] {e}")
@@ -561,6 +1067,52 @@ def handle_group_client(client_socket, addr, db_connection):
     print(f"[GROUP DISCONNECT] {addr} disconnected from group chat.")
 
 
+def process_group_data(data, client_socket, db_connection):
+    """Разбирает порцию данных группового чата"""
+    try:
+        dispatch_group_text(data.decode('utf-8'), client_socket, db_connection)
+    except UnicodeDecodeError:
+        # Обработка бинарных данных если нужно
+        pass
+
+
+def process_group_frames(frames, client_socket, db_connection):
+    """Разбирает кадры группового чата (кадровый протокол)"""
+    for frame_type, payload in frames:
+        if frame_type == FRAME_TEXT:
+            try:
+                dispatch_group_text(str(payload, 'utf-8'), client_socket, db_connection)
+            except UnicodeDecodeError:
+                print("[GROUP ERROR] Invalid UTF-8 in text frame")
+        elif frame_type == FRAME_FILE:
+            handle_group_file_chunk(payload, client_socket, db_connection)
+
+
+def dispatch_group_text(message, client_socket, db_connection):
+    """Направляет текстовые команды группового чата в обработчики"""
+    for msg in message.strip().split('\n'):
+        if msg:
+            if msg.startswith("GROUP_AUTH:"):
+                handle_group_auth(msg, client_socket, db_connection)
+            elif msg.startswith("GROUP_MESSAGE:"):
+                handle_group_message(msg, client_socket, db_connection)
+            elif msg.startswith("GROUP_EDIT_MESSAGE:"):
+                handle_group_edit_message(msg, client_socket, db_connection)
+            elif msg.startswith("GROUP_DELETE_MESSAGE:"):
+                handle_group_delete_message(msg, client_socket, db_connection)
+            elif msg.startswith("GROUP_JOIN:"):
+                handle_group_join(msg, client_socket, db_connection)
+            elif msg.startswith("GROUP_LEAVE:"):
+                handle_group_leave(msg, client_socket, db_connection)
+            # Обработка групповых файлов
+            elif msg.startswith("GROUP_FILE_TRANSFER:"):
+                handle_group_file_transfer(msg, client_socket, db_connection)
+            elif msg.startswith("GROUP_FILE_OFFER:"):
+                handle_file_offer(msg, client_socket, db_connection)
+            elif msg.startswith("GROUP_MEMBERS_CHANGED:"):
+                handle_group_members_changed(msg, client_socket, db_connection)
+
+
 def handle_group_auth(message, client_socket, db_connection):
     """Обрабатывает аутентификацию для группового чата"""
     try:
@@ -573,10 +1125,7 @@ def handle_group_auth(message, client_socket, db_connection):
         print(f"[GROUP AUTH] Authenticating {username} for group chat")
 
         # Сохраняем соединение
-        group_clients[client_socket] = {
-            'username': username,
-            'joined_groups': set()
-        }
+        registry.register_group(client_socket, username)
 
         # Отправляем подтверждение
         client_socket.send("GROUP_AUTH_SUCCESS\n".encode('utf-8'))
@@ -601,22 +1150,14 @@ def handle_group_join(message, client_socket, db_connection):
         username = group_clients[client_socket]['username']
 
         # Проверяем, является ли пользователь участником группы
-        cursor = db_connection.cursor()
-        cursor.execute(
-            "SELECT 1 FROM group_members WHERE group_id = %s AND username = %s",
-            (group_id, username)
-        )
-
-        if cursor.fetchone():
+        if group_cache.is_member(group_id, username, db_connection):
             # Добавляем группу к активным группам пользователя
-            group_clients[client_socket]['joined_groups'].add(group_id)
+            registry.join_group(client_socket, group_id)
 
             # Отправляем подтверждение
             client_socket.send(f"GROUP_JOINED:{group_id}\n".encode('utf-8'))
             print(f"[GROUP JOIN] {username} joined group {group_id}")
 
-        cursor.close()
-
     except Exception as e:
         print(f"[GROUP JOIN ERROR] {e}")
 
@@ -637,8 +1178,7 @@ def handle_group_leave(message, client_socket, db_connection):
         username = group_clients[client_socket]['username']
 
         # Удаляем группу из активных групп пользователя
-        if group_id in group_clients[client_socket]['joined_groups']:
-            group_clients[client_socket]['joined_groups'].remove(group_id)
+        if registry.leave_group(client_socket, group_id):
 
             # Отправляем подтверждение
             client_socket.send(f"GROUP_LEFT:{group_id}\n".encode('utf-8'))
@@ -649,6 +1189,29 @@ def handle_group_leave(message, client_socket, db_connection):
         print(f"[GROUP LEAVE ERROR] {e}")
 
 
+def handle_group_members_changed(message, client_socket, db_connection):
+    """Сбрасывает кэш состава группы после вступления, выхода или удаления группы"""
+    try:
+        # Формат: GROUP_MEMBERS_CHANGED:group_id
+        parts = message.split(":", 1)
+        if len(parts) < 2 or client_socket not in group_clients:
+            return
+
+        group_id = int(parts[1])
+        group_cache.invalidate(group_id)
+        refresh_group_screen_shares(group_id, db_connection)
+
+        # Если пользователь больше не участник, перестаем рассылать ему сообщения группы
+        username = group_clients[client_socket]['username']
+        if not group_cache.is_member(group_id, username, db_connection):
+            registry.leave_group(client_socket, group_id)
+
+        print(f"[GROUP] Members of group {group_id} changed")
+
+    except Exception as e:
+        print(f"[GROUP ERROR] Error handling members change: {e}")
+
+
 def handle_group_message(message, client_socket, db_connection):
     """Обрабатывает сообщения в группе"""
     try:
@@ -677,30 +1240,21 @@ def handle_group_message(message, client_socket, db_connection):
             print(f"[GROUP MESSAGE ERROR] User {username} not joined to group {group_id}")
             return
 
-        # Проверяем, является ли пользователь участником группы в БД
-        cursor = db_connection.cursor()
-        cursor.execute(
-            "SELECT 1 FROM group_members WHERE group_id = %s AND username = %s",
-            (group_id, username)
-        )
-
-        if not cursor.fetchone():
+        # Проверяем, является ли пользователь участником группы
+        if not group_cache.is_member(group_id, username, db_connection):
             print(f"[GROUP MESSAGE ERROR] User {username} is not a member of group {group_id}")
-            cursor.close()
             return
 
-        # Сохраняем сообщение в БД
-        cursor.execute(
-            """
-            INSERT INTO group_messages (group_id, sender, content)
-            VALUES (%s, %s, %s)
-            RETURNING id
-            """,
-            (group_id, sender, content)
-        )
-        message_id = cursor.fetchone()[0]
-        db_connection.commit()
-        cursor.close()
+        # Сохраняем сообщение в БД: в очередь отложенной записи или сразу
+        if message_writer is not None:
+            message_writer.submit("group_messages", group_id, sender, content)
+        else:
+            try:
+                statements.execute(db_connection, "insert_group_message", group_id, sender, content)
+                db_connection.commit()
+            except Exception:
+                db_connection.rollback()
+                raise
 
         print(f"[GROUP MESSAGE] Saved message from {sender} in group {group_id}: {content}")
 
@@ -710,9 +1264,6 @@ def handle_group_message(message, client_socket, db_connection):
 
     except Exception as e:
         print(f"[GROUP MESSAGE ERROR] {e}")
-        if 'cursor' in locals():
-            db_connection.rollback()
-            cursor.close()
 
 
 def handle_group_edit_message(message, client_socket, db_connection):
@@ -812,26 +1363,14 @@ def handle_group_delete_message(message, client_socket, db_connection):
             return
 
         # Проверяем, является ли пользователь владельцем сообщения или администратором группы
-        cursor = db_connection.cursor()
-
-        # Проверяем роль пользователя в группе
-        cursor.execute(
-            """
-            SELECT role FROM group_members 
-            WHERE group_id = %s AND username = %s
-            """,
-            (group_id, username)
-        )
-        role_result = cursor.fetchone()
+        user_role = group_cache.role_of(group_id, username, db_connection)
 
-        if not role_result:
+        if user_role is None:
             print(f"[GROUP DELETE ERROR] User {username} is not a member of group {group_id}")
-            cursor.close()
             return
 
-        user_role = role_result[0]
-
         # Проверяем владельца сообщения
+        cursor = db_connection.cursor()
         cursor.execute(
             """
             SELECT sender FROM group_messages 
@@ -908,20 +1447,13 @@ def handle_group_file_transfer(message, client_socket, db_connection):
             print(f"[GROUP FILE ERROR] User {username} not joined to group {group_id}")
             return
 
-        # Проверяем, является ли пользователь участником группы в БД
-        cursor = db_connection.cursor()
-        cursor.execute(
-            "SELECT 1 FROM group_members WHERE group_id = %s AND username = %s",
-            (group_id, username)
-        )
-
-        if not cursor.fetchone():
+        # Проверяем, является ли пользователь участником группы
+        if not group_cache.is_member(group_id, username, db_connection):
             print(f"[GROUP FILE ERROR] User {username} is not a member of group {group_id}")
-            cursor.close()
             return
 
         if action == "START":
-            file_info = parts[4].split(":", 1)
+            file_info = parts[4].split(":")
             file_name = file_info[0]
             file_size = file_info[1] if len(file_info) > 1 else "0"
 
@@ -931,38 +1463,20 @@ def handle_group_file_transfer(message, client_socket, db_connection):
             # Это будет сделано только при завершении передачи
 
         elif action == "END":
-            file_name = parts[4]
+            file_name = parts[4].split(":")[0]
 
             print(f"[GROUP FILE] Completed transfer of {file_name} from {sender} to group {group_id}")
 
-            # Определяем тип файла
-            file_extension = os.path.splitext(file_name)[1].lower()
-            is_image = file_extension in ['.jpg', '.jpeg', '.png', '.gif', '.bmp']
+            record_group_file_message(group_id, sender, file_name, db_connection)
 
-            # Сохраняем сообщение о завершении передачи файла в БД
-            if is_image:
-                content = f"[Вложение: {file_name}]"
-            else:
-                content = f"[Файл получен: {file_name}]"
-
-            cursor.execute(
-                """
-                INSERT INTO group_messages (group_id, sender, content)
-                VALUES (%s, %s, %s)
-                RETURNING id
-                """,
-                (group_id, sender, content)
-            )
-            message_id = cursor.fetchone()[0]
-            db_connection.commit()
-
-            # Рассылаем сообщение о файле всем участникам группы
-            broadcast_to_group(group_id, f"GROUP_MESSAGE:{group_id}:{sender}:{content}", exclude_socket=None)
-
-        cursor.close()
-
-        # Пересылаем сообщение о передаче файла всем участникам группы
-        broadcast_to_group(group_id, message, exclude_socket=client_socket)
+        # Пересылаем сообщение о передаче файла всем участникам группы (в одном потоке с частями файла)
+        for member_socket in registry.group_sockets_for(group_id):
+            if member_socket != client_socket:
+                try:
+                    send_on_stream(member_socket, file_message_for(member_socket, message), STREAM_FILE,
+                                   client_socket)
+                except Exception as e:
+                    print(f"[GROUP FILE ERROR] Failed to forward file transfer: {e}")
 
     except Exception as e:
         print(f"[GROUP FILE ERROR] {e}")
@@ -971,13 +1485,62 @@ def handle_group_file_transfer(message, client_socket, db_connection):
             cursor.close()
 
 
+def record_group_file_message(group_id, sender, file_name, db_connection):
+    """Сохраняет сообщение о файле в группе и рассылает его участникам"""
+    content = file_message_content(file_name)
+    cursor = db_connection.cursor()
+    try:
+        cursor.execute(
+            """
+            INSERT INTO group_messages (group_id, sender, content)
+            VALUES (%s, %s, %s)
+            RETURNING id
+            """,
+            (group_id, sender, content)
+        )
+        db_connection.commit()
+    finally:
+        cursor.close()
+
+    # Рассылаем сообщение о файле всем участникам группы
+    broadcast_to_group(group_id, f"GROUP_MESSAGE:{group_id}:{sender}:{content}", exclude_socket=None)
+
+
+def handle_group_file_chunk(payload, client_socket, db_connection):
+    """Пересылает часть файла (FRAME_FILE) участникам группы, не разбирая данные"""
+    try:
+        chunk = unpack_file_chunk(payload)
+        if chunk is None or chunk[0] != FILE_GROUP:
+            print("[GROUP FILE ERROR] Malformed file chunk")
+            return
+        kind, sender, target, transfer_id, offset, data = chunk
+        group_id = int(target)
+
+        group_connection = group_clients.get(client_socket)
+        if group_connection is None or group_connection['username'] != sender:
+            print(f"[SECURITY] File chunk from unauthenticated group connection for {sender}")
+            return
+        upload = file_upload_for(client_socket, transfer_id)
+        if upload is not None:
+            store_file_chunk(upload, offset, data, client_socket, db_connection)
+            return
+        if group_id not in group_connection['joined_groups']:
+            return
+        if not group_cache.is_member(group_id, sender, db_connection):
+            return
+
+        relay_file_chunk(payload, chunk, [s for s in registry.group_sockets_for(group_id) if s != client_socket],
+                         client_socket)
+    except Exception as e:
+        print(f"[GROUP FILE ERROR] Error handling file chunk: {e}")
+
+
 def broadcast_to_group(group_id, message, exclude_socket=None):
     """Рассылает сообщение всем участникам группы """
     try:
-        # Находим всех подключенных участников группы
-        for client_socket, client_data in group_clients.items():
-            if (group_id in client_data['joined_groups'] and
-                client_socket != exclude_socket):
+        # Только соединения, открывшие эту группу
+        for client_socket in registry.group_sockets_for(group_id):
+            if client_socket != exclude_socket:
                 try:
                     client_socket.send(f"{message}\n".encode('utf-8'))
                 except Exception as e:
@@ -988,24 +1551,14 @@ def broadcast_to_group(group_id, message, exclude_socket=None):
 
 def cleanup_group_connection(client_socket):
     """Очищает соединение группового чата"""
-    if client_socket in group_clients:
-        username = group_clients[client_socket]['username']
-        joined_groups = group_clients[client_socket]['joined_groups'].copy()
-
-
-        del group_clients[client_socket]
+    registry.unregister_group(client_socket)
+    release_file_uploads(client_socket)
 
 def cleanup_screen_connection(screen_socket):
     """Очищает соединение демонстрации экрана"""
-    # Удаляем из screen_sharing_connections
-    if screen_socket in screen_sharing_connections:
-        del screen_sharing_connections[screen_socket]
-
-    # Находим и очищаем связь в clients
-    for client_socket, client_data in clients.items():
-        if isinstance(client_data, ClientConnection) and client_data.screen_socket == screen_socket:
-            client_data.screen_socket = None
-            break
+    client_connection = registry.unlink_screen(screen_socket)
+    if client_connection is not None and client_connection.username:
+        update_group_screen_viewer(client_connection.username)
 
 
 def handle_screen_auth(message, screen_socket, db_connection):
@@ -1018,17 +1571,12 @@ def handle_screen_auth(message, screen_socket, db_connection):
         username = parts[1]
         print(f"[SCREEN] Authenticating screen connection for {username}")
 
-        # Находим основное соединение пользователя
-        found_client = False
-        for client_socket, client_data in clients.items():
-            if isinstance(client_data, ClientConnection) and client_data.username == username:
-                client_data.screen_socket = screen_socket
-                screen_sharing_connections[screen_socket] = client_data
-                found_client = True
-                print(f"[SCREEN] ✓ Linked screen connection to user {username}")
-                break
-
-        if not found_client:
+        # Привязываем к основному соединению пользователя
+        if registry.link_screen(username, screen_socket):
+            print(f"[SCREEN] ✓ Linked screen connection to user {username}")
+            # Пользователь может смотреть уже идущие демонстрации в своих группах
+            update_group_screen_viewer(username)
+        else:
             print(f"[SCREEN] ✗ Warning: No main connection found for user {username}")
 
         # Отладочная информация
@@ -1071,15 +1619,11 @@ def handle_binary_screen_data(data, sender_socket, db_connection):
         if not recipient_username:
             return
 
-        recipient_connection = None
-        for client_socket, client_data in clients.items():
-            if isinstance(client_data, ClientConnection) and client_data.username == recipient_username:
-                recipient_connection = client_data
-                break
+        recipient_connection = registry.get(recipient_username)
 
         if recipient_connection and recipient_connection.screen_socket:
             try:
-                recipient_connection.screen_socket.sendall(data)
+                send_binary(recipient_connection.screen_socket, FRAME_BINARY, data)
             except Exception as e:
                 print(f"[SCREEN ERROR] Failed to forward binary screen data: {e}")
 
@@ -1087,6 +1631,120 @@ def handle_binary_screen_data(data, sender_socket, db_connection):
         print(f"[SCREEN ERROR] Error handling binary screen data: {e}")
 
 
+def handle_screen_frame(payload, sender_socket, db_connection):
+    """Пересылает бинарный кадр экрана зрителям.
+
+    Изображение не разбирается и не копируется: зрителям нового протокола
+    уходит та же нагрузка (memoryview из разборщика кадров), клиентам
+    старого - части SCREEN_DATA_* в base64, собранные один раз на кадр.
+    Разностные кадры получают только зрители, поддерживающие их; остальным
+    достаются ключевые кадры (обычный JPEG).
+    """
+    try:
+        frame = unpack_screen_frame(payload)
+        if frame is None:
+            print("[SCREEN ERROR] Malformed screen frame")
+            return
+        kind, sender, target, frame_id, image, delta = frame
+
+        sender_connection = screen_sharing_connections.get(sender_socket)
+        if sender_connection is None or sender_connection.username != sender:
+            print(f"[SECURITY] Screen frame from unauthenticated connection for {sender}")
+            return
+
+        if kind == SCREEN_GROUP:
+            viewers = get_group_screen_viewers(int(target), sender, db_connection, create=True)
+        else:
+            recipient_connection = registry.get(target)
+            if not recipient_connection or not recipient_connection.screen_socket:
+                return
+            viewers = [(target, recipient_connection.screen_socket)]
+
+        legacy_lines = None
+        for viewer_username, viewer_socket in viewers:
+            try:
+                if delta and not supports_screen_tiles(viewer_socket):
+                    continue  # разностный кадр не собрать без холста - зритель получит ключевые кадры
+                if supports_screen_frames(viewer_socket):
+                    send_binary(viewer_socket, FRAME_SCREEN, payload)
+                    continue
+                if legacy_lines is None:
+                    legacy_lines = screen_frame_text_lines(kind, sender, target, frame_id, image)
+                for line in legacy_lines:
+                    send_on_stream(viewer_socket, line, STREAM_SCREEN)
+            except Exception as e:
+                print(f"[SCREEN ERROR] Failed to forward screen frame to {viewer_username}: {e}")
+
+    except Exception as e:
+        print(f"[SCREEN ERROR] Error handling screen frame: {e}")
+
+
+def screen_frame_text_lines(kind, sender, target, frame_id, image):
+    """Кадр экрана в виде строк SCREEN_DATA_* / GROUP_SCREEN_DATA_* старого протокола"""
+    prefix = "GROUP_SCREEN_DATA" if kind == SCREEN_GROUP else "SCREEN_DATA"
+    encoded = base64.b64encode(image).decode('ascii')
+    chunks = [encoded[i:i + SCREEN_TEXT_CHUNK_SIZE] for i in range(0, len(encoded), SCREEN_TEXT_CHUNK_SIZE)]
+    lines = [f"{prefix}_START:{sender}:{target}:{frame_id}:{len(chunks)}\n"]
+    lines += [f"{prefix}_CHUNK:{sender}:{target}:{frame_id}:{i}:{chunk}\n" for i, chunk in enumerate(chunks)]
+    lines.append(f"{prefix}_END:{sender}:{target}:{frame_id}\n")
+    return [line.encode('utf-8') for line in lines]
+
+
+def handle_screen_ack(message, viewer_socket, db_connection):
+    """Пересылает демонстрирующему подтверждение кадра от зрителя.
+
+    Формат: SCREEN_ACK:viewer:sender:frame_id[:group_id]. По подтверждениям
+    отправитель подстраивает FPS, масштаб и качество под самого медленного зрителя.
+    """
+    try:
+        parts = message.split(":")
+        if len(parts) < 4:
+            return
+        forward_to_screen_sender(message, viewer_socket, parts[1], parts[2],
+                                 parts[4] if len(parts) > 4 else None, db_connection)
+
+    except Exception as e:
+        print(f"[SCREEN ERROR] Error handling screen ack: {e}")
+
+
+def handle_screen_keyframe_request(message, viewer_socket, db_connection):
+    """Пересылает демонстрирующему просьбу зрителя о ключевом кадре.
+
+    Формат: SCREEN_KEYFRAME:viewer:sender[:group_id]. Зритель отправляет
+    ее, когда заметил пропуск в номерах кадров (разностный кадр отброшен по
+    дороге): без ключевого кадра следующие плитки легли бы на устаревший холст.
+    """
+    try:
+        parts = message.split(":")
+        if len(parts) < 3:
+            return
+        forward_to_screen_sender(message, viewer_socket, parts[1], parts[2],
+                                 parts[3] if len(parts) > 3 else None, db_connection)
+
+    except Exception as e:
+        print(f"[SCREEN ERROR] Error handling keyframe request: {e}")
+
+
+def forward_to_screen_sender(message, viewer_socket, viewer, sender, group_id, db_connection):
+    """Пересылает строку зрителя демонстрирующему, если зритель смотрит его демонстрацию"""
+    viewer_connection = screen_sharing_connections.get(viewer_socket)
+    if viewer_connection is None or viewer_connection.username != viewer:
+        return
+
+    if group_id is not None:
+        with group_screen_lock:
+            share = group_screen_shares.get((int(group_id), sender))
+            allowed = share is not None and viewer in share['viewers']
+    else:
+        allowed = friend_cache.are_friends(sender, viewer, db_connection)
+    if not allowed:
+        return
+
+    sender_screen_socket = registry.screen_socket_for(sender)
+    if sender_screen_socket:
+        send_on_stream(sender_screen_socket, f"{message}\n".encode('utf-8'), STREAM_CHAT)
+
+
 def handle_screen_control(message, sender_socket, db_connection):
     """Обрабатывает сигналы управления демонстрацией экрана"""
     try:
@@ -1103,16 +1761,7 @@ def handle_screen_control(message, sender_socket, db_connection):
 
         # Проверяем дружбу
         try:
-            cursor = db_connection.cursor()
-            cursor.execute(
-                """
-                SELECT 1 FROM friends 
-                WHERE (user1 = %s AND user2 = %s) OR (user1 = %s AND user2 = %s)
-                """,
-                (sender, recipient, recipient, sender)
-            )
-            are_friends = cursor.fetchone() is not None
-            cursor.close()
+            are_friends = friend_cache.are_friends(sender, recipient, db_connection)
 
             if not are_friends:
                 print(f"[FILTER] Blocked screen sharing from {sender} to non-friend {recipient}")
@@ -1122,11 +1771,7 @@ def handle_screen_control(message, sender_socket, db_connection):
             return
 
         # Ищем соединение получателя
-        recipient_connection = None
-        for client_socket, client_data in clients.items():
-            if isinstance(client_data, ClientConnection) and client_data.username == recipient:
-                recipient_connection = client_data
-                break
+        recipient_connection = registry.get(recipient)
 
         if recipient_connection and recipient_connection.screen_socket:
             try:
@@ -1157,41 +1802,35 @@ def handle_group_screen_sharing(message, sender_socket, db_connection):
         print(f"[GROUP SCREEN] {action} from {sender} in group {group_id}")
 
         # Проверяем членство в группе
-        cursor = db_connection.cursor()
-        cursor.execute(
-            "SELECT 1 FROM group_members WHERE group_id = %s AND username = %s",
-            (group_id, sender)
-        )
-        if not cursor.fetchone():
+        members = group_cache.members(group_id, db_connection)
+        if sender not in members:
             print(f"[GROUP SCREEN ERROR] User {sender} is not a member of group {group_id}")
-            cursor.close()
             return
 
         # Получаем всех участников группы, которые сейчас онлайн
-        cursor.execute(
-            "SELECT username FROM group_members WHERE group_id = %s AND username != %s",
-            (group_id, sender)
-        )
-        group_members = [row[0] for row in cursor.fetchall()]
-        cursor.close()
+        group_members = [member for member in members if member != sender]
+
+        # Список зрителей составляется один раз на всю демонстрацию
+        if action == "start":
+            start_group_screen_share(group_id, sender, db_connection)
+        elif action == "stop":
+            stop_group_screen_share(group_id, sender)
 
         print(f"[GROUP SCREEN] Broadcasting to {len(group_members)} group members")
 
         # Отправляем сигнал всем онлайн участникам группы
         sent_count = 0
+        signal = f"GROUP_SCREEN_SIGNAL:{action}:{group_id}:{sender}:{timestamp}"
         for member_username in group_members:
-            for client_socket, client_data in clients.items():
-                if (hasattr(client_data, 'username') and
-                    client_data.username == member_username):
-                    try:
-                        # Отправляем через основной сокет
-                        signal = f"GROUP_SCREEN_SIGNAL:{action}:{group_id}:{sender}:{timestamp}"
-                        client_socket.send(f"{signal}\n".encode('utf-8'))
-                        sent_count += 1
-                        print(f"[GROUP SCREEN] ✓ Sent {action} signal to {member_username}")
-                    except Exception as e:
-                        print(f"[GROUP SCREEN ERROR] Failed to send signal to {member_username}: {e}")
-                    break
+            member_socket = registry.socket_for(member_username)
+            if member_socket:
+                try:
+                    # Отправляем через основной сокет
+                    member_socket.send(f"{signal}\n".encode('utf-8'))
+                    sent_count += 1
+                    print(f"[GROUP SCREEN] ✓ Sent {action} signal to {member_username}")
+                except Exception as e:
+                    print(f"[GROUP SCREEN ERROR] Failed to send signal to {member_username}: {e}")
 
         print(f"[GROUP SCREEN] Successfully sent signals to {sent_count} participants")
 
@@ -1201,6 +1840,70 @@ def handle_group_screen_sharing(message, sender_socket, db_connection):
         traceback.print_exc()
 
 
+def start_group_screen_share(group_id, sender, db_connection):
+    """Начинает демонстрацию: запоминает участников группы и их сокеты экрана"""
+    members = {member for member in group_cache.members(group_id, db_connection) if member != sender}
+    viewers = {}
+    for member_username in members:
+        member_screen_socket = registry.screen_socket_for(member_username)
+        if member_screen_socket:
+            viewers[member_username] = member_screen_socket
+
+    with group_screen_lock:
+        share = {'members': members, 'viewers': viewers}
+        group_screen_shares[(group_id, sender)] = share
+
+    print(f"[GROUP SCREEN] Share of {sender} in group {group_id}: {len(viewers)}/{len(members)} viewers online")
+    return share
+
+
+def stop_group_screen_share(group_id, sender):
+    with group_screen_lock:
+        group_screen_shares.pop((group_id, sender), None)
+
+
+def get_group_screen_viewers(group_id, sender, db_connection, create=False):
+    """Снимок зрителей демонстрации; без обращения к БД, если демонстрация уже идет"""
+    with group_screen_lock:
+        share = group_screen_shares.get((group_id, sender))
+        if share is not None:
+            return list(share['viewers'].items())
+
+    if not create:
+        return []
+
+    # Кадр пришел без сигнала start (например, после переподключения)
+    share = start_group_screen_share(group_id, sender, db_connection)
+    return list(share['viewers'].items())
+
+
+def update_group_screen_viewer(username):
+    """Обновляет сокет экрана пользователя во всех демонстрациях, где он зритель"""
+    screen_socket = registry.screen_socket_for(username)
+    with group_screen_lock:
+        for (group_id, sender), share in list(group_screen_shares.items()):
+            if sender == username and screen_socket is None:
+                # Демонстрирующий отключился
+                del group_screen_shares[(group_id, sender)]
+            elif username in share['members']:
+                if screen_socket:
+                    share['viewers'][username] = screen_socket
+                else:
+                    share['viewers'].pop(username, None)
+
+
+def refresh_group_screen_shares(group_id, db_connection):
+    """Пересобирает зрителей демонстраций группы после изменения ее состава"""
+    with group_screen_lock:
+        senders = [sender for (share_group_id, sender) in group_screen_shares if share_group_id == group_id]
+
+    for sender in senders:
+        if group_cache.is_member(group_id, sender, db_connection):
+            start_group_screen_share(group_id, sender, db_connection)
+        else:
+            stop_group_screen_share(group_id, sender)
+
+
 def handle_group_screen_data(data, sender_socket, group_id):
     """Пересылает данные экрана всем участникам группового звонка"""
     try:
@@ -1229,7 +1932,7 @@ def handle_group_screen_data(data, sender_socket, group_id):
                         # Отправляем через screen_socket если он есть
                         participant_connection = clients[participant_socket]
                         if hasattr(participant_connection, 'screen_socket') and participant_connection.screen_socket:
-                            participant_connection.screen_socket.sendall(data)
+                            send_binary(participant_connection.screen_socket, FRAME_BINARY, data)
                             forwarded_count += 1
                             print(f"[GROUP SCREEN DATA] ✓ Forwarded to {participant_username}")
                 except Exception as e:
@@ -1250,15 +1953,11 @@ def handle_screen_data_start(message, sender_socket, db_connection):
             recipient = parts[2]
 
             # Находим получателя и пересылаем сообщение
-            recipient_connection = None
-            for client_socket, client_data in clients.items():
-                if isinstance(client_data, ClientConnection) and client_data.username == recipient:
-                    recipient_connection = client_data
-                    break
+            recipient_connection = registry.get(recipient)
 
             if recipient_connection and recipient_connection.screen_socket:
                 try:
-                    recipient_connection.screen_socket.send(f"{message}\n".encode('utf-8'))
+                    send_on_stream(recipient_connection.screen_socket, f"{message}\n".encode('utf-8'), STREAM_SCREEN)
                     print(f"[SCREEN] Forwarded data start to {recipient}")
                 except Exception as e:
                     print(f"[ERROR] Failed to forward screen data start: {e}")
@@ -1276,15 +1975,11 @@ def handle_screen_data_chunk(message, sender_socket, db_connection):
             recipient = parts[2]
 
             # Находим получателя и пересылаем сообщение
-            recipient_connection = None
-            for client_socket, client_data in clients.items():
-                if isinstance(client_data, ClientConnection) and client_data.username == recipient:
-                    recipient_connection = client_data
-                    break
+            recipient_connection = registry.get(recipient)
 
             if recipient_connection and recipient_connection.screen_socket:
                 try:
-                    recipient_connection.screen_socket.send(f"{message}\n".encode('utf-8'))
+                    send_on_stream(recipient_connection.screen_socket, f"{message}\n".encode('utf-8'), STREAM_SCREEN)
                 except Exception as e:
                     print(f"[ERROR] Failed to forward screen data chunk: {e}")
 
@@ -1301,15 +1996,11 @@ def handle_screen_data_end(message, sender_socket, db_connection):
             recipient = parts[2]
 
             # Находим получателя и пересылаем сообщение
-            recipient_connection = None
-            for client_socket, client_data in clients.items():
-                if isinstance(client_data, ClientConnection) and client_data.username == recipient:
-                    recipient_connection = client_data
-                    break
+            recipient_connection = registry.get(recipient)
 
             if recipient_connection and recipient_connection.screen_socket:
                 try:
-                    recipient_connection.screen_socket.send(f"{message}\n".encode('utf-8'))
+                    send_on_stream(recipient_connection.screen_socket, f"{message}\n".encode('utf-8'), STREAM_SCREEN)
                     print(f"[SCREEN] Forwarded data end to {recipient}")
                 except Exception as e:
                     print(f"[ERROR] Failed to forward screen data end: {e}")
@@ -1327,16 +2018,12 @@ def handle_screen_data(message, sender_socket, db_connection):
             recipient = parts[2]
 
             # Ищем соединение получателя
-            recipient_connection = None
-            for client_socket, client_data in clients.items():
-                if isinstance(client_data, ClientConnection) and client_data.username == recipient:
-                    recipient_connection = client_data
-                    break
+            recipient_connection = registry.get(recipient)
 
             if recipient_connection and recipient_connection.screen_socket:
                 try:
                     # Пересылаем данные получателю через соединение демонстрации экрана
-                    recipient_connection.screen_socket.send(f"{message}\n".encode('utf-8'))
+                    send_on_stream(recipient_connection.screen_socket, f"{message}\n".encode('utf-8'), STREAM_SCREEN)
                 except Exception as e:
                     print(f"[ERROR] Failed to send screen data: {e}")
             else:
@@ -1345,220 +2032,229 @@ def handle_screen_data(message, sender_socket, db_connection):
         print(f"[ERROR] Error handling screen data: {e}")
 
 
-def handle_client(client_socket, addr, db_connection):
+def handle_client(client_socket, addr, db_pool):
     print(f"[NEW CONNECTION] {addr} connected.")
-    username = None
     client_connection = ClientConnection(client_socket, addr)
-
-    audio_buffer = b""
-    expecting_group_audio = False
-    group_audio_id = None
+    handshake = ServerHandshake()
 
     while True:
         try:
-            data = client_socket.recv(1024)
+            # Получатель файла от этого клиента не успевает - не читаем дальше, пока не разберет очередь
+            wait_before_read(client_socket)
+            data = client_socket.recv(RECV_BUFFER_SIZE if handshake.decoder else 1024)
             if not data:
                 break
 
-            try:
-                # Сначала проверяем, ожидаем ли мы групповые аудиоданные
-                if expecting_group_audio:
-                    # аудиоданные для группового звонка
-                    print(f"[GROUP AUDIO] Received audio data for group {group_audio_id}")
-                    forward_group_audio_data(data, client_socket)
-                    expecting_group_audio = False
-                    group_audio_id = None
+            if not handshake.done:
+                client_socket, data = handshake.accept(data, client_socket)
+                if handshake.done:
+                    client_socket = open_outbound_queue(client_socket, addr)
+                client_connection.main_socket = client_socket
+                if not data:
                     continue
 
-                message = data.decode('utf-8')
-                messages = message.strip().split('\n')
-                for msg in messages:
-                    if msg:
-                        # Обработка статусов
-                        if msg.startswith("STATUS_ONLINE:"):
-                            handle_status_online(msg, client_socket, db_connection)
-                            continue
-                        elif msg.startswith("STATUS_OFFLINE:"):
-                            handle_status_offline(msg, client_socket, db_connection)
-                            continue
-                        elif msg.startswith("STATUS_REQUEST:"):
-                            handle_status_request(msg, client_socket, db_connection)
-                            continue
-                        # Убираем обработку старых сообщений о статусе
-                        if ": в сети" in msg or ": вышел из сети" in msg:
-                            continue  # Игнорируем старые сообщения о статусе
-                        if msg.startswith("GROUP_SCREEN_DATA_START:"):
-                           handle_group_screen_data_start(msg, client_socket, db_connection)
-                           continue
-                        if msg.startswith("GROUP_SCREEN_DATA_CHUNK:"):
-                           handle_group_screen_data_chunk(msg, client_socket, db_connection)
-                           continue
-                        if msg.startswith("GROUP_SCREEN_DATA_END:"):
-                            handle_group_screen_data_end(msg, client_socket, db_connection)
-                            continue
-                        if msg.startswith("GROUP_CALL_AUDIO:"):
-                            parts = msg.split(":", 1)
-                            if len(parts) >= 2:
-                                group_audio_id = int(parts[1])
-                                expecting_group_audio = True
-                                print(f"[GROUP AUDIO] Expecting audio data for group {group_audio_id}")
-                                continue
-                        elif msg.startswith("CALL_SIGNAL:"):
-                            handle_call_signal(msg, client_socket, db_connection)
-                            continue
-                        if msg.startswith("GROUP_CALL_SIGNAL:"):
-                            handle_group_call_signal(msg, client_socket, db_connection)
-                            continue
-                        elif msg.startswith("GROUP_SCREEN_CONTROL:"):
-                            handle_group_screen_sharing(msg, client_socket, db_connection)
-                            continue
-                        # Обработка уведомлений об исключении из группы
-                        if msg.startswith("GROUP_EXCLUSION:"):
-                            handle_group_exclusion(msg, client_socket, db_connection)
-                            continue
-                        elif msg.startswith("EDIT_MESSAGE:"):
-                            handle_edit_message(msg, client_socket, db_connection)
-                            continue
-                        elif msg.startswith("DELETE_MESSAGE:"):
-                            handle_delete_message(msg, client_socket, db_connection)
-                            continue
-                        elif msg.startswith("FILE_TRANSFER:"):
-                            handle_file_transfer(msg, client_socket, db_connection)
-                            continue
-                        # Обработка личных сообщений с явным указанием получателя
-                        elif msg.startswith("DIRECT_MESSAGE:"):
-                            handle_direct_message(msg, client_socket, db_connection)
-                            continue
-                        elif ":" in msg:
-                            parts = msg.split(":", 1)
-                            sender_username = parts[0].strip()
-                            content = parts[1].strip()
-
-                            if client_socket not in clients:
-                                client_connection.username = sender_username
-                                clients[client_socket] = client_connection
-                                username = sender_username
-                                print(f"[NEW USER] {sender_username} connected")
-                            elif clients[client_socket].username != sender_username:
-                                clients[client_socket].username = sender_username
-                                username = sender_username
-                                print(f"[UPDATE] User {sender_username} updated their username")
-
-                            # логика обработки сообщений
-                            if sender_username != "Система" or not content.startswith("Чат с "):
-                                receiver = None
-                                for sock, client_data in clients.items():
-                                    if isinstance(client_data, ClientConnection) and sock != client_socket and client_data.username != sender_username:
-                                        receiver = client_data.username
-                                        break
-
-                                if not receiver and ":" in content:
-                                    try:
-                                        cursor = db_connection.cursor()
-                                        cursor.execute(
-                                            "SELECT username FROM users WHERE username != %s",
-                                            (sender_username,)
-                                        )
-                                        potential_receivers = cursor.fetchall()
-                                        for potential_receiver in potential_receivers:
-                                            potential_name = potential_receiver[0]
-                                            if f"@{potential_name}" in content or potential_name in content:
-                                                receiver = potential_name
-                                                break
-                                        cursor.close()
-                                    except Exception as e:
-                                        print(f"[ERROR] Failed to find receiver: {e}")
-
-                                if not receiver:
-                                    try:
-                                        cursor = db_connection.cursor()
-                                        cursor.execute(
-                                            """
-                                            SELECT receiver FROM messages 
-                                            WHERE sender = %s 
-                                            ORDER BY timestamp DESC 
-                                            LIMIT 1
-                                            """,
-                                            (sender_username,)
-                                        )
-                                        last_receiver = cursor.fetchone()
-                                        if last_receiver:
-                                            receiver = last_receiver[0]
-                                        else:
-                                            cursor.execute(
-                                                """
-                                                SELECT sender FROM messages 
-                                                WHERE receiver = %s 
-                                                ORDER BY timestamp DESC 
-                                                LIMIT 1
-                                                """,
-                                                (sender_username,)
-                                            )
-                                            last_sender = cursor.fetchone()
-                                            if last_sender:
-                                                receiver = last_sender[0]
-                                        cursor.close()
-                                    except Exception as e:
-                                        print(f"[ERROR] Failed to find receiver from history: {e}")
-
-                                if receiver:
-                                    try:
-                                        save_message(db_connection, sender_username, receiver, content)
-                                        print(f"[DATABASE] Saved message from {sender_username} to {receiver}: {content}")
-                                    except Exception as e:
-                                        print(f"[ERROR] Failed to save message: {e}")
-                                else:
-                                    print(f"[WARNING] Could not determine receiver for message: {msg}")
-
-                            broadcast_message(msg, client_socket, db_connection)
-                        else:
-                            broadcast_message(msg, client_socket, db_connection)
-            except UnicodeDecodeError:
-                # Это бинарные аудиоданные
-                client_connection = clients.get(client_socket)
-                if client_connection:
-                    if client_connection.is_in_group_call:
-                        # групповой звонок
-                        print(f"[GROUP AUDIO] Processing group audio from {client_connection.username}")
-                        forward_group_audio_data(data, client_socket)
-                    elif client_connection.is_in_call:
-                        # Личный звонок
-                        forward_audio_data(data, client_socket)
+            if handshake.decoder:
+                frames = handshake.decoder.feed(data)
+                if frames:
+                    run_with_session(db_pool, process_main_frames, frames, client_socket, client_connection)
+            else:
+                run_with_session(db_pool, process_main_data, data, client_socket, client_connection)
 
         except Exception as e:
             print(f"[ERROR] {e}")
             break
 
-    if client_socket in clients:
-        client_data = clients[client_socket]
-        username = client_data.username if isinstance(client_data, ClientConnection) else client_data
-        del clients[client_socket]
+    run_with_session(db_pool, cleanup_main_connection, client_socket, addr)
 
-        if username and db_connection:
+
+def open_outbound_queue(sock, addr, writer=None):
+    """Ставит очередь исходящих данных перед сокетом соединения.
+
+    Без writer очередь разбирает отдельный поток (потоковый режим),
+    с writer - задача в цикле событий (asyncio режим).
+    """
+    outbound = OutboundQueue(sock, name=str(addr), policies=DEFAULT_POLICIES)
+    if writer is None:
+        outbound.start_thread()
+    else:
+        outbound.start_async(writer)
+    return outbound
+
+
+def run_with_session(db_pool, func, *args):
+    """Вызывает func(*args, db_connection) с ленивой сессией из пула соединений"""
+    with db_pool.session() as db_connection:
+        return func(*args, db_connection)
+
+
+def process_main_data(data, client_socket, client_connection, db_connection):
+    """Разбирает порцию данных основного соединения (старый протокол): текстовые команды или аудио"""
+    # Сначала проверяем, ожидаем ли мы групповые аудиоданные
+    if client_connection.expecting_group_audio:
+        handle_main_audio(data, client_socket, client_connection)
+        return
+
+    try:
+        message = data.decode('utf-8')
+    except UnicodeDecodeError:
+        # Это бинарные аудиоданные
+        handle_main_audio(data, client_socket, client_connection)
+        return
+
+    dispatch_main_text(message, client_socket, client_connection, db_connection)
+
+
+def process_main_frames(frames, client_socket, client_connection, db_connection):
+    """Разбирает кадры основного соединения: текст и аудио различаются типом кадра"""
+    for frame_type, payload in frames:
+        if frame_type == FRAME_TEXT:
             try:
-                cursor = db_connection.cursor()
-                cursor.execute(
-                    """
-                    SELECT 
-                        CASE 
-                            WHEN user1 = %s THEN user2 
-                            ELSE user1 
-                        END as friend
-                    FROM friends 
-                    WHERE user1 = %s OR user2 = %s
-                    """,
-                    (username, username, username)
-                )
-                friends = [friend[0] for friend in cursor.fetchall()]
-                cursor.close()
+                message = str(payload, 'utf-8')
+            except UnicodeDecodeError:
+                print("[ERROR] Invalid UTF-8 in text frame")
+                continue
+            dispatch_main_text(message, client_socket, client_connection, db_connection)
+        elif frame_type == FRAME_AUDIO:
+            handle_main_audio(payload, client_socket, client_connection)
+        elif frame_type == FRAME_FILE:
+            handle_file_chunk(payload, client_socket, db_connection)
+
+
+def handle_main_audio(data, client_socket, client_connection):
+    """Пересылает аудиоданные основного соединения в личный или групповой звонок"""
+    if client_connection.expecting_group_audio:
+        # аудиоданные для группового звонка
+        print(f"[GROUP AUDIO] Received audio data for group {client_connection.group_audio_id}")
+        forward_group_audio_data(data, client_socket)
+        client_connection.expecting_group_audio = False
+        client_connection.group_audio_id = None
+        return
 
-                for sock, client_data in clients.items():
-                    client_name = client_data.username if isinstance(client_data, ClientConnection) else client_data
-                    if client_name in friends:
+    registered_connection = clients.get(client_socket)
+    if registered_connection:
+        if registered_connection.is_in_group_call:
+            # групповой звонок
+            print(f"[GROUP AUDIO] Processing group audio from {registered_connection.username}")
+            forward_group_audio_data(data, client_socket)
+        elif registered_connection.is_in_call:
+            # Личный звонок
+            forward_audio_data(data, client_socket)
+
+
+def dispatch_main_text(message, client_socket, client_connection, db_connection):
+    """Направляет текстовые команды основного соединения в обработчики"""
+    messages = message.strip().split('\n')
+    for msg in messages:
+        if msg:
+            # Обработка статусов
+            if msg.startswith("STATUS_ONLINE:"):
+                handle_status_online(msg, client_socket, db_connection)
+                continue
+            elif msg.startswith("STATUS_OFFLINE:"):
+                handle_status_offline(msg, client_socket, db_connection)
+                continue
+            elif msg.startswith("STATUS_REQUEST:"):
+                handle_status_request(msg, client_socket, db_connection)
+                continue
+            elif msg.startswith("FRIENDS_CHANGED:"):
+                handle_friends_changed(msg, client_socket, db_connection)
+                continue
+            elif msg.startswith("CHAT_OPEN:") or msg.startswith("CHAT_CLOSE:"):
+                handle_chat_session(msg, client_socket, db_connection)
+                continue
+            # Убираем обработку старых сообщений о статусе
+            if ": в сети" in msg or ": вышел из сети" in msg:
+                continue  # Игнорируем старые сообщения о статусе
+            if msg.startswith("GROUP_SCREEN_DATA_START:"):
+               handle_group_screen_data_start(msg, client_socket, db_connection)
+               continue
+            if msg.startswith("GROUP_SCREEN_DATA_CHUNK:"):
+               handle_group_screen_data_chunk(msg, client_socket, db_connection)
+               continue
+            if msg.startswith("GROUP_SCREEN_DATA_END:"):
+                handle_group_screen_data_end(msg, client_socket, db_connection)
+                continue
+            if msg.startswith("GROUP_CALL_AUDIO:"):
+                parts = msg.split(":", 1)
+                if len(parts) >= 2:
+                    client_connection.group_audio_id = int(parts[1])
+                    client_connection.expecting_group_audio = True
+                    print(f"[GROUP AUDIO] Expecting audio data for group {client_connection.group_audio_id}")
+                    continue
+            elif msg.startswith("CALL_SIGNAL:"):
+                handle_call_signal(msg, client_socket, db_connection)
+                continue
+            if msg.startswith("GROUP_CALL_SIGNAL:"):
+                handle_group_call_signal(msg, client_socket, db_connection)
+                continue
+            elif msg.startswith("GROUP_SCREEN_CONTROL:"):
+                handle_group_screen_sharing(msg, client_socket, db_connection)
+                continue
+            # Обработка уведомлений об исключении из группы
+            if msg.startswith("GROUP_EXCLUSION:"):
+                handle_group_exclusion(msg, client_socket, db_connection)
+                continue
+            elif msg.startswith("EDIT_MESSAGE:"):
+                handle_edit_message(msg, client_socket, db_connection)
+                continue
+            elif msg.startswith("DELETE_MESSAGE:"):
+                handle_delete_message(msg, client_socket, db_connection)
+                continue
+            elif msg.startswith("FILE_TRANSFER:"):
+                handle_file_transfer(msg, client_socket, db_connection)
+                continue
+            elif msg.startswith("FILE_OFFER:"):
+                handle_file_offer(msg, client_socket, db_connection)
+                continue
+            # Обработка личных сообщений с явным указанием получателя
+            elif msg.startswith("DIRECT_MESSAGE:"):
+                handle_direct_message(msg, client_socket, db_connection)
+                continue
+            elif ":" in msg:
+                parts = msg.split(":", 1)
+                sender_username = parts[0].strip()
+                content = parts[1].strip()
+
+                if client_socket not in clients:
+                    registry.register(client_socket, client_connection, sender_username)
+                    print(f"[NEW USER] {sender_username} connected")
+                elif clients[client_socket].username != sender_username:
+                    registry.register(client_socket, clients[client_socket], sender_username)
+                    print(f"[UPDATE] User {sender_username} updated their username")
+
+                # Получатель - собеседник открытого чата (CHAT_OPEN), без запросов к БД
+                if sender_username != "Система" or not content.startswith("Чат с "):
+                    receiver = clients[client_socket].chat_peer
+                    if receiver and not friend_cache.are_friends(sender_username, receiver, db_connection):
+                        # Дружба могла закончиться, пока чат открыт
+                        print(f"[FILTER] Blocked message from {sender_username} to non-friend {receiver}")
+                    elif receiver:
                         try:
-                            print(f"[SYSTEM] Sent leave notification to friend {client_name}")
+                            save_message(db_connection, sender_username, receiver, content)
                         except Exception as e:
-                            print(f"[ERROR] Failed to send leave notification to {client_name}: {e}")
+                            print(f"[ERROR] Failed to save message: {e}")
+                    else:
+                        print(f"[WARNING] No open chat for {sender_username}, message not routed: {msg}")
+
+                broadcast_message(msg, client_socket, db_connection)
+            else:
+                broadcast_message(msg, client_socket, db_connection)
+
+
+def cleanup_main_connection(client_socket, addr, db_connection):
+    """Снимает регистрацию основного соединения и завершает звонки пользователя"""
+    release_file_uploads(client_socket)
+    client_data = registry.unregister(client_socket)
+    if client_data is not None:
+        username = client_data.username
+
+        if username and db_connection:
+            try:
+                friends = friend_cache.friends_of(username, db_connection)
+
+                for friend_name in friends:
+                    if registry.get(friend_name):
+                        print(f"[SYSTEM] Sent leave notification to friend {friend_name}")
             except Exception as e:
                 print(f"[ERROR] Failed to get friends for leave notification: {e}")
 
@@ -1566,13 +2262,12 @@ def handle_client(client_socket, addr, db_connection):
 
     print(f"[DISCONNECT] {addr} disconnected.")
     if client_socket in clients:
-        client_data = clients[client_socket]
-        username = client_data.username if isinstance(client_data, ClientConnection) else client_data
+        username = clients[client_socket].username
 
         # Обрабатываем отключение
         handle_client_disconnect(client_socket, username, db_connection)
 
-        del clients[client_socket]
+        registry.unregister(client_socket)
         end_user_calls(username, db_connection)
     client_socket.close()
 
@@ -1601,10 +2296,9 @@ def handle_status_online(message, client_socket, db_connection):
 
         # Регистрируем пользователя в clients если еще не зарегистрирован
         if client_socket not in clients:
-            client_connection = ClientConnection(client_socket, None, username)
-            clients[client_socket] = client_connection
+            registry.register(client_socket, ClientConnection(client_socket, None, username))
         else:
-            clients[client_socket].username = username
+            registry.register(client_socket, clients[client_socket], username)
 
         print(f"[STATUS] {username} is now online")
 
@@ -1635,6 +2329,59 @@ def handle_status_offline(message, client_socket, db_connection):
         print(f"[STATUS ERROR] Error handling status offline: {e}")
 
 
+def handle_friends_changed(message, client_socket, db_connection):
+    """Сбрасывает кэш дружбы после добавления или удаления друга клиентом"""
+    try:
+        # Формат: FRIENDS_CHANGED:username:friend_username
+        parts = message.split(":", 2)
+        if len(parts) < 3:
+            return
+
+        username = parts[1]
+        friend_username = parts[2]
+
+        client_data = clients.get(client_socket)
+        if not client_data or client_data.username != username:
+            print(f"[SECURITY] Friends change notice for {username} from foreign socket")
+            return
+
+        # Сами связи перечитываются из БД при следующей проверке
+        friend_cache.invalidate(username, friend_username)
+        print(f"[FRIENDS] Friendship between {username} and {friend_username} changed")
+
+    except Exception as e:
+        print(f"[FRIENDS ERROR] Error handling friends change: {e}")
+
+
+def handle_chat_session(message, client_socket, db_connection):
+    """Запоминает собеседника открытого личного чата (CHAT_OPEN) или забывает его (CHAT_CLOSE)"""
+    try:
+        # Формат: CHAT_OPEN:username:peer / CHAT_CLOSE:username
+        parts = message.split(":", 2)
+        if len(parts) < 2:
+            return
+
+        username = parts[1]
+        client_data = clients.get(client_socket)
+        if not client_data or client_data.username != username:
+            print(f"[SECURITY] Chat session change for {username} from foreign socket")
+            return
+
+        peer = parts[2].strip() if parts[0] == "CHAT_OPEN" and len(parts) == 3 else None
+        if peer and not friend_cache.are_friends(username, peer, db_connection):
+            # В историю можно писать только другу - собеседник из чужого чата не запоминается
+            print(f"[FILTER] Blocked chat open from {username} with non-friend {peer}")
+            peer = None
+        client_data.chat_peer = peer or None
+        if client_data.chat_peer:
+            print(f"[CHAT] {username} opened chat with {client_data.chat_peer}")
+        else:
+            print(f"[CHAT] {username} closed personal chat")
+
+    except Exception as e:
+        print(f"[CHAT ERROR] Error handling chat session: {e}")
+
+
 def handle_status_request(message, client_socket, db_connection):
     """Обрабатывает запрос статуса пользователя"""
     try:
@@ -1647,16 +2394,7 @@ def handle_status_request(message, client_socket, db_connection):
         target_username = parts[2]
 
         # Проверяем, являются ли пользователи друзьями
-        cursor = db_connection.cursor()
-        cursor.execute(
-            """
-            SELECT 1 FROM friends 
-            WHERE (user1 = %s AND user2 = %s) OR (user1 = %s AND user2 = %s)
-            """,
-            (requester, target_username, target_username, requester)
-        )
-        are_friends = cursor.fetchone() is not None
-        cursor.close()
+        are_friends = friend_cache.are_friends(requester, target_username, db_connection)
 
         if not are_friends:
             print(f"[STATUS] Blocked status request from {requester} for non-friend {target_username}")
@@ -1679,34 +2417,19 @@ def notify_friends_status_change(username, status, db_connection):
     """Уведомляет друзей об изменении статуса пользователя"""
     try:
         # Получаем список друзей
-        cursor = db_connection.cursor()
-        cursor.execute(
-            """
-            SELECT 
-                CASE 
-                    WHEN user1 = %s THEN user2 
-                    ELSE user1 
-                END as friend
-            FROM friends 
-            WHERE user1 = %s OR user2 = %s
-            """,
-            (username, username, username)
-        )
-        friends = [friend[0] for friend in cursor.fetchall()]
-        cursor.close()
+        friends = friend_cache.friends_of(username, db_connection)
 
         # Отправляем уведомление всем онлайн друзьям
         status_update = f"STATUS_UPDATE:{username}:{status}"
 
         for friend_username in friends:
-            for client_socket, client_data in clients.items():
-                if isinstance(client_data, ClientConnection) and client_data.username == friend_username:
-                    try:
-                        client_socket.send(f"{status_update}\n".encode('utf-8'))
-                        print(f"[STATUS] Notified {friend_username} about {username}'s status change to {status}")
-                    except Exception as e:
-                        print(f"[STATUS ERROR] Failed to notify {friend_username}: {e}")
-                    break
+            friend_socket = registry.socket_for(friend_username)
+            if friend_socket:
+                try:
+                    friend_socket.send(f"{status_update}\n".encode('utf-8'))
+                    print(f"[STATUS] Notified {friend_username} about {username}'s status change to {status}")
+                except Exception as e:
+                    print(f"[STATUS ERROR] Failed to notify {friend_username}: {e}")
 
     except Exception as e:
         print(f"[STATUS ERROR] Error notifying friends: {e}")
@@ -1724,40 +2447,20 @@ def handle_group_screen_data_start(message, sender_socket, db_connection):
 
             print(f"[GROUP SCREEN DATA] Start from {sender} for group {group_id}, frame {frame_id}, {chunks_count} chunks")
 
-            # Находим всех участников группы из БД
-            cursor = db_connection.cursor()
-            cursor.execute(
-                "SELECT username FROM group_members WHERE group_id = %s AND username != %s",
-                (group_id, sender)
-            )
-            group_members = [row[0] for row in cursor.fetchall()]
-            cursor.close()
-
-            print(f"[GROUP SCREEN DATA] Found {len(group_members)} group members: {group_members}")
+            # Зрители определены при старте демонстрации
+            viewers = get_group_screen_viewers(group_id, sender, db_connection, create=True)
 
-            # Пересылаем всем участникам группы кроме отправителя
+            # Пересылаем всем зрителям
+            payload = f"{message}\n".encode('utf-8')
             forwarded_count = 0
-            for member_username in group_members:
-                # Ищем клиента среди основных соединений
-                for client_socket, client_data in clients.items():
-                    if (hasattr(client_data, 'username') and
-                        client_data.username == member_username):
-                        # Проверяем наличие screen_socket
-                        if (hasattr(client_data, 'screen_socket') and
-                            client_data.screen_socket):
-                            try:
-                                client_data.screen_socket.send(f"{message}\n".encode('utf-8'))
-                                forwarded_count += 1
-                                print(f"[GROUP SCREEN DATA] ✓ Forwarded start to {member_username}")
-                            except Exception as e:
-                                print(f"[GROUP SCREEN DATA ERROR] Failed to send to {member_username}: {e}")
-                        else:
-                            print(f"[GROUP SCREEN DATA] No screen socket for {member_username}")
-                        break
-                else:
-                    print(f"[GROUP SCREEN DATA] Member {member_username} not found online")
+            for member_username, member_screen_socket in viewers:
+                try:
+                    send_on_stream(member_screen_socket, payload, STREAM_SCREEN)
+                    forwarded_count += 1
+                except Exception as e:
+                    print(f"[GROUP SCREEN DATA ERROR] Failed to send to {member_username}: {e}")
 
-            print(f"[GROUP SCREEN DATA] Forwarded start to {forwarded_count}/{len(group_members)} participants")
+            print(f"[GROUP SCREEN DATA] Forwarded start to {forwarded_count}/{len(viewers)} viewers")
 
     except Exception as e:
         print(f"[GROUP SCREEN ERROR] Error handling data start: {e}")
@@ -1776,32 +2479,18 @@ def handle_group_screen_data_chunk(message, sender_socket, db_connection):
             frame_id = parts[3]
             chunk_id = int(parts[4])
 
-            # Находим всех участников группы из БД
-            cursor = db_connection.cursor()
-            cursor.execute(
-                "SELECT username FROM group_members WHERE group_id = %s AND username != %s",
-                (group_id, sender)
-            )
-            group_members = [row[0] for row in cursor.fetchall()]
-            cursor.close()
+            # Зрители определены при старте демонстрации
+            viewers = get_group_screen_viewers(group_id, sender, db_connection)
 
-            # Пересылаем всем участникам группы кроме отправителя
+            # Пересылаем всем зрителям; строку кодируем один раз
+            payload = f"{message}\n".encode('utf-8')
             forwarded_count = 0
-            for member_username in group_members:
-                for client_socket, client_data in clients.items():
-                    if (hasattr(client_data, 'username') and
-                        client_data.username == member_username and
-                        hasattr(client_data, 'screen_socket') and
-                        client_data.screen_socket):
-                        try:
-                            client_data.screen_socket.send(f"{message}\n".encode('utf-8'))
-                            forwarded_count += 1
-                            # Логируем только каждый 10-й chunk чтобы не засорять логи
-                            if int(chunk_id) % 10 == 0:
-                                print(f"[GROUP SCREEN DATA] ✓ Forwarded chunk {chunk_id} to {member_username}")
-                        except Exception as e:
-                            print(f"[GROUP SCREEN DATA ERROR] Failed to send chunk to {member_username}: {e}")
-                        break
+            for member_username, member_screen_socket in viewers:
+                try:
+                    send_on_stream(member_screen_socket, payload, STREAM_SCREEN)
+                    forwarded_count += 1
+                except Exception as e:
+                    print(f"[GROUP SCREEN DATA ERROR] Failed to send chunk to {member_username}: {e}")
 
             # Логируем только для первого и последнего chunk
             if chunk_id == "0" or forwarded_count == 0:
@@ -1823,30 +2512,18 @@ def handle_group_screen_data_end(message, sender_socket, db_connection):
 
             print(f"[GROUP SCREEN DATA] End from {sender} for group {group_id}, frame {frame_id}")
 
-            # Находим всех участников группы из БД
-            cursor = db_connection.cursor()
-            cursor.execute(
-                "SELECT username FROM group_members WHERE group_id = %s AND username != %s",
-                (group_id, sender)
-            )
-            group_members = [row[0] for row in cursor.fetchall()]
-            cursor.close()
+            # Зрители определены при старте демонстрации
+            viewers = get_group_screen_viewers(group_id, sender, db_connection)
 
-            # Пересылаем всем участникам группы кроме отправителя
+            # Пересылаем всем зрителям
+            payload = f"{message}\n".encode('utf-8')
             forwarded_count = 0
-            for member_username in group_members:
-                for client_socket, client_data in clients.items():
-                    if (hasattr(client_data, 'username') and
-                        client_data.username == member_username and
-                        hasattr(client_data, 'screen_socket') and
-                        client_data.screen_socket):
-                        try:
-                            client_data.screen_socket.send(f"{message}\n".encode('utf-8'))
-                            forwarded_count += 1
-                            print(f"[GROUP SCREEN DATA] ✓ Forwarded end to {member_username}")
-                        except Exception as e:
-                            print(f"[GROUP SCREEN DATA ERROR] Failed to send end to {member_username}: {e}")
-                        break
+            for member_username, member_screen_socket in viewers:
+                try:
+                    send_on_stream(member_screen_socket, payload, STREAM_SCREEN)
+                    forwarded_count += 1
+                except Exception as e:
+                    print(f"[GROUP SCREEN DATA ERROR] Failed to send end to {member_username}: {e}")
 
             print(f"[GROUP SCREEN DATA] Forwarded end to {forwarded_count} participants")
 
@@ -1870,24 +2547,14 @@ def handle_direct_message(message, sender_socket, db_connection):
 
         # Проверяем, является ли отправитель владельцем сокета
         if sender_socket in clients:
-            client_data = clients[sender_socket]
-            socket_username = client_data.username if isinstance(client_data, ClientConnection) else client_data
+            socket_username = clients[sender_socket].username
 
             if socket_username != sender:
                 print(f"[SECURITY] Username mismatch: {socket_username} != {sender}")
                 return
 
             # Проверяем, являются ли пользователи друзьями
-            cursor = db_connection.cursor()
-            cursor.execute(
-                """
-                SELECT 1 FROM friends 
-                WHERE (user1 = %s AND user2 = %s) OR (user1 = %s AND user2 = %s)
-                """,
-                (sender, receiver, receiver, sender)
-            )
-            are_friends = cursor.fetchone() is not None
-            cursor.close()
+            are_friends = friend_cache.are_friends(sender, receiver, db_connection)
 
             if not are_friends:
                 print(f"[FILTER] Blocked direct message from {sender} to non-friend {receiver}")
@@ -1897,12 +2564,7 @@ def handle_direct_message(message, sender_socket, db_connection):
             save_message(db_connection, sender, receiver, content)
 
             # Находим сокет получателя и отправляем сообщение
-            recipient_socket = None
-            for sock, client_data in clients.items():
-                client_name = client_data.username if isinstance(client_data, ClientConnection) else client_data
-                if client_name == receiver:
-                    recipient_socket = sock
-                    break
+            recipient_socket = registry.socket_for(receiver)
 
             if recipient_socket:
                 # Отправляем сообщение в формате, который будет обработан как личное сообщение
@@ -1933,12 +2595,16 @@ def handle_group_exclusion(message, sender_socket, db_connection):
 
         print(f"[GROUP EXCLUSION] User {excluded_username} excluded from group {group_name}")
 
+        # Состав группы изменился: сбрасываем кэш и прекращаем рассылку исключенному
+        try:
+            group_cache.invalidate(int(group_id))
+            registry.remove_from_group(int(group_id), excluded_username)
+            refresh_group_screen_shares(int(group_id), db_connection)
+        except ValueError:
+            print(f"[ERROR] Invalid group id in exclusion: {group_id}")
+
         # Находим исключенного пользователя среди подключенных клиентов
-        excluded_client_socket = None
-        for client_socket, client_data in clients.items():
-            if isinstance(client_data, ClientConnection) and client_data.username == excluded_username:
-                excluded_client_socket = client_socket
-                break
+        excluded_client_socket = registry.socket_for(excluded_username)
 
         # Если исключенный пользователь онлайн, отправляем ему уведомление
         if excluded_client_socket:
@@ -1974,21 +2640,6 @@ def handle_edit_message(message, sender_socket, db_connection):
             try:
                 cursor = db_connection.cursor()
 
-                # Проверяем наличие колонки edited в таблице messages
-                cursor.execute("""
-                    SELECT EXISTS (
-                        SELECT FROM information_schema.columns 
-                        WHERE table_name = 'messages' AND column_name = 'edited'
-                    )
-                """)
-                has_edited_column = cursor.fetchone()[0]
-
-                if not has_edited_column:
-                    # Добавляем колонку edited
-                    cursor.execute("ALTER TABLE messages ADD COLUMN edited BOOLEAN DEFAULT FALSE")
-                    db_connection.commit()
-                    print("[DATABASE] Added 'edited' column to messages table")
-
                 # Обновляем сообщение в базе данных
                 cursor.execute(
                     """
@@ -2009,15 +2660,13 @@ def handle_edit_message(message, sender_socket, db_connection):
                     notification = f"Система: Пользователь {sender} отредактировал сообщение\n"
 
                     # Находим сокет получателя
-                    for sock, client_data in clients.items():
-                        client_name = client_data.username if isinstance(client_data, ClientConnection) else client_data
-                        if client_name == receiver:
-                            try:
-                                sock.send(notification.encode('utf-8'))
-                                print(f"[NOTIFICATION] Sent edit notification to {receiver}")
-                            except Exception as e:
-                                print(f"[ERROR] Failed to send edit notification to {receiver}: {e}")
-                            break
+                    receiver_socket = registry.socket_for(receiver)
+                    if receiver_socket:
+                        try:
+                            receiver_socket.send(notification.encode('utf-8'))
+                            print(f"[NOTIFICATION] Sent edit notification to {receiver}")
+                        except Exception as e:
+                            print(f"[ERROR] Failed to send edit notification to {receiver}: {e}")
                 else:
                     print(f"[WARNING] No message updated. Message ID {message_id} not found or not owned by {sender}")
 
@@ -2052,21 +2701,6 @@ def handle_delete_message(message, sender_socket, db_connection):
             try:
                 cursor = db_connection.cursor()
 
-                # Проверяем наличие колонки deleted в таблице messages
-                cursor.execute("""
-                    SELECT EXISTS (
-                        SELECT FROM information_schema.columns 
-                        WHERE table_name = 'messages' AND column_name = 'deleted'
-                    )
-                """)
-                has_deleted_column = cursor.fetchone()[0]
-
-                if not has_deleted_column:
-                    # Добавляем колонку deleted
-                    cursor.execute("ALTER TABLE messages ADD COLUMN deleted BOOLEAN DEFAULT FALSE")
-                    db_connection.commit()
-                    print("[DATABASE] Added 'deleted' column to messages table")
-
                 # Обновляем сообщение в базе данных
                 cursor.execute(
                     """
@@ -2087,15 +2721,13 @@ def handle_delete_message(message, sender_socket, db_connection):
                     notification = f"Система: Пользователь {sender} удалил сообщение\n"
 
                     # Находим сокет получателя
-                    for sock, client_data in clients.items():
-                        client_name = client_data.username if isinstance(client_data, ClientConnection) else client_data
-                        if client_name == receiver:
-                            try:
-                                sock.send(notification.encode('utf-8'))
-                                print(f"[NOTIFICATION] Sent delete notification to {receiver}")
-                            except Exception as e:
-                                print(f"[ERROR] Failed to send delete notification to {receiver}: {e}")
-                            break
+                    receiver_socket = registry.socket_for(receiver)
+                    if receiver_socket:
+                        try:
+                            receiver_socket.send(notification.encode('utf-8'))
+                            print(f"[NOTIFICATION] Sent delete notification to {receiver}")
+                        except Exception as e:
+                            print(f"[ERROR] Failed to send delete notification to {receiver}: {e}")
                 else:
                     print(f"[WARNING] No message deleted. Message ID {message_id} not found or not owned by {sender}")
 
@@ -2126,32 +2758,26 @@ def handle_file_transfer(message, sender_socket, db_connection):
         recipient = parts[3]
 
         # Ищем сокет получателя
-        recipient_socket = None
-        for sock, name in clients.items():
-            if name.lower() == recipient.lower():
-                recipient_socket = sock
-                break
+        recipient_socket = registry.socket_for(recipient, case_insensitive=True)
 
         if not recipient_socket:
             print(f"[ОШИБКА] Получатель {recipient} не найден для передачи файла")
             # Уведомляем отправителя, что получатель недоступен
             return
 
-        # Пересылаем сообщение получателю без изменений
+        # Пересылаем сообщение получателю без изменений (в одном потоке с частями файла)
         try:
-            # Добавляем \n в конец сообщения для правильного разделения
-            if not message.endswith('\n'):
-                message += '\n'
-            recipient_socket.send(message.encode('utf-8'))
+            send_on_stream(recipient_socket, file_message_for(recipient_socket, message), STREAM_FILE,
+                           sender_socket)
 
             # Логируем действие
             if action == "START":
-                file_info = parts[4].split(":", 1)
+                file_info = parts[4].split(":")
                 file_name = file_info[0]
                 file_size = file_info[1] if len(file_info) > 1 else "unknown"
                 print(f"[ФАЙЛ] Начата передача файла {file_name} ({file_size} байт) от {sender} к {recipient}")
             elif action == "END":
-                file_name = parts[4]
+                file_name = parts[4].split(":")[0]
                 print(f"[ФАЙЛ] Завершена передача файла {file_name} от {sender} к {recipient}")
 
             # Логируем начало/конец передачи файла в базе данных
@@ -2170,17 +2796,10 @@ def handle_file_transfer(message, sender_socket, db_connection):
                         )
 
                     elif action == "END":
-                        file_name = parts[4]
-
-                        # Определяем тип файла по расширению
-                        file_extension = os.path.splitext(file_name)[1].lower()
-                        is_image = file_extension in ['.jpg', '.jpeg', '.png', '.gif', '.bmp']
+                        file_name = parts[4].split(":")[0]
 
                         # Добавляем сообщение о завершении
-                        if is_image:
-                            content = f"[Вложение: {file_name}]"
-                        else:
-                            content = f"[Файл получен: {file_name}]"
+                        content = file_message_content(file_name)
 
                         cursor.execute(
                             "INSERT INTO messages (sender, receiver, content) VALUES (%s, %s, %s)",
@@ -2205,6 +2824,237 @@ def handle_file_transfer(message, sender_socket, db_connection):
         print(f"[ОШИБКА] Ошибка обработки передачи файла: {e}")
 
 
+def handle_file_chunk(payload, sender_socket, db_connection):
+    """Пересылает часть файла (FRAME_FILE) получателю личной передачи, не разбирая данные"""
+    try:
+        chunk = unpack_file_chunk(payload)
+        if chunk is None or chunk[0] == FILE_GROUP:
+            print("[FILE ERROR] Malformed file chunk")
+            return
+        kind, sender, recipient, transfer_id, offset, data = chunk
+
+        sender_connection = clients.get(sender_socket)
+        if sender_connection is None or sender_connection.username != sender:
+            print(f"[SECURITY] File chunk from unauthenticated connection for {sender}")
+            return
+
+        upload = file_upload_for(sender_socket, transfer_id)
+        if upload is not None:
+            store_file_chunk(upload, offset, data, sender_socket, db_connection)
+            return
+
+        recipient_socket = registry.socket_for(recipient, case_insensitive=True)
+        if not recipient_socket:
+            return
+        relay_file_chunk(payload, chunk, [recipient_socket], sender_socket)
+    except Exception as e:
+        print(f"[FILE ERROR] Error handling file chunk: {e}")
+
+
+def file_message_content(file_name):
+    """Текст сообщения чата о переданном файле"""
+    if os.path.splitext(file_name)[1].lower() in ['.jpg', '.jpeg', '.png', '.gif', '.bmp']:
+        return f"[Вложение: {file_name}]"
+    return f"[Файл получен: {file_name}]"
+
+
+def handle_file_offer(message, client_socket, db_connection):
+    """Предложение файла в хранилище (протокол 6).
+
+    Формат: FILE_OFFER (GROUP_FILE_OFFER):отправитель:адресат:имя:размер:sha256:номер передачи.
+    Ответ FILE_ACCEPT:номер:смещение - сколько байт уже есть на сервере: все -
+    загружать не нужно (файл уже хранится), часть - продолжение после обрыва;
+    или FILE_REJECT:номер:причина. Части идут обычными кадрами FRAME_FILE с
+    этим номером; когда пришли все, хеш сверяется, отправитель получает
+    FILE_STORED:номер, а получатели - файл из хранилища.
+    """
+    parts = message.split(":")
+    if len(parts) != 7:
+        print(f"[FILE ERROR] Invalid file offer: {message[:100]}")
+        return
+    command, sender, target, file_name, size, digest, transfer_id = parts
+    kind = FILE_GROUP if command == "GROUP_FILE_OFFER" else FILE_PERSONAL
+    try:
+        transfer_id = int(transfer_id)
+        size = int(size)
+    except ValueError:
+        return
+
+    try:
+        if kind == FILE_GROUP:
+            group_connection = group_clients.get(client_socket)
+            if group_connection is None or group_connection['username'] != sender:
+                raise BlobError("Sender mismatch")
+            if (int(target) not in group_connection['joined_groups']
+                    or not group_cache.is_member(int(target), sender, db_connection)):
+                raise BlobError("Not a member of the group")
+        else:
+            sender_connection = clients.get(client_socket)
+            if sender_connection is None or sender_connection.username != sender:
+                raise BlobError("Sender mismatch")
+        store = get_blob_store()
+        if size < 0 or not store.valid_digest(digest):
+            raise BlobError("Invalid offer")
+        offset = store.begin(digest, size, client_socket)
+    except Exception as e:
+        print(f"[FILE ERROR] Rejected offer of {file_name} from {sender}: {e}")
+        client_socket.send(f"FILE_REJECT:{transfer_id}:{e}\n".encode('utf-8'))
+        return
+
+    upload = {
+        "kind": kind, "sender": sender, "target": target, "name": file_name,
+        "size": size, "digest": digest, "transfer_id": transfer_id,
+    }
+    print(f"[FILE] Offer of {file_name} ({size} bytes) from {sender} to {target}: "
+          f"{'already stored' if offset >= size else f'upload from {offset}'}")
+    client_socket.send(f"FILE_ACCEPT:{transfer_id}:{offset}\n".encode('utf-8'))
+    if offset >= size:
+        finish_file_upload(upload, client_socket, db_connection)
+        return
+    with file_uploads_lock:
+        file_uploads[(client_socket, transfer_id)] = upload
+
+
+def file_upload_for(client_socket, transfer_id):
+    with file_uploads_lock:
+        return file_uploads.get((client_socket, transfer_id))
+
+
+def store_file_chunk(upload, offset, data, client_socket, db_connection):
+    """Часть загружаемого файла - в хранилище; после последней части файл раздается получателям"""
+    try:
+        written = get_blob_store().write(upload["digest"], offset, data, client_socket)
+    except (BlobError, OSError) as e:
+        print(f"[FILE ERROR] Upload of {upload['name']} from {upload['sender']} failed: {e}")
+        release_file_upload(client_socket, upload["transfer_id"])
+        client_socket.send(f"FILE_REJECT:{upload['transfer_id']}:{e}\n".encode('utf-8'))
+        return
+    if written >= upload["size"]:
+        release_file_upload(client_socket, upload["transfer_id"], close=False)
+        finish_file_upload(upload, client_socket, db_connection)
+
+
+def release_file_upload(client_socket, transfer_id, close=True):
+    with file_uploads_lock:
+        upload = file_uploads.pop((client_socket, transfer_id), None)
+    if upload is not None and close:
+        get_blob_store().release(client_socket, upload["digest"])
+
+
+def release_file_uploads(client_socket):
+    """Соединение закрыто: недокачанные файлы остаются в хранилище до продолжения"""
+    with file_uploads_lock:
+        keys = [key for key in file_uploads if key[0] is client_socket]
+        for key in keys:
+            del file_uploads[key]
+    if keys:
+        get_blob_store().release(client_socket)
+
+
+def finish_file_upload(upload, client_socket, db_connection):
+    """Файл целиком в хранилище: сверка хеша, сообщение в чат и раздача получателям"""
+    store = get_blob_store()
+    digest = upload["digest"]
+    try:
+        if not store.has(digest):
+            store.complete(digest, client_socket)
+    except (BlobError, OSError) as e:
+        print(f"[FILE ERROR] Upload of {upload['name']} from {upload['sender']} failed: {e}")
+        client_socket.send(f"FILE_REJECT:{upload['transfer_id']}:{e}\n".encode('utf-8'))
+        return
+    client_socket.send(f"FILE_STORED:{upload['transfer_id']}\n".encode('utf-8'))
+    print(f"[FILE] Stored {upload['name']} from {upload['sender']} as {digest[:12]}")
+
+    sender, target = upload["sender"], upload["target"]
+    try:
+        if upload["kind"] == FILE_GROUP:
+            record_group_file_message(int(target), sender, upload["name"], db_connection)
+            recipients = [s for s in registry.group_sockets_for(int(target)) if s != client_socket]
+        else:
+            cursor = db_connection.cursor()
+            try:
+                cursor.execute("INSERT INTO messages (sender, receiver, content) VALUES (%s, %s, %s)",
+                               (sender, target, file_message_content(upload["name"])))
+                db_connection.commit()
+            finally:
+                cursor.close()
+            recipient_socket = registry.socket_for(target, case_insensitive=True)
+            recipients = [recipient_socket] if recipient_socket else []
+    except Exception as e:
+        print(f"[FILE ERROR] Failed to record file message: {e}")
+        db_connection.rollback()
+        return
+
+    # Раздача в своем потоке: очереди получателей могут притормаживать ее, не задерживая отправителя
+    if recipients:
+        threading.Thread(target=send_stored_file, args=(upload, recipients), daemon=True).start()
+
+
+def send_stored_file(upload, recipient_sockets):
+    """Отправляет файл из хранилища: START с хешем, части (по одному чтению на всех получателей), END"""
+    prefix = "GROUP_FILE_TRANSFER" if upload["kind"] == FILE_GROUP else "FILE_TRANSFER"
+    kind, sender, target, transfer_id = upload["kind"], upload["sender"], upload["target"], upload["transfer_id"]
+    header = f"{prefix}:START:{sender}:{target}:{upload['name']}:{upload['size']}:{transfer_id}:{upload['digest']}"
+    footer = f"{prefix}:END:{sender}:{target}:{upload['name']}:{transfer_id}"
+    try:
+        for recipient_socket in recipient_sockets:
+            send_on_stream(recipient_socket, file_message_for(recipient_socket, header), STREAM_FILE)
+        with open(get_blob_store().path(upload["digest"]), "rb") as f:
+            offset = 0
+            while True:
+                data = f.read(BLOB_CHUNK_SIZE)
+                if not data:
+                    break
+                payload = pack_file_chunk(kind, sender, target, transfer_id, offset, data)
+                relay_file_chunk(payload, (kind, sender, target, transfer_id, offset, data), recipient_sockets)
+                offset += len(data)
+        for recipient_socket in recipient_sockets:
+            send_on_stream(recipient_socket, file_message_for(recipient_socket, footer), STREAM_FILE)
+    except Exception as e:
+        print(f"[FILE ERROR] Failed to send stored file {upload['name']}: {e}")
+
+
+def relay_file_chunk(payload, chunk, recipient_sockets, sender_socket=None):
+    """Отправляет часть файла получателям: новым - тот же кадр, старым - строки CHUNK с base64.
+
+    Части ставятся в поток STREAM_FILE без ожидания. Если очередь
+    получателя заполнена, соединение отправителя не читает следующие
+    части, пока она не освободится, - обработчик и поток пула не ждут.
+    Без sender_socket (раздача из хранилища в своем потоке) ждет сам вызов.
+    """
+    legacy_lines = None
+    for recipient_socket in recipient_sockets:
+        try:
+            if supports_file_frames(recipient_socket):
+                send_binary(recipient_socket, FRAME_FILE, payload)
+                throttle_sender(sender_socket, recipient_socket, STREAM_FILE)
+                continue
+            if legacy_lines is None:
+                legacy_lines = file_chunk_text_lines(*chunk[:3], chunk[5])
+            send_on_stream(recipient_socket, legacy_lines, STREAM_FILE, sender_socket)
+        except Exception as e:
+            print(f"[FILE ERROR] Failed to forward file chunk: {e}")
+
+
+def file_chunk_text_lines(kind, sender, target, data):
+    """Часть файла строками FILE_TRANSFER:CHUNK / GROUP_FILE_TRANSFER:CHUNK старого протокола (одним блоком)"""
+    prefix = "GROUP_FILE_TRANSFER" if kind == FILE_GROUP else "FILE_TRANSFER"
+    encoded = base64.b64encode(data).decode('ascii')
+    return "".join(f"{prefix}:CHUNK:{sender}:{target}:{encoded[i:i + FILE_TEXT_CHUNK_SIZE]}\n"
+                   for i in range(0, len(encoded), FILE_TEXT_CHUNK_SIZE)).encode('utf-8')
+
+
+def file_message_for(recipient_socket, message):
+    """START/END передачи файла для получателя: старый протокол не знает номера передачи в конце строки"""
+    if not supports_file_frames(recipient_socket):
+        parts = message.split(":")
+        if parts[1] == "START" and len(parts) > 6:
+            message = ":".join(parts[:6])
+        elif parts[1] == "END" and len(parts) > 5:
+            message = ":".join(parts[:5])
+    return f"{message.rstrip()}\n".encode('utf-8')
+
+
 def handle_call_signal(message, sender_socket, db_connection):
     """Обработка сигналов звонка"""
     try:
@@ -2224,29 +3074,13 @@ def handle_call_signal(message, sender_socket, db_connection):
         print(f"[CALL SIGNAL] {signal_type} from {sender} to {recipient}")
 
         # Обновляем информацию о звонке в соединениях
-        sender_connection = None
-        recipient_connection = None
-
-        for sock, client_data in clients.items():
-            if isinstance(client_data, ClientConnection):
-                if client_data.username == sender:
-                    sender_connection = client_data
-                elif client_data.username == recipient:
-                    recipient_connection = client_data
+        sender_connection = registry.get(sender)
+        recipient_connection = registry.get(recipient) if recipient != sender else None
 
         # Проверяем, являются ли пользователи друзьями для входящих звонков
         if signal_type == "incoming_call":
             try:
-                cursor = db_connection.cursor()
-                cursor.execute(
-                    """
-                    SELECT 1 FROM friends 
-                    WHERE (user1 = %s AND user2 = %s) OR (user1 = %s AND user2 = %s)
-                    """,
-                    (sender, recipient, recipient, sender)
-                )
-                are_friends = cursor.fetchone() is not None
-                cursor.close()
+                are_friends = friend_cache.are_friends(sender, recipient, db_connection)
 
                 if not are_friends:
                     print(f"[FILTER] Blocked call from {sender} to non-friend {recipient}")
@@ -2261,13 +3095,11 @@ def handle_call_signal(message, sender_socket, db_connection):
         recipient_socket = None
         recipient_found = False
 
-        for sock, client_data in clients.items():
-            client_name = client_data.username if isinstance(client_data, ClientConnection) else client_data
-            if client_name.lower() == recipient.lower():
-                recipient_socket = sock
-                recipient = client_name
-                recipient_found = True
-                break
+        found_connection = registry.get(recipient, case_insensitive=True)
+        if found_connection:
+            recipient_socket = found_connection.main_socket
+            recipient = found_connection.username
+            recipient_found = True
 
         if not recipient_found and signal_type == "incoming_call":
             print(f"[ERROR] Recipient {recipient} not found or not connected")
@@ -2278,31 +3110,6 @@ def handle_call_signal(message, sender_socket, db_connection):
                 user_exists = cursor.fetchone() is not None
 
                 if user_exists:
-                    # Создаем таблицу call_logs если не существует
-                    cursor.execute("""
-                        SELECT EXISTS (
-                            SELECT FROM information_schema.tables 
-                            WHERE table_name = 'call_logs'
-                        )
-                    """)
-                    call_logs_exists = cursor.fetchone()[0]
-
-                    if not call_logs_exists:
-                        cursor.execute("""
-                            CREATE TABLE call_logs (
-                                id SERIAL PRIMARY KEY,
-                                caller VARCHAR(50) REFERENCES users(username),
-                                recipient VARCHAR(50) REFERENCES users(username),
-                                start_time TIMESTAMP,
-                                end_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                                duration INTEGER NOT NULL,
-                                status VARCHAR(20) DEFAULT 'ended',
-                                timestamp BIGINT,
-                                notification_seen BOOLEAN DEFAULT FALSE
-                            )
-                        """)
-                        db_connection.commit()
-
                     # Регистрируем пропущенный звонок
                     cursor.execute(
                         """
@@ -2338,7 +3145,9 @@ def handle_call_signal(message, sender_socket, db_connection):
                 "caller": sender,
                 "recipient": recipient,
                 "start_time": timestamp,
-                "status": "ringing"
+                "status": "ringing",
+                # Звонящий согласует кодек - значит, поддерживает и UDP-сессии
+                "negotiates_media": len(parts) > 5
             }
 
             # Устанавливаем информацию о звонке в соединениях
@@ -2357,18 +3166,15 @@ def handle_call_signal(message, sender_socket, db_connection):
                     print(f"[ERROR] Failed to send call signal: {e}")
 
         elif signal_type == "call_accepted":
+            accepted_call = None
             for call_id, call_info in calls.items():
                 if call_info["caller"] == recipient and call_info["recipient"] == sender:
                     call_info["status"] = "active"
                     call_info["accept_time"] = timestamp
+                    accepted_call = call_info
                     break
 
-            caller_socket = None
-            for sock, client_data in clients.items():
-                client_name = client_data.username if isinstance(client_data, ClientConnection) else client_data
-                if client_name.lower() == recipient.lower():
-                    caller_socket = sock
-                    break
+            caller_socket = registry.socket_for(recipient, case_insensitive=True)
 
             if caller_socket:
                 try:
@@ -2377,7 +3183,13 @@ def handle_call_signal(message, sender_socket, db_connection):
                 except Exception as e:
                     print(f"[ERROR] Failed to send call accepted signal: {e}")
 
+            # UDP-сессии - только если оба клиента согласуют кодек (поддерживают media_session)
+            if media_relay is not None and accepted_call and accepted_call.get("negotiates_media") and len(parts) > 5:
+                issue_call_media_sessions(recipient, sender)
+
         elif signal_type == "call_rejected":
+            if media_relay is not None:
+                media_relay.revoke(personal_call_key(sender, recipient))
             for call_id, call_info in calls.items():
                 if call_info["caller"] == recipient and call_info["recipient"] == sender:
                     call_info["status"] = "rejected"
@@ -2391,12 +3203,7 @@ def handle_call_signal(message, sender_socket, db_connection):
                 recipient_connection.is_in_call = False
                 recipient_connection.call_partner = None
 
-            caller_socket = None
-            for sock, client_data in clients.items():
-                client_name = client_data.username if isinstance(client_data, ClientConnection) else client_data
-                if client_name.lower() == recipient.lower():
-                    caller_socket = sock
-                    break
+            caller_socket = registry.socket_for(recipient, case_insensitive=True)
 
             if caller_socket:
                 try:
@@ -2408,6 +3215,8 @@ def handle_call_signal(message, sender_socket, db_connection):
         elif signal_type == "call_ended":
             active_call = None
             active_call_id = None
+            if media_relay is not None:
+                media_relay.revoke(personal_call_key(sender, recipient))
 
             for call_id, call_info in calls.items():
                 if (call_info["caller"].lower() == sender.lower() and call_info[
@@ -2435,14 +3244,8 @@ def handle_call_signal(message, sender_socket, db_connection):
                 active_call["end_time"] = timestamp
                 active_call["duration"] = duration
 
-                caller_socket = None
-                recipient_socket = None
-                for sock, client_data in clients.items():
-                    client_name = client_data.username if isinstance(client_data, ClientConnection) else client_data
-                    if client_name.lower() == active_call["caller"].lower():
-                        caller_socket = sock
-                    elif client_name.lower() == active_call["recipient"].lower():
-                        recipient_socket = sock
+                caller_socket = registry.socket_for(active_call["caller"], case_insensitive=True)
+                recipient_socket = registry.socket_for(active_call["recipient"], case_insensitive=True)
 
                 signal_message = f"CALL_SIGNAL:call_ended:{sender}:{recipient}:{timestamp}:{duration}\n"
 
@@ -2469,31 +3272,6 @@ def handle_call_signal(message, sender_socket, db_connection):
                         ("Система", active_call['recipient'], recipient_call_end_message, True)
                     )
 
-                    # Проверяем существование таблицы call_logs
-                    cursor.execute("""
-                        SELECT EXISTS (
-                            SELECT FROM information_schema.tables 
-                            WHERE table_name = 'call_logs'
-                        )
-                    """)
-                    call_logs_exists = cursor.fetchone()[0]
-
-                    if not call_logs_exists:
-                        cursor.execute("""
-                            CREATE TABLE call_logs (
-                                id SERIAL PRIMARY KEY,
-                                caller VARCHAR(50) REFERENCES users(username),
-                                recipient VARCHAR(50) REFERENCES users(username),
-                                start_time TIMESTAMP,
-                                end_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                                duration INTEGER NOT NULL,
-                                status VARCHAR(20) DEFAULT 'ended',
-                                timestamp BIGINT,
-                                notification_seen BOOLEAN DEFAULT FALSE
-                            )
-                        """)
-                        db_connection.commit()
-
                     cursor.execute(
                         """
                         INSERT INTO call_logs (caller, recipient, start_time, end_time, duration, status, timestamp, notification_seen) 
@@ -2552,15 +3330,11 @@ def forward_audio_data(data, sender_socket):
         if not recipient:
             return
 
-        recipient_socket = None
-        for sock, client_data in clients.items():
-            if isinstance(client_data, ClientConnection) and client_data.username.lower() == recipient.lower():
-                recipient_socket = sock
-                break
+        recipient_socket = registry.socket_for(recipient, case_insensitive=True)
 
         if recipient_socket and recipient_socket != sender_socket:
             try:
-                recipient_socket.sendall(data)
+                send_call_audio(personal_call_key(sender, recipient), recipient, recipient_socket, data)
             except Exception as e:
                 print(f"[ERROR] Failed to forward audio data: {e}")
     except Exception as e:
@@ -2580,22 +3354,22 @@ def end_user_calls(username, db_connection=None):
                     duration = int(end_time - call_info["accept_time"])
 
                 signal = f"CALL_SIGNAL:call_ended:{username}:{other_user}:{end_time}:{duration}\n"
+                if media_relay is not None:
+                    media_relay.revoke(personal_call_key(username, other_user))
                 minutes = duration // 60
                 seconds = duration % 60
                 duration_str = f"{minutes:02d}:{seconds:02d}"
                 current_time = datetime.datetime.now().strftime("%H:%M")
                 system_message = f"Система: Звонок с {username} завершен в {current_time}. Длительность: {duration_str}\n"
 
-                for sock, client_data in clients.items():
-                    client_name = client_data.username if isinstance(client_data, ClientConnection) else client_data
-                    if client_name.lower() == other_user.lower():
-                        try:
-                            sock.send(signal.encode('utf-8'))
-                            sock.send(system_message.encode('utf-8'))
-                            print(f"[CALL] Sent call ended signal and system message to {other_user}")
-                        except Exception as e:
-                            print(f"[ERROR] Failed to send call ended signal: {e}")
-                        break
+                other_socket = registry.socket_for(other_user, case_insensitive=True)
+                if other_socket:
+                    try:
+                        other_socket.send(signal.encode('utf-8'))
+                        other_socket.send(system_message.encode('utf-8'))
+                        print(f"[CALL] Sent call ended signal and system message to {other_user}")
+                    except Exception as e:
+                        print(f"[ERROR] Failed to send call ended signal: {e}")
 
                 if db_connection:
                     try:
@@ -2607,25 +3381,16 @@ def end_user_calls(username, db_connection=None):
                             ("Система", other_user, system_message_content)
                         )
 
-                        cursor.execute("""
-                            SELECT EXISTS (
-                                SELECT FROM information_schema.tables 
-                                WHERE table_name = 'call_logs'
-                            )
-                        """)
-                        call_logs_exists = cursor.fetchone()[0]
-
-                        if call_logs_exists:
-                            cursor.execute(
-                                """
-                                INSERT INTO call_logs (caller, recipient, start_time, end_time, duration, status, timestamp) 
-                                VALUES (%s, %s, to_timestamp(%s), CURRENT_TIMESTAMP, %s, 'ended', %s)
-                                """,
-                                (username if call_info["caller"].lower() == username.lower() else other_user,
-                                 other_user if call_info["caller"].lower() == username.lower() else username,
-                                 call_info.get('accept_time', call_info['start_time']),
-                                 duration, int(end_time))
-                            )
+                        cursor.execute(
+                            """
+                            INSERT INTO call_logs (caller, recipient, start_time, end_time, duration, status, timestamp) 
+                            VALUES (%s, %s, to_timestamp(%s), CURRENT_TIMESTAMP, %s, 'ended', %s)
+                            """,
+                            (username if call_info["caller"].lower() == username.lower() else other_user,
+                             other_user if call_info["caller"].lower() == username.lower() else username,
+                             call_info.get('accept_time', call_info['start_time']),
+                             duration, int(end_time))
+                        )
 
                         db_connection.commit()
                         print(f"[DATABASE] Saved call end message for {other_user}")
@@ -2658,13 +3423,11 @@ def broadcast_message(message, sender_socket, db_connection):
 
             # Системные сообщения отправляем всем
             if sender_name == "Система":
-                for client_socket, client_data in clients.items():
+                for client_socket, client_data in list(clients.items()):
                     if client_socket != sender_socket:
                         try:
                             client_socket.send(f"{message}\n".encode('utf-8'))
-                            client_name = client_data.username if isinstance(client_data,
-                                                                             ClientConnection) else client_data
-                            print(f"[MESSAGE] Sent system message to {client_name}")
+                            print(f"[MESSAGE] Sent system message to {client_data.username}")
                         except Exception as e:
                             print(f"[ERROR] Failed to send message: {e}")
                             client_socket.close()
@@ -2672,73 +3435,32 @@ def broadcast_message(message, sender_socket, db_connection):
 
             # Для обычных сообщений отправляем только конкретному получателю
             if sender_socket in clients:
-                sender_data = clients[sender_socket]
-                sender_username = sender_data.username if isinstance(sender_data, ClientConnection) else sender_data
+                sender_username = clients[sender_socket].username
 
-                # Ищем получателя в истории сообщений
-                receiver = None
-                try:
-                    cursor = db_connection.cursor()
-                    cursor.execute(
-                        """
-                        SELECT receiver FROM messages 
-                        WHERE sender = %s 
-                        ORDER BY timestamp DESC 
-                        LIMIT 1
-                        """,
-                        (sender_username,)
-                    )
-                    last_receiver = cursor.fetchone()
-                    if last_receiver:
-                        receiver = last_receiver[0]
-                    else:
-                        cursor.execute(
-                            """
-                            SELECT sender FROM messages 
-                            WHERE receiver = %s 
-                            ORDER BY timestamp DESC 
-                            LIMIT 1
-                            """,
-                            (sender_username,)
-                        )
-                        last_sender = cursor.fetchone()
-                        if last_sender:
-                            receiver = last_sender[0]
-                    cursor.close()
-                except Exception as e:
-                    print(f"[ERROR] Failed to find receiver from history: {e}")
+                # Получатель - собеседник открытого чата
+                receiver = clients[sender_socket].chat_peer
 
                 if receiver:
                     # Находим сокет получателя
-                    for client_socket, client_data in clients.items():
-                        client_name = client_data.username if isinstance(client_data, ClientConnection) else client_data
-                        if client_name == receiver:
-                            try:
-                                # Проверяем, являются ли пользователи друзьями
-                                cursor = db_connection.cursor()
-                                cursor.execute(
-                                    """
-                                    SELECT 1 FROM friends 
-                                    WHERE (user1 = %s AND user2 = %s) OR (user1 = %s AND user2 = %s)
-                                    """,
-                                    (sender_username, client_name, client_name, sender_username)
-                                )
-                                are_friends = cursor.fetchone() is not None
-                                cursor.close()
-
-                                if are_friends:
-                                    client_socket.send(f"{message}\n".encode('utf-8'))
-                                    print(f"[MESSAGE] Sent message from {sender_username} to friend {client_name}")
-                                else:
-                                    print(
-                                        f"[FILTER] Blocked message from {sender_username} to non-friend {client_name}")
-                            except Exception as e:
-                                print(f"[ERROR] Failed to send message to {client_name}: {e}")
-                                client_socket.close()
-                            break
+                    client_socket = registry.socket_for(receiver)
+                    if client_socket:
+                        client_name = receiver
+                        try:
+                            # Проверяем, являются ли пользователи друзьями
+                            are_friends = friend_cache.are_friends(sender_username, client_name, db_connection)
+
+                            if are_friends:
+                                client_socket.send(f"{message}\n".encode('utf-8'))
+                                print(f"[MESSAGE] Sent message from {sender_username} to friend {client_name}")
+                            else:
+                                print(
+                                    f"[FILTER] Blocked message from {sender_username} to non-friend {client_name}")
+                        except Exception as e:
+                            print(f"[ERROR] Failed to send message to {client_name}: {e}")
+                            client_socket.close()
         else:
             # Для сообщений без формата "имя: содержание"
-            for client in clients:
+            for client in list(clients):
                 if client != sender_socket:
                     try:
                         client.send(f"{message}\n".encode('utf-8'))
@@ -2750,41 +3472,24 @@ def broadcast_message(message, sender_socket, db_connection):
 
 def save_message(connection, sender, receiver, content):
     try:
-        cursor = connection.cursor()
-        cursor.execute("SELECT 1 FROM users WHERE username = %s", (receiver,))
-        user_exists = cursor.fetchone() is not None
+        # Получатель в сети или в друзьях у отправителя точно существует - без запроса к БД
+        user_exists = (registry.is_online(receiver)
+                       or friend_cache.are_friends(sender, receiver, connection)
+                       or statements.fetchone(connection, "user_exists", receiver) is not None)
 
         if user_exists:
-            # Проверяем наличие колонки read в таблице messages
-            cursor.execute("""
-                SELECT EXISTS (
-                    SELECT FROM information_schema.columns 
-                    WHERE table_name = 'messages' AND column_name = 'read'
-                )
-            """)
-            has_read_column = cursor.fetchone()[0]
-
-            if not has_read_column:
-                cursor.execute("""
-                    ALTER TABLE messages 
-                    ADD COLUMN read BOOLEAN DEFAULT TRUE
-                """)
-                connection.commit()
-
             # Проверяем, находится ли получатель в сети
-            is_online = False
-            for sock, client_data in clients.items():
-                client_name = client_data.username if isinstance(client_data, ClientConnection) else client_data
-                if client_name.lower() == receiver.lower():
-                    is_online = True
-                    break
+            is_online = registry.is_online(receiver)
 
             is_read = is_online and sender != "Система"
 
-            cursor.execute(
-                "INSERT INTO messages (sender, receiver, content, read) VALUES (%s, %s, %s, %s)",
-                (sender, receiver, content, is_read)
-            )
+            if message_writer is not None:
+                # Отложенная запись: получатель уже проверен, одна плохая строка не сорвет вставку пакета
+                message_writer.submit("messages", sender, receiver, content, is_read)
+                print(f"[DATABASE] Message queued: {sender} -> {receiver}: {content} (read: {is_read})")
+                return
+
+            statements.execute(connection, "insert_message", sender, receiver, content, is_read)
             connection.commit()
             print(f"[DATABASE] Message saved: {sender} -> {receiver}: {content} (read: {is_read})")
         else:
@@ -2792,186 +3497,171 @@ def save_message(connection, sender, receiver, content):
     except Exception as e:
         print(f"Error saving message: {e}")
         connection.rollback()
-    finally:
-        cursor.close()
 
 
-def start_server():
-    global db_connection
-    try:
-        db_connection = pg8000.connect(**DB_CONFIG)
-        print("[DATABASE] Connected to PostgreSQL database")
+def upgrade_database_schema():
+    """Приводит схему БД к последней миграции (alembic upgrade head).
 
-        cursor = db_connection.cursor()
-
-        # Создаем необходимые таблицы
-        cursor.execute("""
-            SELECT EXISTS (
-                SELECT FROM information_schema.tables 
-                WHERE table_name = 'users'
-            )
-        """)
-        users_table_exists = cursor.fetchone()[0]
-
-        if not users_table_exists:
-            print("[DATABASE] Creating users table")
-            cursor.execute("""
-                CREATE TABLE users (
-                    username VARCHAR(50) PRIMARY KEY,
-                    password VARCHAR(100) NOT NULL,
-                    email VARCHAR(100)
-                )
-            """)
-            db_connection.commit()
+    Таблицы, колонки и индексы описаны миграциями в alembic/versions,
+    поэтому обработчики рассчитывают на готовую схему и каталог БД не
+    проверяют. Без alembic схема считается уже обновленной вручную.
+    """
+    try:
+        from alembic import command
+        from alembic.config import Config
+    except ImportError:
+        print("[DATABASE] alembic is not installed, assuming the schema is up to date (alembic upgrade head)")
+        return
 
-        cursor.execute("""
-            SELECT EXISTS (
-                SELECT FROM information_schema.tables 
-                WHERE table_name = 'messages'
-            )
-        """)
-        messages_table_exists = cursor.fetchone()[0]
-
-        if not messages_table_exists:
-            print("[DATABASE] Creating messages table")
-            cursor.execute("""
-                CREATE TABLE messages (
-                    id SERIAL PRIMARY KEY,
-                    sender VARCHAR(50) REFERENCES users(username),
-                    receiver VARCHAR(50) REFERENCES users(username),
-                    content TEXT NOT NULL,
-                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            db_connection.commit()
+    config = Config(ALEMBIC_CONFIG)
+    config.attributes["db_config"] = DB_CONFIG
+    command.upgrade(config, "head")
+    print("[DATABASE] Schema is up to date")
 
-        cursor.execute("""
-            SELECT EXISTS (
-                SELECT FROM information_schema.tables 
-                WHERE table_name = 'friends'
-            )
-        """)
-        friends_table_exists = cursor.fetchone()[0]
-
-        if not friends_table_exists:
-            print("[DATABASE] Creating friends table")
-            cursor.execute("""
-                CREATE TABLE friends (
-                    id SERIAL PRIMARY KEY,
-                    user1 VARCHAR(50) REFERENCES users(username),
-                    user2 VARCHAR(50) REFERENCES users(username),
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    UNIQUE(user1, user2)
-                )
-            """)
-            db_connection.commit()
-
-        # Таблица групп
-        cursor.execute("""
-            SELECT EXISTS (
-                SELECT FROM information_schema.tables 
-                WHERE table_name = 'groups'
-            )
-        """)
-        groups_table_exists = cursor.fetchone()[0]
-
-        if not groups_table_exists:
-            print("[DATABASE] Creating groups table")
-            cursor.execute("""
-                CREATE TABLE groups (
-                    id SERIAL PRIMARY KEY,
-                    name VARCHAR(100) NOT NULL,
-                    invite_link VARCHAR(50) UNIQUE NOT NULL,
-                    avatar_path VARCHAR(255),
-                    creator_username VARCHAR(50) REFERENCES users(username),
-                    description TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            db_connection.commit()
-
-        # Таблица участников групп
-        cursor.execute("""
-            SELECT EXISTS (
-                SELECT FROM information_schema.tables 
-                WHERE table_name = 'group_members'
-            )
-        """)
-        group_members_table_exists = cursor.fetchone()[0]
-
-        if not group_members_table_exists:
-            print("[DATABASE] Creating group_members table")
-            cursor.execute("""
-                CREATE TABLE group_members (
-                    id SERIAL PRIMARY KEY,
-                    group_id INTEGER REFERENCES groups(id) ON DELETE CASCADE,
-                    username VARCHAR(50) REFERENCES users(username),
-                    role VARCHAR(20) DEFAULT 'member',
-                    joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    UNIQUE(group_id, username)
-                )
-            """)
-            db_connection.commit()
-
-        # Таблица сообщений групп
-        cursor.execute("""
-            SELECT EXISTS (
-                SELECT FROM information_schema.tables 
-                WHERE table_name = 'group_messages'
-            )
-        """)
-        group_messages_table_exists = cursor.fetchone()[0]
-
-        if not group_messages_table_exists:
-            print("[DATABASE] Creating group_messages table")
-            cursor.execute("""
-                CREATE TABLE group_messages (
-                    id SERIAL PRIMARY KEY,
-                    group_id INTEGER REFERENCES groups(id) ON DELETE CASCADE,
-                    sender VARCHAR(50) REFERENCES users(username),
-                    content TEXT NOT NULL,
-                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    edited BOOLEAN DEFAULT FALSE,
-                    deleted BOOLEAN DEFAULT FALSE
-                )
-            """)
-            db_connection.commit()
 
-        cursor.close()
+def start_server(mode=SERVER_MODE, mix_group_calls=GROUP_CALL_MIXING, udp_media=UDP_MEDIA):
+    try:
+        db_pool = ConnectionPool(DB_CONFIG, **DB_POOL_CONFIG)
+        print(f"[DATABASE] Connected to PostgreSQL database "
+              f"(pool {DB_POOL_CONFIG['min_size']}-{DB_POOL_CONFIG['max_size']})")
+        upgrade_database_schema()
     except Exception as e:
         print(f"[DATABASE ERROR] {e}")
         return
 
+    stats_thread = threading.Thread(target=report_server_stats, args=(db_pool,))
+    stats_thread.daemon = True
+    stats_thread.start()
+
+    if WRITE_BEHIND:
+        start_message_writer(db_pool)
+    if mix_group_calls:
+        start_group_call_mixer()
+    if udp_media:
+        start_media_relay()
+
+    try:
+        if mode == "threaded":
+            run_threaded_server(db_pool)
+        else:
+            asyncio.run(run_asyncio_server(db_pool))
+    except KeyboardInterrupt:
+        print("[SERVER] Servers are shutting down...")
+    finally:
+        if message_writer is not None:
+            message_writer.close()
+        db_pool.close()
+
+
+def report_server_stats(db_pool, interval=STATS_INTERVAL):
+    """Периодически выводит статистику сервера (пул соединений и т.д.)"""
+    while True:
+        time.sleep(interval)
+        try:
+            pool_stats = db_pool.stats()
+            print(f"[DB POOL] size={pool_stats['size']}/{pool_stats['max_size']} "
+                  f"in_use={pool_stats['in_use']} idle={pool_stats['idle']} "
+                  f"checkouts={pool_stats['checkouts']} waits={pool_stats['waits']} "
+                  f"avg_wait={pool_stats['wait_time_avg'] * 1000:.1f}ms "
+                  f"max_wait={pool_stats['wait_time_max'] * 1000:.1f}ms "
+                  f"timeouts={pool_stats['timeouts']} discarded={pool_stats['discarded']}")
+            statement_stats = statements.stats()
+            print(f"[DB STATEMENTS] prepared={statement_stats['prepares']} "
+                  f"executions={statement_stats['executions']} plain={statement_stats['fallbacks']} "
+                  f"connections={statement_stats['connections']} invalidations={statement_stats['invalidations']}")
+            if message_writer is not None:
+                writer_stats = message_writer.stats()
+                print(f"[WRITE BEHIND] queue={writer_stats['queue_depth']} rows={writer_stats['rows']} "
+                      f"batches={writer_stats['batches']} avg_batch={writer_stats['avg_batch']:.1f} "
+                      f"max_batch={writer_stats['max_batch']} "
+                      f"avg_latency={writer_stats['flush_latency_avg'] * 1000:.1f}ms "
+                      f"max_latency={writer_stats['flush_latency_max'] * 1000:.1f}ms "
+                      f"dropped={writer_stats['dropped']} retries={writer_stats['retries']}")
+            cache_stats = friend_cache.stats()
+            print(f"[FRIEND CACHE] users={cache_stats['users']}/{cache_stats['max_users']} "
+                  f"hits={cache_stats['hits']} misses={cache_stats['misses']} "
+                  f"evictions={cache_stats['evictions']} invalidations={cache_stats['invalidations']}")
+            group_stats = group_cache.stats()
+            print(f"[GROUP CACHE] groups={group_stats['groups']}/{group_stats['max_groups']} "
+                  f"hits={group_stats['hits']} misses={group_stats['misses']} "
+                  f"evictions={group_stats['evictions']} invalidations={group_stats['invalidations']}")
+            report_outbound_stats()
+            if group_call_mixer is not None:
+                mixer_stats = group_call_mixer.stats()
+                print(f"[GROUP CALL MIXER] calls={mixer_stats['calls']} speakers={mixer_stats['speakers']} "
+                      f"ticks={mixer_stats['ticks']} mixed={mixer_stats['mixed_blocks']} "
+                      f"dropped={mixer_stats['dropped_blocks']} underruns={mixer_stats['underruns']} "
+                      f"late={mixer_stats['late_ticks']} pauses={mixer_stats['pauses']}")
+            if group_calls:
+                participants = sum(len(call['participants']) for call in list(group_calls.values()))
+                paused = sum(len(call.get('paused', ())) for call in list(group_calls.values()))
+                print(f"[GROUP CALL] calls={len(group_calls)} participants={participants} "
+                      f"speaking={participants - paused} paused={paused}")
+            if media_relay is not None:
+                media_stats = media_relay.stats()
+                print(f"[MEDIA] sessions={media_stats['sessions']} active={media_stats['active']} "
+                      f"received={media_stats['received']} sent={media_stats['sent']} "
+                      f"unknown={media_stats['unknown']}")
+        except Exception as e:
+            print(f"[STATS ERROR] {e}")
+
+
+def report_outbound_stats(top=5):
+    """Выводит суммарную статистику очередей исходящих данных и самые загруженные соединения"""
+    queue_stats = [queue.stats() for queue in live_queues()]
+    if not queue_stats:
+        return
+
+    depth = {stream: sum(stats['depth'][stream] for stats in queue_stats) for stream in DEFAULT_POLICIES}
+    dropped = {stream: sum(stats['dropped'][stream] for stats in queue_stats) for stream in DEFAULT_POLICIES}
+    print(f"[OUTBOUND] connections={len(queue_stats)} "
+          f"depth={' '.join(f'{stream}:{count}' for stream, count in depth.items())} "
+          f"dropped={' '.join(f'{stream}:{count}' for stream, count in dropped.items())}")
+
+    busiest = sorted(queue_stats, key=lambda stats: (sum(stats['dropped'].values()), sum(stats['depth'].values())),
+                     reverse=True)[:top]
+    for stats in busiest:
+        if sum(stats['dropped'].values()) or sum(stats['depth'].values()):
+            print(f"[OUTBOUND]   {stats['name']}: depth={stats['depth']} max_depth={stats['max_depth']} "
+                  f"dropped={stats['dropped']}")
+
+
+def run_threaded_server(db_pool):
+    """Прежний режим: поток на каждое соединение для всех четырех портов"""
     # Создаем основной сервер для текстового чата и аудио
     main_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    main_server.bind(("127.0.0.1", 5555))
+    main_server.bind((SERVER_HOST, MAIN_PORT))
     main_server.listen(5)
-    print("[SERVER] Main server is running on 127.0.0.1:5555")
+    print(f"[SERVER] Main server is running on {SERVER_HOST}:{MAIN_PORT}")
 
     # Создаем отдельный сервер для демонстрации экрана
     screen_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    screen_server.bind(("127.0.0.1", 5556))
+    screen_server.bind((SERVER_HOST, SCREEN_PORT))
     screen_server.listen(5)
-    print("[SERVER] Screen sharing server is running on 127.0.0.1:5556")
+    print(f"[SERVER] Screen sharing server is running on {SERVER_HOST}:{SCREEN_PORT}")
 
     # Создаем отдельный сервер для группового чата
     group_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    group_server.bind(("127.0.0.1", 5557))
+    group_server.bind((SERVER_HOST, GROUP_PORT))
     group_server.listen(5)
-    print("[SERVER] Group chat server is running on 127.0.0.1:5557")
+    print(f"[SERVER] Group chat server is running on {SERVER_HOST}:{GROUP_PORT}")
 
     # Создаем сервер для групповых звонков
     group_call_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    group_call_server.bind(("127.0.0.1", 5558))
+    group_call_server.bind((SERVER_HOST, GROUP_CALL_PORT))
     group_call_server.listen(5)
-    print("[SERVER] Group call server is running on 127.0.0.1:5558")
+    print(f"[SERVER] Group call server is running on {SERVER_HOST}:{GROUP_CALL_PORT}")
+
+    if media_relay is not None:
+        media_relay.serve_thread(SERVER_HOST, MEDIA_PORT)
+        print(f"[SERVER] Media relay is running on {SERVER_HOST}:{MEDIA_PORT}/udp")
 
     def accept_main_connections():
         """Принимает основные соединения"""
         while True:
             try:
                 client_socket, addr = main_server.accept()
-                thread = threading.Thread(target=handle_client, args=(client_socket, addr, db_connection))
+                thread = threading.Thread(target=handle_client, args=(client_socket, addr, db_pool))
                 thread.daemon = True
                 thread.start()
                 print(f"[MAIN] New main connection from {addr}")
@@ -2985,7 +3675,7 @@ def start_server():
             try:
                 screen_socket, addr = screen_server.accept()
                 thread = threading.Thread(target=handle_screen_sharing_connection,
-                                          args=(screen_socket, addr, db_connection))
+                                          args=(screen_socket, addr, db_pool))
                 thread.daemon = True
                 thread.start()
                 print(f"[SCREEN] New screen sharing connection from {addr}")
@@ -2998,7 +3688,7 @@ def start_server():
             try:
                 client_socket, addr = group_server.accept()
                 thread = threading.Thread(target=handle_group_client,
-                                          args=(client_socket, addr, db_connection))
+                                          args=(client_socket, addr, db_pool))
                 thread.daemon = True
                 thread.start()
                 print(f"[GROUP] New group connection from {addr}")
@@ -3011,7 +3701,7 @@ def start_server():
             try:
                 client_socket, addr = group_call_server.accept()
                 thread = threading.Thread(target=handle_group_call_client,
-                                          args=(client_socket, addr, db_connection))
+                                          args=(client_socket, addr, db_pool))
                 thread.daemon = True
                 thread.start()
                 print(f"[GROUP CALL] New group call connection from {addr}")
@@ -3042,13 +3732,279 @@ def start_server():
         print("[SERVER] Both servers are running. Press Ctrl+C to stop.")
         while True:
             time.sleep(1)
-    except KeyboardInterrupt:
-        print("[SERVER] Servers are shutting down...")
     finally:
-        db_connection.close()
         main_server.close()
         screen_server.close()
         group_server.close()
+        group_call_server.close()
+
+
+class AsyncSocketAdapter:
+    """Обертка над asyncio StreamWriter с интерфейсом сокета.
+
+    Существующие обработчики вызывают send/sendall из потоков пула,
+    поэтому запись передается в цикл событий через call_soon_threadsafe.
+    Объект хешируется по идентичности и служит ключом в clients и др.
+    """
+    def __init__(self, writer, loop):
+        self.writer = writer
+        self.loop = loop
+        self.loop_thread_id = threading.get_ident()
+        self.closed = False
+
+    def _write(self, data):
+        if not self.closed and not self.writer.is_closing():
+            self.writer.write(data)
+
+    def send(self, data):
+        if self.closed:
+            raise ConnectionError("Socket is closed")
+        data = bytes(data)
+        if threading.get_ident() == self.loop_thread_id:
+            self._write(data)
+        else:
+            self.loop.call_soon_threadsafe(self._write, data)
+        return len(data)
+
+    def sendall(self, data):
+        self.send(data)
+
+    def send_parts(self, parts):
+        """Отправляет части кадра (заголовок + данные) без склейки в один буфер"""
+        if self.closed:
+            raise ConnectionError("Socket is closed")
+        parts = list(parts)
+        if threading.get_ident() == self.loop_thread_id:
+            self._write_parts(parts)
+        else:
+            self.loop.call_soon_threadsafe(self._write_parts, parts)
+
+    def _write_parts(self, parts):
+        if not self.closed and not self.writer.is_closing():
+            self.writer.writelines(parts)
+
+    def setsockopt(self, *args):
+        sock = self.writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(*args)
+
+    def getpeername(self):
+        return self.writer.get_extra_info('peername')
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if threading.get_ident() == self.loop_thread_id:
+            self.writer.close()
+        else:
+            self.loop.call_soon_threadsafe(self.writer.close)
+
+
+async def handle_client_async(reader, writer, db_pool, executor):
+    """asyncio версия handle_client: чтение в цикле событий, обработка в пуле"""
+    loop = asyncio.get_running_loop()
+    client_socket = AsyncSocketAdapter(writer, loop)
+    addr = client_socket.getpeername()
+    print(f"[NEW CONNECTION] {addr} connected.")
+    client_connection = ClientConnection(client_socket, addr)
+    handshake = ServerHandshake()
+
+    try:
+        while True:
+            # Получатель файла от этого клиента не успевает - не читаем дальше (TCP притормозит
+            # клиента), ожидание идет в цикле событий и не занимает поток пула обработчиков
+            await wait_before_read_async(client_socket)
+            data = await reader.read(RECV_BUFFER_SIZE if handshake.decoder else 1024)
+            if not data:
+                break
+
+            if not handshake.done:
+                client_socket, data = handshake.accept(data, client_socket)
+                if handshake.done:
+                    client_socket = open_outbound_queue(client_socket, addr, writer)
+                client_connection.main_socket = client_socket
+                if not data:
+                    continue
+
+            # Обработка по порядку: следующее чтение только после разбора предыдущего
+            if handshake.decoder:
+                frames = handshake.decoder.feed(data)
+                if frames:
+                    await loop.run_in_executor(executor, run_with_session, db_pool, process_main_frames,
+                                               frames, client_socket, client_connection)
+            else:
+                await loop.run_in_executor(executor, run_with_session, db_pool, process_main_data,
+                                           data, client_socket, client_connection)
+    except Exception as e:
+        print(f"[ERROR] {e}")
+    finally:
+        await loop.run_in_executor(executor, run_with_session, db_pool, cleanup_main_connection,
+                                   client_socket, addr)
+
+
+async def handle_screen_sharing_connection_async(reader, writer, db_pool, executor):
+    """asyncio версия handle_screen_sharing_connection"""
+    loop = asyncio.get_running_loop()
+    screen_socket = AsyncSocketAdapter(writer, loop)
+    addr = screen_socket.getpeername()
+    print(f"[SCREEN] New screen sharing connection from {addr}")
+
+    screen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1048576)
+    screen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1048576)
+
+    buffer = ""
+    handshake = ServerHandshake()
+    try:
+        while True:
+            data = await reader.read(RECV_BUFFER_SIZE if handshake.decoder else 65536)
+            if not data:
+                break
+
+            if not handshake.done:
+                screen_socket, data = handshake.accept(data, screen_socket)
+                if handshake.done:
+                    screen_socket = open_outbound_queue(screen_socket, addr, writer)
+                if not data:
+                    continue
+
+            if handshake.decoder:
+                frames = handshake.decoder.feed(data)
+                if frames:
+                    await loop.run_in_executor(executor, run_with_session, db_pool, process_screen_frames,
+                                               frames, screen_socket)
+            else:
+                buffer = await loop.run_in_executor(executor, run_with_session, db_pool, process_screen_data,
+                                                    data, buffer, screen_socket)
+    except ConnectionResetError:
+        print(f"[SCREEN] Connection reset by peer {addr}")
+    except Exception as e:
+        print(f"[SCREEN ERROR] {e}")
+    finally:
+        cleanup_screen_connection(screen_socket)
+        screen_socket.close()
+        print(f"[SCREEN] Screen sharing connection {addr} closed")
+
+
+async def handle_group_client_async(reader, writer, db_pool, executor):
+    """asyncio версия handle_group_client"""
+    loop = asyncio.get_running_loop()
+    client_socket = AsyncSocketAdapter(writer, loop)
+    addr = client_socket.getpeername()
+    print(f"[GROUP CONNECTION] {addr} connected to group chat.")
+
+    handshake = ServerHandshake()
+
+    try:
+        while True:
+            await wait_before_read_async(client_socket)
+            data = await reader.read(RECV_BUFFER_SIZE if handshake.decoder else 8192)
+            if not data:
+                break
+
+            if not handshake.done:
+                client_socket, data = handshake.accept(data, client_socket)
+                if handshake.done:
+                    client_socket = open_outbound_queue(client_socket, addr, writer)
+                if not data:
+                    continue
+
+            if handshake.decoder:
+                frames = handshake.decoder.feed(data)
+                if frames:
+                    await loop.run_in_executor(executor, run_with_session, db_pool, process_group_frames,
+                                               frames, client_socket)
+            else:
+                await loop.run_in_executor(executor, run_with_session, db_pool, process_group_data,
+                                           data, client_socket)
+    except Exception as e:
+        print(f"[GROUP ERROR] {e}")
+    finally:
+        cleanup_group_connection(client_socket)
+        client_socket.close()
+        print(f"[GROUP DISCONNECT] {addr} disconnected from group chat.")
+
+
+async def handle_group_call_client_async(reader, writer, db_pool, executor):
+    """asyncio версия handle_group_call_client"""
+    loop = asyncio.get_running_loop()
+    client_socket = AsyncSocketAdapter(writer, loop)
+    addr = client_socket.getpeername()
+    print(f"[GROUP CALL CONNECTION] {addr} connected to group call server.")
+
+    handshake = ServerHandshake()
+
+    try:
+        while True:
+            data = await reader.read(RECV_BUFFER_SIZE if handshake.decoder else 8192)
+            if not data:
+                break
+
+            if not handshake.done:
+                client_socket, data = handshake.accept(data, client_socket)
+                if handshake.done:
+                    client_socket = open_outbound_queue(client_socket, addr, writer)
+                if not data:
+                    continue
+
+            if handshake.decoder:
+                frames = handshake.decoder.feed(data)
+                if frames:
+                    await loop.run_in_executor(executor, run_with_session, db_pool, process_group_call_frames,
+                                               frames, client_socket)
+            else:
+                await loop.run_in_executor(executor, run_with_session, db_pool, process_group_call_data,
+                                           data, client_socket)
+    except Exception as e:
+        print(f"[GROUP CALL ERROR] {e}")
+    finally:
+        cleanup_group_call_connection(client_socket)
+        client_socket.close()
+        print(f"[GROUP CALL DISCONNECT] {addr} disconnected from group call server.")
+
+
+async def run_asyncio_server(db_pool):
+    """Запускает все четыре слушателя в одном цикле событий"""
+    executor = ThreadPoolExecutor(max_workers=ASYNC_HANDLER_WORKERS, thread_name_prefix="handler")
+    listeners = [
+        (handle_client_async, MAIN_PORT, "Main server"),
+        (handle_screen_sharing_connection_async, SCREEN_PORT, "Screen sharing server"),
+        (handle_group_client_async, GROUP_PORT, "Group chat server"),
+        (handle_group_call_client_async, GROUP_CALL_PORT, "Group call server"),
+    ]
+
+    servers = []
+    media_endpoint = None
+    try:
+        for handler, port, name in listeners:
+            server = await asyncio.start_server(
+                functools.partial(handler, db_pool=db_pool, executor=executor),
+                SERVER_HOST, port
+            )
+            servers.append(server)
+            print(f"[SERVER] {name} is running on {SERVER_HOST}:{port} (asyncio)")
+
+        if media_relay is not None:
+            media_endpoint = await media_relay.serve_async(SERVER_HOST, MEDIA_PORT)
+            print(f"[SERVER] Media relay is running on {SERVER_HOST}:{MEDIA_PORT}/udp (asyncio)")
+
+        print("[SERVER] All servers are running. Press Ctrl+C to stop.")
+        await asyncio.gather(*(server.serve_forever() for server in servers))
+    finally:
+        for server in servers:
+            server.close()
+        if media_endpoint is not None:
+            media_endpoint.close()
+        executor.shutdown(wait=False)
+
 
 if __name__ == "__main__":
-    start_server()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Сервер Volum")
+    parser.add_argument("--mode", choices=["asyncio", "threaded"], default=SERVER_MODE,
+                        help="asyncio - один цикл событий, threaded - поток на соединение (прежний режим)")
+    parser.add_argument("--mix-group-calls", action="store_true", default=GROUP_CALL_MIXING,
+                        help="микшировать аудио групповых звонков на сервере (нужен numpy)")
+    parser.add_argument("--udp-media", action="store_true", default=UDP_MEDIA,
+                        help=f"передавать аудио звонков по UDP (порт {MEDIA_PORT}) с откатом на TCP")
+    args = parser.parse_args()
+    start_server(args.mode, args.mix_group_calls, args.udp_media)
@@ -0,0 +1,96 @@
+import math
+
+import numpy as np
+
+# Решение детектора для очередного блока записи
+VAD_SPEECH = "speech"  # отправить блок
+VAD_PAUSE = "pause"  # начало паузы (или повтор маркера) - отправить маркер комфортного шума
+VAD_SILENCE = "silence"  # пауза - ничего не отправлять
+
+# Речь должна быть громче оценки фонового шума на столько дБ
+SPEECH_MARGIN_DB = 9.0
+# Тише этого уровня блок считается тишиной при любом шуме, дБFS
+MIN_SPEECH_DB = -55.0
+# В пограничной зоне (до margin + 6 дБ) речью считается только блок с низкой
+# частотой переходов через ноль: у широкополосного шума она около 0.5
+NOISE_ZCR = 0.35
+# Оценка шума быстро опускается к тихим блокам и медленно растет, дБ за блок
+NOISE_FLOOR_RISE_DB = 0.05
+# После конца речи блоки еще отправляются столько секунд, чтобы не обрезать окончания слов
+HANGOVER_SECONDS = 0.3
+# Маркер паузы повторяется раз в столько секунд (на случай потери по UDP)
+MARKER_INTERVAL_SECONDS = 0.5
+
+
+class VoiceActivityDetector:
+    """Детектор речи по энергии и частоте переходов через ноль (16-bit PCM).
+
+    process() возвращает VAD_SPEECH для блоков с речью (и блоков в течение
+    HANGOVER_SECONDS после нее), VAD_PAUSE для первого блока паузы и затем
+    раз в MARKER_INTERVAL_SECONDS, VAD_SILENCE для остальных. noise_floor_db -
+    текущая оценка фонового шума, ее передают в маркере комфортного шума.
+    """
+    def __init__(self, frame_duration):
+        self.hangover_frames = max(1, math.ceil(HANGOVER_SECONDS / frame_duration))
+        self.marker_frames = max(1, math.ceil(MARKER_INTERVAL_SECONDS / frame_duration))
+        self.noise_floor_db = None  # до первого блока оценки нет
+        self._hangover = 0
+        self._silent_frames = None  # блоков с начала паузы; None - идет речь
+
+        # Статистика
+        self.speech_frames = 0
+        self.suppressed_frames = 0
+
+    def process(self, pcm):
+        samples = np.frombuffer(pcm, dtype="<i2").astype(np.float32)
+        if samples.size == 0:
+            return VAD_SILENCE
+
+        rms = np.sqrt(np.mean(samples * samples))
+        energy_db = 20.0 * math.log10(rms / 32768.0 + 1e-9)
+        signs = np.signbit(samples)
+        zcr = np.count_nonzero(signs[1:] != signs[:-1]) / samples.size
+
+        if self.noise_floor_db is None or energy_db < self.noise_floor_db:
+            self.noise_floor_db = energy_db
+        else:
+            self.noise_floor_db += NOISE_FLOOR_RISE_DB
+
+        above_floor = energy_db - self.noise_floor_db
+        speech = energy_db > MIN_SPEECH_DB and above_floor > SPEECH_MARGIN_DB
+        if speech and above_floor < SPEECH_MARGIN_DB + 6.0 and zcr > NOISE_ZCR:
+            speech = False
+
+        if speech:
+            self._hangover = self.hangover_frames
+        elif self._hangover > 0:
+            self._hangover -= 1
+            speech = True
+
+        if speech:
+            self._silent_frames = None
+            self.speech_frames += 1
+            return VAD_SPEECH
+
+        self.suppressed_frames += 1
+        if self._silent_frames is None or self._silent_frames >= self.marker_frames:
+            self._silent_frames = 1
+            return VAD_PAUSE
+        self._silent_frames += 1
+        return VAD_SILENCE
+
+    def stats(self):
+        total = self.speech_frames + self.suppressed_frames
+        return {
+            "speech": self.speech_frames,
+            "suppressed": self.suppressed_frames,
+            "suppressed_ratio": self.suppressed_frames / total if total else 0.0,
+            "noise_floor_db": self.noise_floor_db if self.noise_floor_db is not None else float("nan"),
+        }
+
+
+def comfort_noise(frame_size, level_db):
+    """Блок комфортного шума (16-bit PCM) заданного уровня, дБFS"""
+    amplitude = 32768.0 * 10 ** (level_db / 20.0)
+    noise = np.random.normal(0.0, amplitude, frame_size)
+    return np.clip(noise, -32768, 32767).astype("<i2").tobytes()